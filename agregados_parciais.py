@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+"""
+Agregados Parciais para Análise Multicêntrica - IMMUNED
+Cada centro compartilha apenas agregados, nunca notas ou linhas de paciente.
+O estado parcial de um centro é um JSON com contagens que se somam entre
+centros, de modo que o coordenador obtém exatamente as mesmas estatísticas
+que teria com a base longitudinal de todos os centros juntos:
+
+- resposta: melhoraram/total por combinação completa das dimensões de
+  subgrupo (a agregação base do CuboResposta)
+- perfis: pacientes por perfil de tratamento (medicamentos em uso prévio,
+  medicamentos em uso). Matriz de transição, taxas de abandono e sequências
+  saem dos perfis para qualquer lista de medicamentos
+- motivos: pacientes por (medicamento suspenso, motivo de suspensão)
+- pacientes distintos: esboço HyperLogLog dos identificadores, combinado
+  pelo máximo de cada registrador. Um paciente atendido em dois centros
+  conta uma vez, desde que os centros usem a mesma pseudonimização. O erro
+  relativo típico é 1,04/sqrt(2^PRECISAO_HLL) (~1,6%)
+
+O tamanho do estado depende do número de subgrupos e perfis, não do número
+de pacientes, e a combinação no coordenador é uma soma de tabelas pequenas.
+
+Uso:
+    # em cada centro
+    python agregados_parciais.py resultados/dados_longitudinais.parquet --saida centro_a.json
+    # no coordenador
+    python agregados_parciais.py --combinar centro_a.json centro_b.json --saida consorcio.json
+"""
+
+import argparse
+import base64
+import json
+import sys
+
+import numpy as np
+import pandas as pd
+
+from cubo_resposta import FAIXAS_ETARIAS, CuboResposta, agregado_subgrupos
+from etl_streaming import hash_pacientes
+from pipeline_etl import BIOLOGICOS_CONFIG, DMARDS_CONFIG
+
+VERSAO_ESTADO = 1
+
+# Registradores do HyperLogLog: 2^PRECISAO_HLL bytes por estado
+PRECISAO_HLL = 12
+
+
+# =============================================================================
+# ESBOÇO DE PACIENTES DISTINTOS (HYPERLOGLOG)
+# =============================================================================
+
+def _zeros_a_esquerda(valores):
+    """Zeros à esquerda de cada uint64 (64 para zero)"""
+    zeros = np.zeros(len(valores), dtype=np.int64)
+    x = valores.copy()
+    for deslocamento in (32, 16, 8, 4, 2, 1):
+        vazio = x < (np.uint64(1) << np.uint64(64 - deslocamento))
+        zeros += np.where(vazio, deslocamento, 0)
+        x = np.where(vazio, x << np.uint64(deslocamento), x)
+    return zeros + (x == 0)
+
+
+class EsbocoPacientes:
+    """
+    HyperLogLog sobre o hash estável dos identificadores de paciente.
+
+    Args:
+        precisao: bits do hash que escolhem o registrador
+    """
+
+    def __init__(self, precisao=PRECISAO_HLL, registradores=None):
+        self.precisao = precisao
+        self.registradores = (np.zeros(1 << precisao, dtype=np.uint8) if registradores is None
+                              else np.asarray(registradores, dtype=np.uint8))
+
+    def adicionar(self, pacientes):
+        hashes = hash_pacientes(pd.Series(pacientes).dropna())
+        indices = (hashes >> np.uint64(64 - self.precisao)).astype(np.int64)
+        resto = hashes << np.uint64(self.precisao)
+        postos = np.minimum(_zeros_a_esquerda(resto), 64 - self.precisao) + 1
+        np.maximum.at(self.registradores, indices, postos.astype(np.uint8))
+        return self
+
+    def combinar(self, outro):
+        if outro.precisao != self.precisao:
+            raise ValueError(f"Esboços com precisões diferentes: {self.precisao} e {outro.precisao}")
+        return EsbocoPacientes(self.precisao, np.maximum(self.registradores, outro.registradores))
+
+    def estimativa(self):
+        m = len(self.registradores)
+        alfa = 0.7213 / (1 + 1.079 / m)
+        estimativa = alfa * m * m / np.sum(np.ldexp(1.0, -self.registradores.astype(np.int64)))
+        vazios = int(np.sum(self.registradores == 0))
+        # Correção para poucos pacientes (contagem linear dos registradores vazios)
+        if estimativa <= 2.5 * m and vazios:
+            estimativa = m * np.log(m / vazios)
+        return int(round(estimativa))
+
+    def para_json(self):
+        return {'precisao': self.precisao,
+                'registradores': base64.b64encode(self.registradores.tobytes()).decode('ascii')}
+
+    @classmethod
+    def de_json(cls, dados):
+        return cls(dados['precisao'], np.frombuffer(base64.b64decode(dados['registradores']), dtype=np.uint8))
+
+
+# =============================================================================
+# PERFIS DE TRATAMENTO
+# =============================================================================
+
+def medicamentos_com_status(df):
+    """Medicamentos com coluna <med>_status na base, na ordem das colunas"""
+    conhecidos = {**BIOLOGICOS_CONFIG, **DMARDS_CONFIG}
+    return [c[:-len('_status')] for c in df.columns
+            if c.endswith('_status') and c[:-len('_status')] in conhecidos]
+
+
+def perfis_tratamento(df):
+    """
+    Pacientes por perfil de tratamento.
+
+    Returns:
+        DataFrame com previos (tupla dos medicamentos em uso prévio), em_uso
+        (tupla dos medicamentos em uso) e pacientes
+    """
+    medicamentos = medicamentos_com_status(df)
+    if not medicamentos or df.empty:
+        return pd.DataFrame({'previos': pd.Series(dtype=object), 'em_uso': pd.Series(dtype=object),
+                             'pacientes': pd.Series(dtype='int64')})
+    status = df[[f'{m}_status' for m in medicamentos]]
+    marcas = pd.DataFrame(np.hstack([(status == 'PRÉVIO').to_numpy(), (status == 'SIM').to_numpy()]))
+    contagens = marcas.value_counts(sort=False)
+    n = len(medicamentos)
+    return pd.DataFrame({
+        'previos': [tuple(m for m, sim in zip(medicamentos, chave[:n]) if sim) for chave in contagens.index],
+        'em_uso': [tuple(m for m, sim in zip(medicamentos, chave[n:]) if sim) for chave in contagens.index],
+        'pacientes': contagens.to_numpy(dtype='int64'),
+    })
+
+
+def contagem_motivos(df):
+    """Pacientes por (medicamento, motivo) entre os que suspenderam o medicamento"""
+    linhas = []
+    for med in medicamentos_com_status(df):
+        if f'{med}_motivo' not in df.columns:
+            continue
+        motivos = df.loc[df[f'{med}_status'] == 'PRÉVIO', f'{med}_motivo'].dropna().value_counts()
+        linhas.extend({'medicamento': med, 'motivo': motivo, 'pacientes': int(n)} for motivo, n in motivos.items())
+    return pd.DataFrame(linhas, columns=['medicamento', 'motivo', 'pacientes'])
+
+
+def _atual(em_uso, medicamentos):
+    """Medicamento atual: o primeiro da lista em uso (ou None)"""
+    return next((m for m in medicamentos if m in em_uso), None)
+
+
+def matriz_transicao(perfis, medicamentos):
+    """Pacientes de cada medicamento prévio (linhas) para o atual (colunas)"""
+    nomes = [m.title() for m in medicamentos]
+    matriz = pd.DataFrame(0, index=nomes, columns=nomes)
+    for previos, em_uso, pacientes in perfis.itertuples(index=False):
+        atual = _atual(em_uso, medicamentos)
+        if atual:
+            for previo in (m for m in medicamentos if m in previos):
+                matriz.loc[previo.title(), atual.title()] += pacientes
+    return matriz
+
+
+def taxas_abandono(perfis, medicamentos):
+    """Total que usou, total que suspendeu e taxa de abandono (%) por medicamento"""
+    taxas = []
+    for med in medicamentos:
+        previo = perfis['previos'].map(lambda p: med in p).astype(bool)
+        em_uso = perfis['em_uso'].map(lambda p: med in p).astype(bool)
+        total_usaram = int(perfis.loc[previo | em_uso, 'pacientes'].sum())
+        if total_usaram > 0:
+            suspenderam = int(perfis.loc[previo, 'pacientes'].sum())
+            taxas.append({
+                'Medicamento': med.title(),
+                'Total Usaram': total_usaram,
+                'Suspenderam': suspenderam,
+                'Taxa Abandono (%)': round(suspenderam / total_usaram * 100, 2)
+            })
+
+    df_taxas = pd.DataFrame(taxas)
+    if not df_taxas.empty:
+        df_taxas = df_taxas.sort_values('Taxa Abandono (%)', ascending=False)
+    return df_taxas
+
+
+def motivos_suspensao(motivos, medicamentos):
+    """Pacientes por medicamento e motivo de suspensão"""
+    linhas = []
+    for med in medicamentos:
+        do_med = motivos[motivos['medicamento'] == med]
+        do_med = do_med.sort_values(['pacientes', 'motivo'], ascending=[False, True], kind='mergesort')
+        linhas.extend({'Medicamento': med.title(), 'Motivo': motivo.title(), 'Pacientes': int(n)}
+                      for motivo, n in zip(do_med['motivo'], do_med['pacientes']))
+    if linhas:
+        return pd.DataFrame(linhas)
+    return pd.DataFrame(columns=['Medicamento', 'Motivo', 'Pacientes'])
+
+
+def sequencias_comuns(perfis, medicamentos, top_n=10):
+    """As top_n sequências (até 3 prévios → atual) mais comuns"""
+    contagem = {}
+    for previos, em_uso, pacientes in perfis.itertuples(index=False):
+        atual = _atual(em_uso, medicamentos)
+        anteriores = [m.title() for m in medicamentos if m in previos]
+        if anteriores and atual:
+            seq = ' → '.join(anteriores[:3]) + f' → {atual.title()}'
+            contagem[seq] = contagem.get(seq, 0) + int(pacientes)
+    # Empates em ordem alfabética: o resultado não depende da ordem dos centros
+    ordenadas = sorted(contagem.items(), key=lambda item: (-item[1], item[0]))[:top_n]
+    return pd.DataFrame({
+        'Sequência': [seq for seq, _ in ordenadas],
+        'Pacientes': np.array([n for _, n in ordenadas], dtype='int64'),
+    })
+
+
+# =============================================================================
+# ESTADO PARCIAL E COMBINAÇÃO
+# =============================================================================
+
+def _valor_json(valor):
+    if isinstance(valor, list):
+        return valor
+    if pd.isna(valor):
+        return None
+    return valor.item() if isinstance(valor, np.generic) else valor
+
+
+def _tabela_json(df):
+    return {'colunas': list(df.columns),
+            'linhas': [[_valor_json(v) for v in linha] for linha in df.itertuples(index=False)]}
+
+
+def _tabela_de_json(dados):
+    return pd.DataFrame(dados['linhas'], columns=dados['colunas'])
+
+
+def _agregado_resposta(tabela):
+    """Agregação base do cubo (somada por combinação) a partir da tabela do estado"""
+    dimensoes = [c for c in tabela.columns if c not in ('sum', 'count')]
+    if 'faixa_etaria' in dimensoes:
+        tabela = tabela.astype({'faixa_etaria': pd.CategoricalDtype(FAIXAS_ETARIAS, ordered=True)})
+    if not dimensoes:
+        return tabela[['sum', 'count']].sum().to_frame().T
+    return tabela.groupby(dimensoes, dropna=False, observed=True)[['sum', 'count']].sum()
+
+
+def estado_parcial(df_long, centro=None):
+    """
+    Estado parcial (dict serializável em JSON) de uma base longitudinal.
+
+    Args:
+        df_long: base longitudinal de um centro (uma linha por paciente)
+        centro: identificação do centro, guardada no estado
+    """
+    estado = {
+        'versao': VERSAO_ESTADO,
+        'centros': [centro] if centro is not None else [],
+        'n_linhas': len(df_long),
+        'resposta': None,
+        'perfis': _tabela_json(perfis_tratamento(df_long).assign(
+            previos=lambda p: p['previos'].map(list), em_uso=lambda p: p['em_uso'].map(list))),
+        'motivos': _tabela_json(contagem_motivos(df_long)),
+        'pacientes': None,
+    }
+    if 'improvement' in df_long.columns:
+        estado['resposta'] = _tabela_json(agregado_subgrupos(df_long).reset_index())
+    if 'paciente' in df_long.columns:
+        estado['pacientes'] = EsbocoPacientes().adicionar(df_long['paciente']).para_json()
+    return estado
+
+
+def combinar_estados(estados):
+    """
+    Combina estados parciais (de centros ou de combinações anteriores).
+
+    Raises:
+        ValueError se os estados forem de versões ou conteúdos incompatíveis
+    """
+    if not estados:
+        raise ValueError("Nenhum estado para combinar")
+    problemas = []
+    versoes = {e.get('versao') for e in estados}
+    if versoes != {VERSAO_ESTADO}:
+        problemas.append(f"versões de estado diferentes de {VERSAO_ESTADO}: {sorted(map(str, versoes))}")
+    for chave in ('resposta', 'pacientes'):
+        if len({e[chave] is None for e in estados}) > 1:
+            problemas.append(f"só parte dos estados tem '{chave}'")
+    if estados[0]['resposta'] is not None and not problemas:
+        colunas = {tuple(e['resposta']['colunas']) for e in estados}
+        if len(colunas) > 1:
+            problemas.append(f"dimensões de subgrupo diferentes: {sorted(colunas)}")
+    if problemas:
+        raise ValueError("Estados incompatíveis:\n- " + "\n- ".join(problemas))
+
+    perfis = pd.concat([_tabela_de_json(e['perfis']) for e in estados], ignore_index=True)
+    perfis = (perfis.assign(previos=perfis['previos'].map(tuple), em_uso=perfis['em_uso'].map(tuple))
+              .groupby(['previos', 'em_uso'], sort=True)['pacientes'].sum().reset_index())
+    motivos = pd.concat([_tabela_de_json(e['motivos']) for e in estados], ignore_index=True)
+    motivos = motivos.groupby(['medicamento', 'motivo'], sort=True)['pacientes'].sum().reset_index()
+
+    combinado = {
+        'versao': VERSAO_ESTADO,
+        'centros': [c for e in estados for c in e['centros']],
+        'n_linhas': sum(e['n_linhas'] for e in estados),
+        'resposta': None,
+        'perfis': _tabela_json(perfis.assign(previos=perfis['previos'].map(list),
+                                             em_uso=perfis['em_uso'].map(list))),
+        'motivos': _tabela_json(motivos),
+        'pacientes': None,
+    }
+    if estados[0]['resposta'] is not None:
+        tabela = pd.concat([_tabela_de_json(e['resposta']) for e in estados], ignore_index=True)
+        combinado['resposta'] = _tabela_json(_agregado_resposta(tabela).reset_index())
+    if estados[0]['pacientes'] is not None:
+        esboco = EsbocoPacientes.de_json(estados[0]['pacientes'])
+        for e in estados[1:]:
+            esboco = esboco.combinar(EsbocoPacientes.de_json(e['pacientes']))
+        combinado['pacientes'] = esboco.para_json()
+    return combinado
+
+
+# =============================================================================
+# ESTATÍSTICAS A PARTIR DO ESTADO
+# =============================================================================
+
+def _perfis_do_estado(estado):
+    perfis = _tabela_de_json(estado['perfis'])
+    return perfis.assign(previos=perfis['previos'].map(tuple), em_uso=perfis['em_uso'].map(tuple))
+
+
+def cubo_do_estado(estado, max_dimensoes=None):
+    """CuboResposta com as taxas de resposta por subgrupo (None sem critério de melhora)"""
+    if estado['resposta'] is None:
+        return None
+    return CuboResposta.do_agregado(_agregado_resposta(_tabela_de_json(estado['resposta'])), max_dimensoes)
+
+
+def pacientes_distintos(estado):
+    """Estimativa de pacientes distintos (None se os estados não têm o identificador)"""
+    if estado['pacientes'] is None:
+        return None
+    return EsbocoPacientes.de_json(estado['pacientes']).estimativa()
+
+
+def resumo_estado(estado, medicamentos=None, top_n=10):
+    """
+    Estatísticas principais de um estado (de um centro ou combinado).
+
+    Args:
+        medicamentos: lista usada na matriz, abandono, motivos e sequências
+                      (None = todos os biológicos)
+    """
+    medicamentos = list(BIOLOGICOS_CONFIG) if medicamentos is None else medicamentos
+    perfis = _perfis_do_estado(estado)
+    return {
+        'cubo': cubo_do_estado(estado),
+        'matriz_transicao': matriz_transicao(perfis, medicamentos),
+        'abandono': taxas_abandono(perfis, medicamentos),
+        'motivos_suspensao': motivos_suspensao(_tabela_de_json(estado['motivos']), medicamentos),
+        'sequencias': sequencias_comuns(perfis, medicamentos, top_n),
+        'pacientes_distintos': pacientes_distintos(estado),
+    }
+
+
+def _gravar_estado(estado, caminho):
+    with open(caminho, 'w', encoding='utf-8') as f:
+        json.dump(estado, f, ensure_ascii=False, indent=2)
+
+
+def _ler_estado(caminho):
+    with open(caminho, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Agregados parciais IMMUNED para análise multicêntrica")
+    parser.add_argument('longitudinal', nargs='?', help="dados_longitudinais.parquet de um centro")
+    parser.add_argument('--centro', help="Identificação do centro guardada no estado")
+    parser.add_argument('--combinar', nargs='+', metavar='ESTADO', help="Estados JSON a combinar")
+    parser.add_argument('--saida', required=True, help="Arquivo JSON do estado gerado")
+    args = parser.parse_args(argv)
+
+    if (args.longitudinal is None) == (args.combinar is None):
+        parser.error("informe a base longitudinal ou --combinar (um dos dois)")
+
+    try:
+        if args.combinar:
+            estado = combinar_estados([_ler_estado(c) for c in args.combinar])
+        else:
+            estado = estado_parcial(pd.read_parquet(args.longitudinal), centro=args.centro)
+        _gravar_estado(estado, args.saida)
+    except Exception as e:
+        print(f"[ERRO] {e}", file=sys.stderr)
+        return 1
+    distintos = pacientes_distintos(estado)
+    print(f"[AGREGADOS] {estado['n_linhas']} pacientes de {len(estado['centros']) or 1} centro(s)"
+          + (f", ~{distintos} distintos" if distintos is not None else "") + f" - estado em {args.saida}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -15,11 +15,30 @@ import pandas as pd
 import plotly.graph_objects as go
 import plotly.express as px
 from datetime import datetime
-import re
 import io
+import html
 from PIL import Image
 import numpy as np
 
+import jobs_etl
+from agregados_parciais import (contagem_motivos, matriz_transicao, motivos_suspensao, perfis_tratamento,
+                                sequencias_comuns, taxas_abandono)
+from artefatos_etl import ArmazemArtefatos
+from banco_coortes import BancoCoortes
+from busca_textos import IndiceInvertido, trecho
+from cache_resultados import CacheResultadosETL, hash_conteudo, impressao_config
+from cubo_resposta import CuboResposta
+from filtro_coortes import IndiceBitmap, interpretar_filtro
+from graficos import (
+    CacheFiguras, histograma_agregado, histograma_agregado_por_grupo, box_agregado,
+    box_agregado_por_grupo, dispersao,
+)
+from jobs_etl import GerenciadorJobsETL
+from pipeline_etl import (MARCADORES_CONFIG, COMORBIDADES_CONFIG, REGISTRO, construir_tabela_pacientes,
+                          obter_mascara, tem_alguma, contar_comorbidades,
+                          frequencia_combinacoes, evidencias_da_nota, tabela_regras, tabela_notas_lentas)
+from textos_prontuarios import para_arrow, restaurar_texto
+
 # =============================================================================
 # FUNÇÕES DE ANÁLISE DE TROCAS DE MEDICAMENTOS
 # =============================================================================
@@ -50,105 +69,22 @@ def calcular_taxa_troca_geral(df):
 
 def construir_matriz_transicao(df, medicamentos):
     """Constrói matriz de transição entre medicamentos"""
-    matriz = pd.DataFrame(0, 
-                         index=[m.title() for m in medicamentos],
-                         columns=[m.title() for m in medicamentos])
-    
-    for idx, row in df.iterrows():
-        previos = [m for m in medicamentos 
-                   if f'{m}_status' in df.columns 
-                   and row.get(f'{m}_status') == 'PRÉVIO']
-        
-        atual = None
-        for m in medicamentos:
-            if f'{m}_status' in df.columns and row.get(f'{m}_status') == 'SIM':
-                atual = m
-                break
-        
-        if atual:
-            for previo in previos:
-                matriz.loc[previo.title(), atual.title()] += 1
-    
-    return matriz
+    return matriz_transicao(perfis_tratamento(df), medicamentos)
 
 
 def analisar_motivos_suspensao(df, medicamentos):
     """Analisa motivos de suspensão de medicamentos"""
-    motivos_data = []
-    
-    for med in medicamentos:
-        col_status = f'{med}_status'
-        col_motivo = f'{med}_motivo'
-        
-        if col_status in df.columns and col_motivo in df.columns:
-            suspenderam = df[df[col_status] == 'PRÉVIO']
-            motivos = suspenderam[col_motivo].dropna().value_counts()
-            
-            for motivo, count in motivos.items():
-                motivos_data.append({
-                    'Medicamento': med.title(),
-                    'Motivo': motivo.title(),
-                    'Pacientes': count
-                })
-    
-    if motivos_data:
-        return pd.DataFrame(motivos_data)
-    else:
-        return pd.DataFrame(columns=['Medicamento', 'Motivo', 'Pacientes'])
+    return motivos_suspensao(contagem_motivos(df), medicamentos)
 
 
 def calcular_taxa_abandono_por_medicamento(df, medicamentos):
     """Calcula taxa de abandono para cada medicamento"""
-    taxas = []
-    
-    for med in medicamentos:
-        col_status = f'{med}_status'
-        
-        if col_status in df.columns:
-            total_usaram = (df[col_status].isin(['SIM', 'PRÉVIO'])).sum()
-            suspenderam = (df[col_status] == 'PRÉVIO').sum()
-            
-            if total_usaram > 0:
-                taxa_pct = (suspenderam / total_usaram) * 100
-                taxas.append({
-                    'Medicamento': med.title(),
-                    'Total Usaram': total_usaram,
-                    'Suspenderam': suspenderam,
-                    'Taxa Abandono (%)': round(taxa_pct, 2)
-                })
-    
-    df_taxas = pd.DataFrame(taxas)
-    if not df_taxas.empty:
-        df_taxas = df_taxas.sort_values('Taxa Abandono (%)', ascending=False)
-    
-    return df_taxas
+    return taxas_abandono(perfis_tratamento(df), medicamentos)
 
 
 def identificar_sequencias_comuns(df, medicamentos, top_n=10):
     """Identifica as sequências de tratamento mais comuns"""
-    sequencias = []
-    
-    for idx, row in df.iterrows():
-        previos = [m.title() for m in medicamentos 
-                   if f'{m}_status' in df.columns 
-                   and row.get(f'{m}_status') == 'PRÉVIO']
-        
-        atual = None
-        for m in medicamentos:
-            if f'{m}_status' in df.columns and row.get(f'{m}_status') == 'SIM':
-                atual = m.title()
-                break
-        
-        if previos and atual:
-            seq = ' → '.join(previos[:3]) + f' → {atual}'
-            sequencias.append(seq)
-    
-    seq_counts = pd.Series(sequencias).value_counts().head(top_n)
-    
-    return pd.DataFrame({
-        'Sequência': seq_counts.index,
-        'Pacientes': seq_counts.values
-    })
+    return sequencias_comuns(perfis_tratamento(df), medicamentos, top_n)
 
 
 def analisar_eficacia_pos_troca(df):
@@ -177,480 +113,526 @@ def analisar_eficacia_pos_troca(df):
 
 
 # =============================================================================
-# CONFIGURAÇÕES E CONSTANTES
+# FIGURAS MEMORIZADAS (ANÁLISE EXPLORATÓRIA E DE EFICÁCIA)
 # =============================================================================
+# Cada função monta as figuras/tabelas de uma seção a partir dos dados, sem
+# chamar o Streamlit e sem alterar os DataFrames: os resultados ficam no
+# CacheFiguras (por impressão digital do dataset e parâmetros da visualização)
+# e são reconstruídos apenas quando os dados ou parâmetros mudam.
+# Gráficos por paciente leem a tabela de pacientes (df_pacientes, uma linha por
+# paciente, consolidada no ETL); gráficos por registro leem df_processed.
+
+CORES_MELHORA = {0: '#ef4444', 1: '#22c55e'}
+
+
+def _contagens(serie):
+    """value_counts sem as categorias ausentes (colunas categóricas do ETL)"""
+    contagens = serie.value_counts()
+    return contagens[contagens > 0]
+
+
+def _figura_pizza(contagens, cores, hole=0.4, height=None, title=None):
+    fig = go.Figure(data=[go.Pie(
+        labels=contagens.index,
+        values=contagens.values,
+        marker=dict(colors=cores),
+        textinfo='label+percent+value',
+        hole=hole
+    )])
+    fig.update_layout(height=height)
+    if title:
+        fig.update_layout(title=title)
+    return fig
+
+
+def figuras_demografia(df_pacientes):
+    figuras = {}
+    if 'idade' in df_pacientes.columns:
+        fig = histograma_agregado(df_pacientes['idade'], nbins=30, cor='#3b82f6')
+        fig.update_layout(xaxis_title='Idade', yaxis_title='Frequência', height=400)
+        figuras['idade'] = fig
+        figuras['idade_stats'] = (df_pacientes['idade'].mean(), df_pacientes['idade'].median(), df_pacientes['idade'].std())
+    if 'sexo' in df_pacientes.columns:
+        figuras['sexo'] = _figura_pizza(df_pacientes['sexo'].value_counts(), ['#ff9999', '#66b3ff'], hole=None, height=400)
+    if 'idade' in df_pacientes.columns and 'sexo' in df_pacientes.columns:
+        fig = histograma_agregado_por_grupo(df_pacientes['idade'], df_pacientes['sexo'], nbins=25,
+                                            cores={'F': '#ff9999', 'M': '#66b3ff'},
+                                            barmode='stack', nome_legenda='sexo')
+        fig.update_layout(xaxis_title='idade', yaxis_title='count', height=400)
+        figuras['idade_sexo'] = fig
+    return figuras
+
+
+def figuras_fator_reumatoide(df_pacientes):
+    figuras = {'distribuicao': _figura_pizza(_contagens(df_pacientes['fr_resultado']),
+                                             ['#ef4444', '#22c55e', '#9ca3af'], height=400)}
+    
+    origem_counts = _contagens(df_pacientes['fr_origem'])
+    fig = px.bar(x=origem_counts.index, y=origem_counts.values,
+                 color=origem_counts.index,
+                 color_discrete_map={'LAB': '#3b82f6', 'TEXTO': '#06b6d4', 'CID': '#8b5cf6'})
+    fig.update_layout(height=400, showlegend=False,
+                      xaxis_title='Origem', yaxis_title='Pacientes')
+    figuras['origem'] = fig
+    
+    fr_valores = df_pacientes['fr_valor'].dropna()
+    if len(fr_valores) > 0:
+        fig = histograma_agregado(fr_valores, nbins=20, cor='#3b82f6')
+        fig.update_layout(xaxis_title='Valor FR (UI/mL)', yaxis_title='Frequência')
+        figuras['valores_hist'] = fig
+        fig = box_agregado(fr_valores, cor='#3b82f6')
+        fig.update_layout(yaxis_title='Valor FR (UI/mL)')
+        figuras['valores_box'] = fig
+    return figuras
+
+
+def figuras_marcador(df, marcador):
+    marker_data = df[marcador].dropna()
+    if len(marker_data) == 0:
+        return None
+    
+    fig_hist = histograma_agregado(marker_data, nbins=30, cor='#22c55e')
+    fig_hist.update_layout(title=f"Distribuição de {marcador.upper()}",
+                           xaxis_title=marcador.upper(),
+                           yaxis_title='Frequência', height=350)
+    
+    fig_box = box_agregado(marker_data, cor='#22c55e')
+    fig_box.update_layout(title=f"Box Plot - {marcador.upper()}",
+                          yaxis_title=marcador.upper(), height=350)
+    
+    stats_df = pd.DataFrame({
+        'Métrica': ['Média', 'Mediana', 'Desvio Padrão', 'Mínimo', 'Máximo'],
+        'Valor': [f"{marker_data.mean():.2f}", f"{marker_data.median():.2f}",
+                  f"{marker_data.std():.2f}", f"{marker_data.min():.2f}",
+                  f"{marker_data.max():.2f}"]
+    })
+    return {'hist': fig_hist, 'box': fig_box, 'stats': stats_df, 'disponiveis': len(marker_data)}
+
+
+def figura_correlacao_marcadores(df, marcadores):
+    markers_df = df[list(marcadores)].apply(pd.to_numeric, errors='coerce')
+    corr_matrix = markers_df.corr()
+    
+    fig = px.imshow(corr_matrix,
+                    labels=dict(color="Correlação"),
+                    x=[m.upper() for m in corr_matrix.columns],
+                    y=[m.upper() for m in corr_matrix.index],
+                    color_continuous_scale='RdBu_r',
+                    zmin=-1, zmax=1)
+    fig.update_layout(height=500)
+    return fig
+
+
+def figuras_comorbidades(df_pacientes, comorbidades):
+    mascara = obter_mascara(df_pacientes)
+    comorb_counts = {c.upper(): int(tem_alguma(mascara, [c]).sum()) for c in comorbidades}
+    
+    fig = px.bar(x=list(comorb_counts.keys()), y=list(comorb_counts.values()),
+                 color=list(comorb_counts.values()),
+                 color_continuous_scale='Reds')
+    fig.update_layout(title="Frequência de Comorbidades",
+                      xaxis_title='Comorbidade', yaxis_title='Pacientes',
+                      showlegend=False, height=400)
+    
+    freq_df = pd.DataFrame({
+        'Comorbidade': list(comorb_counts.keys()),
+        'Pacientes': list(comorb_counts.values())
+    }).sort_values('Pacientes', ascending=False)
+    freq_df['%'] = (freq_df['Pacientes'] / len(df_pacientes) * 100).round(2)
+    
+    comorb_dist = contar_comorbidades(mascara).value_counts().sort_index()
+    fig_multiplas = px.bar(x=comorb_dist.index, y=comorb_dist.values,
+                           color=comorb_dist.values, color_continuous_scale='Oranges')
+    fig_multiplas.update_layout(title="Número de Comorbidades por Paciente",
+                                xaxis_title='Número de Comorbidades',
+                                yaxis_title='Pacientes', showlegend=False)
+    
+    combinacoes = frequencia_combinacoes(mascara, comorbidades)
+    combinacoes = combinacoes[combinacoes['n_comorbidades'] >= 2].head(15)
+    combinacoes = pd.DataFrame({
+        'Combinação': combinacoes['combinacao'],
+        'Comorbidades': combinacoes['n_comorbidades'],
+        'Pacientes': combinacoes['frequencia'],
+        '%': (combinacoes['frequencia'] / len(df_pacientes) * 100).round(2),
+    })
+    return {'frequencia': fig, 'tabela': freq_df, 'multiplas': fig_multiplas, 'combinacoes': combinacoes}
 
-# Padrões de Fator Reumatoide
-FR_POSITIVO_PATTERNS = [
-    r'\bfr\s*\+', r'\bfr\s*positivo', r'\bfr\s*reagente', r'\(fr\s*\+\)',
-    r'fator\s+reumat[oó]ide\s*(positivo|reagente|\+)', r'soropositiv[ao]',
-    r'ar\s*\(?\s*fr\s*\+\s*\)?', r'\bfr\s*[:\s]+\d+[\.,]?\d*\s*\(?positivo\)?',
-]
-
-FR_NEGATIVO_PATTERNS = [
-    r'\bfr\s*-(?!\d)', r'\bfr\s*negativo', r'\bfr\s*n[aã]o\s*reagente',
-    r'\(fr\s*-\)', r'fator\s+reumat[oó]ide\s*(negativo|n[aã]o\s*reagente|-)',
-    r'soronegativ[ao]', r'\bfr\s*[:\s]+\d+[\.,]?\d*\s*\(?(neg|negativo)\)?',
-]
-
-FR_VALOR_PATTERN = r'\bfr\s*[:\s]+(\d+[\.,]?\d*)'
-
-CID_FR_MAPPING = {
-    'M06.0': 'NEGATIVO', 'M05.9': 'POSITIVO', 'M05.0': 'POSITIVO',
-    'M05.1': 'POSITIVO', 'M05.2': 'POSITIVO', 'M05.3': 'POSITIVO',
-    'M05.8': 'POSITIVO', 'M06.8': 'NÃO INFORMADO', 'M06.9': 'NÃO INFORMADO',
-}
-
-CID_PATTERN = r'CID[\s\-]*10?\s*[:\s]*([M]\d{2}\.?\d?)'
-
-# Medicamentos biológicos e JAK
-BIOLOGICOS_CONFIG = {
-    # JAK Inibidores
-    'tofacitinibe': {'aliases': ['tofacitinibe', 'xeljanz', 'tofa'], 'grupo': 'JAK Inibidores'},
-    'upadacitinibe': {'aliases': ['upadacitinibe', 'rinvoq', 'upada'], 'grupo': 'JAK Inibidores'},
-    'baricitinibe': {'aliases': ['baricitinibe', 'olumiant', 'bari'], 'grupo': 'JAK Inibidores'},
-    # Anti-TNF
-    'adalimumabe': {'aliases': ['adalimumabe', 'humira', 'ada'], 'grupo': 'Anti-TNF'},
-    'etanercepte': {'aliases': ['etanercepte', 'enbrel', 'eta'], 'grupo': 'Anti-TNF'},
-    'golimumabe': {'aliases': ['golimumabe', 'simponi', 'goli'], 'grupo': 'Anti-TNF'},
-    'infliximabe': {'aliases': ['infliximabe', 'remicade', 'ifx'], 'grupo': 'Anti-TNF'},
-    'certolizumabe': {'aliases': ['certolizumabe', 'cimzia', 'czp'], 'grupo': 'Anti-TNF'},
-    # Outros biológicos
-    'tocilizumabe': {'aliases': ['tocilizumabe', 'actemra', 'tcz'], 'grupo': 'Anti-IL/Outros'},
-    'rituximabe': {'aliases': ['rituximabe', 'mabthera', 'rtx'], 'grupo': 'Anti-IL/Outros'},
-    'abatacepte': {'aliases': ['abatacepte', 'orencia', 'aba'], 'grupo': 'Anti-IL/Outros'},
-    'secuquinumabe': {'aliases': ['secuquinumabe', 'cosentyx'], 'grupo': 'Anti-IL17'},
-    'ixequizumabe': {'aliases': ['ixequizumabe', 'taltz'], 'grupo': 'Anti-IL17'},
-}
 
-# DMARDs convencionais
-DMARDS_CONFIG = {
-    'metotrexato': {'aliases': ['metotrexato', 'metotrexate', 'mtx'], 'grupo': 'csDMARD'},
-    'leflunomida': {'aliases': ['leflunomida', 'arava', 'lef'], 'grupo': 'csDMARD'},
-    'sulfassalazina': {'aliases': ['sulfassalazina', 'azulfin', 'ssz'], 'grupo': 'csDMARD'},
-    'hidroxicloroquina': {'aliases': ['hidroxicloroquina', 'plaquinol', 'hcq'], 'grupo': 'csDMARD'},
-}
+def figuras_mtx(df_pacientes, df):
+    mtx_by_patient = df_pacientes['uso_mtx']
+    mtx_counts = _contagens(mtx_by_patient)
+    figuras = {
+        'status': _figura_pizza(mtx_counts, ['#22c55e', '#f59e0b', '#ef4444'], height=350),
+        'contagens': mtx_counts,
+        'total_pacientes': len(mtx_by_patient),
+    }
+    
+    if 'mtx_dose_mg_semana' in df.columns:
+        doses = df['mtx_dose_mg_semana'].dropna()
+        if len(doses) > 0:
+            fig = histograma_agregado(doses, nbins=15, cor='#3b82f6')
+            fig.update_layout(xaxis_title='Dose (mg/semana)', yaxis_title='Frequência')
+            figuras['doses'] = fig
+    
+    if 'mtx_via' in df.columns:
+        via_counts = _contagens(df['mtx_via'])
+        if len(via_counts) > 0:
+            figuras['via'] = px.pie(values=via_counts.values, names=via_counts.index)
+    return figuras
+
+
+def figuras_biologicos(df_pacientes):
+    figuras = {'status': _figura_pizza(_contagens(df_pacientes['uso_biologico']),
+                                       ['#22c55e', '#f59e0b', '#ef4444'], height=350)}
+    
+    nome_counts = _contagens(df_pacientes['biologico_nome']).head(10)
+    fig = px.bar(x=nome_counts.values, y=nome_counts.index,
+                 orientation='h', color=nome_counts.values,
+                 color_continuous_scale='Blues')
+    fig.update_layout(height=350, showlegend=False,
+                      xaxis_title='Pacientes', yaxis_title='')
+    figuras['mais_usados'] = fig
+    
+    grupo_counts = _contagens(df_pacientes['biologico_grupo'])
+    fig = px.bar(x=grupo_counts.index, y=grupo_counts.values,
+                 color=grupo_counts.index,
+                 color_discrete_map={
+                     'Anti-TNF': '#3b82f6',
+                     'Anti-IL/Outros': '#06b6d4',
+                     'JAK Inibidores': '#8b5cf6',
+                     'Anti-IL17': '#f59e0b'
+                 })
+    fig.update_layout(xaxis_title='', yaxis_title='Pacientes', showlegend=False)
+    figuras['grupos'] = fig
+    return figuras
+
+
+def figuras_medicamentos(df_pacientes, medicamentos):
+    med_by_patient = df_pacientes[list(medicamentos)]
+    med_counts = {m.title(): int(med_by_patient[m].sum()) for m in medicamentos}
+    med_counts_sorted = dict(sorted(med_counts.items(), key=lambda x: x[1], reverse=True))
+    
+    fig = px.bar(x=list(med_counts_sorted.values()),
+                 y=list(med_counts_sorted.keys()),
+                 orientation='h',
+                 color=list(med_counts_sorted.values()),
+                 color_continuous_scale='Greens')
+    fig.update_layout(title="Frequência de Uso de Medicamentos",
+                      xaxis_title='Pacientes', yaxis_title='',
+                      showlegend=False, height=max(400, len(med_counts)*30))
+    
+    politerapia_counts = med_by_patient.sum(axis=1).value_counts().sort_index()
+    fig_politerapia = px.bar(x=politerapia_counts.index, y=politerapia_counts.values,
+                             color=politerapia_counts.values, color_continuous_scale='Purples')
+    fig_politerapia.update_layout(xaxis_title='Número de Medicamentos',
+                                  yaxis_title='Pacientes', showlegend=False)
+    return {'frequencia': fig, 'politerapia': fig_politerapia}
+
+
+def figuras_visao_geral_eficacia(df_long):
+    improved = df_long['improvement'].sum()
+    figuras = {'resposta': _figura_pizza(pd.Series([improved, len(df_long) - improved],
+                                                   index=['Com Melhora', 'Sem Melhora']),
+                                         ['#22c55e', '#ef4444'], hole=0.3, height=400,
+                                         title="Distribuição de Resposta")}
+    if 'tempo_tratamento_dias' in df_long.columns:
+        fig = histograma_agregado_por_grupo(df_long['tempo_tratamento_dias'], df_long['improvement'],
+                                            nbins=30, cores=CORES_MELHORA,
+                                            barmode='overlay', nome_legenda='Melhorou')
+        fig.update_layout(title="Tempo de Tratamento por Resposta", xaxis_title='Dias', height=400)
+        figuras['tempo'] = fig
+    return figuras
+
+
+def figuras_evolucao_marcador(df_long, marcador):
+    col_t0 = f'{marcador}_t0'
+    col_t1 = f'{marcador}_t1'
+    df_marker = df_long[[col_t0, col_t1, 'improvement']].dropna()
+    if len(df_marker) == 0:
+        return None
+    
+    df_melt = pd.melt(df_marker, id_vars=['improvement'],
+                      value_vars=[col_t0, col_t1],
+                      var_name='Tempo', value_name='Valor')
+    df_melt['Tempo'] = df_melt['Tempo'].map({col_t0: 'Baseline', col_t1: 'Follow-up'})
+    
+    fig_box = box_agregado_por_grupo(df_melt, x='Tempo', y='Valor', cor='improvement',
+                                     cores=CORES_MELHORA, nome_legenda='Melhorou')
+    fig_box.update_layout(xaxis_title='Tempo', yaxis_title='Valor')
+    fig_box.update_layout(title=f"Comparação {marcador.upper()}", height=400)
+    
+    df_marker = df_marker.assign(mudanca=df_marker[col_t1] - df_marker[col_t0])
+    fig_disp = dispersao(df_marker, x=col_t0, y=col_t1, color='improvement',
+                         color_discrete_map=CORES_MELHORA,
+                         hover_data=['mudanca'],
+                         labels={'improvement': 'Melhorou'})
+    max_val = max(df_marker[col_t0].max(), df_marker[col_t1].max())
+    min_val = min(df_marker[col_t0].min(), df_marker[col_t1].min())
+    fig_disp.add_shape(type='line', x0=min_val, y0=min_val, x1=max_val, y1=max_val,
+                       line=dict(color='gray', dash='dash'))
+    fig_disp.update_layout(title=f"Evolução Individual", height=400)
+    return {'comparacao': fig_box, 'individual': fig_disp}
+
+
+def figura_taxa_resposta(tabela, titulo, eixo_x, escala=None, cores=None):
+    """Barras da taxa de resposta (%) por grupo: escala contínua ou mapa de cores por grupo"""
+    x = tabela.index.astype(str)
+    if cores is not None:
+        fig = px.bar(x=x, y=tabela['taxa'], color=x, color_discrete_map=cores,
+                     text=tabela['taxa'].round(1))
+    else:
+        fig = px.bar(x=x, y=tabela['taxa'], color=tabela['taxa'], color_continuous_scale=escala,
+                     text=tabela['taxa'].round(1))
+    fig.update_traces(texttemplate='%{text}%', textposition='outside')
+    fig.update_layout(title=titulo, xaxis_title=eixo_x, yaxis_title='Taxa (%)', showlegend=False)
+    return fig
 
-# Comorbidades
-COMORBIDADES_CONFIG = {
-    'has': ['has', 'hipertensão', 'hipertensao', 'hipertenso'],
-    'dm': ['dm', 'dm2', 'diabetes', 'diabético', 'diabetico'],
-    'pre_dm': ['pré-dm', 'pre-dm', 'pré-diabetes', 'pre-diabetes', 'pre-dm2'],
-    'dlp': ['dlp', 'dislipidemia', 'dislipidêmico'],
-    'fm': ['fm', 'fibromialgia'],
-    'op': ['op', 'osteoporose', 'osteoporótico'],
-    'hipotireoidismo': ['hipotireoidismo', 'tireoidite', 'hipotireoideo'],
-    'obesidade': ['obesidade', 'obeso', 'imc >30'],
-    'dpoc': ['dpoc', 'enfisema', 'bronquite crônica'],
-    'irc': ['irc', 'doença renal', 'insuficiência renal', 'nefropatia'],
-    'hepatopatia': ['hepatopatia', 'doença hepática', 'cirrose', 'esteatose'],
-    'depressao': ['depressão', 'depressao', 'transtorno depressivo'],
-}
 
-# Marcadores clínicos
-MARCADORES_CONFIG = {
-    'vhs': {'pattern': r'v[hs]s\s*[:\s=]*(\d+[\.,]?\d*)', 'label': 'VHS - Velocidade de Hemossedimentação'},
-    'leucocitos': {'pattern': r'leuc[oó]?c?i?t?o?s?\s*[:\s=]*(\d+[\.,]?\d*)', 'label': 'Leucócitos'},
-    'pcr': {'pattern': r'pcr\s*[:\s=]*(\d+[\.,]?\d*)', 'label': 'PCR - Proteína C-Reativa'},
-    'haq': {'pattern': r'haq\s*[:\s=]*(\d+[\.,]?\d*)', 'label': 'HAQ - Health Assessment Questionnaire'},
-    'das28': {'pattern': r'das\s*-?\s*28\s*[:\s=]*(\d+[\.,]?\d*)', 'label': 'DAS28 - Disease Activity Score'},
-    'cdai': {'pattern': r'cdai\s*[:\s=]*(\d+[\.,]?\d*)', 'label': 'CDAI - Clinical Disease Activity Index'},
-    'sdai': {'pattern': r'sdai\s*[:\s=]*(\d+[\.,]?\d*)', 'label': 'SDAI - Simplified Disease Activity Index'},
-    'basdai': {'pattern': r'basdai\s*[:\s=]*(\d+[\.,]?\d*)', 'label': 'BASDAI - Bath Ankylosing Spondylitis DAI'},
-    'asdas': {'pattern': r'asdas\s*[:\s=]*(\d+[\.,]?\d*)', 'label': 'ASDAS - Ankylosing Spondylitis DAS'},
+ROTULOS_DIMENSOES = {
+    'sexo': 'Sexo', 'faixa_etaria': 'Faixa Etária', 'fr_resultado': 'FR',
+    'tem_comorbidade': 'Comorbidades', 'uso_biologico': 'Uso de Biológico',
+    'biologico_nome': 'Biológico',
 }
 
-# Padrões de status de uso
-USO_ATIVO_PATTERNS = [
-    r'em\s+uso', r'mant[eé]m', r'mantenho', r'renovo\s+lme',
-    r'segue\s+com', r'continua\s+com', r'uso\s+atual',
-    r'medicaç[oõ]es?\s+em\s+uso', r'usando',
-]
-
-USO_PREVIO_PATTERNS = [
-    r'uso\s+pr[eé]vio', r'pr[eé]vio[s]?\s*[:\s]', r'fez\s+uso',
-    r'j[aá]\s+usou', r'suspen[sd][oa]', r'parou', r'interromp',
-    r'descontinua', r'n[aã]o\s+tolera', r'intoler[aâ]ncia',
-    r'hepatotoxicidade', r'alop[eé]cia', r'falha\s+terap[eê]utica',
-]
-
-MOTIVOS_SUSPENSAO = [
-    'intolerância', 'hepatotoxicidade', 'alopécia', 'alopecia',
-    'falha', 'infecção', 'efeito adverso', 'evento adverso',
-    'falta', 'indisponibilidade', 'gestação', 'gravidez',
-]
-
-
-# =============================================================================
-# FUNÇÕES DE EXTRAÇÃO
-# =============================================================================
 
-def is_number(s):
-    """Verifica se uma string contém números"""
-    return bool(re.search(r'\d', str(s)))
-
-
-def extract_fator_reumatoide(text):
-    """Extrai informações sobre Fator Reumatoide"""
-    if pd.isna(text):
-        return {'fr_resultado': 'NÃO INFORMADO', 'fr_valor': None, 'fr_origem': None}
-    
-    text_lower = str(text).lower()
-    result = {'fr_resultado': 'NÃO INFORMADO', 'fr_valor': None, 'fr_origem': None}
-    
-    # Buscar padrões positivos
-    for pattern in FR_POSITIVO_PATTERNS:
-        if re.search(pattern, text_lower):
-            result['fr_resultado'] = 'POSITIVO'
-            result['fr_origem'] = 'TEXTO'
-            break
-    
-    # Buscar padrões negativos
-    if result['fr_resultado'] == 'NÃO INFORMADO':
-        for pattern in FR_NEGATIVO_PATTERNS:
-            if re.search(pattern, text_lower):
-                result['fr_resultado'] = 'NEGATIVO'
-                result['fr_origem'] = 'TEXTO'
-                break
-    
-    # Extrair valor numérico
-    valor_match = re.search(FR_VALOR_PATTERN, text_lower)
-    if valor_match:
-        try:
-            result['fr_valor'] = float(valor_match.group(1).replace(',', '.'))
-            result['fr_origem'] = 'LAB'
-        except:
-            pass
-    
-    # Inferir por CID-10
-    if result['fr_resultado'] == 'NÃO INFORMADO':
-        cid_match = re.search(CID_PATTERN, text, re.IGNORECASE)
-        if cid_match:
-            cid = cid_match.group(1).upper()
-            if '.' not in cid and len(cid) >= 4:
-                cid = cid[:3] + '.' + cid[3:]
-            if cid in CID_FR_MAPPING:
-                result['fr_resultado'] = CID_FR_MAPPING[cid]
-                result['fr_origem'] = 'CID'
-    
-    return result
-
-
-def extract_medicamento_status(text, medicamento, aliases):
-    """Extrai status de uso de medicamento (SIM/PRÉVIO/NÃO)"""
-    if pd.isna(text):
-        return {'uso': 'NÃO', 'nome': None, 'motivo_suspensao': None}
-    
-    text_lower = str(text).lower()
-    result = {'uso': 'NÃO', 'nome': None, 'motivo_suspensao': None}
-    
-    # Verificar se o medicamento é mencionado
-    med_found = False
-    for alias in aliases:
-        if alias.lower() in text_lower:
-            med_found = True
-            result['nome'] = medicamento
-            break
-    
-    if not med_found:
-        return result
-    
-    # Buscar contexto próximo ao medicamento
-    for alias in aliases:
-        for match in re.finditer(re.escape(alias.lower()), text_lower):
-            start = max(0, match.start() - 300)
-            end = min(len(text_lower), match.end() + 300)
-            context = text_lower[start:end]
-            
-            # Verificar uso prévio
-            for pattern in USO_PREVIO_PATTERNS:
-                if re.search(pattern, context):
-                    result['uso'] = 'PRÉVIO'
-                    for motivo in MOTIVOS_SUSPENSAO:
-                        if motivo in context:
-                            result['motivo_suspensao'] = motivo
-                            break
-                    break
+def figuras_subgrupos(cubo):
+    """Taxas de resposta por subgrupo, todas consultadas no cubo pré-agregado"""
+    figuras = {}
+    
+    if 'sexo' in cubo.dimensoes:
+        tabela = cubo.tabela('sexo')
+        figuras['sexo'] = {'tabela': tabela, 'figura': figura_taxa_resposta(
+            tabela, "Taxa de Resposta por Sexo", 'Sexo', escala='Blues')}
+    
+    if 'faixa_etaria' in cubo.dimensoes:
+        tabela = cubo.tabela('faixa_etaria')
+        figuras['idade'] = {'tabela': tabela, 'figura': figura_taxa_resposta(
+            tabela, "Taxa de Resposta por Faixa Etária", 'Faixa Etária', escala='Greens')}
+    
+    if 'fr_resultado' in cubo.dimensoes:
+        tabela = cubo.tabela('fr_resultado')
+        figuras['fr'] = {'tabela': tabela, 'figura': figura_taxa_resposta(
+            tabela, "Taxa de Resposta por Fator Reumatoide", 'FR',
+            cores={'POSITIVO': '#ef4444', 'NEGATIVO': '#22c55e', 'NÃO INFORMADO': '#9ca3af'})}
+    
+    if 'tem_comorbidade' in cubo.dimensoes:
+        tabela = cubo.tabela('tem_comorbidade')
+        figuras['comorbidade'] = {'tabela': tabela, 'figura': figura_taxa_resposta(
+            tabela, "Taxa de Resposta por Comorbidades", '', escala='Reds')}
+    
+    if 'uso_biologico' in cubo.dimensoes:
+        tabela = cubo.tabela('uso_biologico')
+        figuras['biologico'] = {'tabela': tabela, 'figura': figura_taxa_resposta(
+            tabela, "Taxa de Resposta por Uso de Biológico", '',
+            cores={'SIM': '#22c55e', 'PRÉVIO': '#f59e0b', 'NÃO': '#ef4444'})}
+    
+    if 'biologico_nome' in cubo.dimensoes:
+        por_bio = cubo.tabela('biologico_nome')
+        por_bio = por_bio[por_bio['count'] >= 5]
+        if len(por_bio) > 0:
+            bio_df = pd.DataFrame({
+                'Total': por_bio['count'],
+                'Melhoraram': por_bio['sum'],
+                'Taxa (%)': por_bio['taxa'].round(2),
+            })
+            bio_df.index = bio_df.index.str.title()
+            bio_df = bio_df.sort_values('Taxa (%)', ascending=False)
             
-            # Verificar uso ativo
-            if result['uso'] != 'PRÉVIO':
-                for pattern in USO_ATIVO_PATTERNS:
-                    if re.search(pattern, context):
-                        result['uso'] = 'SIM'
-                        break
-    
-    # Default: se menciona, assume uso
-    if result['uso'] == 'NÃO' and med_found:
-        result['uso'] = 'SIM'
-    
-    return result
-
-
-def extract_marcadores(df, selected_markers, column_name='descricao'):
-    """Extrai marcadores clínicos selecionados"""
-    for marker in selected_markers:
-        df[marker] = None
-    
-    for idx, text in enumerate(df[column_name]):
-        if pd.isna(text):
-            continue
-        text_lower = str(text).lower()
-        
-        for marker in selected_markers:
-            if marker in MARCADORES_CONFIG:
-                pattern = MARCADORES_CONFIG[marker]['pattern']
-                match = re.search(pattern, text_lower)
-                if match and pd.isna(df.loc[idx, marker]):
-                    try:
-                        df.loc[idx, marker] = float(match.group(1).replace(',', '.'))
-                    except:
-                        pass
-    
-    return df
-
-
-def extract_comorbidades(df, selected_comorbidities, column_name='descricao'):
-    """Extrai comorbidades selecionadas como flags binárias"""
-    for comorb in selected_comorbidities:
-        df[comorb] = 0
-    
-    for idx, text in enumerate(df[column_name]):
-        if pd.isna(text):
-            continue
-        text_lower = str(text).lower()
-        
-        for comorb in selected_comorbidities:
-            if comorb in COMORBIDADES_CONFIG:
-                for alias in COMORBIDADES_CONFIG[comorb]:
-                    if alias in text_lower:
-                        df.loc[idx, comorb] = 1
-                        break
-    
-    # Flag geral
-    if selected_comorbidities:
-        df['comorbidade_qualquer'] = (df[list(selected_comorbidities)].sum(axis=1) > 0).astype(int)
-    
-    return df
-
-
-def extract_medicamentos_v3(df, selected_medications, column_name='descricao'):
-    """Extrai medicamentos com status SIM/PRÉVIO/NÃO"""
-    # Colunas de status (novo)
-    for med in selected_medications:
-        df[f'{med}_status'] = 'NÃO'
-        df[f'{med}_motivo'] = None
-        df[med] = 0  # Manter compatibilidade binária
-    
-    for idx, text in enumerate(df[column_name]):
-        if pd.isna(text):
-            continue
-        
-        for med in selected_medications:
-            # Buscar config em biológicos ou DMARDs
-            config = BIOLOGICOS_CONFIG.get(med) or DMARDS_CONFIG.get(med)
-            if config:
-                aliases = config['aliases']
-                status = extract_medicamento_status(text, med, aliases)
-                
-                df.loc[idx, f'{med}_status'] = status['uso']
-                df.loc[idx, f'{med}_motivo'] = status['motivo_suspensao']
-                
-                # Flag binária para compatibilidade
-                if status['uso'] in ['SIM', 'PRÉVIO']:
-                    df.loc[idx, med] = 1
-    
-    return df
-
-
-def extract_mtx_detalhado(df, column_name='descricao'):
-    """Extrai detalhes específicos do Metotrexato"""
-    df['uso_mtx'] = 'NÃO'
-    df['mtx_dose_mg_semana'] = None
-    df['mtx_via'] = None
-    df['motivo_suspensao_mtx'] = None
-    
-    for idx, text in enumerate(df[column_name]):
-        if pd.isna(text):
-            continue
-        
-        text_lower = str(text).lower()
-        
-        # Status
-        status = extract_medicamento_status(text, 'metotrexato', DMARDS_CONFIG['metotrexato']['aliases'])
-        df.loc[idx, 'uso_mtx'] = status['uso']
-        df.loc[idx, 'motivo_suspensao_mtx'] = status['motivo_suspensao']
-        
-        # Dose
-        dose_match = re.search(r'(?:mtx|metotrexato)\s*[:\s]*(\d+[\.,]?\d*)\s*(?:mg)?', text_lower)
-        if dose_match:
-            try:
-                df.loc[idx, 'mtx_dose_mg_semana'] = float(dose_match.group(1).replace(',', '.'))
-            except:
-                pass
-        
-        # Via
-        if re.search(r'(?:mtx|metotrexato)\s*\S*\s*(sc|subcutan[eê])', text_lower):
-            df.loc[idx, 'mtx_via'] = 'SC'
-        elif re.search(r'(?:mtx|metotrexato)\s*\S*\s*(vo|oral|comprimido)', text_lower):
-            df.loc[idx, 'mtx_via'] = 'VO'
-        elif re.search(r'(?:mtx|metotrexato)\s*\S*\s*(im|intramuscular)', text_lower):
-            df.loc[idx, 'mtx_via'] = 'IM'
-    
-    return df
-
-
-def extract_biologicos_detalhado(df, selected_biologicos, column_name='descricao'):
-    """Extrai detalhes de biológicos com grupo terapêutico"""
-    df['uso_biologico'] = 'NÃO'
-    df['biologico_nome'] = None
-    df['biologico_grupo'] = None
-    df['num_biologicos_previos'] = 0
-    
-    for idx, text in enumerate(df[column_name]):
-        if pd.isna(text):
-            continue
-        
-        biologicos_em_uso = []
-        biologicos_previos = []
-        
-        for med in selected_biologicos:
-            if med in BIOLOGICOS_CONFIG:
-                config = BIOLOGICOS_CONFIG[med]
-                status = extract_medicamento_status(text, med, config['aliases'])
-                
-                if status['uso'] == 'SIM':
-                    biologicos_em_uso.append({'nome': med, 'grupo': config['grupo']})
-                elif status['uso'] == 'PRÉVIO':
-                    biologicos_previos.append({'nome': med, 'grupo': config['grupo']})
-        
-        if biologicos_em_uso:
-            df.loc[idx, 'uso_biologico'] = 'SIM'
-            df.loc[idx, 'biologico_nome'] = biologicos_em_uso[0]['nome']
-            df.loc[idx, 'biologico_grupo'] = biologicos_em_uso[0]['grupo']
-        elif biologicos_previos:
-            df.loc[idx, 'uso_biologico'] = 'PRÉVIO'
-            df.loc[idx, 'biologico_nome'] = biologicos_previos[0]['nome']
-            df.loc[idx, 'biologico_grupo'] = biologicos_previos[0]['grupo']
-        
-        df.loc[idx, 'num_biologicos_previos'] = len(biologicos_previos)
-    
-    return df
-
-
-def extract_fator_reumatoide_df(df, column_name='descricao'):
-    """Aplica extração de FR ao DataFrame"""
-    df['fr_resultado'] = 'NÃO INFORMADO'
-    df['fr_valor'] = None
-    df['fr_origem'] = None
-    
-    for idx, text in enumerate(df[column_name]):
-        fr_info = extract_fator_reumatoide(text)
-        df.loc[idx, 'fr_resultado'] = fr_info['fr_resultado']
-        df.loc[idx, 'fr_valor'] = fr_info['fr_valor']
-        df.loc[idx, 'fr_origem'] = fr_info['fr_origem']
-    
-    return df
-
-
-def clean_numeric_columns(df, columns):
-    """Limpa e converte colunas numéricas"""
-    for col in columns:
-        if col in df.columns:
-            df[col] = (
-                df[col]
-                .astype(str)
-                .str.extract(r'(\d+[.,]?\d*)', expand=False)
-                .str.replace(',', '.', regex=False)
-            )
-            df[col] = pd.to_numeric(df[col], errors='coerce')
-    return df
+            fig = px.bar(x=bio_df.index, y=bio_df['Taxa (%)'],
+                         color=bio_df['Taxa (%)'], color_continuous_scale='Purples',
+                         text=bio_df['Taxa (%)'].round(1))
+            fig.update_traces(texttemplate='%{text}%', textposition='outside')
+            fig.update_layout(xaxis_title='', yaxis_title='Taxa (%)', showlegend=False)
+            figuras['biologico_nome'] = {'tabela': bio_df, 'figura': fig}
+    return figuras
+
+
+def figura_combinacao_subgrupos(cubo, linhas, colunas):
+    """Heatmap da taxa de resposta no cruzamento de duas dimensões (ex.: sexo × biológico)"""
+    tabela = cubo.tabela(linhas, colunas)
+    taxa = tabela['taxa'].unstack(colunas)
+    total = tabela['count'].unstack(colunas).reindex_like(taxa)
+    texto = (taxa.round(1).astype(str) + '% (n=' + total.fillna(0).astype(int).astype(str) + ')').where(taxa.notna(), '')
+    
+    fig = go.Figure(data=go.Heatmap(
+        z=taxa.values,
+        x=[str(c) for c in taxa.columns],
+        y=[str(i) for i in taxa.index],
+        colorscale='RdYlGn',
+        zmin=0, zmax=100,
+        text=texto.values,
+        texttemplate='%{text}',
+        colorbar=dict(title='Taxa (%)'),
+        hoverongaps=False
+    ))
+    fig.update_layout(
+        title=f"Taxa de Resposta: {ROTULOS_DIMENSOES[linhas]} × {ROTULOS_DIMENSOES[colunas]}",
+        xaxis_title=ROTULOS_DIMENSOES[colunas],
+        yaxis_title=ROTULOS_DIMENSOES[linhas],
+        height=max(400, len(taxa) * 45),
+    )
+    return {'figura': fig, 'tabela': tabela}
+
+
+def figuras_trocas_visao_geral(df_long):
+    stats_troca = calcular_taxa_troca_geral(df_long)
+    figuras = {'stats': stats_troca}
+    
+    if stats_troca['pacientes_que_trocaram'] > 0:
+        figuras['distribuicao'] = _figura_pizza(
+            pd.Series([stats_troca['pacientes_primeiro_biologico'], stats_troca['pacientes_que_trocaram']],
+                      index=['Primeiro Biológico', 'Trocaram']),
+            ['#22c55e', '#f59e0b'], height=350, title="Distribuição de Pacientes")
+        
+        if 'num_biologicos_previos' in df_long.columns:
+            dist_trocas = df_long[df_long['num_biologicos_previos'] > 0]['num_biologicos_previos'].value_counts().sort_index()
+            if len(dist_trocas) > 0:
+                fig = px.bar(x=dist_trocas.index, y=dist_trocas.values,
+                             labels={'x': 'Número de Trocas', 'y': 'Pacientes'},
+                             color=dist_trocas.values,
+                             color_continuous_scale='Oranges')
+                fig.update_layout(title="Distribuição do Número de Trocas",
+                                  showlegend=False, height=300)
+                figuras['num_trocas'] = fig
+    return figuras
+
+
+def figuras_matriz_transicao(df_long, biologicos):
+    matriz = construir_matriz_transicao(df_long, biologicos)
+    if matriz.sum().sum() == 0:
+        return {'matriz': matriz, 'figura': None}
+    
+    fig = go.Figure(data=go.Heatmap(
+        z=matriz.values,
+        x=matriz.columns,
+        y=matriz.index,
+        colorscale='Blues',
+        text=matriz.values,
+        texttemplate='%{text}',
+        textfont={"size": 10},
+        hoverongaps=False
+    ))
+    fig.update_layout(
+        title="Matriz de Transição de Medicamentos",
+        xaxis_title='Para (Medicamento Atual)',
+        yaxis_title='De (Medicamento Prévio)',
+        height=500,
+        xaxis={'side': 'bottom'},
+    )
+    return {'matriz': matriz, 'figura': fig}
+
+
+def figuras_abandono(df_long, biologicos):
+    df_taxas = calcular_taxa_abandono_por_medicamento(df_long, biologicos)
+    if df_taxas.empty:
+        return {'tabela': df_taxas, 'figura': None}
+    
+    fig = px.bar(
+        df_taxas,
+        x='Medicamento',
+        y='Taxa Abandono (%)',
+        color='Taxa Abandono (%)',
+        color_continuous_scale='Reds',
+        text='Taxa Abandono (%)',
+        hover_data=['Total Usaram', 'Suspenderam']
+    )
+    fig.update_traces(texttemplate='%{text:.1f}%', textposition='outside')
+    fig.update_layout(
+        title='Taxa de Abandono por Medicamento',
+        xaxis_title='',
+        yaxis_title='Taxa de Abandono (%)',
+        showlegend=False,
+        height=400
+    )
+    return {'tabela': df_taxas, 'figura': fig}
 
 
-def create_longitudinal_data(df, baseline_type, followup_type, marker_cols,
-                            date_col='data_hora', patient_col='paciente'):
-    """Cria base longitudinal com medidas t0 e t1"""
-    baseline = df[df['tipo'] == baseline_type].copy()
-    followup = df[df['tipo'] == followup_type].copy()
-    
-    baseline = baseline.sort_values(by=date_col, ascending=True)
-    baseline = baseline.drop_duplicates(subset=[patient_col], keep="first")
-    
-    followup = followup.sort_values(by=date_col, ascending=False)
-    followup = followup.drop_duplicates(subset=[patient_col], keep="first")
-    
-    baseline_marker_cols = marker_cols + [date_col]
-    baseline.columns = [
-        col + '_t0' if col in baseline_marker_cols else col
-        for col in baseline.columns
-    ]
-    
-    followup.columns = [
-        col + '_t1' if col in baseline_marker_cols else col
-        for col in followup.columns
-    ]
-    
-    # Colunas extras para manter do baseline (não são marcadores, não ganham _t0)
-    extra_cols = ['idade', 'sexo', 'fr_resultado', 'fr_valor', 'fr_origem',
-                  'uso_mtx', 'mtx_dose_mg_semana', 'mtx_via', 'motivo_suspensao_mtx',
-                  'uso_biologico', 'biologico_nome', 'biologico_grupo', 'num_biologicos_previos',
-                  'comorbidade_qualquer']
-    
-    # Adicionar colunas de comorbidades individuais
-    comorb_cols = [c for c in baseline.columns if c in COMORBIDADES_CONFIG.keys()]
-    extra_cols.extend(comorb_cols)
-    
-    # Adicionar colunas de medicamentos individuais (status e binário)
-    med_cols = [c for c in baseline.columns if c.endswith('_status') or c.endswith('_motivo')]
-    extra_cols.extend(med_cols)
-    
-    # Colunas para manter do baseline
-    keep_cols = [patient_col]
-    keep_cols += [c for c in extra_cols if c in baseline.columns]
-    keep_cols += [col for col in baseline.columns if '_t0' in col]
-    
-    # Remover duplicatas na lista
-    keep_cols = list(dict.fromkeys(keep_cols))
-    
-    # Selecionar colunas do followup (apenas marcadores _t1 e paciente)
-    followup_keep = [patient_col] + [col for col in followup.columns if '_t1' in col]
-    
-    merged = baseline[keep_cols].merge(followup[followup_keep], on=patient_col, how='inner')
-    
-    # Tratar possíveis duplicatas restantes
-    for col in extra_cols:
-        if f'{col}_y' in merged.columns:
-            merged = merged.drop(columns=[f'{col}_y'], errors='ignore')
-        if f'{col}_x' in merged.columns:
-            merged = merged.rename(columns={f'{col}_x': col})
+def figuras_motivos_suspensao(df_long, biologicos):
+    df_motivos = analisar_motivos_suspensao(df_long, biologicos)
+    if df_motivos.empty:
+        return None
     
-    # Calcular tempo de tratamento
-    if f'{date_col}_t0' in merged.columns and f'{date_col}_t1' in merged.columns:
-        merged['tempo_tratamento_dias'] = (
-            merged[f'{date_col}_t1'] - merged[f'{date_col}_t0']
-        ).dt.days
-    
-    return merged
+    fig = px.sunburst(
+        df_motivos,
+        path=['Medicamento', 'Motivo'],
+        values='Pacientes',
+        color='Pacientes',
+        color_continuous_scale='Oranges'
+    )
+    fig.update_layout(
+        title='Motivos de Suspensão por Medicamento',
+        height=500
+    )
+    return {
+        'figura': fig,
+        'top_motivos': df_motivos.groupby('Motivo')['Pacientes'].sum().sort_values(ascending=False).head(5),
+        'detalhes': df_motivos.pivot_table(index='Medicamento', columns='Motivo',
+                                           values='Pacientes', fill_value=0),
+    }
 
 
-def calculate_improvement(merged_df, criteria_dict):
-    """Calcula melhora baseada em critérios personalizados"""
-    merged_df['improvement'] = None
+def figura_sequencias(df_long, biologicos):
+    df_seq = identificar_sequencias_comuns(df_long, biologicos, top_n=10)
+    if df_seq.empty:
+        return None
     
-    for marker, criteria_func in criteria_dict.items():
-        col_t0 = f'{marker}_t0'
-        col_t1 = f'{marker}_t1'
-        
-        if col_t0 in merged_df.columns and col_t1 in merged_df.columns:
-            for idx in merged_df.index:
-                v0 = merged_df.loc[idx, col_t0]
-                v1 = merged_df.loc[idx, col_t1]
-                
-                if merged_df.loc[idx, 'improvement'] is None:
-                    if not pd.isna(v0) and not pd.isna(v1):
-                        merged_df.loc[idx, 'improvement'] = int(criteria_func(v0, v1))
-    
-    merged_df['improvement'] = merged_df['improvement'].fillna(0).astype(int)
-    return merged_df
+    fig = px.bar(
+        df_seq,
+        x='Pacientes',
+        y='Sequência',
+        orientation='h',
+        color='Pacientes',
+        color_continuous_scale='Purples',
+        text='Pacientes'
+    )
+    fig.update_traces(textposition='outside')
+    fig.update_layout(
+        title='Sequências de Tratamento Mais Comuns',
+        xaxis_title='Número de Pacientes',
+        yaxis_title='',
+        showlegend=False,
+        height=max(400, len(df_seq) * 40)
+    )
+    return fig
+
+
+def figuras_eficacia_pos_troca(df_long):
+    stats_eficacia = analisar_eficacia_pos_troca(df_long)
+    if not (stats_eficacia['com_troca']['total'] > 0 and stats_eficacia['sem_troca']['total'] > 0):
+        return {'stats': stats_eficacia, 'figura': None}
+    
+    df_comp = pd.DataFrame({
+        'Grupo': ['Primeiro Biológico', 'Após Troca(s)'],
+        'Taxa de Resposta (%)': [
+            stats_eficacia['sem_troca']['taxa_pct'],
+            stats_eficacia['com_troca']['taxa_pct']
+        ],
+        'N': [
+            stats_eficacia['sem_troca']['total'],
+            stats_eficacia['com_troca']['total']
+        ]
+    })
+    fig = px.bar(
+        df_comp,
+        x='Grupo',
+        y='Taxa de Resposta (%)',
+        color='Grupo',
+        color_discrete_map={
+            'Primeiro Biológico': '#22c55e',
+            'Após Troca(s)': '#f59e0b'
+        },
+        text='Taxa de Resposta (%)',
+        hover_data=['N']
+    )
+    fig.update_traces(texttemplate='%{text:.1f}%', textposition='outside')
+    fig.update_layout(
+        title='Taxa de Resposta: Primeiro Biológico vs Após Troca',
+        xaxis_title='',
+        yaxis_title='Taxa de Resposta (%)',
+        showlegend=False,
+        height=400
+    )
+    return {'stats': stats_eficacia, 'figura': fig}
 
 
 # =============================================================================
@@ -838,6 +820,453 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 
+# =============================================================================
+# EXECUÇÃO DO ETL EM SEGUNDO PLANO
+# =============================================================================
+
+# Memória máxima ocupada pelos resultados compartilhados entre sessões
+LIMITE_CACHE_RESULTADOS_MB = 1024
+
+# Execuções salvas em disco (reabertas após reiniciar o servidor)
+PASTA_ARTEFATOS = 'artefatos_immuned'
+LIMITE_ARTEFATOS_MB = 2048
+
+# Cada execução salva ganha um banco SQLite indexado (consultas de coorte e prévias paginadas)
+USAR_BANCO_COORTES = True
+LINHAS_PREVIA = 500
+
+# Checkpoints dos jobs em andamento (retomados se o servidor cair durante a extração)
+PASTA_CHECKPOINTS = 'checkpoints_immuned'
+
+# Seções de figuras memorizadas (todas as sessões)
+MAX_FIGURAS_MEMORIZADAS = 512
+
+# Índices do tamanho do dataset (bitmap de coortes, índice invertido do texto),
+# guardados à parte para não serem descartados pelas figuras
+MAX_INDICES_MEMORIZADOS = 8
+
+
+@st.cache_resource
+def obter_cache_resultados():
+    """Cache único por processo dos resultados do ETL (hash do arquivo, configuração)"""
+    return CacheResultadosETL(limite_bytes=LIMITE_CACHE_RESULTADOS_MB * 1024 * 1024)
+
+
+@st.cache_resource
+def obter_gerenciador_jobs():
+    """Gerenciador único por processo: limita jobs pesados simultâneos entre sessões"""
+    return GerenciadorJobsETL(max_jobs_simultaneos=1, cache=obter_cache_resultados(),
+                              pasta_checkpoints=PASTA_CHECKPOINTS)
+
+
+@st.cache_resource
+def obter_cache_figuras():
+    """Figuras memorizadas por (dataset, parâmetros da visualização), compartilhadas entre sessões"""
+    return CacheFiguras(max_itens=MAX_FIGURAS_MEMORIZADAS)
+
+
+@st.cache_resource
+def obter_cache_indices():
+    """Índices por dataset (bitmap de coortes, busca no texto), compartilhados entre sessões"""
+    return CacheFiguras(max_itens=MAX_INDICES_MEMORIZADOS)
+
+
+@st.cache_resource
+def obter_armazem_artefatos():
+    """Execuções salvas em disco: sobrevivem a reinícios do servidor"""
+    return ArmazemArtefatos(PASTA_ARTEFATOS, limite_mb=LIMITE_ARTEFATOS_MB)
+
+
+@st.cache_resource
+def abrir_banco_coortes(caminho):
+    """Conexão somente leitura compartilhada por arquivo de banco"""
+    return BancoCoortes(caminho)
+
+
+def obter_banco_sessao():
+    """Banco de coortes da execução em análise (None se não houver)"""
+    chave = st.session_state.get('chave_dados')
+    if not USAR_BANCO_COORTES or not chave:
+        return None
+    armazem = obter_armazem_artefatos()
+    caminho = armazem.caminho_banco(armazem.id_da_chave(*chave))
+    return abrir_banco_coortes(caminho) if caminho else None
+
+
+def exibir_consulta_coorte(banco, medicamentos):
+    """Filtros de coorte respondidos pelo banco (notas por tipo, período e status de medicamento)"""
+    st.markdown("#### 🔎 Consulta de Coorte")
+    filtros = {}
+    col1, col2 = st.columns(2)
+    with col1:
+        if 'tipo' in banco.colunas('processados'):
+            tipos = st.multiselect("Tipo de nota:", banco.valores_distintos('processados', 'tipo'),
+                                   key='coorte_tipo')
+            if tipos:
+                filtros['tipo'] = tipos
+    with col2:
+        if 'data_hora' in banco.colunas('processados'):
+            periodo = st.date_input("Período:", value=(), key='coorte_periodo')
+            if len(periodo) == 2:
+                filtros['data_hora'] = (pd.Timestamp(periodo[0]), pd.Timestamp(periodo[1]))
+    
+    status_disponiveis = [m for m in medicamentos if f'{m}_status' in banco.colunas('processados')]
+    colunas = st.columns(3)
+    for i, med in enumerate(status_disponiveis):
+        status = colunas[i % 3].selectbox(f"{med.title()}:", ['Qualquer', 'SIM', 'PRÉVIO', 'NÃO'],
+                                          key=f'coorte_{med}')
+        if status != 'Qualquer':
+            filtros[f'{med}_status'] = status
+    
+    pacientes = banco.pacientes_coorte(filtros)
+    col1, col2 = st.columns(2)
+    col1.metric("Notas", f"{banco.contar('processados', filtros):,}".replace(',', '.'))
+    col2.metric("Pacientes", f"{len(pacientes):,}".replace(',', '.'))
+    if len(pacientes) and 'pacientes' in banco.tabelas:
+        st.dataframe(banco.consultar('pacientes', {'paciente': pacientes.head(LINHAS_PREVIA).tolist()},
+                                     ordem='paciente'),
+                     use_container_width=True)
+
+
+def exibir_previa_banco(banco, tabela):
+    """Uma página da tabela lida do banco, sem enviar a tabela inteira ao navegador"""
+    total = banco.contar(tabela)
+    paginas = max(1, -(-total // LINHAS_PREVIA))
+    pagina = st.number_input(f"Página (de {paginas}):", min_value=1, max_value=paginas, value=1,
+                             key=f'pagina_{tabela}')
+    st.caption(f"{total} linhas • exibindo até {LINHAS_PREVIA} por página")
+    st.dataframe(banco.consultar(tabela, limite=LINHAS_PREVIA, inicio=(pagina - 1) * LINHAS_PREVIA),
+                 use_container_width=True)
+
+
+def indice_coorte():
+    """Índice bitmap da tabela de pacientes do dataset em análise (memorizado)"""
+    df_pacientes = st.session_state['df_pacientes']
+    return obter_cache_indices().construir(st.session_state.get('impressao_dados'), {
+        'indice_coorte': ((), lambda: IndiceBitmap(df_pacientes))
+    })['indice_coorte']
+
+
+def exibir_filtro_coorte():
+    """Filtro de coorte na barra lateral, aplicado às análises exploratória e de eficácia"""
+    with st.sidebar.expander("🎯 Filtro de Coorte", expanded=bool(st.session_state.get('filtro_coorte'))):
+        indice = indice_coorte()
+        texto = st.text_area(
+            "Filtro (e / ou / não, parênteses):", key='filtro_coorte_texto',
+            placeholder='fr_resultado = POSITIVO e uso_mtx = PRÉVIO e biologico_grupo = "JAK Inibidores" e has e dm',
+        )
+        try:
+            filtro = interpretar_filtro(texto)
+            indice.avaliar(filtro)
+        except ValueError as e:
+            st.error(f"❌ {e}")
+            filtro = None
+        st.session_state['filtro_coorte'] = str(filtro) if filtro is not None else None
+        if filtro is not None:
+            st.success(f"✅ {indice.contar(filtro)} de {indice.n} pacientes")
+        st.markdown("**Colunas e valores:**")
+        for coluna in indice.colunas:
+            st.caption(f"**{coluna}**: {', '.join(map(str, indice.valores(coluna)))}")
+
+
+def dados_analise():
+    """
+    Tabelas usadas nas análises, restritas à coorte filtrada na barra lateral.
+
+    Returns:
+        (df_processed, df_pacientes, df_longitudinal, impressao) - a impressão
+        identifica a coorte nas figuras memorizadas
+    """
+    impressao = st.session_state.get('impressao_dados')
+    df_processed = st.session_state['df_processed']
+    df_pacientes = st.session_state['df_pacientes']
+    df_long = st.session_state.get('df_longitudinal')
+    texto = st.session_state.get('filtro_coorte')
+    if not texto:
+        return df_processed, df_pacientes, df_long, impressao
+    
+    # Só o bitmap da coorte (um bit por paciente) é memorizado; as tabelas
+    # filtradas são refeitas a cada execução em vez de guardar cópias delas
+    indice = indice_coorte()
+    bitmap = obter_cache_figuras().construir(impressao, {
+        'coorte': ((texto,), lambda: indice.avaliar(interpretar_filtro(texto)))
+    })['coorte']
+    pacientes = indice.pacientes_bitmap(bitmap)
+    return (df_processed[df_processed['paciente'].isin(pacientes)],
+            df_pacientes[df_pacientes['paciente'].isin(pacientes)],
+            None if df_long is None else df_long[df_long['paciente'].isin(pacientes)],
+            None if impressao is None else f"{impressao}|{texto}")
+
+
+def indice_busca():
+    """Índice invertido do texto do dataset em análise (None se não foi construído no ETL)"""
+    tabela = st.session_state.get('indice_busca')
+    if tabela is None:
+        return None
+    n_notas = len(st.session_state['df_processed'])
+    return obter_cache_indices().construir(st.session_state.get('impressao_dados'), {
+        'indice_busca': ((), lambda: IndiceInvertido(tabela, n_notas=n_notas))
+    })['indice_busca']
+
+
+def exibir_busca_textos(indice):
+    """Busca por termo, frase ou proximidade no texto das notas"""
+    st.markdown("#### 🔤 Busca no Texto")
+    consulta = st.text_input(
+        "Buscar:", key='busca_textos',
+        placeholder='metotrexato "perda de seguimento" "suspenso nausea"~5 adalim* -herpes',
+        help='Palavras sem acento nem maiúsculas; "frase exata"; "a b"~N para palavras a até N '
+             'posições; termo* para prefixo; -termo para excluir'
+    )
+    if not consulta.strip():
+        return
+    try:
+        notas = indice.buscar(consulta)
+    except ValueError as e:
+        st.error(f"❌ {e}")
+        return
+    
+    df_proc = st.session_state['df_processed']
+    encontradas = df_proc.iloc[notas]
+    col1, col2 = st.columns(2)
+    col1.metric("Notas", f"{len(notas):,}".replace(',', '.'))
+    col2.metric("Pacientes", f"{encontradas['paciente'].nunique():,}".replace(',', '.'))
+    if not len(notas):
+        return
+    
+    previa = restaurar_texto(encontradas.head(LINHAS_PREVIA), st.session_state.get('textos'))
+    colunas = [c for c in ['paciente', 'tipo', 'data_hora'] if c in previa.columns]
+    tabela = previa[colunas].copy()
+    tabela['trecho'] = [trecho(texto, consulta) for texto in previa['descricao']]
+    st.caption(f"Exibindo até {LINHAS_PREVIA} notas")
+    st.dataframe(tabela, use_container_width=True)
+
+
+def destacar_trechos(texto, trechos):
+    """HTML do texto com os trechos (início, fim) marcados; trechos sobrepostos são unidos"""
+    partes, atual = [], 0
+    for inicio, fim in sorted(trechos):
+        inicio = max(inicio, atual)
+        if fim <= inicio:
+            continue
+        partes += [html.escape(texto[atual:inicio]), f'<mark>{html.escape(texto[inicio:fim])}</mark>']
+        atual = fim
+    partes.append(html.escape(texto[atual:]))
+    return ''.join(partes).replace('\n', '<br>')
+
+
+def exibir_evidencias_nota(evidencias):
+    """Nota com os trechos que decidiram cada valor extraído, sem refazer a extração"""
+    st.markdown("#### 🧾 Evidências da Extração")
+    df_proc = st.session_state['df_processed']
+    pacientes = df_proc['paciente'].drop_duplicates().sort_values().tolist()
+    col1, col2 = st.columns(2)
+    with col1:
+        paciente = st.selectbox("Paciente:", pacientes, key='evidencias_paciente')
+    notas = np.flatnonzero((df_proc['paciente'] == paciente).to_numpy())
+    rotulo = {
+        nota: ' • '.join(str(df_proc[c].iloc[nota]) for c in ['tipo', 'data_hora'] if c in df_proc.columns)
+        for nota in notas
+    }
+    with col2:
+        nota = st.selectbox("Nota:", notas, format_func=lambda n: rotulo[n], key='evidencias_nota')
+    if nota is None:
+        return
+    
+    tabela = evidencias_da_nota(evidencias, int(nota))
+    texto = restaurar_texto(df_proc.iloc[[nota]], st.session_state.get('textos'))['descricao'].iloc[0]
+    colunas = st.multiselect("Variáveis:", sorted(tabela['coluna'].astype(str).unique()),
+                             key='evidencias_colunas')
+    if colunas:
+        tabela = tabela[tabela['coluna'].astype(str).isin(colunas)]
+    tabela['trecho'] = [texto[i:f] for i, f in zip(tabela['inicio'], tabela['fim'])]
+    st.markdown(f"<div style='max-height: 300px; overflow-y: auto'>"
+                f"{destacar_trechos(str(texto), zip(tabela['inicio'], tabela['fim']))}</div>",
+                unsafe_allow_html=True)
+    st.dataframe(tabela[['coluna', 'regra', 'trecho', 'padrao', 'inicio', 'fim']], use_container_width=True)
+
+
+def exibir_contadores_regras(contadores):
+    """Custo e acertos de cada regra de extração na última execução"""
+    st.markdown("#### 📏 Regras de Extração")
+    tabela = tabela_regras(contadores)
+    sem_acerto = tabela['acertos'] == 0
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Regras avaliadas", len(tabela))
+    col2.metric("Sem nenhum acerto", int(sem_acerto.sum()))
+    col3.metric("Tempo nas regras", f"{tabela['tempo_ms'].sum() / 1000:.1f} s")
+    if st.checkbox("Mostrar só regras sem acerto", key='regras_sem_acerto'):
+        tabela = tabela[sem_acerto]
+    st.caption("Notas reaproveitadas de uma quase duplicata não são avaliadas e não entram nas contagens")
+    st.dataframe(tabela.round({'taxa_acerto': 3, 'tempo_ms': 1, 'us_por_avaliacao': 2}), use_container_width=True)
+    st.download_button(
+        label="📥 Download CSV - Regras de Extração",
+        data=tabela.to_csv(index=False),
+        file_name=f"immuned_regras_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
+        mime="text/csv",
+        key="btn_csv_regras"
+    )
+
+
+def exibir_notas_lentas(notas):
+    """Notas que mais tempo levaram na extração, para encontrar entradas que fazem as regras retrocederem"""
+    st.markdown("#### 🐢 Notas Mais Lentas na Extração")
+    tabela = tabela_notas_lentas(notas)
+    st.caption("Tempo de cada nota em cada extrator e a regra que dominou o tempo da nota; "
+               "a nota é identificada por paciente, tipo, data e impressão do texto")
+    st.dataframe(tabela.round({c: 2 for c in tabela.columns if c.endswith('_ms')}), use_container_width=True)
+    st.download_button(
+        label="📥 Download CSV - Notas Mais Lentas",
+        data=tabela.to_csv(index=False),
+        file_name=f"immuned_notas_lentas_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
+        mime="text/csv",
+        key="btn_csv_notas_lentas"
+    )
+
+
+def exibir_execucoes_salvas():
+    """Lista na barra lateral as execuções salvas e permite reabrir uma delas"""
+    execucoes = obter_armazem_artefatos().listar()
+    if not execucoes:
+        return
+    
+    with st.sidebar.expander(f"📂 Execuções salvas ({len(execucoes)})"):
+        por_id = {e['id']: e for e in execucoes}
+        id_escolhido = st.selectbox(
+            "Execução:", list(por_id.keys()),
+            format_func=lambda i: (f"{por_id[i]['nome_arquivo'] or 'sem nome'} • "
+                                   f"{datetime.fromtimestamp(por_id[i]['criado_em']).strftime('%d/%m/%Y %H:%M')} • "
+                                   f"{por_id[i]['tamanho_bytes'] / 1024 ** 2:.1f} MB"),
+            key='execucao_salva'
+        )
+        if st.button("📂 Abrir execução", key='abrir_execucao', use_container_width=True):
+            execucao = por_id[id_escolhido]
+            resultado, metadados = obter_armazem_artefatos().abrir(id_escolhido)
+            chave = (execucao['hash_entrada'], execucao['hash_config'])
+            if 'df_pacientes' not in resultado:
+                # Execuções salvas por versões anteriores
+                resultado['df_pacientes'] = construir_tabela_pacientes(resultado['df_processed'])
+            obter_cache_resultados().guardar(chave, resultado)
+            anexar_resultado_sessao(resultado, metadados, chave)
+            st.session_state['execucao_aberta'] = execucao
+            st.session_state.pop('job_etl_id', None)
+            st.query_params.pop('job', None)
+            st.success("✅ Execução carregada")
+
+
+def anexar_resultado_sessao(resultado, metadados, chave=None):
+    """
+    Salva no session_state o resultado do ETL e as seleções usadas. A chave
+    (hash do arquivo, impressão da configuração) identifica o dataset nas
+    figuras memorizadas.
+    """
+    st.session_state['impressao_dados'] = '_'.join(chave) if chave else None
+    st.session_state['chave_dados'] = tuple(chave) if chave else None
+    st.session_state['df_processed'] = resultado['df_processed']
+    st.session_state['df_longitudinal'] = resultado['df_longitudinal']
+    st.session_state['df_pacientes'] = resultado['df_pacientes']
+    st.session_state['textos'] = resultado.get('textos')
+    st.session_state['indice_busca'] = resultado.get('indice_busca')
+    st.session_state['evidencias'] = resultado.get('evidencias')
+    st.session_state['regras_extracao'] = resultado.get('relatorio', {}).get('regras')
+    st.session_state['notas_lentas'] = resultado.get('relatorio', {}).get('notas_lentas')
+    st.session_state['selected_markers'] = metadados['selected_markers']
+    st.session_state['selected_comorbidities'] = metadados['selected_comorbidities']
+    st.session_state['selected_medications'] = metadados['selected_medications']
+    st.session_state['selected_biologicos'] = metadados['selected_biologicos']
+
+
+def exibir_resumo_etl(df_pacientes, df_longitudinal, extract_fr):
+    """Métricas exibidas ao final do processamento"""
+    st.markdown("### 📋 Resumo do Processamento")
+    
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Pacientes Finais", len(df_longitudinal))
+    
+    if 'improvement' in df_longitudinal.columns:
+        improved = df_longitudinal['improvement'].sum()
+        col2.metric("Melhoraram", improved)
+        pct = (improved / len(df_longitudinal) * 100) if len(df_longitudinal) > 0 else 0
+        col3.metric("% Melhora", f"{pct:.1f}%")
+    
+    if 'tempo_tratamento_dias' in df_longitudinal.columns:
+        col4.metric("Tempo Médio", f"{df_longitudinal['tempo_tratamento_dias'].mean():.0f} dias")
+    
+    # Resumo FR (novo)
+    if extract_fr and 'fr_resultado' in df_pacientes.columns:
+        st.markdown("#### 🧬 Fator Reumatoide")
+        fr_by_patient = df_pacientes['fr_resultado']
+        col1, col2, col3 = st.columns(3)
+        col1.metric("FR Positivo", (fr_by_patient == 'POSITIVO').sum())
+        col2.metric("FR Negativo", (fr_by_patient == 'NEGATIVO').sum())
+        col3.metric("Não Informado", (fr_by_patient == 'NÃO INFORMADO').sum())
+
+
+@st.fragment(run_every=1)
+def painel_progresso_job(job_id):
+    """
+    Progresso do job em andamento. Só este painel é reexecutado a cada
+    segundo; ao terminar o job, a página inteira é reexecutada uma vez para
+    exibir o resultado.
+    """
+    gerenciador = obter_gerenciador_jobs()
+    job = gerenciador.estado(job_id)
+    if job is None or job['status'] not in (jobs_etl.NA_FILA, jobs_etl.EXECUTANDO):
+        st.rerun()
+
+    if job['status'] == jobs_etl.NA_FILA:
+        st.info("⏳ Aguardando na fila (outro processamento em andamento)...")
+    else:
+        st.progress(job['indice_etapa'] / job['total_etapas'],
+                    text=f"⚙️ Etapa {job['indice_etapa']}/{job['total_etapas']}: {job['etapa']}")
+        if job['total_blocos']:
+            st.progress(job['blocos_concluidos'] / job['total_blocos'],
+                        text=f"Blocos extraídos: {job['blocos_concluidos']}/{job['total_blocos']}")
+        for mensagem in job['mensagens']:
+            st.info(mensagem)
+
+    if st.button("⛔ Cancelar processamento", key=f'cancelar_{job_id}'):
+        gerenciador.cancelar(job_id)
+
+
+def exibir_job_etl(job_id):
+    """Mostra o progresso do job e, ao concluir, anexa os resultados à sessão"""
+    gerenciador = obter_gerenciador_jobs()
+    job = gerenciador.estado(job_id)
+    
+    if job is None:
+        st.warning("⚠️ Processamento não encontrado (o servidor pode ter sido reiniciado)")
+        st.session_state.pop('job_etl_id', None)
+        st.query_params.pop('job', None)
+        return
+    
+    if job['status'] in (jobs_etl.NA_FILA, jobs_etl.EXECUTANDO):
+        painel_progresso_job(job_id)
+        return
+    
+    for mensagem in job['mensagens']:
+        st.info(mensagem)
+    
+    if job['status'] == jobs_etl.CANCELADO:
+        st.warning("⛔ Processamento cancelado")
+        return
+    
+    if job['status'] == jobs_etl.ERRO:
+        st.error(f"❌ Erro: {job['erro']}")
+        with st.expander("Detalhes do erro"):
+            st.code(job['traceback'])
+        return
+    
+    metadados = job['metadados']
+    if st.session_state.get('job_etl_anexado') != job_id:
+        anexar_resultado_sessao(job['resultado'], metadados, job['chave_cache'])
+        st.session_state['job_etl_anexado'] = job_id
+    
+    st.success("✅ Processamento concluído!")
+    exibir_resumo_etl(job['resultado']['df_pacientes'], job['resultado']['df_longitudinal'],
+                      metadados['extract_fr'])
+
+
 # =============================================================================
 # INTERFACE PRINCIPAL
 # =============================================================================
@@ -877,6 +1306,7 @@ def main():
     # Sidebar
     with st.sidebar:
         st.markdown("### ⚙️ Configurações")
+        st.caption(f"Regras de extração: versão {REGISTRO.versao} (impressão {REGISTRO.impressao})")
         st.markdown("---")
     
     uploaded_file = st.sidebar.file_uploader(
@@ -885,7 +1315,9 @@ def main():
         help="Faça upload da planilha com os prontuários médicos"
     )
     
-    if uploaded_file is None:
+    exibir_execucoes_salvas()
+    
+    if uploaded_file is None and 'execucao_aberta' not in st.session_state:
         st.info("👈 Por favor, faça upload de um arquivo na barra lateral para começar.")
         
         with st.expander("📋 Estrutura de dados esperada"):
@@ -904,21 +1336,44 @@ def main():
 
         return
     
-    # Carregar dados
-    try:
-        if uploaded_file.name.endswith('.csv'):
-            df = pd.read_csv(uploaded_file)
-        else:
-            df = pd.read_excel(uploaded_file)
-        
-        if 'data_hora' in df.columns:
-            df['data_hora'] = pd.to_datetime(df['data_hora'], errors='coerce')
+    if uploaded_file is None:
+        # Execução salva reaberta sem novo upload: a visão geral usa os dados processados
+        execucao = st.session_state['execucao_aberta']
+        hash_arquivo = execucao['hash_entrada']
+        nome_arquivo = execucao['nome_arquivo']
+        df = st.session_state['df_processed']
+        st.sidebar.info(f"📂 Execução salva: {nome_arquivo} ({len(df)} registros)")
+    else:
+        nome_arquivo = uploaded_file.name
         
-        st.sidebar.success(f"✅ {len(df)} registros carregados")
+        # Hash do conteúdo (chave do cache compartilhado), calculado uma vez por arquivo enviado
+        id_arquivo = getattr(uploaded_file, 'file_id', None) or f"{uploaded_file.name}:{uploaded_file.size}"
+        if st.session_state.get('hash_arquivo_id') != id_arquivo:
+            st.session_state['hash_arquivo'] = hash_conteudo(uploaded_file.getvalue())
+            st.session_state['hash_arquivo_id'] = id_arquivo
+            st.session_state.pop('execucao_aberta', None)
+        hash_arquivo = st.session_state['hash_arquivo']
         
-    except Exception as e:
-        st.sidebar.error(f"❌ Erro: {str(e)}")
-        return
+        # Carregar dados
+        try:
+            if uploaded_file.name.endswith('.csv'):
+                df = pd.read_csv(uploaded_file)
+            else:
+                df = pd.read_excel(uploaded_file)
+            
+            if 'data_hora' in df.columns:
+                df['data_hora'] = pd.to_datetime(df['data_hora'], errors='coerce')
+            if 'descricao' in df.columns:
+                df['descricao'] = para_arrow(df['descricao'])
+            
+            st.sidebar.success(f"✅ {len(df)} registros carregados")
+            
+        except Exception as e:
+            st.sidebar.error(f"❌ Erro: {str(e)}")
+            return
+    
+    if 'df_pacientes' in st.session_state:
+        exibir_filtro_coorte()
     
     # =============================================================================
     # TABS PRINCIPAIS
@@ -992,7 +1447,9 @@ def main():
         
         # Verificar requisitos
         required_cols = ['paciente', 'tipo', 'descricao', 'data_hora']
-        missing_cols = [col for col in required_cols if col not in df.columns]
+        # Execução salva reaberta: o texto está no armazém comprimido (texto_id)
+        missing_cols = [col for col in required_cols if col not in df.columns
+                        and not (col == 'descricao' and 'texto_id' in df.columns)]
         
         if missing_cols:
             st.error(f"❌ Colunas obrigatórias ausentes: {', '.join(missing_cols)}")
@@ -1109,7 +1566,7 @@ def main():
                 haq_threshold = st.number_input("Redução HAQ", min_value=0.0, max_value=3.0, 
                                                  value=0.35, step=0.05, key='haq_threshold',
                                                  label_visibility='collapsed')
-            improvement_criteria['haq'] = lambda v0, v1, t=haq_threshold: v1 <= v0 - t
+            improvement_criteria['haq'] = {'tipo': 'reducao_absoluta', 'valor': haq_threshold}
         
         if 'das28' in selected_markers:
             col1, col2 = st.columns([3, 1])
@@ -1119,7 +1576,7 @@ def main():
                 das28_pct = st.number_input("% Redução DAS28", min_value=0, max_value=100,
                                             value=50, step=5, key='das28_pct',
                                             label_visibility='collapsed')
-            improvement_criteria['das28'] = lambda v0, v1, p=das28_pct: v1 <= v0 * (1 - p/100)
+            improvement_criteria['das28'] = {'tipo': 'reducao_percentual', 'valor': das28_pct}
         
         if 'cdai' in selected_markers:
             col1, col2 = st.columns([3, 1])
@@ -1129,7 +1586,7 @@ def main():
                 cdai_threshold = st.number_input("Redução CDAI", min_value=0.0, max_value=50.0,
                                                   value=10.0, step=1.0, key='cdai_threshold',
                                                   label_visibility='collapsed')
-            improvement_criteria['cdai'] = lambda v0, v1, t=cdai_threshold: v1 <= v0 - t
+            improvement_criteria['cdai'] = {'tipo': 'reducao_absoluta', 'valor': cdai_threshold}
         
         st.markdown("---")
         
@@ -1143,130 +1600,110 @@ def main():
         
         st.markdown("---")
         
+        # --- TEXTO DOS PRONTUÁRIOS ---
+        st.markdown("#### 🗜️ 6. Texto dos Prontuários")
+        comprimir_texto = st.checkbox(
+            "Guardar o texto comprimido, fora das tabelas de análise", value=True,
+            help="As análises não usam o texto livre após a extração; ele volta às tabelas apenas na exportação"
+        )
+        dedup_normalizada = st.checkbox(
+            "Considerar duplicadas notas que diferem só em maiúsculas ou espaços", value=False,
+            help="A deduplicação compara uma impressão digital de 64 bits de cada nota"
+        )
+        reaproveitar_quase_duplicatas = st.checkbox(
+            "Reaproveitar a extração de notas copiadas da anterior", value=False,
+            help="Evoluções quase idênticas à anterior do paciente, sem alteração perto de um termo "
+                 "procurado pelos extratores, recebem o mesmo resultado sem nova extração"
+        )
+        indexar_texto = st.checkbox(
+            "Indexar o texto para a busca por termos", value=False,
+            help="Cria um índice das palavras das notas (sem acentos) usado pela busca na aba de dados; "
+                 "em bases grandes o índice aumenta o tempo do ETL e a memória ocupada"
+        )
+        guardar_evidencias = st.checkbox(
+            "Guardar as evidências de cada valor extraído", value=True,
+            help="Registra o trecho da nota e a regra que decidiram cada valor, exibidos na aba de dados"
+        )
+        contar_regras = st.checkbox(
+            "Medir o custo de cada regra de extração", value=True,
+            help="Conta avaliações, acertos e tempo de cada padrão, exibidos na aba de dados"
+        )
+        perfil_notas = st.number_input(
+            "Notas mais lentas a registrar (0 = desligado)", min_value=0, max_value=1000, value=0, step=10,
+            help="Cronometra cada nota em cada extrator e guarda as mais lentas, com a regra que dominou o tempo"
+        )
+        
+        st.markdown("---")
+        
         # BOTÃO DE PROCESSAMENTO
         col1, col2, col3 = st.columns([1, 2, 1])
         with col2:
-            process_button = st.button("🚀 Processar Dados (ETL)", type="primary", use_container_width=True)
+            # Uma execução reaberta só tem as tabelas já processadas (deduplicadas,
+            # filtradas e extraídas): reprocessá-las daria outro resultado sob a
+            # chave do arquivo original. É preciso enviar o arquivo de novo.
+            process_button = st.button("🚀 Processar Dados (ETL)", type="primary", use_container_width=True,
+                                       disabled=uploaded_file is None)
+            if uploaded_file is None:
+                st.caption("Para reprocessar uma execução salva, envie o arquivo original na barra lateral")
         
         # =============================================================================
         # PROCESSAMENTO ETL
         # =============================================================================
         
         if process_button:
-            with st.spinner("⚙️ Processando dados..."):
-                try:
-                    df_processed = df.copy()
-                    
-                    # Remover duplicatas
-                    initial_len = len(df_processed)
-                    df_processed = df_processed.drop_duplicates(subset=['descricao']).reset_index(drop=True)
-                    st.info(f"🗑️ Removidas {initial_len - len(df_processed)} duplicatas")
-                    
-                    # ETAPA 0: Fator Reumatoide (NOVO)
-                    if extract_fr:
-                        st.info("🧬 Extraindo Fator Reumatoide...")
-                        df_processed = extract_fator_reumatoide_df(df_processed)
-                    
-                    # ETAPA 1: Marcadores clínicos
-                    if selected_markers:
-                        st.info("📊 Extraindo marcadores clínicos...")
-                        df_processed = extract_marcadores(df_processed, list(selected_markers.keys()))
-                    
-                    # ETAPA 2: Comorbidades
-                    if selected_comorbidities:
-                        st.info("🏥 Identificando comorbidades...")
-                        df_processed = extract_comorbidades(df_processed, list(selected_comorbidities.keys()))
-                    
-                    # ETAPA 3: Medicamentos com status (NOVO v3.1)
-                    if selected_medications:
-                        st.info("💊 Identificando medicamentos (com status SIM/PRÉVIO/NÃO)...")
-                        df_processed = extract_medicamentos_v3(df_processed, selected_medications)
-                    
-                    # ETAPA 3.1: MTX detalhado
-                    if 'metotrexato' in selected_medications:
-                        st.info("💊 Extraindo detalhes do Metotrexato...")
-                        df_processed = extract_mtx_detalhado(df_processed)
-                    
-                    # ETAPA 3.2: Biológicos detalhado
-                    if selected_biologicos:
-                        st.info("🧬 Extraindo detalhes de Biológicos...")
-                        df_processed = extract_biologicos_detalhado(df_processed, selected_biologicos)
-                    
-                    # ETAPA 4: Limpeza numérica
-                    st.info("🧹 Limpando dados numéricos...")
-                    df_processed = clean_numeric_columns(df_processed, list(selected_markers.keys()))
-                    
-                    # ETAPA 5: Filtrar pacientes válidos
-                    st.info("🔍 Filtrando pacientes válidos...")
-                    tipo_counts = df_processed.groupby('paciente')['tipo'].nunique()
-                    valid_patients = tipo_counts[tipo_counts >= 2].index
-                    df_processed = df_processed[df_processed['paciente'].isin(valid_patients)].reset_index(drop=True)
-                    st.success(f"✅ {len(valid_patients)} pacientes válidos")
-                    
-                    # ETAPA 6: Base longitudinal
-                    st.info("📈 Criando base longitudinal...")
-                    
-                    tipos_disponiveis = df_processed['tipo'].unique()
-                    baseline_type = 'ANAMNESE' if 'ANAMNESE' in tipos_disponiveis else tipos_disponiveis[0]
-                    followup_type = 'EVOLUCAO' if 'EVOLUCAO' in tipos_disponiveis else tipos_disponiveis[1]
-                    
-                    st.info(f"📌 Baseline: {baseline_type} | Follow-up: {followup_type}")
-                    
-                    df_longitudinal = create_longitudinal_data(
-                        df_processed, baseline_type, followup_type,
-                        list(selected_markers.keys())
-                    )
-                    
-                    # ETAPA 7: Calcular melhora
-                    if improvement_criteria:
-                        st.info("🎯 Calculando melhora clínica...")
-                        df_longitudinal = calculate_improvement(df_longitudinal, improvement_criteria)
-                    
-                    # ETAPA 8: Filtrar tempo mínimo
-                    if min_treatment_days > 0 and 'tempo_tratamento_dias' in df_longitudinal.columns:
-                        before_filter = len(df_longitudinal)
-                        df_longitudinal = df_longitudinal[
-                            df_longitudinal['tempo_tratamento_dias'] >= min_treatment_days
-                        ].reset_index(drop=True)
-                        st.info(f"⏱️ Removidos {before_filter - len(df_longitudinal)} pacientes com <{min_treatment_days} dias")
-                    
-                    # Salvar no session_state
-                    st.session_state['df_processed'] = df_processed
-                    st.session_state['df_longitudinal'] = df_longitudinal
-                    st.session_state['selected_markers'] = selected_markers
-                    st.session_state['selected_comorbidities'] = selected_comorbidities
-                    st.session_state['selected_medications'] = selected_medications
-                    st.session_state['selected_biologicos'] = selected_biologicos
-                    
-                    st.success("✅ Processamento concluído!")
-                    
-                    # Resumo
-                    st.markdown("### 📋 Resumo do Processamento")
-                    
-                    col1, col2, col3, col4 = st.columns(4)
-                    col1.metric("Pacientes Finais", len(df_longitudinal))
-                    
-                    if 'improvement' in df_longitudinal.columns:
-                        improved = df_longitudinal['improvement'].sum()
-                        col2.metric("Melhoraram", improved)
-                        pct = (improved / len(df_longitudinal) * 100) if len(df_longitudinal) > 0 else 0
-                        col3.metric("% Melhora", f"{pct:.1f}%")
-                    
-                    if 'tempo_tratamento_dias' in df_longitudinal.columns:
-                        col4.metric("Tempo Médio", f"{df_longitudinal['tempo_tratamento_dias'].mean():.0f} dias")
-                    
-                    # Resumo FR (novo)
-                    if extract_fr and 'fr_resultado' in df_processed.columns:
-                        st.markdown("#### 🧬 Fator Reumatoide")
-                        fr_by_patient = df_processed.groupby('paciente')['fr_resultado'].first()
-                        col1, col2, col3 = st.columns(3)
-                        col1.metric("FR Positivo", (fr_by_patient == 'POSITIVO').sum())
-                        col2.metric("FR Negativo", (fr_by_patient == 'NEGATIVO').sum())
-                        col3.metric("Não Informado", (fr_by_patient == 'NÃO INFORMADO').sum())
-                    
-                except Exception as e:
-                    st.error(f"❌ Erro: {str(e)}")
-                    st.exception(e)
+            config_etl = {
+                'extrair_fr': extract_fr,
+                'marcadores': list(selected_markers.keys()),
+                'comorbidades': list(selected_comorbidities.keys()),
+                'medicamentos': selected_medications,
+                'criterios_melhora': improvement_criteria,
+                'dias_minimos_tratamento': min_treatment_days,
+                'texto_descricao': 'comprimido' if comprimir_texto else 'arrow',
+                'deduplicacao': 'normalizada' if dedup_normalizada else 'exata',
+                'reaproveitar_quase_duplicatas': reaproveitar_quase_duplicatas,
+                'indice_busca': indexar_texto,
+                'evidencias': guardar_evidencias,
+                'contadores_regras': contar_regras,
+                'perfil_notas': int(perfil_notas),
+            }
+            
+            metadados_etl = {
+                'extract_fr': extract_fr,
+                'selected_markers': selected_markers,
+                'selected_comorbidities': selected_comorbidities,
+                'selected_medications': selected_medications,
+                'selected_biologicos': selected_biologicos,
+            }
+            metadados_etl['nome_arquivo'] = nome_arquivo
+            chave = (hash_arquivo, impressao_config(config_etl))
+            resultado_cache = obter_cache_resultados().obter(chave)
+            
+            # Sem resultado em memória: procurar execução idêntica salva em disco
+            armazem = obter_armazem_artefatos()
+            id_salvo = armazem.buscar(hash_arquivo, config_etl) if resultado_cache is None else None
+            if id_salvo is not None:
+                resultado_cache, _ = armazem.abrir(id_salvo)
+                obter_cache_resultados().guardar(chave, resultado_cache)
+            
+            if resultado_cache is not None:
+                anexar_resultado_sessao(resultado_cache, metadados_etl, chave)
+                st.session_state.pop('job_etl_id', None)
+                st.query_params.pop('job', None)
+                st.success("⚡ Resultado reaproveitado: este arquivo já foi processado com a mesma configuração")
+                exibir_resumo_etl(resultado_cache['df_pacientes'], resultado_cache['df_longitudinal'], extract_fr)
+            else:
+                job_id = obter_gerenciador_jobs().submeter(
+                    df, config_etl, metadados=metadados_etl, chave_cache=chave,
+                    ao_concluir=lambda resultado, h=hash_arquivo, c=config_etl, m=metadados_etl:
+                        armazem.salvar(h, c, resultado, m, banco=USAR_BANCO_COORTES)
+                )
+                st.session_state['job_etl_id'] = job_id
+                # Guardar o id na URL permite reencontrar o job após recarregar a página
+                st.query_params['job'] = job_id
+        
+        job_id = st.session_state.get('job_etl_id') or st.query_params.get('job')
+        if job_id:
+            exibir_job_etl(job_id)
     
     # =============================================================================
     # TAB 3: ANÁLISE EXPLORATÓRIA
@@ -1279,7 +1716,35 @@ def main():
             st.warning("⚠️ Execute o processamento ETL primeiro (Tab: Configurar ETL)")
             return
         
-        df_analysis = st.session_state['df_processed']
+        df_analysis, df_pacientes, _, impressao = dados_analise()
+        if st.session_state.get('filtro_coorte'):
+            st.info(f"🎯 Coorte filtrada: {st.session_state['filtro_coorte']} ({len(df_pacientes)} pacientes)")
+        
+        markers = list(st.session_state.get('selected_markers', {}).keys())
+        available_markers = [m for m in markers if m in df_analysis.columns]
+        comorb_cols = list(st.session_state.get('selected_comorbidities', {}).keys())
+        available_comorb = [c for c in comorb_cols if c in df_analysis.columns]
+        selected_meds = st.session_state.get('selected_medications', [])
+        available_meds = [m for m in selected_meds if m in df_analysis.columns]
+        
+        # Figuras independentes da seleção do usuário: construídas em paralelo e memorizadas
+        tarefas = {'demografia': ((), lambda: figuras_demografia(df_pacientes))}
+        if 'fr_resultado' in df_analysis.columns:
+            tarefas['fator_reumatoide'] = ((), lambda: figuras_fator_reumatoide(df_pacientes))
+        if len(available_markers) > 1:
+            tarefas['correlacao'] = (tuple(available_markers),
+                                     lambda: figura_correlacao_marcadores(df_analysis, available_markers))
+        if available_comorb:
+            tarefas['comorbidades'] = (tuple(available_comorb),
+                                       lambda: figuras_comorbidades(df_pacientes, available_comorb))
+        if 'uso_mtx' in df_analysis.columns:
+            tarefas['mtx'] = ((), lambda: figuras_mtx(df_pacientes, df_analysis))
+        if 'uso_biologico' in df_analysis.columns:
+            tarefas['biologicos'] = ((), lambda: figuras_biologicos(df_pacientes))
+        if available_meds:
+            tarefas['medicamentos'] = (tuple(available_meds),
+                                       lambda: figuras_medicamentos(df_pacientes, available_meds))
+        figuras = obter_cache_figuras().construir(impressao, tarefas)
         
         # Subtabs para diferentes análises
         subtab1, subtab2, subtab3, subtab4, subtab5 = st.tabs([
@@ -1293,96 +1758,57 @@ def main():
         # --- SUBTAB 1: DEMOGRAFIA ---
         with subtab1:
             st.markdown("#### 👥 Análise Demográfica")
+            demografia = figuras['demografia']
             
             col1, col2 = st.columns(2)
             
             with col1:
-                if 'idade' in df_analysis.columns:
+                if 'idade' in demografia:
                     st.markdown("**Distribuição de Idades**")
-                    fig = px.histogram(df_analysis, x='idade', nbins=30,
-                                       color_discrete_sequence=['#3b82f6'])
-                    fig.update_layout(xaxis_title='Idade', yaxis_title='Frequência', height=400)
-                    st.plotly_chart(fig, use_container_width=True)
+                    st.plotly_chart(demografia['idade'], use_container_width=True)
                     
+                    media, mediana, desvio = demografia['idade_stats']
                     col_a, col_b, col_c = st.columns(3)
-                    col_a.metric("Média", f"{df_analysis['idade'].mean():.1f}")
-                    col_b.metric("Mediana", f"{df_analysis['idade'].median():.0f}")
-                    col_c.metric("Desvio Padrão", f"{df_analysis['idade'].std():.1f}")
+                    col_a.metric("Média", f"{media:.1f}")
+                    col_b.metric("Mediana", f"{mediana:.0f}")
+                    col_c.metric("Desvio Padrão", f"{desvio:.1f}")
             
             with col2:
-                if 'sexo' in df_analysis.columns:
+                if 'sexo' in demografia:
                     st.markdown("**Distribuição por Sexo**")
-                    sexo_counts = df_analysis['sexo'].value_counts()
-                    fig = go.Figure(data=[go.Pie(
-                        labels=sexo_counts.index,
-                        values=sexo_counts.values,
-                        marker=dict(colors=['#ff9999', '#66b3ff']),
-                        textinfo='label+percent+value'
-                    )])
-                    fig.update_layout(height=400)
-                    st.plotly_chart(fig, use_container_width=True)
+                    st.plotly_chart(demografia['sexo'], use_container_width=True)
             
-            if 'idade' in df_analysis.columns and 'sexo' in df_analysis.columns:
+            if 'idade_sexo' in demografia:
                 st.markdown("**Distribuição de Idade por Sexo**")
-                fig = px.histogram(df_analysis, x='idade', color='sexo', nbins=25,
-                                   barmode='stack',
-                                   color_discrete_map={'F': '#ff9999', 'M': '#66b3ff'})
-                fig.update_layout(height=400)
-                st.plotly_chart(fig, use_container_width=True)
+                st.plotly_chart(demografia['idade_sexo'], use_container_width=True)
         
         # --- SUBTAB 2: FATOR REUMATOIDE (NOVO) ---
         with subtab2:
             st.markdown("#### 🧬 Análise do Fator Reumatoide")
             
-            if 'fr_resultado' not in df_analysis.columns:
+            if 'fator_reumatoide' not in figuras:
                 st.info("Fator Reumatoide não foi extraído. Ative a opção na configuração do ETL.")
             else:
-                # Por paciente único
-                fr_by_patient = df_analysis.groupby('paciente').agg({
-                    'fr_resultado': 'first',
-                    'fr_valor': 'first',
-                    'fr_origem': 'first'
-                }).reset_index()
+                fator_reumatoide = figuras['fator_reumatoide']
                 
                 col1, col2 = st.columns(2)
                 
                 with col1:
                     st.markdown("**Distribuição do FR**")
-                    fr_counts = fr_by_patient['fr_resultado'].value_counts()
-                    fig = go.Figure(data=[go.Pie(
-                        labels=fr_counts.index,
-                        values=fr_counts.values,
-                        marker=dict(colors=['#ef4444', '#22c55e', '#9ca3af']),
-                        textinfo='label+percent+value',
-                        hole=0.4
-                    )])
-                    fig.update_layout(height=400)
-                    st.plotly_chart(fig, use_container_width=True)
+                    st.plotly_chart(fator_reumatoide['distribuicao'], use_container_width=True)
                 
                 with col2:
                     st.markdown("**Origem da Informação**")
-                    origem_counts = fr_by_patient['fr_origem'].dropna().value_counts()
-                    fig = px.bar(x=origem_counts.index, y=origem_counts.values,
-                                 color=origem_counts.index,
-                                 color_discrete_map={'LAB': '#3b82f6', 'TEXTO': '#06b6d4', 'CID': '#8b5cf6'})
-                    fig.update_layout(height=400, showlegend=False,
-                                      xaxis_title='Origem', yaxis_title='Pacientes')
-                    st.plotly_chart(fig, use_container_width=True)
+                    st.plotly_chart(fator_reumatoide['origem'], use_container_width=True)
                 
                 # Valores numéricos
-                fr_valores = fr_by_patient[fr_by_patient['fr_valor'].notna()]
-                if len(fr_valores) > 0:
+                if 'valores_hist' in fator_reumatoide:
                     st.markdown("**Valores Laboratoriais de FR**")
                     col1, col2 = st.columns(2)
                     with col1:
-                        fig = px.histogram(fr_valores, x='fr_valor', nbins=20,
-                                           color_discrete_sequence=['#3b82f6'])
-                        fig.update_layout(xaxis_title='Valor FR (UI/mL)', yaxis_title='Frequência')
-                        st.plotly_chart(fig, use_container_width=True)
+                        st.plotly_chart(fator_reumatoide['valores_hist'], use_container_width=True)
                     with col2:
-                        fig = px.box(fr_valores, y='fr_valor', color_discrete_sequence=['#3b82f6'])
-                        fig.update_layout(yaxis_title='Valor FR (UI/mL)')
-                        st.plotly_chart(fig, use_container_width=True)
+                        st.plotly_chart(fator_reumatoide['valores_box'], use_container_width=True)
         
         # --- SUBTAB 3: MARCADORES ---
         with subtab3:
@@ -1390,66 +1816,38 @@ def main():
             
             if 'selected_markers' not in st.session_state:
                 st.info("Nenhum marcador configurado")
+            elif not available_markers:
+                st.warning("Nenhum marcador foi extraído dos dados")
             else:
-                markers = list(st.session_state['selected_markers'].keys())
-                available_markers = [m for m in markers if m in df_analysis.columns]
+                selected_marker = st.selectbox("Selecione o marcador:", available_markers,
+                                                format_func=lambda x: x.upper())
+                
+                marcador = obter_cache_figuras().construir(impressao, {
+                    'marcador': ((selected_marker,), lambda: figuras_marcador(df_analysis, selected_marker))
+                })['marcador']
                 
-                if not available_markers:
-                    st.warning("Nenhum marcador foi extraído dos dados")
+                if marcador is None:
+                    st.warning(f"Nenhum dado disponível para {selected_marker.upper()}")
                 else:
-                    selected_marker = st.selectbox("Selecione o marcador:", available_markers,
-                                                    format_func=lambda x: x.upper())
-                    
-                    marker_data = df_analysis[selected_marker].dropna()
+                    col1, col2 = st.columns(2)
                     
-                    if len(marker_data) == 0:
-                        st.warning(f"Nenhum dado disponível para {selected_marker.upper()}")
-                    else:
-                        col1, col2 = st.columns(2)
-                        
-                        with col1:
-                            fig = px.histogram(marker_data, nbins=30,
-                                               color_discrete_sequence=['#22c55e'])
-                            fig.update_layout(title=f"Distribuição de {selected_marker.upper()}",
-                                              xaxis_title=selected_marker.upper(),
-                                              yaxis_title='Frequência', height=350)
-                            st.plotly_chart(fig, use_container_width=True)
-                            
-                            stats_df = pd.DataFrame({
-                                'Métrica': ['Média', 'Mediana', 'Desvio Padrão', 'Mínimo', 'Máximo'],
-                                'Valor': [f"{marker_data.mean():.2f}", f"{marker_data.median():.2f}",
-                                          f"{marker_data.std():.2f}", f"{marker_data.min():.2f}",
-                                          f"{marker_data.max():.2f}"]
-                            })
-                            st.dataframe(stats_df, use_container_width=True, hide_index=True)
-                        
-                        with col2:
-                            fig = px.box(marker_data, y=marker_data.values,
-                                         color_discrete_sequence=['#22c55e'])
-                            fig.update_layout(title=f"Box Plot - {selected_marker.upper()}",
-                                              yaxis_title=selected_marker.upper(), height=350)
-                            st.plotly_chart(fig, use_container_width=True)
-                            
-                            total_records = len(df_analysis)
-                            available = len(marker_data)
-                            st.metric("Registros Disponíveis", f"{available} / {total_records}")
-                            st.metric("% Completo", f"{(available/total_records*100):.1f}%")
+                    with col1:
+                        st.plotly_chart(marcador['hist'], use_container_width=True)
+                        st.dataframe(marcador['stats'], use_container_width=True, hide_index=True)
                     
-                    # Matriz de correlação
-                    if len(available_markers) > 1:
-                        st.markdown("---")
-                        st.markdown("**Matriz de Correlação dos Marcadores**")
-                        markers_df = df_analysis[available_markers].apply(pd.to_numeric, errors='coerce')
-                        corr_matrix = markers_df.corr()
+                    with col2:
+                        st.plotly_chart(marcador['box'], use_container_width=True)
                         
-                        fig = px.imshow(corr_matrix,
-                                        labels=dict(color="Correlação"),
-                                        x=[m.upper() for m in corr_matrix.columns],
-                                        y=[m.upper() for m in corr_matrix.index],
-                                        color_continuous_scale='RdBu_r',
-                                        zmin=-1, zmax=1)
-                        fig.update_layout(height=500)
-                        st.plotly_chart(fig, use_container_width=True)
+                        total_records = len(df_analysis)
+                        available = marcador['disponiveis']
+                        st.metric("Registros Disponíveis", f"{available} / {total_records}")
+                        st.metric("% Completo", f"{(available/total_records*100):.1f}%")
+                
+                # Matriz de correlação
+                if 'correlacao' in figuras:
+                    st.markdown("---")
+                    st.markdown("**Matriz de Correlação dos Marcadores**")
+                    st.plotly_chart(figuras['correlacao'], use_container_width=True)
         
         # --- SUBTAB 4: COMORBIDADES ---
         with subtab4:
@@ -1457,53 +1855,31 @@ def main():
             
             if 'selected_comorbidities' not in st.session_state:
                 st.info("Nenhuma comorbidade configurada")
+            elif not available_comorb:
+                st.warning("Nenhuma comorbidade foi identificada")
             else:
-                comorb_cols = list(st.session_state['selected_comorbidities'].keys())
-                available_comorb = [c for c in comorb_cols if c in df_analysis.columns]
+                comorbidades = figuras['comorbidades']
+                st.plotly_chart(comorbidades['frequencia'], use_container_width=True)
                 
-                if not available_comorb:
-                    st.warning("Nenhuma comorbidade foi identificada")
-                else:
-                    # Por paciente único
-                    comorb_by_patient = df_analysis.groupby('paciente')[available_comorb].max()
-                    comorb_counts = {c.upper(): int(comorb_by_patient[c].sum()) for c in available_comorb}
-                    
-                    fig = px.bar(x=list(comorb_counts.keys()), y=list(comorb_counts.values()),
-                                 color=list(comorb_counts.values()),
-                                 color_continuous_scale='Reds')
-                    fig.update_layout(title="Frequência de Comorbidades",
-                                      xaxis_title='Comorbidade', yaxis_title='Pacientes',
-                                      showlegend=False, height=400)
-                    st.plotly_chart(fig, use_container_width=True)
-                    
-                    col1, col2 = st.columns(2)
-                    
-                    with col1:
-                        st.markdown("**Frequência Absoluta:**")
-                        freq_df = pd.DataFrame({
-                            'Comorbidade': list(comorb_counts.keys()),
-                            'Pacientes': list(comorb_counts.values())
-                        }).sort_values('Pacientes', ascending=False)
-                        st.dataframe(freq_df, use_container_width=True, hide_index=True)
-                    
-                    with col2:
-                        st.markdown("**Frequência Relativa:**")
-                        total_patients = df_analysis['paciente'].nunique()
-                        freq_df['%'] = (freq_df['Pacientes'] / total_patients * 100).round(2)
-                        st.dataframe(freq_df[['Comorbidade', '%']], use_container_width=True, hide_index=True)
-                    
-                    # Comorbidades múltiplas
-                    st.markdown("---")
-                    st.markdown("**Análise de Comorbidades Múltiplas**")
-                    comorb_by_patient['num_comorbidades'] = comorb_by_patient.sum(axis=1)
-                    comorb_dist = comorb_by_patient['num_comorbidades'].value_counts().sort_index()
-                    
-                    fig = px.bar(x=comorb_dist.index, y=comorb_dist.values,
-                                 color=comorb_dist.values, color_continuous_scale='Oranges')
-                    fig.update_layout(title="Número de Comorbidades por Paciente",
-                                      xaxis_title='Número de Comorbidades',
-                                      yaxis_title='Pacientes', showlegend=False)
-                    st.plotly_chart(fig, use_container_width=True)
+                freq_df = comorbidades['tabela']
+                col1, col2 = st.columns(2)
+                
+                with col1:
+                    st.markdown("**Frequência Absoluta:**")
+                    st.dataframe(freq_df[['Comorbidade', 'Pacientes']], use_container_width=True, hide_index=True)
+                
+                with col2:
+                    st.markdown("**Frequência Relativa:**")
+                    st.dataframe(freq_df[['Comorbidade', '%']], use_container_width=True, hide_index=True)
+                
+                # Comorbidades múltiplas
+                st.markdown("---")
+                st.markdown("**Análise de Comorbidades Múltiplas**")
+                st.plotly_chart(comorbidades['multiplas'], use_container_width=True)
+                
+                if len(comorbidades['combinacoes']) > 0:
+                    st.markdown("**Combinações mais frequentes (2 ou mais comorbidades):**")
+                    st.dataframe(comorbidades['combinacoes'], use_container_width=True, hide_index=True)
         
         # --- SUBTAB 5: MEDICAMENTOS ---
         with subtab5:
@@ -1516,129 +1892,63 @@ def main():
                 
                 # MTX
                 with med_tabs[0]:
-                    if 'uso_mtx' in df_analysis.columns:
-                        mtx_by_patient = df_analysis.groupby('paciente')['uso_mtx'].first()
-                        mtx_counts = mtx_by_patient.value_counts()
+                    if 'mtx' in figuras:
+                        mtx = figuras['mtx']
+                        mtx_counts = mtx['contagens']
                         
                         col1, col2 = st.columns(2)
                         
                         with col1:
                             st.markdown("**Status de Uso do MTX**")
-                            fig = go.Figure(data=[go.Pie(
-                                labels=mtx_counts.index,
-                                values=mtx_counts.values,
-                                marker=dict(colors=['#22c55e', '#f59e0b', '#ef4444']),
-                                textinfo='label+percent+value',
-                                hole=0.4
-                            )])
-                            fig.update_layout(height=350)
-                            st.plotly_chart(fig, use_container_width=True)
+                            st.plotly_chart(mtx['status'], use_container_width=True)
                         
                         with col2:
                             st.markdown("**Estatísticas MTX**")
-                            total = len(mtx_by_patient)
+                            total = mtx['total_pacientes']
                             st.metric("Uso Atual (SIM)", f"{mtx_counts.get('SIM', 0)} ({mtx_counts.get('SIM', 0)/total*100:.1f}%)")
                             st.metric("Uso Prévio", f"{mtx_counts.get('PRÉVIO', 0)} ({mtx_counts.get('PRÉVIO', 0)/total*100:.1f}%)")
                             st.metric("Nunca Usou", f"{mtx_counts.get('NÃO', 0)} ({mtx_counts.get('NÃO', 0)/total*100:.1f}%)")
                         
                         # Dose e via
-                        if 'mtx_dose_mg_semana' in df_analysis.columns:
-                            doses = df_analysis['mtx_dose_mg_semana'].dropna()
-                            if len(doses) > 0:
-                                st.markdown("**Distribuição de Doses de MTX**")
-                                fig = px.histogram(doses, nbins=15, color_discrete_sequence=['#3b82f6'])
-                                fig.update_layout(xaxis_title='Dose (mg/semana)', yaxis_title='Frequência')
-                                st.plotly_chart(fig, use_container_width=True)
+                        if 'doses' in mtx:
+                            st.markdown("**Distribuição de Doses de MTX**")
+                            st.plotly_chart(mtx['doses'], use_container_width=True)
                         
-                        if 'mtx_via' in df_analysis.columns:
-                            via_counts = df_analysis['mtx_via'].dropna().value_counts()
-                            if len(via_counts) > 0:
-                                st.markdown("**Via de Administração**")
-                                fig = px.pie(values=via_counts.values, names=via_counts.index)
-                                st.plotly_chart(fig, use_container_width=True)
+                        if 'via' in mtx:
+                            st.markdown("**Via de Administração**")
+                            st.plotly_chart(mtx['via'], use_container_width=True)
                     else:
                         st.info("MTX não foi configurado para extração")
                 
                 # Biológicos
                 with med_tabs[1]:
-                    if 'uso_biologico' in df_analysis.columns:
-                        bio_by_patient = df_analysis.groupby('paciente').agg({
-                            'uso_biologico': 'first',
-                            'biologico_nome': 'first',
-                            'biologico_grupo': 'first'
-                        }).reset_index()
+                    if 'biologicos' in figuras:
+                        biologicos_fig = figuras['biologicos']
                         
                         col1, col2 = st.columns(2)
                         
                         with col1:
                             st.markdown("**Status de Uso de Biológicos**")
-                            bio_counts = bio_by_patient['uso_biologico'].value_counts()
-                            fig = go.Figure(data=[go.Pie(
-                                labels=bio_counts.index,
-                                values=bio_counts.values,
-                                marker=dict(colors=['#22c55e', '#f59e0b', '#ef4444']),
-                                textinfo='label+percent+value',
-                                hole=0.4
-                            )])
-                            fig.update_layout(height=350)
-                            st.plotly_chart(fig, use_container_width=True)
+                            st.plotly_chart(biologicos_fig['status'], use_container_width=True)
                         
                         with col2:
                             st.markdown("**Biológicos Mais Utilizados**")
-                            nome_counts = bio_by_patient['biologico_nome'].dropna().value_counts().head(10)
-                            fig = px.bar(x=nome_counts.values, y=nome_counts.index,
-                                         orientation='h', color=nome_counts.values,
-                                         color_continuous_scale='Blues')
-                            fig.update_layout(height=350, showlegend=False,
-                                              xaxis_title='Pacientes', yaxis_title='')
-                            st.plotly_chart(fig, use_container_width=True)
+                            st.plotly_chart(biologicos_fig['mais_usados'], use_container_width=True)
                         
                         st.markdown("**Distribuição por Grupo Terapêutico**")
-                        grupo_counts = bio_by_patient['biologico_grupo'].dropna().value_counts()
-                        fig = px.bar(x=grupo_counts.index, y=grupo_counts.values,
-                                     color=grupo_counts.index,
-                                     color_discrete_map={
-                                         'Anti-TNF': '#3b82f6',
-                                         'Anti-IL/Outros': '#06b6d4',
-                                         'JAK Inibidores': '#8b5cf6',
-                                         'Anti-IL17': '#f59e0b'
-                                     })
-                        fig.update_layout(xaxis_title='', yaxis_title='Pacientes', showlegend=False)
-                        st.plotly_chart(fig, use_container_width=True)
+                        st.plotly_chart(biologicos_fig['grupos'], use_container_width=True)
                     else:
                         st.info("Biológicos não foram configurados para extração")
                 
                 # Todos
                 with med_tabs[2]:
-                    selected_meds = st.session_state.get('selected_medications', [])
-                    available_meds = [m for m in selected_meds if m in df_analysis.columns]
-                    
-                    if available_meds:
-                        med_by_patient = df_analysis.groupby('paciente')[available_meds].max()
-                        med_counts = {m.title(): int(med_by_patient[m].sum()) for m in available_meds}
-                        med_counts_sorted = dict(sorted(med_counts.items(), key=lambda x: x[1], reverse=True))
-                        
-                        fig = px.bar(x=list(med_counts_sorted.values()),
-                                     y=list(med_counts_sorted.keys()),
-                                     orientation='h',
-                                     color=list(med_counts_sorted.values()),
-                                     color_continuous_scale='Greens')
-                        fig.update_layout(title="Frequência de Uso de Medicamentos",
-                                          xaxis_title='Pacientes', yaxis_title='',
-                                          showlegend=False, height=max(400, len(med_counts)*30))
-                        st.plotly_chart(fig, use_container_width=True)
+                    if 'medicamentos' in figuras:
+                        st.plotly_chart(figuras['medicamentos']['frequencia'], use_container_width=True)
                         
                         # Politerapia
                         st.markdown("---")
                         st.markdown("**Análise de Politerapia**")
-                        med_by_patient['num_medicamentos'] = med_by_patient.sum(axis=1)
-                        politerapia_counts = med_by_patient['num_medicamentos'].value_counts().sort_index()
-                        
-                        fig = px.bar(x=politerapia_counts.index, y=politerapia_counts.values,
-                                     color=politerapia_counts.values, color_continuous_scale='Purples')
-                        fig.update_layout(xaxis_title='Número de Medicamentos',
-                                          yaxis_title='Pacientes', showlegend=False)
-                        st.plotly_chart(fig, use_container_width=True)
+                        st.plotly_chart(figuras['medicamentos']['politerapia'], use_container_width=True)
     
     # =============================================================================
     # TAB 4: ANÁLISE DE EFICÁCIA
@@ -1651,11 +1961,36 @@ def main():
             st.warning("⚠️ Execute o processamento ETL primeiro")
             return
         
-        df_long = st.session_state['df_longitudinal']
+        _, _, df_long, impressao = dados_analise()
         
         if 'improvement' not in df_long.columns:
             st.warning("⚠️ Nenhum critério de melhora foi configurado")
             return
+        if st.session_state.get('filtro_coorte'):
+            st.info(f"🎯 Coorte filtrada: {st.session_state['filtro_coorte']} ({len(df_long)} pacientes)")
+        biologicos = st.session_state.get('selected_biologicos') or []
+        
+        # Cubo de resposta por subgrupos: uma agregação por base longitudinal
+        cubo = obter_cache_figuras().construir(impressao, {
+            'cubo_resposta': ((), lambda: CuboResposta(df_long))
+        })['cubo_resposta']
+        
+        # Todas as seções que não dependem de seleção na tela: construídas em paralelo
+        # e memorizadas (trocar o marcador abaixo não refaz os agrupamentos)
+        tarefas = {
+            'visao_geral': ((), lambda: figuras_visao_geral_eficacia(df_long)),
+            'subgrupos': ((), lambda: figuras_subgrupos(cubo)),
+        }
+        if biologicos:
+            tarefas.update({
+                'trocas_visao_geral': ((), lambda: figuras_trocas_visao_geral(df_long)),
+                'trocas_matriz': (tuple(biologicos), lambda: figuras_matriz_transicao(df_long, biologicos)),
+                'trocas_abandono': (tuple(biologicos), lambda: figuras_abandono(df_long, biologicos)),
+                'trocas_motivos': (tuple(biologicos), lambda: figuras_motivos_suspensao(df_long, biologicos)),
+                'trocas_sequencias': (tuple(biologicos), lambda: figura_sequencias(df_long, biologicos)),
+                'trocas_eficacia': ((), lambda: figuras_eficacia_pos_troca(df_long)),
+            })
+        figuras = obter_cache_figuras().construir(impressao, tarefas)
         
         # Métricas gerais
         st.markdown("#### 📊 Visão Geral da Eficácia")
@@ -1671,24 +2006,11 @@ def main():
         col1, col2 = st.columns(2)
         
         with col1:
-            fig = go.Figure(data=[go.Pie(
-                labels=['Com Melhora', 'Sem Melhora'],
-                values=[improved, len(df_long) - improved],
-                marker=dict(colors=['#22c55e', '#ef4444']),
-                textinfo='label+percent+value',
-                hole=0.3
-            )])
-            fig.update_layout(title="Distribuição de Resposta", height=400)
-            st.plotly_chart(fig, use_container_width=True)
+            st.plotly_chart(figuras['visao_geral']['resposta'], use_container_width=True)
         
         with col2:
-            if 'tempo_tratamento_dias' in df_long.columns:
-                fig = px.histogram(df_long, x='tempo_tratamento_dias',
-                                   color='improvement', nbins=30, barmode='overlay',
-                                   color_discrete_map={0: '#ef4444', 1: '#22c55e'},
-                                   labels={'tempo_tratamento_dias': 'Dias', 'improvement': 'Melhorou'})
-                fig.update_layout(title="Tempo de Tratamento por Resposta", height=400)
-                st.plotly_chart(fig, use_container_width=True)
+            if 'tempo' in figuras['visao_geral']:
+                st.plotly_chart(figuras['visao_geral']['tempo'], use_container_width=True)
         
         # Evolução dos marcadores
         if 'selected_markers' in st.session_state:
@@ -1703,168 +2025,99 @@ def main():
                 selected_marker_evo = st.selectbox("Marcador para análise:",
                                                     available_t0t1, format_func=lambda x: x.upper())
                 
-                col_t0 = f'{selected_marker_evo}_t0'
-                col_t1 = f'{selected_marker_evo}_t1'
-                
-                df_marker = df_long[[col_t0, col_t1, 'improvement']].dropna()
+                evolucao = obter_cache_figuras().construir(impressao, {
+                    'evolucao': ((selected_marker_evo,),
+                                 lambda: figuras_evolucao_marcador(df_long, selected_marker_evo))
+                })['evolucao']
                 
-                if len(df_marker) > 0:
+                if evolucao is not None:
                     col1, col2 = st.columns(2)
                     
                     with col1:
-                        df_melt = pd.melt(df_marker, id_vars=['improvement'],
-                                          value_vars=[col_t0, col_t1],
-                                          var_name='Tempo', value_name='Valor')
-                        df_melt['Tempo'] = df_melt['Tempo'].map({col_t0: 'Baseline', col_t1: 'Follow-up'})
-                        
-                        fig = px.box(df_melt, x='Tempo', y='Valor', color='improvement',
-                                     color_discrete_map={0: '#ef4444', 1: '#22c55e'},
-                                     labels={'improvement': 'Melhorou'})
-                        fig.update_layout(title=f"Comparação {selected_marker_evo.upper()}", height=400)
-                        st.plotly_chart(fig, use_container_width=True)
+                        st.plotly_chart(evolucao['comparacao'], use_container_width=True)
                     
                     with col2:
-                        df_marker['mudanca'] = df_marker[col_t1] - df_marker[col_t0]
-                        
-                        fig = px.scatter(df_marker, x=col_t0, y=col_t1, color='improvement',
-                                         color_discrete_map={0: '#ef4444', 1: '#22c55e'},
-                                         hover_data=['mudanca'],
-                                         labels={'improvement': 'Melhorou'})
-                        
-                        max_val = max(df_marker[col_t0].max(), df_marker[col_t1].max())
-                        min_val = min(df_marker[col_t0].min(), df_marker[col_t1].min())
-                        fig.add_shape(type='line', x0=min_val, y0=min_val, x1=max_val, y1=max_val,
-                                      line=dict(color='gray', dash='dash'))
-                        fig.update_layout(title=f"Evolução Individual", height=400)
-                        st.plotly_chart(fig, use_container_width=True)
+                        st.plotly_chart(evolucao['individual'], use_container_width=True)
         
         # Análise por subgrupos
         st.markdown("---")
         st.markdown("#### 👥 Análise por Subgrupos")
         
-        subtab_sex, subtab_age, subtab_fr, subtab_comorb, subtab_meds, subtab_trocas = st.tabs([
-            "Por Sexo", "Por Idade", "Por FR", "Por Comorbidades", "Por Medicamentos", "🔄 Análise de Trocas"
+        subgrupos = figuras['subgrupos']
+        
+        subtab_sex, subtab_age, subtab_fr, subtab_comorb, subtab_meds, subtab_comb, subtab_trocas = st.tabs([
+            "Por Sexo", "Por Idade", "Por FR", "Por Comorbidades", "Por Medicamentos",
+            "🔀 Combinações", "🔄 Análise de Trocas"
         ])
         
         with subtab_sex:
-            if 'sexo' in df_long.columns:
-                response_by_sex = df_long.groupby('sexo')['improvement'].agg(['sum', 'count'])
-                response_by_sex['taxa'] = (response_by_sex['sum'] / response_by_sex['count'] * 100)
+            if 'sexo' in subgrupos:
+                st.plotly_chart(subgrupos['sexo']['figura'], use_container_width=True)
                 
-                fig = px.bar(x=response_by_sex.index, y=response_by_sex['taxa'],
-                             color=response_by_sex['taxa'], color_continuous_scale='Blues',
-                             text=response_by_sex['taxa'].round(1))
-                fig.update_traces(texttemplate='%{text}%', textposition='outside')
-                fig.update_layout(title="Taxa de Resposta por Sexo",
-                                  xaxis_title='Sexo', yaxis_title='Taxa (%)', showlegend=False)
-                st.plotly_chart(fig, use_container_width=True)
-                
-                st.dataframe(response_by_sex.rename(columns={
+                st.dataframe(subgrupos['sexo']['tabela'].rename(columns={
                     'sum': 'Melhoraram', 'count': 'Total', 'taxa': 'Taxa (%)'
                 }).round(2), use_container_width=True)
             else:
                 st.info("Dados de sexo não disponíveis")
         
         with subtab_age:
-            if 'idade' in df_long.columns:
-                df_long['faixa_etaria'] = pd.cut(df_long['idade'],
-                                                  bins=[0, 30, 40, 50, 60, 70, 120],
-                                                  labels=['<30', '30-40', '40-50', '50-60', '60-70', '>70'])
-                
-                response_by_age = df_long.groupby('faixa_etaria')['improvement'].agg(['sum', 'count'])
-                response_by_age['taxa'] = (response_by_age['sum'] / response_by_age['count'] * 100)
-                
-                fig = px.bar(x=response_by_age.index.astype(str), y=response_by_age['taxa'],
-                             color=response_by_age['taxa'], color_continuous_scale='Greens',
-                             text=response_by_age['taxa'].round(1))
-                fig.update_traces(texttemplate='%{text}%', textposition='outside')
-                fig.update_layout(title="Taxa de Resposta por Faixa Etária",
-                                  xaxis_title='Faixa Etária', yaxis_title='Taxa (%)', showlegend=False)
-                st.plotly_chart(fig, use_container_width=True)
+            if 'idade' in subgrupos:
+                st.plotly_chart(subgrupos['idade']['figura'], use_container_width=True)
             else:
                 st.info("Dados de idade não disponíveis")
         
         with subtab_fr:
-            if 'fr_resultado' in df_long.columns:
-                response_by_fr = df_long.groupby('fr_resultado')['improvement'].agg(['sum', 'count'])
-                response_by_fr['taxa'] = (response_by_fr['sum'] / response_by_fr['count'] * 100)
-                
-                fig = px.bar(x=response_by_fr.index, y=response_by_fr['taxa'],
-                             color=response_by_fr.index,
-                             color_discrete_map={'POSITIVO': '#ef4444', 'NEGATIVO': '#22c55e', 'NÃO INFORMADO': '#9ca3af'},
-                             text=response_by_fr['taxa'].round(1))
-                fig.update_traces(texttemplate='%{text}%', textposition='outside')
-                fig.update_layout(title="Taxa de Resposta por Fator Reumatoide",
-                                  xaxis_title='FR', yaxis_title='Taxa (%)', showlegend=False)
-                st.plotly_chart(fig, use_container_width=True)
+            if 'fr' in subgrupos:
+                st.plotly_chart(subgrupos['fr']['figura'], use_container_width=True)
                 
-                st.dataframe(response_by_fr.rename(columns={
+                st.dataframe(subgrupos['fr']['tabela'].rename(columns={
                     'sum': 'Melhoraram', 'count': 'Total', 'taxa': 'Taxa (%)'
                 }).round(2), use_container_width=True)
             else:
                 st.info("FR não foi extraído")
         
         with subtab_comorb:
-            if 'comorbidade_qualquer' in df_long.columns:
-                df_long['tem_comorbidade'] = df_long['comorbidade_qualquer'].map({
-                    0: 'Sem Comorbidades', 1: 'Com Comorbidades'
-                })
-                
-                response_by_comorb = df_long.groupby('tem_comorbidade')['improvement'].agg(['sum', 'count'])
-                response_by_comorb['taxa'] = (response_by_comorb['sum'] / response_by_comorb['count'] * 100)
-                
-                fig = px.bar(x=response_by_comorb.index, y=response_by_comorb['taxa'],
-                             color=response_by_comorb['taxa'], color_continuous_scale='Reds',
-                             text=response_by_comorb['taxa'].round(1))
-                fig.update_traces(texttemplate='%{text}%', textposition='outside')
-                fig.update_layout(title="Taxa de Resposta por Comorbidades",
-                                  xaxis_title='', yaxis_title='Taxa (%)', showlegend=False)
-                st.plotly_chart(fig, use_container_width=True)
+            if 'comorbidade' in subgrupos:
+                st.plotly_chart(subgrupos['comorbidade']['figura'], use_container_width=True)
             else:
                 st.info("Comorbidades não foram configuradas")
         
         with subtab_meds:
-            if 'uso_biologico' in df_long.columns:
+            if 'biologico' in subgrupos:
                 st.markdown("**Por Status de Biológico:**")
-                response_by_bio = df_long.groupby('uso_biologico')['improvement'].agg(['sum', 'count'])
-                response_by_bio['taxa'] = (response_by_bio['sum'] / response_by_bio['count'] * 100)
-                
-                fig = px.bar(x=response_by_bio.index, y=response_by_bio['taxa'],
-                             color=response_by_bio.index,
-                             color_discrete_map={'SIM': '#22c55e', 'PRÉVIO': '#f59e0b', 'NÃO': '#ef4444'},
-                             text=response_by_bio['taxa'].round(1))
-                fig.update_traces(texttemplate='%{text}%', textposition='outside')
-                fig.update_layout(title="Taxa de Resposta por Uso de Biológico",
-                                  xaxis_title='', yaxis_title='Taxa (%)', showlegend=False)
-                st.plotly_chart(fig, use_container_width=True)
+                st.plotly_chart(subgrupos['biologico']['figura'], use_container_width=True)
                 
                 # Por biológico específico
-                if 'biologico_nome' in df_long.columns:
+                if 'biologico_nome' in subgrupos:
                     st.markdown("**Por Biológico Específico:**")
-                    bio_response = {}
-                    for bio in df_long['biologico_nome'].dropna().unique():
-                        df_bio = df_long[df_long['biologico_nome'] == bio]
-                        if len(df_bio) >= 5:
-                            bio_response[bio.title()] = {
-                                'Total': len(df_bio),
-                                'Melhoraram': df_bio['improvement'].sum(),
-                                'Taxa (%)': round(df_bio['improvement'].mean() * 100, 2)
-                            }
-                    
-                    if bio_response:
-                        bio_df = pd.DataFrame(bio_response).T.sort_values('Taxa (%)', ascending=False)
-                        
-                        fig = px.bar(x=bio_df.index, y=bio_df['Taxa (%)'],
-                                     color=bio_df['Taxa (%)'], color_continuous_scale='Purples',
-                                     text=bio_df['Taxa (%)'].round(1))
-                        fig.update_traces(texttemplate='%{text}%', textposition='outside')
-                        fig.update_layout(xaxis_title='', yaxis_title='Taxa (%)', showlegend=False)
-                        st.plotly_chart(fig, use_container_width=True)
-                        
-                        st.dataframe(bio_df, use_container_width=True)
+                    st.plotly_chart(subgrupos['biologico_nome']['figura'], use_container_width=True)
+                    st.dataframe(subgrupos['biologico_nome']['tabela'], use_container_width=True)
             else:
                 st.info("Medicamentos não foram configurados")
         
+        with subtab_comb:
+            if len(cubo.dimensoes) >= 2:
+                col1, col2 = st.columns(2)
+                dim_linhas = col1.selectbox("Linhas:", cubo.dimensoes,
+                                            format_func=ROTULOS_DIMENSOES.get, key='comb_linhas')
+                opcoes_colunas = [d for d in cubo.dimensoes if d != dim_linhas]
+                dim_colunas = col2.selectbox("Colunas:", opcoes_colunas,
+                                             index=len(opcoes_colunas) - 1,
+                                             format_func=ROTULOS_DIMENSOES.get, key='comb_colunas')
+                
+                combinacao = obter_cache_figuras().construir(impressao, {
+                    'combinacao': ((dim_linhas, dim_colunas),
+                                   lambda: figura_combinacao_subgrupos(cubo, dim_linhas, dim_colunas))
+                })['combinacao']
+                st.plotly_chart(combinacao['figura'], use_container_width=True)
+                
+                with st.expander("📋 Ver tabela"):
+                    st.dataframe(combinacao['tabela'].rename(columns={
+                        'sum': 'Melhoraram', 'count': 'Total', 'taxa': 'Taxa (%)'
+                    }).round(2), use_container_width=True)
+            else:
+                st.info("São necessárias pelo menos duas dimensões de subgrupo")
+        
         # =============================================================================
         # SUBTAB: ANÁLISE DE TROCAS DE MEDICAMENTOS
         # =============================================================================
@@ -1872,15 +2125,14 @@ def main():
         with subtab_trocas:
             st.markdown("#### 🔄 Análise de Trocas de Medicamentos")
             
-            if 'selected_biologicos' not in st.session_state or not st.session_state['selected_biologicos']:
+            if not biologicos:
                 st.info("💡 Configure medicamentos biológicos no ETL para ver análise de trocas")
             else:
-                biologicos = st.session_state['selected_biologicos']
-                
                 # --- SEÇÃO 1: VISÃO GERAL ---
                 st.markdown("##### 📊 Visão Geral das Trocas")
                 
-                stats_troca = calcular_taxa_troca_geral(df_long)
+                trocas = figuras['trocas_visao_geral']
+                stats_troca = trocas['stats']
                 
                 col1, col2, col3, col4 = st.columns(4)
                 col1.metric("Total de Pacientes", stats_troca['total_pacientes'])
@@ -1893,16 +2145,7 @@ def main():
                     
                     with col1:
                         # Gráfico pizza: trocaram vs não trocaram
-                        fig = go.Figure(data=[go.Pie(
-                            labels=['Primeiro Biológico', 'Trocaram'],
-                            values=[stats_troca['pacientes_primeiro_biologico'], 
-                                    stats_troca['pacientes_que_trocaram']],
-                            marker=dict(colors=['#22c55e', '#f59e0b']),
-                            textinfo='label+percent+value',
-                            hole=0.4
-                        )])
-                        fig.update_layout(title="Distribuição de Pacientes", height=350)
-                        st.plotly_chart(fig, use_container_width=True)
+                        st.plotly_chart(trocas['distribuicao'], use_container_width=True)
                     
                     with col2:
                         st.metric("Número Médio de Trocas", 
@@ -1910,17 +2153,8 @@ def main():
                                  help="Entre pacientes que trocaram pelo menos uma vez")
                         
                         # Distribuição do número de trocas
-                        if 'num_biologicos_previos' in df_long.columns:
-                            dist_trocas = df_long[df_long['num_biologicos_previos'] > 0]['num_biologicos_previos'].value_counts().sort_index()
-                            
-                            if len(dist_trocas) > 0:
-                                fig = px.bar(x=dist_trocas.index, y=dist_trocas.values,
-                                             labels={'x': 'Número de Trocas', 'y': 'Pacientes'},
-                                             color=dist_trocas.values,
-                                             color_continuous_scale='Oranges')
-                                fig.update_layout(title="Distribuição do Número de Trocas", 
-                                                  showlegend=False, height=300)
-                                st.plotly_chart(fig, use_container_width=True)
+                        if 'num_trocas' in trocas:
+                            st.plotly_chart(trocas['num_trocas'], use_container_width=True)
                 
                 st.markdown("---")
                 
@@ -1928,30 +2162,10 @@ def main():
                 st.markdown("##### 🔀 Matriz de Transição de Medicamentos")
                 st.markdown("*Mostra quantos pacientes trocaram de um medicamento (linhas) para outro (colunas)*")
                 
-                matriz = construir_matriz_transicao(df_long, biologicos)
+                matriz = figuras['trocas_matriz']['matriz']
                 
-                if matriz.sum().sum() > 0:  # Se há pelo menos uma transição
-                    # Heatmap da matriz
-                    fig = go.Figure(data=go.Heatmap(
-                        z=matriz.values,
-                        x=matriz.columns,
-                        y=matriz.index,
-                        colorscale='Blues',
-                        text=matriz.values,
-                        texttemplate='%{text}',
-                        textfont={"size": 10},
-                        hoverongaps=False
-                    ))
-                    
-                    fig.update_layout(
-                        title="Matriz de Transição de Medicamentos",
-                        xaxis_title='Para (Medicamento Atual)',
-                        yaxis_title='De (Medicamento Prévio)',
-                        height=500,
-                        xaxis={'side': 'bottom'},
-                    )
-                    
-                    st.plotly_chart(fig, use_container_width=True)
+                if figuras['trocas_matriz']['figura'] is not None:  # Se há pelo menos uma transição
+                    st.plotly_chart(figuras['trocas_matriz']['figura'], use_container_width=True)
                     
                     # Mostrar tabela
                     with st.expander("📋 Ver tabela de transições"):
@@ -1961,8 +2175,7 @@ def main():
                     st.markdown("**💡 Insights:**")
                     max_val = matriz.max().max()
                     if max_val > 0:
-                        max_pos = [(i, j) for i in matriz.index for j in matriz.columns 
-                                  if matriz.loc[i, j] == max_val][0]
+                        max_pos = matriz.stack().idxmax()
                         st.info(f"• Transição mais comum: **{max_pos[0]} → {max_pos[1]}** ({int(max_val)} pacientes)")
                 else:
                     st.info("Nenhuma transição de medicamento identificada nos dados")
@@ -1972,31 +2185,13 @@ def main():
                 # --- SEÇÃO 3: TAXA DE ABANDONO ---
                 st.markdown("##### 📉 Taxa de Abandono por Medicamento")
                 
-                df_taxas = calcular_taxa_abandono_por_medicamento(df_long, biologicos)
+                df_taxas = figuras['trocas_abandono']['tabela']
                 
                 if not df_taxas.empty:
                     col1, col2 = st.columns([2, 1])
                     
                     with col1:
-                        fig = px.bar(
-                            df_taxas,
-                            x='Medicamento',
-                            y='Taxa Abandono (%)',
-                            color='Taxa Abandono (%)',
-                            color_continuous_scale='Reds',
-                            text='Taxa Abandono (%)',
-                            hover_data=['Total Usaram', 'Suspenderam']
-                        )
-                        
-                        fig.update_traces(texttemplate='%{text:.1f}%', textposition='outside')
-                        fig.update_layout(
-                            title='Taxa de Abandono por Medicamento',
-                            xaxis_title='',
-                            yaxis_title='Taxa de Abandono (%)',
-                            showlegend=False,
-                            height=400
-                        )
-                        st.plotly_chart(fig, use_container_width=True)
+                        st.plotly_chart(figuras['trocas_abandono']['figura'], use_container_width=True)
                     
                     with col2:
                         st.markdown("**Ranking de Abandono:**")
@@ -2004,9 +2199,8 @@ def main():
                                     use_container_width=True, hide_index=True)
                         
                         # Destaque
-                        if len(df_taxas) > 0:
-                            mais_abandonado = df_taxas.iloc[0]
-                            st.warning(f"⚠️ Maior taxa de abandono: **{mais_abandonado['Medicamento']}** ({mais_abandonado['Taxa Abandono (%)']:.1f}%)")
+                        mais_abandonado = df_taxas.iloc[0]
+                        st.warning(f"⚠️ Maior taxa de abandono: **{mais_abandonado['Medicamento']}** ({mais_abandonado['Taxa Abandono (%)']:.1f}%)")
                 else:
                     st.info("Sem dados de suspensão de medicamentos")
                 
@@ -2015,43 +2209,23 @@ def main():
                 # --- SEÇÃO 4: MOTIVOS DE SUSPENSÃO ---
                 st.markdown("##### 📋 Motivos de Suspensão")
                 
-                df_motivos = analisar_motivos_suspensao(df_long, biologicos)
+                motivos = figuras['trocas_motivos']
                 
-                if not df_motivos.empty:
+                if motivos is not None:
                     col1, col2 = st.columns([3, 2])
                     
                     with col1:
                         # Gráfico sunburst
-                        fig = px.sunburst(
-                            df_motivos,
-                            path=['Medicamento', 'Motivo'],
-                            values='Pacientes',
-                            color='Pacientes',
-                            color_continuous_scale='Oranges'
-                        )
-                        
-                        fig.update_layout(
-                            title='Motivos de Suspensão por Medicamento',
-                            height=500
-                        )
-                        
-                        st.plotly_chart(fig, use_container_width=True)
+                        st.plotly_chart(motivos['figura'], use_container_width=True)
                     
                     with col2:
                         st.markdown("**Motivos Mais Frequentes:**")
-                        top_motivos = df_motivos.groupby('Motivo')['Pacientes'].sum().sort_values(ascending=False).head(5)
-                        for motivo, count in top_motivos.items():
+                        for motivo, count in motivos['top_motivos'].items():
                             st.text(f"• {motivo}: {int(count)} pacientes")
                     
                     # Tabela detalhada
                     with st.expander("📊 Ver detalhes por medicamento"):
-                        pivot = df_motivos.pivot_table(
-                            index='Medicamento', 
-                            columns='Motivo', 
-                            values='Pacientes', 
-                            fill_value=0
-                        )
-                        st.dataframe(pivot, use_container_width=True)
+                        st.dataframe(motivos['detalhes'], use_container_width=True)
                 else:
                     st.info("Motivos de suspensão não foram identificados")
                 
@@ -2060,29 +2234,8 @@ def main():
                 # --- SEÇÃO 5: SEQUÊNCIAS COMUNS ---
                 st.markdown("##### 🔗 Sequências de Tratamento Mais Comuns")
                 
-                df_seq = identificar_sequencias_comuns(df_long, biologicos, top_n=10)
-                
-                if not df_seq.empty:
-                    fig = px.bar(
-                        df_seq,
-                        x='Pacientes',
-                        y='Sequência',
-                        orientation='h',
-                        color='Pacientes',
-                        color_continuous_scale='Purples',
-                        text='Pacientes'
-                    )
-                    
-                    fig.update_traces(textposition='outside')
-                    fig.update_layout(
-                        title='Sequências de Tratamento Mais Comuns',
-                        xaxis_title='Número de Pacientes',
-                        yaxis_title='',
-                        showlegend=False,
-                        height=max(400, len(df_seq) * 40)
-                    )
-                    
-                    st.plotly_chart(fig, use_container_width=True)
+                if figuras['trocas_sequencias'] is not None:
+                    st.plotly_chart(figuras['trocas_sequencias'], use_container_width=True)
                     
                     st.markdown("**💡 Interpretação:**")
                     st.markdown("As sequências mostram a ordem de uso de medicamentos. O símbolo → indica a progressão temporal do tratamento.")
@@ -2094,50 +2247,14 @@ def main():
                 # --- SEÇÃO 6: EFICÁCIA PÓS-TROCA ---
                 st.markdown("##### 🎯 Eficácia: Primeiro Biológico vs Após Troca")
                 
-                stats_eficacia = analisar_eficacia_pos_troca(df_long)
+                stats_eficacia = figuras['trocas_eficacia']['stats']
                 
-                if stats_eficacia['com_troca']['total'] > 0 and stats_eficacia['sem_troca']['total'] > 0:
+                if figuras['trocas_eficacia']['figura'] is not None:
                     col1, col2 = st.columns([2, 1])
                     
                     with col1:
                         # Gráfico comparativo
-                        data = {
-                            'Grupo': ['Primeiro Biológico', 'Após Troca(s)'],
-                            'Taxa de Resposta (%)': [
-                                stats_eficacia['sem_troca']['taxa_pct'],
-                                stats_eficacia['com_troca']['taxa_pct']
-                            ],
-                            'N': [
-                                stats_eficacia['sem_troca']['total'],
-                                stats_eficacia['com_troca']['total']
-                            ]
-                        }
-                        
-                        df_comp = pd.DataFrame(data)
-                        
-                        fig = px.bar(
-                            df_comp,
-                            x='Grupo',
-                            y='Taxa de Resposta (%)',
-                            color='Grupo',
-                            color_discrete_map={
-                                'Primeiro Biológico': '#22c55e',
-                                'Após Troca(s)': '#f59e0b'
-                            },
-                            text='Taxa de Resposta (%)',
-                            hover_data=['N']
-                        )
-                        
-                        fig.update_traces(texttemplate='%{text:.1f}%', textposition='outside')
-                        fig.update_layout(
-                            title='Taxa de Resposta: Primeiro Biológico vs Após Troca',
-                            xaxis_title='',
-                            yaxis_title='Taxa de Resposta (%)',
-                            showlegend=False,
-                            height=400
-                        )
-                        
-                        st.plotly_chart(fig, use_container_width=True)
+                        st.plotly_chart(figuras['trocas_eficacia']['figura'], use_container_width=True)
                     
                     with col2:
                         st.markdown("**Comparativo:**")
@@ -2178,7 +2295,7 @@ def main():
         
         with col1:
             st.markdown("#### 📊 Dados Processados")
-            df_proc = st.session_state['df_processed']
+            df_proc = restaurar_texto(st.session_state['df_processed'], st.session_state.get('textos'))
             st.info(f"Total de registros: {len(df_proc)}")
             
             output = io.BytesIO()
@@ -2236,14 +2353,41 @@ def main():
         st.markdown("---")
         st.markdown("#### 📋 Preview dos Dados")
         
-        preview_option = st.radio("Dataset:", ["Dados Processados", "Dados Longitudinais"], horizontal=True)
+        preview_option = st.radio("Dataset:", ["Dados Processados", "Dados Longitudinais", "Tabela de Pacientes"],
+                                  horizontal=True)
         
-        if preview_option == "Dados Processados":
+        banco = obter_banco_sessao()
+        if banco is not None:
+            exibir_previa_banco(banco, {"Dados Processados": 'processados',
+                                        "Dados Longitudinais": 'longitudinais',
+                                        "Tabela de Pacientes": 'pacientes'}[preview_option])
+            st.markdown("---")
+            exibir_consulta_coorte(banco, st.session_state.get('selected_medications') or [])
+        elif preview_option == "Dados Processados":
             st.dataframe(st.session_state['df_processed'], use_container_width=True)
+        elif preview_option == "Tabela de Pacientes":
+            st.dataframe(st.session_state['df_pacientes'], use_container_width=True)
         else:
             if 'df_longitudinal' in st.session_state:
                 st.dataframe(st.session_state['df_longitudinal'], use_container_width=True)
         
+        indice = indice_busca()
+        if indice is not None:
+            st.markdown("---")
+            exibir_busca_textos(indice)
+        
+        if st.session_state.get('evidencias') is not None:
+            st.markdown("---")
+            exibir_evidencias_nota(st.session_state['evidencias'])
+        
+        if st.session_state.get('regras_extracao'):
+            st.markdown("---")
+            exibir_contadores_regras(st.session_state['regras_extracao'])
+        
+        if st.session_state.get('notas_lentas'):
+            st.markdown("---")
+            exibir_notas_lentas(st.session_state['notas_lentas'])
+        
         # Resumo da configuração
         st.markdown("---")
         st.markdown("#### ⚙️ Configuração Utilizada")
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Armazém de Artefatos do ETL - IMMUNED
+Persiste em disco as saídas de cada execução (dados processados,
+longitudinais e agregados), indexadas por hash da entrada, hash da
+configuração e versão do código, com um manifesto. Permite reabrir uma
+execução anterior em segundos após reiniciar o servidor. O espaço ocupado
+é limitado: as execuções acessadas há mais tempo são removidas primeiro.
+
+Estrutura:
+    artefatos_immuned/
+    ├── manifesto.json
+    └── <hash_entrada>_<hash_config>_<versao>/
+        ├── df_processed.parquet
+        ├── df_longitudinal.parquet
+        ├── relatorio.json
+        ├── metadados.json
+        └── coorte.sqlite          (opcional: banco de consulta, ver banco_coortes)
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+import pandas as pd
+
+from banco_coortes import gravar_banco
+from cache_resultados import impressao_config
+from registro_regras import carregar_regras
+
+PASTA_PADRAO = 'artefatos_immuned'
+ARQUIVO_BANCO = 'coorte.sqlite'
+
+# Módulos cujo código define o resultado do ETL
+_MODULOS_VERSAO = ['pipeline_etl.py', 'textos_prontuarios.py', 'quase_duplicatas.py', 'busca_textos.py',
+                   'registro_regras.py']
+
+
+def versao_codigo():
+    """
+    Hash curto do código do pipeline e da impressão do conjunto de regras
+    carregado: resultados de outra versão não são reaproveitados
+    """
+    h = hashlib.sha256()
+    pasta = os.path.dirname(os.path.abspath(__file__))
+    for nome in _MODULOS_VERSAO:
+        with open(os.path.join(pasta, nome), 'rb') as f:
+            h.update(f.read())
+    h.update(carregar_regras().impressao.encode())
+    return h.hexdigest()[:12]
+
+
+def _escrever_json(caminho, dados):
+    temporario = caminho + '.tmp'
+    with open(temporario, 'w', encoding='utf-8') as f:
+        json.dump(dados, f, ensure_ascii=False, indent=2, default=str)
+    os.replace(temporario, caminho)
+
+
+def _tamanho_pasta(pasta):
+    return sum(os.path.getsize(os.path.join(pasta, nome)) for nome in os.listdir(pasta))
+
+
+class ArmazemArtefatos:
+    """
+    Args:
+        pasta: diretório local dos artefatos
+        limite_mb: espaço máximo ocupado por todas as execuções
+    """
+
+    def __init__(self, pasta=PASTA_PADRAO, limite_mb=2048):
+        self.pasta = pasta
+        self.limite_bytes = limite_mb * 1024 * 1024
+        self.versao = versao_codigo()
+        self._lock = threading.Lock()
+        os.makedirs(self.pasta, exist_ok=True)
+
+    # --- manifesto ---
+
+    @property
+    def _caminho_manifesto(self):
+        return os.path.join(self.pasta, 'manifesto.json')
+
+    def _ler_manifesto(self):
+        if not os.path.exists(self._caminho_manifesto):
+            return {}
+        with open(self._caminho_manifesto, encoding='utf-8') as f:
+            return json.load(f)
+
+    def listar(self):
+        """Execuções salvas, da mais recente para a mais antiga"""
+        with self._lock:
+            execucoes = list(self._ler_manifesto().values())
+        return sorted(execucoes, key=lambda e: e['criado_em'], reverse=True)
+
+    def id_execucao(self, hash_entrada, config):
+        return self.id_da_chave(hash_entrada, impressao_config(config))
+
+    def id_da_chave(self, hash_entrada, hash_config):
+        """Id da execução a partir da chave (hash da entrada, impressão da configuração)"""
+        return f"{hash_entrada[:16]}_{hash_config}_{self.versao}"
+
+    def buscar(self, hash_entrada, config):
+        """Id da execução salva para esta entrada/configuração/versão (ou None)"""
+        id_execucao = self.id_execucao(hash_entrada, config)
+        with self._lock:
+            return id_execucao if id_execucao in self._ler_manifesto() else None
+
+    # --- gravação e leitura ---
+
+    def salvar(self, hash_entrada, config, resultado, metadados=None, banco=False):
+        """
+        Grava os DataFrames do resultado em Parquet e os demais itens em JSON.
+        Com banco=True, grava também o banco de consulta de coortes (SQLite).
+
+        Returns:
+            Id da execução
+        """
+        id_execucao = self.id_execucao(hash_entrada, config)
+        destino = os.path.join(self.pasta, id_execucao)
+        temporario = destino + '.tmp'
+        shutil.rmtree(temporario, ignore_errors=True)
+        os.makedirs(temporario)
+
+        arquivos = []
+        for nome, valor in resultado.items():
+            if isinstance(valor, pd.DataFrame):
+                valor.to_parquet(os.path.join(temporario, f'{nome}.parquet'), index=False)
+                arquivos.append(f'{nome}.parquet')
+            else:
+                _escrever_json(os.path.join(temporario, f'{nome}.json'), valor)
+                arquivos.append(f'{nome}.json')
+        _escrever_json(os.path.join(temporario, 'metadados.json'), metadados or {})
+        if banco:
+            gravar_banco(os.path.join(temporario, ARQUIVO_BANCO), resultado)
+
+        agora = time.time()
+        entrada = {
+            'id': id_execucao,
+            'hash_entrada': hash_entrada,
+            'hash_config': impressao_config(config),
+            'versao_codigo': self.versao,
+            'config': config,
+            'arquivos': arquivos,
+            'banco': bool(banco),
+            'tamanho_bytes': _tamanho_pasta(temporario),
+            'criado_em': agora,
+            'ultimo_acesso': agora,
+            'nome_arquivo': (metadados or {}).get('nome_arquivo'),
+        }
+
+        with self._lock:
+            shutil.rmtree(destino, ignore_errors=True)
+            os.replace(temporario, destino)
+            manifesto = self._ler_manifesto()
+            manifesto[id_execucao] = entrada
+            self._aplicar_retencao(manifesto, preservar=id_execucao)
+            _escrever_json(self._caminho_manifesto, manifesto)
+        return id_execucao
+
+    def abrir(self, id_execucao):
+        """
+        Carrega uma execução salva.
+
+        Returns:
+            (resultado, metadados) - resultado no mesmo formato de executar_pipeline
+        """
+        with self._lock:
+            manifesto = self._ler_manifesto()
+            if id_execucao not in manifesto:
+                raise KeyError(f"Execução não encontrada: {id_execucao}")
+            manifesto[id_execucao]['ultimo_acesso'] = time.time()
+            _escrever_json(self._caminho_manifesto, manifesto)
+            arquivos = manifesto[id_execucao]['arquivos']
+
+        pasta = os.path.join(self.pasta, id_execucao)
+        resultado = {}
+        for nome_arquivo in arquivos:
+            nome, extensao = os.path.splitext(nome_arquivo)
+            caminho = os.path.join(pasta, nome_arquivo)
+            if extensao == '.parquet':
+                resultado[nome] = pd.read_parquet(caminho)
+            else:
+                with open(caminho, encoding='utf-8') as f:
+                    resultado[nome] = json.load(f)
+        with open(os.path.join(pasta, 'metadados.json'), encoding='utf-8') as f:
+            metadados = json.load(f)
+        return resultado, metadados
+
+    def caminho_banco(self, id_execucao):
+        """Arquivo do banco de coortes da execução (None se não foi gravado)"""
+        caminho = os.path.join(self.pasta, id_execucao, ARQUIVO_BANCO)
+        return caminho if os.path.exists(caminho) else None
+
+    def remover(self, id_execucao):
+        with self._lock:
+            manifesto = self._ler_manifesto()
+            manifesto.pop(id_execucao, None)
+            shutil.rmtree(os.path.join(self.pasta, id_execucao), ignore_errors=True)
+            _escrever_json(self._caminho_manifesto, manifesto)
+
+    def _aplicar_retencao(self, manifesto, preservar=None):
+        """Remove as execuções acessadas há mais tempo até caber no limite"""
+        total = sum(e['tamanho_bytes'] for e in manifesto.values())
+        for entrada in sorted(manifesto.values(), key=lambda e: e['ultimo_acesso']):
+            if total <= self.limite_bytes:
+                break
+            if entrada['id'] == preservar:
+                continue
+            shutil.rmtree(os.path.join(self.pasta, entrada['id']), ignore_errors=True)
+            del manifesto[entrada['id']]
+            total -= entrada['tamanho_bytes']
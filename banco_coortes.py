@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+Banco Analítico de Coortes - IMMUNED
+Grava as saídas de uma execução do ETL em um arquivo SQLite local, com
+índices nas colunas usadas para selecionar coortes (paciente, tipo,
+data_hora e status de cada medicamento). Perguntas sobre uma execução já
+processada passam a ser consultas ao arquivo, sem reenviar a exportação nem
+manter todas as tabelas na memória da sessão.
+
+Tabelas:
+    processados     df_processed (uma linha por nota)
+    longitudinais   df_longitudinal (uma linha por paciente, baseline × follow-up)
+    pacientes       df_pacientes (uma linha por paciente)
+    textos          textos comprimidos (só com texto_descricao='comprimido')
+    _esquema        tipo original de cada coluna, para reconstruir os DataFrames
+
+Colunas categóricas (status, tipo, FR...) são gravadas pelos códigos
+inteiros das categorias e datas como microssegundos desde 1970, o que
+mantém o arquivo e os índices compactos; os filtros aceitam os valores
+originais ('PRÉVIO', '2021-01-01') e os convertem. Na leitura os tipos são
+reconstruídos (categorias, datetime, impressao_texto como uint64).
+
+Uso:
+    banco = BancoCoortes('coorte.sqlite')
+    banco.contar('processados', {'tipo': 'EVOLUCAO', 'adalimumabe_status': 'SIM'})
+    banco.pacientes_coorte({'data_hora': ('2021-01-01', '2021-12-31'), 'uso_biologico': ['SIM', 'PRÉVIO']})
+"""
+
+import json
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+# Nome de cada resultado do ETL no banco
+TABELAS = {
+    'df_processed': 'processados',
+    'df_longitudinal': 'longitudinais',
+    'df_pacientes': 'pacientes',
+    'textos': 'textos',
+}
+
+# Colunas indexadas (quando existem na tabela), além de <medicamento>_status
+COLUNAS_INDEXADAS = ['paciente', 'tipo', 'data_hora', 'uso_biologico', 'uso_mtx']
+
+LINHAS_POR_LOTE = 50_000
+
+
+# =============================================================================
+# GRAVAÇÃO
+# =============================================================================
+
+def _tipo_coluna(serie):
+    """Descrição JSON do tipo da coluna, para reconstruí-la na leitura"""
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        return {'tipo': 'category', 'categorias': [str(c) for c in serie.cat.categories],
+                'ordenada': bool(serie.cat.ordered)}
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        return {'tipo': 'datetime'}
+    if serie.dtype == object and serie.isna().any():
+        # O SQLite devolve NULL como NaN; colunas como <med>_motivo usam None
+        nulos = serie[serie.isna()]
+        return {'tipo': 'object', 'nulo': 'None' if any(v is None for v in nulos) else 'NaN'}
+    return {'tipo': str(serie.dtype)}
+
+
+def _microssegundos(valores):
+    return pd.Series(valores).astype('datetime64[us]').to_numpy().view(np.int64)
+
+
+def _para_sql(serie):
+    """Valores da coluna em tipos que o SQLite guarda (e compara) corretamente"""
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        codigos = serie.cat.codes
+        return codigos.astype(object).where(codigos >= 0, None)
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        return pd.Series(_microssegundos(serie), index=serie.index).astype(object).where(serie.notna(), None)
+    if serie.dtype == np.uint64:
+        return pd.Series(serie.to_numpy().view(np.int64), index=serie.index)
+    return serie
+
+
+def colunas_indexadas(colunas):
+    """Colunas da tabela que recebem índice"""
+    return ([c for c in COLUNAS_INDEXADAS if c in colunas]
+            + [c for c in colunas if c.endswith('_status') and c not in COLUNAS_INDEXADAS])
+
+
+def _identificador(nome):
+    return '"' + str(nome).replace('"', '""') + '"'
+
+
+def _criar_indices(conexao, tabela, colunas):
+    indexadas = colunas_indexadas(colunas)
+    for coluna in indexadas:
+        # Com paciente no fim, "pacientes com esta condição" é respondida só pelo índice
+        extra = ', "paciente"' if coluna != 'paciente' and 'paciente' in colunas else ''
+        conexao.execute(f'CREATE INDEX {_identificador(f"idx_{tabela}_{coluna}")} '
+                        f'ON {_identificador(tabela)} ({_identificador(coluna)}{extra})')
+    if 'paciente' in colunas and 'data_hora' in colunas:
+        conexao.execute(f'CREATE INDEX {_identificador(f"idx_{tabela}_paciente_data")} '
+                        f'ON {_identificador(tabela)} ("paciente", "data_hora")')
+    if 'tipo' in colunas and 'data_hora' in colunas:
+        conexao.execute(f'CREATE INDEX {_identificador(f"idx_{tabela}_tipo_data")} '
+                        f'ON {_identificador(tabela)} ("tipo", "data_hora", "paciente")')
+
+
+def gravar_banco(caminho, resultado):
+    """
+    Grava os DataFrames do resultado do ETL (ver TABELAS) em um novo arquivo
+    SQLite, substituindo o anterior apenas ao final.
+
+    Returns:
+        Dict tabela -> linhas gravadas
+    """
+    temporario = caminho + '.tmp'
+    if os.path.exists(temporario):
+        os.remove(temporario)
+
+    linhas = {}
+    conexao = sqlite3.connect(temporario)
+    try:
+        # Arquivo novo, trocado pelo definitivo só no fim: dispensa o diário de transações
+        conexao.execute('PRAGMA journal_mode = OFF')
+        conexao.execute('PRAGMA synchronous = OFF')
+        conexao.execute('CREATE TABLE _esquema (tabela TEXT, coluna TEXT, posicao INTEGER, tipo TEXT)')
+        for nome, tabela in TABELAS.items():
+            df = resultado.get(nome)
+            if not isinstance(df, pd.DataFrame):
+                continue
+            conexao.executemany('INSERT INTO _esquema VALUES (?, ?, ?, ?)', [
+                (tabela, str(coluna), posicao, json.dumps(_tipo_coluna(df[coluna]), ensure_ascii=False))
+                for posicao, coluna in enumerate(df.columns)
+            ])
+            for inicio in range(0, max(len(df), 1), LINHAS_POR_LOTE):
+                parte = df.iloc[inicio:inicio + LINHAS_POR_LOTE]
+                parte = pd.DataFrame({str(c): _para_sql(parte[c]) for c in parte.columns})
+                parte.to_sql(tabela, conexao, index=False, if_exists='append')
+            _criar_indices(conexao, tabela, [str(c) for c in df.columns])
+            linhas[tabela] = len(df)
+        conexao.execute('ANALYZE')
+        conexao.commit()
+    finally:
+        conexao.close()
+    os.replace(temporario, caminho)
+    return linhas
+
+
+# =============================================================================
+# CONSULTA
+# =============================================================================
+
+def _restaurar(df, tipos):
+    """Converte as colunas lidas do SQLite de volta aos tipos originais"""
+    for coluna in df.columns:
+        tipo = tipos.get(coluna)
+        if tipo is None:
+            continue
+        if tipo['tipo'] == 'category':
+            codigos = df[coluna].fillna(-1).to_numpy(dtype=np.int64)
+            df[coluna] = pd.Categorical.from_codes(codigos, categories=tipo['categorias'], ordered=tipo['ordenada'])
+        elif tipo['tipo'] == 'datetime':
+            df[coluna] = pd.to_datetime(df[coluna], unit='us')
+        elif tipo['tipo'] == 'uint64':
+            df[coluna] = df[coluna].to_numpy(dtype=np.int64).view(np.uint64)
+        elif str(df[coluna].dtype) != tipo['tipo']:
+            df[coluna] = df[coluna].astype(tipo['tipo'])
+        if tipo.get('nulo') == 'None':
+            df[coluna] = df[coluna].where(df[coluna].notna(), None)
+    return df
+
+
+def _valor_sql(valor, tipo):
+    """Valor de filtro no formato gravado (código da categoria, microssegundos)"""
+    if valor is None:
+        return None
+    if tipo['tipo'] == 'category':
+        # Valor fora das categorias: código que não existe no banco
+        return tipo['categorias'].index(valor) if valor in tipo['categorias'] else -1
+    if tipo['tipo'] == 'datetime':
+        return int(_microssegundos([pd.Timestamp(valor)])[0])
+    if isinstance(valor, np.generic):
+        return valor.item()
+    return valor
+
+
+class BancoCoortes:
+    """
+    Acesso somente leitura a um banco gravado por gravar_banco.
+
+    Args:
+        caminho: arquivo SQLite
+    """
+
+    def __init__(self, caminho):
+        if not os.path.exists(caminho):
+            raise FileNotFoundError(f"Banco de coortes não encontrado: {caminho}")
+        self.caminho = caminho
+        # Uma conexão por objeto; o Streamlit consulta de threads diferentes
+        self._conexao = sqlite3.connect(f'file:{caminho}?mode=ro', uri=True, check_same_thread=False)
+        self._tipos = {}
+        for tabela, coluna, tipo in self._conexao.execute(
+                'SELECT tabela, coluna, tipo FROM _esquema ORDER BY tabela, posicao'):
+            self._tipos.setdefault(tabela, {})[coluna] = json.loads(tipo)
+
+    def fechar(self):
+        self._conexao.close()
+
+    @property
+    def tabelas(self):
+        return list(self._tipos)
+
+    def colunas(self, tabela):
+        return list(self._tabela(tabela))
+
+    def _tabela(self, tabela):
+        if tabela not in self._tipos:
+            raise KeyError(f"Tabela inexistente no banco: {tabela}")
+        return self._tipos[tabela]
+
+    def _onde(self, tabela, filtros):
+        """
+        Cláusula WHERE (com parâmetros) de filtros {coluna: condição}, onde a
+        condição é um valor (igualdade), uma lista (qualquer um dos valores) ou
+        uma tupla (início, fim) inclusiva, com None para um lado aberto.
+        """
+        tipos = self._tabela(tabela)
+        clausulas, parametros = [], []
+        for coluna, condicao in (filtros or {}).items():
+            if coluna not in tipos:
+                raise KeyError(f"Coluna inexistente em {tabela}: {coluna}")
+            nome = _identificador(coluna)
+            if tipos[coluna]['tipo'] == 'datetime' and not isinstance(condicao, (list, tuple)):
+                condicao = (condicao, condicao)
+            if isinstance(condicao, tuple):
+                inicio, fim = condicao
+                if tipos[coluna]['tipo'] == 'datetime':
+                    inicio = None if inicio is None else pd.Timestamp(inicio)
+                    # Data sem hora no fim do intervalo inclui o dia inteiro
+                    if fim is not None:
+                        fim = pd.Timestamp(fim)
+                        if fim == fim.normalize():
+                            fim = fim + pd.Timedelta(days=1) - pd.Timedelta(microseconds=1)
+                if inicio is not None:
+                    clausulas.append(f'{nome} >= ?')
+                    parametros.append(_valor_sql(inicio, tipos[coluna]))
+                if fim is not None:
+                    clausulas.append(f'{nome} <= ?')
+                    parametros.append(_valor_sql(fim, tipos[coluna]))
+            elif isinstance(condicao, list):
+                if not condicao:
+                    clausulas.append('0')
+                    continue
+                clausulas.append(f'{nome} IN ({", ".join("?" * len(condicao))})')
+                parametros.extend(_valor_sql(v, tipos[coluna]) for v in condicao)
+            elif condicao is None:
+                clausulas.append(f'{nome} IS NULL')
+            else:
+                clausulas.append(f'{nome} = ?')
+                parametros.append(_valor_sql(condicao, tipos[coluna]))
+        onde = f' WHERE {" AND ".join(clausulas)}' if clausulas else ''
+        return onde, parametros
+
+    def consultar(self, tabela, filtros=None, colunas=None, ordem=None, limite=None, inicio=0):
+        """
+        Linhas da tabela que atendem aos filtros (ver _onde), com os tipos originais.
+
+        Args:
+            colunas: colunas retornadas (None = todas)
+            ordem: coluna ou lista de colunas de ordenação
+            limite/inicio: paginação
+        """
+        tipos = self._tabela(tabela)
+        colunas = list(tipos) if colunas is None else list(colunas)
+        for coluna in colunas + ([ordem] if isinstance(ordem, str) else list(ordem or [])):
+            if coluna not in tipos:
+                raise KeyError(f"Coluna inexistente em {tabela}: {coluna}")
+        onde, parametros = self._onde(tabela, filtros)
+        sql = f'SELECT {", ".join(map(_identificador, colunas))} FROM {_identificador(tabela)}{onde}'
+        if ordem:
+            sql += ' ORDER BY ' + ', '.join(map(_identificador, [ordem] if isinstance(ordem, str) else ordem))
+        if limite is not None:
+            sql += ' LIMIT ? OFFSET ?'
+            parametros += [int(limite), int(inicio)]
+        df = pd.read_sql_query(sql, self._conexao, params=parametros)
+        return _restaurar(df, tipos)
+
+    def contar(self, tabela, filtros=None):
+        """Número de linhas da tabela que atendem aos filtros"""
+        onde, parametros = self._onde(tabela, filtros)
+        return self._conexao.execute(f'SELECT COUNT(*) FROM {_identificador(tabela)}{onde}', parametros).fetchone()[0]
+
+    def valores_distintos(self, tabela, coluna, limite=200):
+        """Valores distintos não nulos da coluna (para montar filtros)"""
+        tipos = self._tabela(tabela)
+        if coluna not in tipos:
+            raise KeyError(f"Coluna inexistente em {tabela}: {coluna}")
+        nome = _identificador(coluna)
+        df = pd.read_sql_query(f'SELECT DISTINCT {nome} FROM {_identificador(tabela)} '
+                               f'WHERE {nome} IS NOT NULL ORDER BY {nome} LIMIT ?',
+                               self._conexao, params=[int(limite)])
+        return _restaurar(df, {coluna: tipos[coluna]})[coluna].tolist()
+
+    def pacientes_coorte(self, filtros=None, tabela='processados'):
+        """
+        Pacientes com alguma linha da tabela que atende a todos os filtros
+        (por padrão, alguma nota), em ordem de paciente.
+        """
+        if 'paciente' not in self._tabela(tabela):
+            raise KeyError(f"Tabela sem coluna paciente: {tabela}")
+        onde, parametros = self._onde(tabela, filtros)
+        df = pd.read_sql_query(f'SELECT DISTINCT "paciente" FROM {_identificador(tabela)}{onde} ORDER BY "paciente"',
+                               self._conexao, params=parametros)
+        return _restaurar(df, self._tipos[tabela])['paciente']
+
+    def resultado(self):
+        """Todas as tabelas no formato de executar_pipeline (df_processed, df_longitudinal, ...)"""
+        return {nome: self.consultar(tabela) for nome, tabela in TABELAS.items() if tabela in self._tipos}
@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+"""
+Busca no Texto dos Prontuários - IMMUNED
+Índice invertido do texto livre construído durante o ETL: cada palavra da
+nota (sem acentos e sem maiúsculas) aponta para as notas e posições em que
+aparece. As buscas consultam só as listas dos termos pedidos, sem percorrer
+o texto.
+
+O índice é uma tabela (termo, nota, posicao) ordenada por termo, guardada
+como as demais saídas (resultado['indice_busca'], indice_busca.parquet);
+nota é a posição da linha em df_processed (o mesmo texto_id do armazém de
+textos) e posicao é o número da palavra dentro da nota.
+
+Consultas (ver interpretar_consulta):
+
+    metotrexato nausea              notas com as duas palavras
+    "perda de seguimento"           frase exata
+    "suspenso nausea"~5             palavras a até 5 posições uma da outra
+    adalimum*                       prefixo (adalimumabe, adalimumab, ...)
+    tofacitinibe -herpes            exclui as notas com herpes
+"""
+
+import re
+import unicodedata
+from array import array
+from bisect import bisect_left
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+_PALAVRA = re.compile(r'\w+')
+
+# Maior caractere Unicode: limite superior dos termos que começam com um prefixo
+_FIM_PREFIXO = '\U0010ffff'
+
+_CLAUSULA = re.compile(
+    r'\s*(?P<negar>-)?(?:"(?P<frase>[^"]*)"(?:~(?P<distancia>\d+))?|(?P<palavra>[^\s"]+))'
+)
+
+
+# =============================================================================
+# TERMOS
+# =============================================================================
+
+@lru_cache(maxsize=200_000)
+def dobrar(palavra):
+    """Palavra sem acentos e sem maiúsculas ('Náusea' -> 'nausea')"""
+    decomposta = unicodedata.normalize('NFKD', palavra)
+    return ''.join(c for c in decomposta if not unicodedata.combining(c)).casefold()
+
+
+def termos(texto):
+    """Termos do texto, na ordem (a posição de cada termo é o seu índice na lista)"""
+    return [dobrar(p) for p in _PALAVRA.findall(texto)] if isinstance(texto, str) else []
+
+
+def construir_indice(textos):
+    """
+    Tabela de ocorrências do índice a partir dos textos das notas.
+
+    Args:
+        textos: Series ou lista de textos (a nota i é o i-ésimo texto)
+
+    Returns:
+        DataFrame (termo categórico, nota int32, posicao int32) ordenado por termo
+    """
+    ids_termos = {}
+    por_palavra = {}
+    codigos = array('i')
+    comprimentos = np.zeros(len(textos), dtype=np.int64)
+    for nota, texto in enumerate(textos):
+        if not isinstance(texto, str):
+            continue
+        palavras = _PALAVRA.findall(texto)
+        # Cada grafia é dobrada uma vez; as seguintes são só uma consulta ao dicionário
+        for palavra in palavras:
+            if palavra not in por_palavra:
+                por_palavra[palavra] = ids_termos.setdefault(dobrar(palavra), len(ids_termos))
+        codigos.extend([por_palavra[p] for p in palavras])
+        comprimentos[nota] = len(palavras)
+
+    notas = np.repeat(np.arange(len(textos), dtype=np.int32), comprimentos)
+    inicios = np.cumsum(comprimentos) - comprimentos
+    posicoes = (np.arange(len(notas), dtype=np.int64) - np.repeat(inicios, comprimentos)).astype(np.int32)
+
+    # Vocabulário em ordem alfabética: um prefixo corresponde a um intervalo contínuo
+    vocabulario = np.array(list(ids_termos), dtype=object)
+    ordem_alfabetica = np.argsort(vocabulario, kind='stable')
+    posto = np.empty(len(vocabulario), dtype=np.int32)
+    posto[ordem_alfabetica] = np.arange(len(vocabulario), dtype=np.int32)
+    codigos = posto[np.frombuffer(codigos, dtype=np.int32)] if len(codigos) else np.zeros(0, dtype=np.int32)
+    ordem = np.argsort(codigos, kind='stable')
+
+    return pd.DataFrame({
+        'termo': pd.Categorical.from_codes(codigos[ordem], categories=vocabulario[ordem_alfabetica]),
+        'nota': notas[ordem],
+        'posicao': posicoes[ordem],
+    })
+
+
+# =============================================================================
+# CONSULTAS
+# =============================================================================
+
+class Clausula:
+    """
+    Um item da consulta: palavra, frase ou palavras próximas.
+
+    Args:
+        termos: lista de (termo dobrado, é prefixo)
+        distancia: None para frase exata (termos consecutivos); N para termos
+                   consecutivos da cláusula a até N posições um do outro
+        negar: exclui as notas que atendem à cláusula
+    """
+
+    def __init__(self, termos, distancia=None, negar=False):
+        self.termos = termos
+        self.distancia = distancia
+        self.negar = negar
+
+    def __str__(self):
+        palavras = [t + ('*' if prefixo else '') for t, prefixo in self.termos]
+        if len(palavras) == 1 and self.distancia is None:
+            texto = palavras[0]
+        else:
+            texto = f'"{" ".join(palavras)}"' + (f'~{self.distancia}' if self.distancia is not None else '')
+        return ('-' if self.negar else '') + texto
+
+
+def _termos_consulta(texto):
+    """Termos de um trecho da consulta; '*' ao final de uma palavra a torna prefixo"""
+    resultado = []
+    for palavra in texto.split():
+        prefixo = palavra.endswith('*')
+        partes = termos(palavra)
+        resultado += [(t, False) for t in partes[:-1]]
+        if partes:
+            resultado.append((partes[-1], prefixo))
+    return resultado
+
+
+def interpretar_consulta(texto):
+    """
+    Cláusulas da consulta (todas precisam ser atendidas).
+
+    Raises:
+        ValueError se há aspas sem fechamento ou nenhuma cláusula sem '-'
+    """
+    texto = (texto or '').strip()
+    if texto.count('"') % 2:
+        raise ValueError("Busca inválida: aspas sem fechamento")
+    clausulas, posicao = [], 0
+    while posicao < len(texto):
+        encontrado = _CLAUSULA.match(texto, posicao)
+        posicao = encontrado.end()
+        trecho = encontrado.group('frase') if encontrado.group('frase') is not None else encontrado.group('palavra')
+        termos_clausula = _termos_consulta(trecho or '')
+        if not termos_clausula:
+            continue
+        distancia = encontrado.group('distancia')
+        clausulas.append(Clausula(termos_clausula, int(distancia) if distancia is not None else None,
+                                  encontrado.group('negar') is not None))
+    if clausulas and all(c.negar for c in clausulas):
+        raise ValueError("Busca inválida: informe ao menos um termo sem '-'")
+    return clausulas
+
+
+# =============================================================================
+# ÍNDICE
+# =============================================================================
+
+def _unicos(ordenado):
+    """Valores distintos de um array já ordenado"""
+    if not len(ordenado):
+        return ordenado
+    return ordenado[np.concatenate([[True], ordenado[1:] != ordenado[:-1]])]
+
+
+def _ordenado(codigos, notas, posicoes):
+    """Ocorrências já em ordem de termo, nota e posição"""
+    if len(codigos) < 2:
+        return True
+    termo, nota = np.diff(codigos.astype(np.int64)), np.diff(notas.astype(np.int64))
+    posicao = np.diff(posicoes.astype(np.int64))
+    return bool(np.all((termo > 0) | ((termo == 0) & ((nota > 0) | ((nota == 0) & (posicao > 0))))))
+
+
+class IndiceInvertido:
+    """
+    Args:
+        tabela: ocorrências (termo, nota, posicao), como devolvidas por
+                construir_indice (tabelas de shards ou partições concatenadas
+                são reordenadas aqui)
+        n_notas: número de notas indexadas (None = maior nota + 1)
+    """
+
+    def __init__(self, tabela, n_notas=None):
+        termo = tabela['termo']
+        if not isinstance(termo.dtype, pd.CategoricalDtype):
+            termo = termo.astype('category')
+        categorias = list(termo.cat.categories)
+        if categorias != sorted(categorias):
+            termo = termo.cat.reorder_categories(sorted(categorias))
+        codigos = termo.cat.codes.to_numpy()
+        notas = tabela['nota'].to_numpy(dtype=np.int32)
+        posicoes = tabela['posicao'].to_numpy(dtype=np.int32)
+        if not _ordenado(codigos, notas, posicoes):
+            ordem = np.lexsort((posicoes, notas, codigos))
+            codigos, notas, posicoes = codigos[ordem], notas[ordem], posicoes[ordem]
+
+        self.vocabulario = list(termo.cat.categories)
+        self._inicios = np.searchsorted(codigos, np.arange(len(self.vocabulario) + 1))
+        self._notas = notas
+        self._posicoes = posicoes
+        self.n_notas = n_notas if n_notas is not None else (int(notas.max()) + 1 if len(notas) else 0)
+        self._por_trecho = {}
+
+    def __len__(self):
+        """Número de ocorrências indexadas"""
+        return len(self._notas)
+
+    def _intervalo(self, termo, prefixo=False):
+        """Posições no vocabulário dos termos iguais a termo (ou que começam com ele)"""
+        inicio = bisect_left(self.vocabulario, termo)
+        if prefixo:
+            return inicio, bisect_left(self.vocabulario, termo + _FIM_PREFIXO)
+        existe = inicio < len(self.vocabulario) and self.vocabulario[inicio] == termo
+        return inicio, inicio + existe
+
+    def ocorrencias(self, termo, prefixo=False):
+        """(notas, posicoes) de todas as ocorrências do termo já dobrado, em ordem de nota e posição"""
+        primeiro, ultimo = self._intervalo(termo, prefixo)
+        fatia = slice(self._inicios[primeiro], self._inicios[ultimo])
+        notas, posicoes = self._notas[fatia], self._posicoes[fatia]
+        if ultimo - primeiro > 1:
+            ordem = np.lexsort((posicoes, notas))
+            notas, posicoes = notas[ordem], posicoes[ordem]
+        return notas, posicoes
+
+    def frequencia(self, termo):
+        """Número de notas com o termo (dobrado aqui)"""
+        return len(_unicos(self.ocorrencias(dobrar(termo))[0]))
+
+    def _notas_clausula(self, clausula):
+        listas = [self.ocorrencias(t, prefixo) for t, prefixo in clausula.termos]
+        if len(listas) == 1:
+            return _unicos(listas[0][0])
+        if clausula.distancia is None:
+            # Frase: nota e posição de início iguais para todos os termos. As
+            # chaves (nota, início) saem ordenadas das listas; as da lista mais
+            # curta são procuradas nas demais por busca binária
+            chaves = [(notas[posicoes >= i].astype(np.int64) << 32) | (posicoes[posicoes >= i] - i)
+                      for i, (notas, posicoes) in enumerate(listas)]
+            chaves.sort(key=len)
+            comuns = chaves[0]
+            for outras in chaves[1:]:
+                if not len(comuns):
+                    break
+                encontradas = np.minimum(np.searchsorted(outras, comuns), max(len(outras) - 1, 0))
+                comuns = comuns[outras[encontradas] == comuns] if len(outras) else outras
+            return _unicos((comuns >> 32).astype(np.int32))
+        resultado = None
+        for a, b in zip(listas, listas[1:]):
+            notas = self._proximas(a, b, clausula.distancia)
+            resultado = notas if resultado is None else np.intersect1d(resultado, notas, assume_unique=True)
+        return resultado
+
+    @staticmethod
+    def _proximas(a, b, distancia):
+        """Notas com uma ocorrência de a e uma de b a até distancia posições"""
+        notas = np.concatenate([a[0], b[0]])
+        posicoes = np.concatenate([a[1], b[1]])
+        rotulos = np.concatenate([np.zeros(len(a[0]), dtype=bool), np.ones(len(b[0]), dtype=bool)])
+        ordem = np.lexsort((posicoes, notas))
+        notas, posicoes, rotulos = notas[ordem], posicoes[ordem], rotulos[ordem]
+        # O par mais próximo de termos diferentes é sempre vizinho na ordem (nota, posição)
+        perto = ((notas[1:] == notas[:-1]) & (rotulos[1:] != rotulos[:-1])
+                 & (posicoes[1:] - posicoes[:-1] <= distancia))
+        return _unicos(notas[1:][perto])
+
+    def buscar(self, consulta):
+        """
+        Notas que atendem à consulta (texto ou lista de Clausula).
+
+        Returns:
+            Array ordenado com a posição das notas em df_processed
+        """
+        clausulas = interpretar_consulta(consulta) if isinstance(consulta, str) else consulta
+        positivas = [c for c in clausulas if not c.negar]
+        if not positivas:
+            return np.zeros(0, dtype=np.int32)
+        resultado = None
+        for clausula in positivas:
+            notas = self._notas_clausula(clausula)
+            resultado = notas if resultado is None else np.intersect1d(resultado, notas, assume_unique=True)
+            if not len(resultado):
+                return resultado
+        for clausula in clausulas:
+            if clausula.negar:
+                resultado = np.setdiff1d(resultado, self._notas_clausula(clausula), assume_unique=True)
+        return resultado
+
+    def pacientes(self, consulta, df_processed):
+        """Pacientes com ao menos uma nota que atende à consulta"""
+        notas = self.buscar(consulta)
+        return pd.Series(df_processed['paciente'].iloc[notas].unique(), name='paciente')
+
+    # --- apoio aos extratores ---
+
+    def _contendo(self, trecho):
+        """Notas com algum termo que contém o trecho (busca no vocabulário, não no texto)"""
+        if trecho not in self._por_trecho:
+            partes = [self.ocorrencias(t)[0] for t in self.vocabulario if trecho in t]
+            self._por_trecho[trecho] = np.unique(np.concatenate(partes)) if partes else np.zeros(0, dtype=np.int32)
+        return self._por_trecho[trecho]
+
+    def notas_candidatas(self, alias):
+        """
+        Notas que podem conter o alias de um extrator. Os extratores procuram o
+        alias como trecho do texto em minúsculas ('ada' casa com 'adalimumabe'),
+        então a busca é feita no vocabulário por termos que contêm cada palavra
+        do alias: o resultado inclui todas as notas em que alias.lower() aparece
+        (e pode incluir outras), servindo de pré-filtro antes das regex.
+        """
+        resultado = None
+        for termo in termos(alias):
+            notas = self._contendo(termo)
+            resultado = notas if resultado is None else np.intersect1d(resultado, notas, assume_unique=True)
+        return np.arange(self.n_notas, dtype=np.int32) if resultado is None else resultado
+
+
+def trecho(texto, consulta, largura=80):
+    """
+    Trecho do texto em volta da primeira palavra da consulta, destacada com **.
+
+    Returns:
+        Texto do trecho ('' se nenhuma palavra da consulta aparece)
+    """
+    clausulas = interpretar_consulta(consulta) if isinstance(consulta, str) else consulta
+    procurados = [(t, prefixo) for c in clausulas if not c.negar for t, prefixo in c.termos]
+    if not isinstance(texto, str):
+        return ''
+    for palavra in _PALAVRA.finditer(texto):
+        termo = dobrar(palavra.group())
+        if any(termo.startswith(t) if prefixo else termo == t for t, prefixo in procurados):
+            inicio, fim = max(0, palavra.start() - largura), min(len(texto), palavra.end() + largura)
+            return ('…' if inicio else '') + texto[inicio:palavra.start()] + f'**{palavra.group()}**' \
+                + texto[palavra.end():fim] + ('…' if fim < len(texto) else '')
+    return ''
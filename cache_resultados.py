@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Cache Compartilhado de Resultados do ETL - IMMUNED
+Cache único por processo, com limite de memória e descarte LRU, indexado por
+(hash do arquivo, impressão digital da configuração). Sessões que processam a
+mesma exportação com a mesma configuração recebem os mesmos DataFrames, sem
+reprocessar e sem duplicar memória.
+
+Os DataFrames devolvidos são compartilhados entre sessões e não devem ser
+alterados no lugar.
+"""
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from pipeline_etl import normalizar_config
+
+
+def hash_conteudo(conteudo):
+    """Hash SHA-256 (hex) dos bytes do arquivo enviado"""
+    return hashlib.sha256(conteudo).hexdigest()
+
+
+def impressao_config(config):
+    """Impressão digital estável da configuração (independente da ordem das chaves)"""
+    normalizada = normalizar_config(config)
+    serializada = json.dumps(normalizada, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(serializada.encode('utf-8')).hexdigest()[:16]
+
+
+def chave_resultado(conteudo, config):
+    """Chave do cache para um arquivo (bytes) e uma configuração"""
+    return (hash_conteudo(conteudo), impressao_config(config))
+
+
+def tamanho_resultado(resultado):
+    """Memória aproximada (bytes) dos DataFrames de um resultado do pipeline"""
+    return int(sum(
+        valor.memory_usage(index=True, deep=True).sum()
+        for valor in resultado.values()
+        if hasattr(valor, 'memory_usage')
+    ))
+
+
+class CacheResultadosETL:
+    """
+    Cache LRU limitado por memória.
+
+    Args:
+        limite_bytes: memória máxima ocupada pelos resultados guardados
+    """
+
+    def __init__(self, limite_bytes=1024 * 1024 * 1024):
+        self.limite_bytes = limite_bytes
+        self._itens = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes_ocupados = 0
+        self.acertos = 0
+        self.falhas = 0
+
+    def obter(self, chave):
+        """Resultado guardado para a chave (ou None), marcando-o como recém-usado"""
+        with self._lock:
+            item = self._itens.get(chave)
+            if item is None:
+                self.falhas += 1
+                return None
+            self._itens.move_to_end(chave)
+            self.acertos += 1
+            return item['resultado']
+
+    def guardar(self, chave, resultado):
+        """Guarda um resultado, descartando os menos usados se passar do limite"""
+        tamanho = tamanho_resultado(resultado)
+        if tamanho > self.limite_bytes:
+            return False
+
+        with self._lock:
+            if chave in self._itens:
+                self.bytes_ocupados -= self._itens.pop(chave)['tamanho']
+            self._itens[chave] = {'resultado': resultado, 'tamanho': tamanho}
+            self.bytes_ocupados += tamanho
+
+            while self.bytes_ocupados > self.limite_bytes:
+                _, antigo = self._itens.popitem(last=False)
+                self.bytes_ocupados -= antigo['tamanho']
+        return True
+
+    def estatisticas(self):
+        with self._lock:
+            return {
+                'itens': len(self._itens),
+                'mb_ocupados': round(self.bytes_ocupados / 1024 ** 2, 1),
+                'mb_limite': round(self.limite_bytes / 1024 ** 2, 1),
+                'acertos': self.acertos,
+                'falhas': self.falhas,
+            }
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Checkpoints do ETL - IMMUNED
+Guarda em disco o progresso de uma execução longa para que ela possa ser
+retomada depois de uma queda (servidor reiniciado, runtime do Colab
+reciclado, processo interrompido):
+
+- cada bloco de extração concluído, com o nome dado pelo hash do conteúdo
+  do bloco: ao retomar, só blocos com exatamente a mesma entrada são
+  reaproveitados
+- as etapas seguintes (extração completa e base longitudinal), com o
+  relatório até ali
+
+As tabelas são gravadas em pickle, que reproduz exatamente os tipos das
+colunas (object, categorias, strings Arrow): uma execução retomada dá o
+mesmo resultado de uma execução contínua. São arquivos temporários, lidos
+apenas pelo próprio pipeline.
+
+Os checkpoints de uma pasta pertencem a uma única combinação de entrada,
+configuração e versão do código; qualquer mudança descarta os anteriores.
+
+Estrutura:
+    <pasta>/
+    ├── manifesto.json
+    ├── bloco_<hash>.pkl
+    ├── etapa_<nome>_<tabela>.pkl
+    └── etapa_<nome>.json          (gravado por último: marca a etapa como concluída)
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+import pandas as pd
+
+from artefatos_etl import versao_codigo
+from cache_resultados import impressao_config
+
+
+def hash_dataframe(df):
+    """Hash SHA-256 (hex) do conteúdo de um DataFrame (valores e nomes das colunas)"""
+    h = hashlib.sha256()
+    h.update(json.dumps([str(c) for c in df.columns]).encode('utf-8'))
+    h.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return h.hexdigest()
+
+
+def _gravar_tabela(df, caminho):
+    temporario = caminho + '.tmp'
+    df.to_pickle(temporario)
+    os.replace(temporario, caminho)
+
+
+def _gravar_json(dados, caminho):
+    temporario = caminho + '.tmp'
+    with open(temporario, 'w', encoding='utf-8') as f:
+        json.dump(dados, f, ensure_ascii=False, indent=2, default=str)
+    os.replace(temporario, caminho)
+
+
+class CheckpointsETL:
+    """
+    Args:
+        pasta: diretório dos checkpoints de uma execução
+        retomar: se False, checkpoints existentes são descartados em iniciar()
+    """
+
+    def __init__(self, pasta, retomar=True):
+        self.pasta = pasta
+        self.retomar = retomar
+        self.blocos_retomados = 0
+        self.etapas_retomadas = []
+
+    @property
+    def _caminho_manifesto(self):
+        return os.path.join(self.pasta, 'manifesto.json')
+
+    def iniciar(self, hash_entrada, config):
+        """Associa a pasta à entrada e configuração, descartando checkpoints de outra execução"""
+        manifesto = {
+            'hash_entrada': hash_entrada,
+            'hash_config': impressao_config(config),
+            'versao_codigo': versao_codigo(),
+        }
+        anterior = None
+        if os.path.exists(self._caminho_manifesto):
+            with open(self._caminho_manifesto, encoding='utf-8') as f:
+                anterior = json.load(f)
+        if not self.retomar or anterior != manifesto:
+            shutil.rmtree(self.pasta, ignore_errors=True)
+        os.makedirs(self.pasta, exist_ok=True)
+        _gravar_json(manifesto, self._caminho_manifesto)
+
+    def limpar(self):
+        """Remove todos os checkpoints (execução concluída e salva em outro lugar)"""
+        shutil.rmtree(self.pasta, ignore_errors=True)
+
+    # --- blocos de extração ---
+
+    def _caminho_bloco(self, hash_bloco):
+        return os.path.join(self.pasta, f'bloco_{hash_bloco}.pkl')
+
+    @staticmethod
+    def hash_bloco(bloco):
+        return hash_dataframe(bloco)
+
+    def carregar_bloco(self, hash_bloco):
+        """Resultado salvo do bloco com este hash de entrada (ou None)"""
+        caminho = self._caminho_bloco(hash_bloco)
+        if not os.path.exists(caminho):
+            return None
+        self.blocos_retomados += 1
+        return pd.read_pickle(caminho)
+
+    def salvar_bloco(self, hash_bloco, df):
+        _gravar_tabela(df, self._caminho_bloco(hash_bloco))
+
+    # --- etapas ---
+
+    def carregar_etapa(self, nome):
+        """
+        Etapa concluída anteriormente.
+
+        Returns:
+            (dict nome -> DataFrame, relatorio até a etapa) ou None
+        """
+        caminho = os.path.join(self.pasta, f'etapa_{nome}.json')
+        if not os.path.exists(caminho):
+            return None
+        with open(caminho, encoding='utf-8') as f:
+            salvo = json.load(f)
+        tabelas = {
+            tabela: pd.read_pickle(os.path.join(self.pasta, f'etapa_{nome}_{tabela}.pkl'))
+            for tabela in salvo['tabelas']
+        }
+        self.etapas_retomadas.append(nome)
+        return tabelas, salvo['relatorio']
+
+    def salvar_etapa(self, nome, tabelas, relatorio):
+        for tabela, df in tabelas.items():
+            _gravar_tabela(df, os.path.join(self.pasta, f'etapa_{nome}_{tabela}.pkl'))
+        _gravar_json({'tabelas': list(tabelas), 'relatorio': relatorio},
+                     os.path.join(self.pasta, f'etapa_{nome}.json'))
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Cubo de Resposta por Subgrupos - IMMUNED
+Agregação única (grouping sets) de melhoraram/total sobre todas as dimensões
+de subgrupo da base longitudinal. O agrupamento pela combinação completa das
+dimensões é feito uma vez; os demais conjuntos (cada dimensão isolada, pares
+como sexo × biológico, etc.) são consolidados a partir dele. Qualquer tabela
+de taxa de resposta por subgrupo passa a ser uma consulta a um dicionário.
+"""
+
+from itertools import combinations
+
+import pandas as pd
+
+FAIXAS_ETARIAS = ['<30', '30-40', '40-50', '50-60', '60-70', '>70']
+
+# Dimensões na ordem em que aparecem no índice das tabelas
+DIMENSOES_SUBGRUPOS = ['sexo', 'faixa_etaria', 'fr_resultado', 'tem_comorbidade',
+                       'uso_biologico', 'biologico_nome']
+
+
+def dimensoes_subgrupos(df_long):
+    """
+    Colunas de dimensão derivadas da base longitudinal (sem alterá-la).
+
+    Returns:
+        DataFrame com as dimensões disponíveis e a coluna improvement
+    """
+    dimensoes = pd.DataFrame(index=df_long.index)
+    if 'sexo' in df_long.columns:
+        dimensoes['sexo'] = df_long['sexo']
+    if 'idade' in df_long.columns:
+        dimensoes['faixa_etaria'] = pd.cut(df_long['idade'], bins=[0, 30, 40, 50, 60, 70, 120],
+                                           labels=FAIXAS_ETARIAS)
+    if 'fr_resultado' in df_long.columns:
+        dimensoes['fr_resultado'] = df_long['fr_resultado']
+    if 'comorbidade_qualquer' in df_long.columns:
+        dimensoes['tem_comorbidade'] = df_long['comorbidade_qualquer'].map({
+            0: 'Sem Comorbidades', 1: 'Com Comorbidades'
+        })
+    if 'uso_biologico' in df_long.columns:
+        dimensoes['uso_biologico'] = df_long['uso_biologico']
+    if 'biologico_nome' in df_long.columns:
+        dimensoes['biologico_nome'] = df_long['biologico_nome']
+    # Enumerações categóricas do ETL viram texto: os subgrupos seguem a ordem alfabética
+    for coluna in ['sexo', 'fr_resultado', 'uso_biologico', 'biologico_nome']:
+        if coluna in dimensoes.columns and isinstance(dimensoes[coluna].dtype, pd.CategoricalDtype):
+            dimensoes[coluna] = dimensoes[coluna].astype(object)
+    dimensoes['improvement'] = df_long['improvement']
+    return dimensoes
+
+
+def agregado_subgrupos(df_long):
+    """
+    Agregação base do cubo: melhoraram (sum) e total (count) por combinação
+    completa das dimensões disponíveis, com valores ausentes preservados.
+    Agregados de bases diferentes se somam (ver agregados_parciais).
+    """
+    dados = dimensoes_subgrupos(df_long)
+    dimensoes = [d for d in DIMENSOES_SUBGRUPOS if d in dados.columns]
+    if not dimensoes:
+        return dados['improvement'].agg(['sum', 'count']).to_frame().T
+    return dados.groupby(dimensoes, dropna=False, observed=True)['improvement'].agg(['sum', 'count'])
+
+
+class CuboResposta:
+    """
+    Args:
+        df_long: base longitudinal com a coluna improvement
+        max_dimensoes: maior combinação de dimensões pré-calculada (None = todas)
+    """
+
+    def __init__(self, df_long, max_dimensoes=None):
+        self._montar(agregado_subgrupos(df_long), max_dimensoes)
+
+    @classmethod
+    def do_agregado(cls, base, max_dimensoes=None):
+        """Cubo a partir de uma agregação base já calculada (ou combinada entre centros)"""
+        cubo = cls.__new__(cls)
+        cubo._montar(base, max_dimensoes)
+        return cubo
+
+    def _montar(self, base, max_dimensoes):
+        self.dimensoes = [d for d in DIMENSOES_SUBGRUPOS if d in base.index.names]
+        # Dimensões ordinais: tabelas isoladas mostram todas as faixas, mesmo vazias
+        self.categorias = {'faixa_etaria': FAIXAS_ETARIAS} if 'faixa_etaria' in self.dimensoes else {}
+
+        self._conjuntos = {(): self._com_taxa(base[['sum', 'count']].sum().rename('improvement').to_frame().T)}
+        if not self.dimensoes:
+            return
+
+        limite = len(self.dimensoes) if max_dimensoes is None else max_dimensoes
+        for tamanho in range(1, limite + 1):
+            for conjunto in combinations(self.dimensoes, tamanho):
+                self._conjuntos[conjunto] = self._com_taxa(
+                    base.groupby(level=list(conjunto), dropna=True, observed=True).sum()
+                )
+
+    @staticmethod
+    def _com_taxa(tabela):
+        tabela = tabela.astype({'sum': int, 'count': int})
+        tabela['taxa'] = tabela['sum'] / tabela['count'] * 100
+        return tabela
+
+    def _conjunto(self, dimensoes):
+        ordenado = tuple(d for d in self.dimensoes if d in dimensoes)
+        if len(ordenado) != len(dimensoes):
+            raise KeyError(f"Dimensão indisponível: {', '.join(set(dimensoes) - set(ordenado))}")
+        if ordenado not in self._conjuntos:
+            raise KeyError(f"Combinação não pré-calculada: {' × '.join(ordenado)}")
+        return ordenado
+
+    def tabela(self, *dimensoes):
+        """
+        Melhoraram (sum), total (count) e taxa (%) por subgrupo, indexados pelas
+        dimensões na ordem pedida. Uma dimensão categórica isolada (faixa
+        etária) inclui as categorias vazias, com total 0.
+        """
+        tabela = self._conjuntos[self._conjunto(dimensoes)]
+        if len(dimensoes) > 1:
+            tabela = tabela.reorder_levels(list(dimensoes)).sort_index()
+        elif len(dimensoes) == 1 and dimensoes[0] in self.categorias:
+            tabela = tabela.reindex(pd.CategoricalIndex(
+                self.categorias[dimensoes[0]], categories=self.categorias[dimensoes[0]],
+                ordered=True, name=dimensoes[0]
+            ))
+            tabela[['sum', 'count']] = tabela[['sum', 'count']].fillna(0).astype(int)
+        return tabela.copy()
+
+    def celula(self, **valores):
+        """Totais de um subgrupo, ex.: celula(sexo='F', biologico_nome='adalimumabe')"""
+        tabela = self._conjuntos[self._conjunto(tuple(valores))]
+        chave = tuple(valores[d] for d in self.dimensoes if d in valores)
+        linha = tabela.loc[chave[0] if len(chave) == 1 else chave]
+        return {'melhoraram': int(linha['sum']), 'total': int(linha['count']), 'taxa': float(linha['taxa'])}
+
+    @property
+    def conjuntos(self):
+        return list(self._conjuntos)
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+Execução em Lote do ETL - IMMUNED
+Roda o mesmo pipeline da aplicação Streamlit sem navegador, a partir de um
+arquivo de configuração JSON, e grava as saídas em Parquet com um relatório.
+
+Uso:
+    python etl_batch.py exportacao.xlsx --config config_etl_exemplo.json --saida resultados/
+    python etl_batch.py exportacao.csv --streaming --linhas-por-parte 100000   # memória limitada
+    python etl_batch.py exportacao.xlsx --checkpoints ckpt/ --retomar            # retoma após queda
+    python etl_batch.py exportacao.xlsx --banco                                  # + coorte.sqlite para consultas
+    python etl_batch.py exportacao.csv --shard 0/4 --saida shard_0/              # um nó de 4 (ver shards_etl)
+    python etl_batch.py --juntar shard_0/ shard_1/ shard_2/ shard_3/ --saida final/
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import pandas as pd
+
+from banco_coortes import gravar_banco
+from checkpoints_etl import CheckpointsETL
+from etl_streaming import LINHAS_POR_PARTE, N_PARTICOES, executar_pipeline_streaming
+from pipeline_etl import executar_pipeline, normalizar_config
+from shards_etl import carregar_shard, descricao_shard, interpretar_shard, juntar_shards
+
+
+def carregar_entrada(caminho):
+    """Lê o arquivo de prontuários (CSV, Excel ou Parquet)"""
+    extensao = os.path.splitext(caminho)[1].lower()
+    if extensao == '.csv':
+        df = pd.read_csv(caminho)
+    elif extensao in ('.xlsx', '.xls'):
+        df = pd.read_excel(caminho)
+    elif extensao == '.parquet':
+        df = pd.read_parquet(caminho)
+    else:
+        raise ValueError(f"Formato de arquivo não suportado: {extensao}")
+
+    if 'data_hora' in df.columns:
+        df['data_hora'] = pd.to_datetime(df['data_hora'], errors='coerce')
+    return df
+
+
+def carregar_config(caminho):
+    """Lê a configuração JSON do ETL (chaves ausentes usam CONFIG_PADRAO)"""
+    if caminho is None:
+        return normalizar_config()
+    with open(caminho, encoding='utf-8') as f:
+        return normalizar_config(json.load(f))
+
+
+def executar_lote(entrada, config, pasta_saida, n_workers=1, tamanho_bloco=5000, log=print,
+                  streaming=False, linhas_por_parte=LINHAS_POR_PARTE, n_particoes=N_PARTICOES,
+                  pasta_checkpoints=None, retomar=False, shard=None, banco=False):
+    """
+    Executa o ETL completo e grava dados_processados.parquet,
+    dados_longitudinais.parquet, dados_pacientes.parquet,
+    textos_prontuarios.parquet (com texto_descricao='comprimido'),
+    indice_busca.parquet (com indice_busca=true), evidencias_extracao.parquet
+    (com evidencias=true) e relatorio_execucao.json em pasta_saida.
+
+    Com streaming=True a entrada é lida em partes de linhas_por_parte
+    registros e as etapas por paciente rodam em n_particoes partições
+    (ver etl_streaming), sem carregar o arquivo inteiro em memória.
+
+    Com pasta_checkpoints, cada bloco extraído e cada etapa concluída são
+    gravados ali (ver checkpoints_etl); com retomar=True, uma execução
+    interrompida com a mesma entrada e configuração continua de onde parou.
+    Os checkpoints são removidos quando as saídas são gravadas.
+
+    Com shard=(i, N), só os pacientes do shard i de N são lidos e processados
+    (ver shards_etl); as saídas de todos os shards são unidas com juntar_shards.
+
+    Com banco=True, as tabelas também são gravadas em coorte.sqlite, com
+    índices para consultas de coorte (ver banco_coortes).
+
+    Returns:
+        Dict com o relatório da execução
+    """
+    os.makedirs(pasta_saida, exist_ok=True)
+    inicio = time.perf_counter()
+
+    if streaming and (pasta_checkpoints or shard or banco):
+        raise ValueError("Checkpoints, shards e banco de coortes não estão disponíveis no modo streaming")
+
+    if streaming:
+        log(f"[ETL] Lendo {entrada} em partes de {linhas_por_parte} registros...")
+        relatorio, saidas = executar_pipeline_streaming(
+            entrada, config, pasta_saida, n_workers=n_workers, tamanho_bloco=tamanho_bloco,
+            linhas_por_parte=linhas_por_parte, n_particoes=n_particoes,
+            progresso=lambda etapa, mensagem: log(f"[{etapa}] {mensagem}")
+        )
+        return _gravar_relatorio(relatorio, entrada, config, n_workers, saidas, pasta_saida, inicio, log)
+
+    if shard is not None:
+        log(f"[ETL] Lendo os pacientes do shard {shard[0]}/{shard[1]} de {entrada}...")
+        df = carregar_shard(entrada, *shard, linhas_por_parte=linhas_por_parte)
+    else:
+        log(f"[ETL] Lendo {entrada}...")
+        df = carregar_entrada(entrada)
+    tempo_leitura = time.perf_counter() - inicio
+
+    checkpoints = CheckpointsETL(pasta_checkpoints, retomar=retomar) if pasta_checkpoints else None
+    resultado = executar_pipeline(
+        df, config, n_workers=n_workers, tamanho_bloco=tamanho_bloco,
+        progresso=lambda etapa, mensagem: log(f"[{etapa}] {mensagem}"),
+        checkpoints=checkpoints
+    )
+
+    saidas = {
+        'dados_processados': os.path.join(pasta_saida, 'dados_processados.parquet'),
+        'dados_longitudinais': os.path.join(pasta_saida, 'dados_longitudinais.parquet'),
+        'dados_pacientes': os.path.join(pasta_saida, 'dados_pacientes.parquet'),
+    }
+    resultado['df_processed'].to_parquet(saidas['dados_processados'], index=False)
+    resultado['df_longitudinal'].to_parquet(saidas['dados_longitudinais'], index=False)
+    resultado['df_pacientes'].to_parquet(saidas['dados_pacientes'], index=False)
+    if 'textos' in resultado:
+        saidas['textos_prontuarios'] = os.path.join(pasta_saida, 'textos_prontuarios.parquet')
+        resultado['textos'].to_parquet(saidas['textos_prontuarios'], index=False)
+    if 'indice_busca' in resultado:
+        saidas['indice_busca'] = os.path.join(pasta_saida, 'indice_busca.parquet')
+        resultado['indice_busca'].to_parquet(saidas['indice_busca'], index=False)
+    if 'evidencias' in resultado:
+        saidas['evidencias_extracao'] = os.path.join(pasta_saida, 'evidencias_extracao.parquet')
+        resultado['evidencias'].to_parquet(saidas['evidencias_extracao'], index=False)
+    if banco:
+        saidas['banco_coortes'] = os.path.join(pasta_saida, 'coorte.sqlite')
+        log(f"[ETL] Gravando banco de coortes em {saidas['banco_coortes']}...")
+        gravar_banco(saidas['banco_coortes'], resultado)
+
+    if checkpoints is not None:
+        checkpoints.limpar()
+
+    relatorio = resultado['relatorio']
+    relatorio['etapas'] = {'leitura': round(tempo_leitura, 3), **relatorio['etapas']}
+    if shard is not None:
+        relatorio['shard'] = descricao_shard(*shard, config)
+    return _gravar_relatorio(relatorio, entrada, config, n_workers, saidas, pasta_saida, inicio, log)
+
+
+def _gravar_relatorio(relatorio, entrada, config, n_workers, saidas, pasta_saida, inicio, log):
+    relatorio.update({
+        'entrada': os.path.abspath(entrada),
+        'data_execucao': datetime.now().isoformat(timespec='seconds'),
+        'n_workers': n_workers,
+        'config': config,
+        'saidas': saidas,
+        'tempo_total_s': round(time.perf_counter() - inicio, 3),
+    })
+
+    caminho_relatorio = os.path.join(pasta_saida, 'relatorio_execucao.json')
+    with open(caminho_relatorio, 'w', encoding='utf-8') as f:
+        json.dump(relatorio, f, ensure_ascii=False, indent=2, default=str)
+
+    log(f"[ETL] Concluído em {relatorio['tempo_total_s']:.1f}s - relatório em {caminho_relatorio}")
+    return relatorio
+
+
+def pasta_shard(pasta_saida, indice, n_shards):
+    return os.path.join(pasta_saida, f'shard_{indice:03d}_de_{n_shards:03d}')
+
+
+def executar_shards_locais(entrada, config, pasta_saida, n_shards, tamanho_bloco=5000, log=print):
+    """
+    Roda cada shard em um processo local (no lugar de um nó) e junta as saídas
+    em pasta_saida; as pastas de cada shard ficam em pasta_saida/shard_*.
+
+    Returns:
+        Relatório combinado (ver juntar_shards)
+    """
+    pastas = [pasta_shard(pasta_saida, i, n_shards) for i in range(n_shards)]
+    with ProcessPoolExecutor(max_workers=n_shards) as executor:
+        futuros = [
+            executor.submit(executar_lote, entrada, config, pasta, 1, tamanho_bloco, print, shard=(i, n_shards))
+            for i, pasta in enumerate(pastas)
+        ]
+        for futuro in futuros:
+            futuro.result()
+    return juntar_shards(pastas, pasta_saida, log=log)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Executa o ETL IMMUNED em lote (sem Streamlit)")
+    parser.add_argument('entrada', nargs='?', help="Arquivo de prontuários (.csv, .xlsx, .xls ou .parquet)")
+    parser.add_argument('--config', help="Arquivo JSON de configuração do ETL")
+    parser.add_argument('--saida', default='resultados_etl', help="Pasta de saída (padrão: resultados_etl)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="Processos paralelos para a extração (padrão: número de CPUs)")
+    parser.add_argument('--tamanho-bloco', type=int, default=5000,
+                        help="Registros por bloco enviado a cada processo (padrão: 5000)")
+    parser.add_argument('--checkpoints', metavar='PASTA',
+                        help="Grava blocos e etapas concluídos nesta pasta durante a execução")
+    parser.add_argument('--retomar', action='store_true',
+                        help="Retoma uma execução interrompida a partir dos checkpoints (requer --checkpoints)")
+    parser.add_argument('--shard', metavar='i/N',
+                        help="Processa apenas os pacientes do shard i de N (um nó de uma execução distribuída)")
+    parser.add_argument('--shards-locais', type=int, metavar='N',
+                        help="Roda N shards em processos locais e junta as saídas")
+    parser.add_argument('--juntar', nargs='+', metavar='PASTA',
+                        help="Valida e junta as pastas de saída dos shards em --saida")
+    parser.add_argument('--banco', action='store_true',
+                        help="Grava também coorte.sqlite, com índices para consultas de coorte")
+    parser.add_argument('--streaming', action='store_true',
+                        help="Lê a entrada em partes e processa por partições de pacientes (memória limitada)")
+    parser.add_argument('--linhas-por-parte', type=int, default=LINHAS_POR_PARTE,
+                        help=f"Registros lidos por vez no modo streaming (padrão: {LINHAS_POR_PARTE})")
+    parser.add_argument('--particoes', type=int, default=N_PARTICOES,
+                        help=f"Partições por paciente no modo streaming (padrão: {N_PARTICOES})")
+    args = parser.parse_args(argv)
+
+    if args.juntar is None and args.entrada is None:
+        parser.error("informe o arquivo de entrada (ou --juntar)")
+
+    try:
+        if args.juntar is not None:
+            juntar_shards(args.juntar, args.saida)
+            return 0
+        config = carregar_config(args.config)
+        if args.shards_locais:
+            executar_shards_locais(args.entrada, config, args.saida, args.shards_locais,
+                                   tamanho_bloco=args.tamanho_bloco)
+            return 0
+        executar_lote(args.entrada, config, args.saida,
+                      n_workers=args.workers, tamanho_bloco=args.tamanho_bloco,
+                      streaming=args.streaming, linhas_por_parte=args.linhas_por_parte,
+                      n_particoes=args.particoes, pasta_checkpoints=args.checkpoints,
+                      retomar=args.retomar,
+                      shard=interpretar_shard(args.shard) if args.shard else None,
+                      banco=args.banco)
+    except Exception as e:
+        print(f"[ERRO] {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
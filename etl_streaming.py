@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""
+ETL em Fluxo (Streaming) - IMMUNED
+Processa exportações maiores que a memória disponível com as mesmas regras
+de executar_pipeline, lendo a entrada em partes de tamanho fixo:
+
+1. Cada parte é lida (CSV em blocos, Excel com openpyxl read-only, Parquet
+   por lotes), deduplicada, extraída e gravada em Parquet, já dividida em
+   partições por hash do paciente. Só as impressões digitais das notas já
+   vistas (8 bytes por nota) e os pares (paciente, tipo) ficam em memória.
+2. Com os pacientes válidos conhecidos, cada partição (que contém todos os
+   registros dos seus pacientes) é carregada sozinha, ordenada e passa pelas
+   etapas por paciente: base longitudinal, melhora, tempo mínimo e tabela de
+   pacientes.
+3. As saídas de cada partição são concatenadas, lote a lote, em um único
+   arquivo Parquet por tabela.
+
+Diferenças em relação ao pipeline em memória:
+- as linhas saem agrupadas por partição (dentro dela, na ordem original; as
+  tabelas de pacientes e longitudinal em ordem de paciente)
+- entre partes diferentes, a deduplicação compara apenas as impressões de
+  64 bits (sem conferir o texto) e notas quase duplicadas só reaproveitam a
+  extração de notas da mesma parte
+"""
+
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from pipeline_etl import (
+    COLUNAS_OBRIGATORIAS, REGISTRO, _extrair_em_blocos, base_longitudinal, calcular_melhora,
+    construir_tabela_pacientes, extrair_registros, filtrar_tempo_minimo, normalizar_config,
+    remover_duplicatas, separar_evidencias, tipos_longitudinais,
+)
+from busca_textos import construir_indice
+from textos_prontuarios import separar_texto
+
+# Registros lidos de cada vez
+LINHAS_POR_PARTE = 100_000
+
+# Partições por paciente: cada uma precisa caber em memória na segunda fase
+N_PARTICOES = 32
+
+# Nomes dos arquivos de saída (os mesmos da execução em lote)
+SAIDAS = {
+    'df_processed': 'dados_processados',
+    'df_longitudinal': 'dados_longitudinais',
+    'df_pacientes': 'dados_pacientes',
+    'textos': 'textos_prontuarios',
+    'indice_busca': 'indice_busca',
+    'evidencias': 'evidencias_extracao',
+}
+
+
+# =============================================================================
+# LEITURA EM PARTES
+# =============================================================================
+
+def _partes_excel(caminho, linhas_por_parte):
+    from openpyxl import load_workbook
+
+    livro = load_workbook(caminho, read_only=True, data_only=True)
+    try:
+        linhas = livro.active.iter_rows(values_only=True)
+        cabecalho = next(linhas, None)
+        if cabecalho is None:
+            return
+        parte = []
+        for linha in linhas:
+            if all(valor is None for valor in linha):
+                continue
+            parte.append(linha)
+            if len(parte) == linhas_por_parte:
+                yield pd.DataFrame(parte, columns=cabecalho)
+                parte = []
+        if parte:
+            yield pd.DataFrame(parte, columns=cabecalho)
+    finally:
+        livro.close()
+
+
+def ler_em_partes(caminho, linhas_por_parte=LINHAS_POR_PARTE):
+    """Gera DataFrames de até linhas_por_parte registros (CSV, Excel .xlsx ou Parquet)"""
+    extensao = os.path.splitext(caminho)[1].lower()
+    if extensao == '.csv':
+        partes = pd.read_csv(caminho, chunksize=linhas_por_parte)
+    elif extensao == '.xlsx':
+        partes = _partes_excel(caminho, linhas_por_parte)
+    elif extensao == '.parquet':
+        partes = (lote.to_pandas() for lote in pq.ParquetFile(caminho).iter_batches(batch_size=linhas_por_parte))
+    else:
+        raise ValueError(f"Formato não suportado no modo streaming: {extensao} (use .csv, .xlsx ou .parquet)")
+
+    for parte in partes:
+        if 'data_hora' in parte.columns:
+            parte['data_hora'] = pd.to_datetime(parte['data_hora'], errors='coerce')
+        yield parte
+
+
+# =============================================================================
+# ESTADO ENTRE PARTES
+# =============================================================================
+
+class ImpressoesVistas:
+    """Impressões digitais das notas já mantidas, em um array uint64 ordenado"""
+
+    def __init__(self):
+        self._valores = np.empty(0, dtype=np.uint64)
+
+    def __len__(self):
+        return len(self._valores)
+
+    def novas(self, impressoes):
+        """Máscara das impressões ainda não vistas, que passam a ser conhecidas"""
+        impressoes = np.asarray(impressoes, dtype=np.uint64)
+        posicoes = np.searchsorted(self._valores, impressoes)
+        vistas = posicoes < len(self._valores)
+        vistas[vistas] = self._valores[posicoes[vistas]] == impressoes[vistas]
+        novas = np.unique(impressoes[~vistas])
+        self._valores = np.insert(self._valores, np.searchsorted(self._valores, novas), novas)
+        return ~vistas
+
+
+def hash_pacientes(pacientes):
+    """Hash uint64 de cada identificador de paciente, estável entre partes, processos e máquinas"""
+    # Numéricos como float64: o mesmo paciente lido como int em uma parte e
+    # float (parte com nulos) em outra tem o mesmo hash
+    if pd.api.types.is_numeric_dtype(pacientes):
+        pacientes = pacientes.astype('float64')
+    else:
+        pacientes = pacientes.astype(str)
+    return pd.util.hash_pandas_object(pacientes, index=False).to_numpy()
+
+
+def particao_paciente(pacientes, n_particoes):
+    """Partição (0..n_particoes-1) de cada paciente, estável entre partes lidas"""
+    return (hash_pacientes(pacientes) % np.uint64(n_particoes)).astype(np.int64)
+
+
+# =============================================================================
+# ARQUIVOS TEMPORÁRIOS
+# =============================================================================
+
+def _ler_partes(pasta):
+    if not os.path.isdir(pasta):
+        return None
+    arquivos = sorted(os.listdir(pasta))
+    return pd.concat([pd.read_parquet(os.path.join(pasta, nome)) for nome in arquivos], ignore_index=True)
+
+
+def juntar_parquet(arquivos, destino, deslocamentos=None):
+    """
+    Concatena arquivos Parquet em um só, uma tabela por vez. Os esquemas são
+    unificados (coluna só com nulos em uma parte, inteiro em uma e float em outra).
+
+    Args:
+        deslocamentos: lista opcional (um item por arquivo) de {coluna: valor}
+                       somado às colunas inteiras daquele arquivo (ids contínuos)
+    """
+    esquemas = [pq.read_schema(arquivo).remove_metadata() for arquivo in arquivos]
+    esquema = pa.unify_schemas(esquemas, promote_options='permissive')
+    with pq.ParquetWriter(destino, esquema) as escritor:
+        for i, arquivo in enumerate(arquivos):
+            tabela = pq.read_table(arquivo).replace_schema_metadata(None)
+            for coluna, valor in (deslocamentos[i] if deslocamentos else {}).items():
+                indice = tabela.schema.get_field_index(coluna)
+                somada = pc.add_checked(tabela[coluna], pa.scalar(valor, tabela[coluna].type))
+                tabela = tabela.set_column(indice, coluna, somada)
+            for campo in esquema:
+                if campo.name not in tabela.column_names:
+                    tabela = tabela.append_column(campo.name, pa.nulls(len(tabela), campo.type))
+            escritor.write_table(tabela.select(esquema.names).cast(esquema))
+
+
+# =============================================================================
+# EXECUÇÃO
+# =============================================================================
+
+def executar_pipeline_streaming(entrada, config, pasta_saida, n_workers=1, tamanho_bloco=5000,
+                                linhas_por_parte=LINHAS_POR_PARTE, n_particoes=N_PARTICOES, progresso=None):
+    """
+    Executa o ETL completo sobre um arquivo, em memória limitada, e grava as
+    saídas em Parquet em pasta_saida (ver SAIDAS).
+
+    Returns:
+        (relatorio, dict nome da saída -> caminho do arquivo)
+    """
+    config = normalizar_config(config)
+    relatorio = {'etapas': {}, 'registros_entrada': 0, 'duplicatas_removidas': 0,
+                 'partes_lidas': 0, 'particoes': n_particoes, 'conjunto_regras': REGISTRO.descricao()}
+    if config['reaproveitar_quase_duplicatas']:
+        relatorio['notas_reaproveitadas'] = 0
+    medicoes = {}
+
+    def notificar(etapa, mensagem):
+        if progresso:
+            progresso(etapa, mensagem)
+
+    def cronometrar(etapa, inicio):
+        relatorio['etapas'][etapa] = round(relatorio['etapas'].get(etapa, 0) + time.perf_counter() - inicio, 3)
+
+    def extrair(df_parcial):
+        return _extrair_em_blocos(df_parcial, config, n_workers, tamanho_bloco,
+                                  lambda concluidos, total: None, lambda: False,
+                                  medicoes=medicoes)
+
+    os.makedirs(pasta_saida, exist_ok=True)
+    temporaria = tempfile.mkdtemp(prefix='_partes_', dir=pasta_saida)
+    try:
+        vistas = ImpressoesVistas()
+        pares = []
+        linha_inicial = 0
+
+        # FASE 1: ler, deduplicar, extrair e gravar por partição
+        for numero, parte in enumerate(ler_em_partes(entrada, linhas_por_parte)):
+            inicio = time.perf_counter()
+            if numero == 0:
+                ausentes = [c for c in COLUNAS_OBRIGATORIAS if c not in parte.columns]
+                if ausentes:
+                    raise ValueError(f"Colunas obrigatórias ausentes: {', '.join(ausentes)}")
+            parte['_linha'] = np.arange(linha_inicial, linha_inicial + len(parte), dtype=np.int64)
+            linha_inicial += len(parte)
+
+            unicos = remover_duplicatas(parte, config)
+            unicos = unicos[vistas.novas(unicos['impressao_texto'])].reset_index(drop=True)
+            relatorio['registros_entrada'] += len(parte)
+            relatorio['duplicatas_removidas'] += len(parte) - len(unicos)
+            cronometrar('deduplicacao', inicio)
+
+            inicio = time.perf_counter()
+            extraidos, reaproveitadas = extrair_registros(unicos, config, extrair)
+            if reaproveitadas is not None:
+                relatorio['notas_reaproveitadas'] += reaproveitadas
+            cronometrar('extracao', inicio)
+
+            inicio = time.perf_counter()
+            extraidos = extraidos[extraidos['paciente'].notna()]
+            pares.append(extraidos.groupby(['paciente', 'tipo'], sort=False, observed=True)['_linha'].min())
+            particoes = particao_paciente(extraidos['paciente'], n_particoes)
+            for particao in np.unique(particoes):
+                pasta = os.path.join(temporaria, f'particao_{particao:03d}')
+                os.makedirs(pasta, exist_ok=True)
+                extraidos[particoes == particao].to_parquet(os.path.join(pasta, f'parte_{numero:05d}.parquet'),
+                                                            index=False)
+            relatorio['partes_lidas'] += 1
+            cronometrar('particionamento', inicio)
+            notificar('extracao', f"📦 Parte {numero + 1}: {linha_inicial} registros lidos, "
+                                  f"{relatorio['duplicatas_removidas']} duplicatas removidas")
+
+        if config['contadores_regras']:
+            relatorio['regras'] = medicoes.get('regras', {})
+        if config['perfil_notas']:
+            relatorio['notas_lentas'] = medicoes.get('notas_lentas', [])
+
+        # Pacientes válidos (pelo menos dois tipos) e tipos na ordem em que aparecem
+        inicio = time.perf_counter()
+        pares = pd.concat(pares).groupby(level=['paciente', 'tipo'], sort=False).min() if pares else None
+        if pares is None or pares.empty:
+            raise ValueError("Nenhum registro com paciente na entrada")
+        tipos_por_paciente = pares.groupby(level='paciente').size()
+        validos = tipos_por_paciente[tipos_por_paciente >= 2].index
+        relatorio['pacientes_validos'] = len(validos)
+        pares_validos = pares[pares.index.get_level_values('paciente').isin(validos)].sort_values(kind='mergesort')
+        tipos_disponiveis = pares_validos.index.get_level_values('tipo').unique()
+        baseline_type, followup_type = tipos_longitudinais(tipos_disponiveis, config)
+        relatorio['baseline'] = str(baseline_type)
+        relatorio['followup'] = str(followup_type)
+        cronometrar('filtro_pacientes', inicio)
+        notificar('filtro_pacientes', f"✅ {len(validos)} pacientes válidos")
+
+        # FASE 2: etapas por paciente, uma partição de cada vez
+        notificar('longitudinal', f"📈 Criando base longitudinal por partição "
+                                  f"(Baseline: {baseline_type} | Follow-up: {followup_type})...")
+        arquivos = {nome: [] for nome in SAIDAS}
+        contagens = {'registros_processados': 0, 'pacientes_longitudinal': 0}
+        removidos_total = None
+        melhoraram = None
+        proximo_texto_id = 0
+        for particao in range(n_particoes):
+            df_particao = _ler_partes(os.path.join(temporaria, f'particao_{particao:03d}'))
+            if df_particao is None:
+                continue
+            inicio = time.perf_counter()
+            df_particao = df_particao[df_particao['paciente'].isin(validos)]
+            df_particao = df_particao.sort_values('_linha', kind='mergesort').drop(columns=['_linha'])
+            df_particao = df_particao.reset_index(drop=True)
+            if df_particao.empty:
+                continue
+
+            df_longitudinal = base_longitudinal(df_particao, config, baseline_type, followup_type)
+            if config['criterios_melhora']:
+                df_longitudinal = calcular_melhora(df_longitudinal, config)
+            df_longitudinal, removidos = filtrar_tempo_minimo(df_longitudinal, config)
+            if removidos is not None:
+                removidos_total = (removidos_total or 0) + removidos
+            df_pacientes = construir_tabela_pacientes(df_particao)
+
+            primeira_nota = contagens['registros_processados']
+            contagens['registros_processados'] += len(df_particao)
+            contagens['pacientes_longitudinal'] += len(df_longitudinal)
+            if 'improvement' in df_longitudinal.columns:
+                melhoraram = (melhoraram or 0) + int(df_longitudinal['improvement'].sum())
+
+            df_particao, evidencias = separar_evidencias(df_particao)
+            tabelas = {'df_processed': df_particao, 'df_longitudinal': df_longitudinal,
+                       'df_pacientes': df_pacientes}
+            if evidencias is not None:
+                evidencias['nota'] += np.int32(primeira_nota)
+                tabelas['evidencias'] = evidencias
+            if config['indice_busca']:
+                # nota contínua entre as partições (posição no arquivo final, como texto_id)
+                indice = construir_indice(df_particao['descricao'])
+                indice['nota'] += np.int32(primeira_nota)
+                tabelas['indice_busca'] = indice
+            if config['texto_descricao'] == 'comprimido':
+                sem_texto, blocos = separar_texto(df_particao)
+                # texto_id e primeiro_id contínuos entre as partições
+                sem_texto['texto_id'] += np.int32(proximo_texto_id)
+                blocos['primeiro_id'] += proximo_texto_id
+                proximo_texto_id += len(df_particao)
+                tabelas.update({'df_processed': sem_texto, 'textos': blocos})
+
+            for nome, tabela in tabelas.items():
+                arquivo = os.path.join(temporaria, f'{SAIDAS[nome]}_{particao:03d}.parquet')
+                tabela.to_parquet(arquivo, index=False)
+                arquivos[nome].append(arquivo)
+            cronometrar('etapas_por_paciente', inicio)
+
+        if removidos_total is not None:
+            relatorio['removidos_tempo_minimo'] = removidos_total
+        relatorio.update(contagens)
+        if melhoraram is not None:
+            relatorio['pacientes_melhoraram'] = melhoraram
+
+        # FASE 3: um arquivo por tabela
+        inicio = time.perf_counter()
+        saidas = {}
+        for nome, partes in arquivos.items():
+            if not partes:
+                continue
+            saidas[SAIDAS[nome]] = os.path.join(pasta_saida, f'{SAIDAS[nome]}.parquet')
+            juntar_parquet(partes, saidas[SAIDAS[nome]])
+        cronometrar('gravacao', inicio)
+    finally:
+        shutil.rmtree(temporaria, ignore_errors=True)
+
+    return relatorio, saidas
@@ -6,131 +6,84 @@ Implementa regras de variáveis conforme documento de especificação
 
 import pandas as pd
 import re
-from typing import Dict, List, Tuple, Optional
+from typing import Dict, List, Mapping, Tuple, Optional
+
+from registro_regras import carregar_regras
 
 # =============================================================================
 # CONSTANTES E CONFIGURAÇÕES
 # =============================================================================
 
-# Padrões de Fator Reumatoide
-FR_POSITIVO_PATTERNS = [
-    r'\bfr\s*\+',
-    r'\bfr\s*positivo',
-    r'\bfr\s*reagente',
-    r'\(fr\s*\+\)',
-    r'fator\s+reumat[oó]ide\s*(positivo|reagente|\+)',
-    r'soropositiv[ao]',
-    r'ar\s*\(?\s*fr\s*\+\s*\)?',
-    r'\bfr\s*[:\s]+\d+[\.,]?\d*\s*\(?positivo\)?',
-]
-
-FR_NEGATIVO_PATTERNS = [
-    r'\bfr\s*-(?!\d)',  # FR - mas não FR -5 (número negativo)
-    r'\bfr\s*negativo',
-    r'\bfr\s*n[aã]o\s*reagente',
-    r'\(fr\s*-\)',
-    r'fator\s+reumat[oó]ide\s*(negativo|n[aã]o\s*reagente|-)',
-    r'soronegativ[ao]',
-    r'\bfr\s*[:\s]+\d+[\.,]?\d*\s*\(?(neg|negativo)\)?',
-]
-
-FR_VALOR_PATTERN = r'\bfr\s*[:\s]+(\d+[\.,]?\d*)'
-
-# CID-10 para inferência de FR
-CID_FR_MAPPING = {
-    'M06.0': 'NEGATIVO',   # AR soronegativa
-    'M05.9': 'POSITIVO',   # AR soropositiva
-    'M05.0': 'POSITIVO',   # Síndrome de Felty
-    'M05.1': 'POSITIVO',   # Doença reumatoide do pulmão
-    'M05.2': 'POSITIVO',   # Vasculite reumatoide
-    'M05.3': 'POSITIVO',   # AR com comprometimento de outros órgãos
-    'M05.8': 'POSITIVO',   # Outras AR soropositivas
-    'M06.8': 'NÃO INFORMADO',  # Outras AR especificadas
-    'M06.9': 'NÃO INFORMADO',  # AR não especificada
-}
+# As tabelas de padrões vêm do conjunto de regras compartilhado com o
+# pipeline (regras_extracao.json, ver registro_regras), compilado uma única
+# vez por processo.
+REGISTRO = carregar_regras()
 
-CID_PATTERN = r'CID[\s\-]*10?\s*[:\s]*([M]\d{2}\.?\d?)'
-
-# Biológicos e JAK inibidores
-BIOLOGICOS = {
-    # Anti-TNF
-    'adalimumabe': ['adalimumabe', 'humira', 'ada'],
-    'infliximabe': ['infliximabe', 'remicade', 'ifx'],
-    'etanercepte': ['etanercepte', 'enbrel', 'eta'],
-    'golimumabe': ['golimumabe', 'simponi', 'goli'],
-    'certolizumabe': ['certolizumabe', 'cimzia', 'czp'],
-    # Anti-IL/Outros biológicos
-    'tocilizumabe': ['tocilizumabe', 'actemra', 'tcz'],
-    'rituximabe': ['rituximabe', 'mabthera', 'rtx'],
-    'abatacepte': ['abatacepte', 'orencia', 'aba'],
-    # JAK inibidores (contabilizados como biológico)
-    'tofacitinibe': ['tofacitinibe', 'xeljanz', 'tofa'],
-    'upadacitinibe': ['upadacitinibe', 'rinvoq', 'upada'],
-    'baricitinibe': ['baricitinibe', 'olumiant', 'bari'],
-}
+# Padrões de Fator Reumatoide e CID-10 para inferência de FR
+FR_POSITIVO_PATTERNS = REGISTRO['FR_POSITIVO_PATTERNS']
+FR_NEGATIVO_PATTERNS = REGISTRO['FR_NEGATIVO_PATTERNS']
+FR_VALOR_PATTERN = REGISTRO['FR_VALOR_PATTERN']
+CID_FR_MAPPING = REGISTRO['CID_FR_MAPPING']
+CID_PATTERN = REGISTRO['CID_PATTERN']
 
+# Biológicos e JAK inibidores (contabilizados como biológico), por grupo
+BIOLOGICOS = {med: c['aliases'] for med, c in REGISTRO['BIOLOGICOS_CONFIG'].items()}
 BIOLOGICOS_GRUPOS = {
-    'anti_tnf': ['adalimumabe', 'infliximabe', 'etanercepte', 'golimumabe', 'certolizumabe'],
-    'anti_il_outros': ['tocilizumabe', 'rituximabe', 'abatacepte'],
-    'jak_inibidores': ['tofacitinibe', 'upadacitinibe', 'baricitinibe'],
+    grupo: [med for med, c in REGISTRO['BIOLOGICOS_CONFIG'].items() if c['grupo'] == nome]
+    for nome, grupo in REGISTRO['GRUPOS_BIOLOGICOS'].items()
 }
 
 # DMARDs convencionais
-DMARDS = {
-    'metotrexato': ['metotrexato', 'metotrexate', 'mtx'],
-    'leflunomida': ['leflunomida', 'arava', 'lef'],
-    'sulfassalazina': ['sulfassalazina', 'azulfin', 'ssz'],
-    'hidroxicloroquina': ['hidroxicloroquina', 'plaquinol', 'hcq'],
-}
+DMARDS = {med: c['aliases'] for med, c in REGISTRO['DMARDS_CONFIG'].items()}
+
+# Comorbidades
+COMORBIDADES = REGISTRO['COMORBIDADES_CONFIG']
 
 # Padrões de status de uso
-USO_ATIVO_PATTERNS = [
-    r'em\s+uso',
-    r'mant[eé]m',
-    r'mantenho',
-    r'renovo\s+lme',
-    r'segue\s+com',
-    r'continua\s+com',
-    r'uso\s+atual',
-    r'medicaç[oõ]es?\s+em\s+uso',
-    r'usando',
-]
-
-USO_PREVIO_PATTERNS = [
-    r'uso\s+pr[eé]vio',
-    r'pr[eé]vio[s]?\s*[:\s]',
-    r'fez\s+uso',
-    r'j[aá]\s+usou',
-    r'suspen[sd][oa]',
-    r'parou',
-    r'interromp',
-    r'descontinua',
-    r'n[aã]o\s+tolera',
-    r'intoler[aâ]ncia',
-    r'hepatotoxicidade',
-    r'alop[eé]cia',
-    r'falha\s+terap[eê]utica',
-]
+USO_ATIVO_PATTERNS = REGISTRO['USO_ATIVO_PATTERNS']
+USO_PREVIO_PATTERNS = REGISTRO['USO_PREVIO_PATTERNS']
+
+# Caracteres antes e depois de cada menção examinados para o status de uso
+JANELA_CONTEXTO = REGISTRO['JANELA_CONTEXTO']
 
 # Padrões de dose
 DOSE_PATTERNS = {
-    'mtx': r'(?:mtx|metotrexato)\s*[:\s]*(\d+[\.,]?\d*)\s*(?:mg)?(?:\s*/?\s*sem(?:ana)?)?',
+    'mtx': REGISTRO['MTX_DOSE_PATTERN'],
     'biologico': r'(\d+[\.,]?\d*)\s*(?:mg|ml)',
 }
 
+# Marcadores clínicos
+MARCADORES_PATTERNS = {m: c['pattern'] for m, c in REGISTRO['MARCADORES_CONFIG'].items()}
+
 # Motivos de suspensão comuns
-MOTIVOS_SUSPENSAO = [
-    'intolerância',
-    'hepatotoxicidade', 
-    'alopécia',
-    'alopecia',
-    'falha',
-    'infecção',
-    'efeito adverso',
-    'evento adverso',
-    'falta',
-    'indisponibilidade',
-]
+MOTIVOS_SUSPENSAO = REGISTRO['MOTIVOS_SUSPENSAO']
+
+# Padrões pré-compilados (os do conjunto de regras já vêm compilados do registro)
+FR_POSITIVO_RE = [REGISTRO.regex(('FR_POSITIVO_PATTERNS', i)) for i in range(len(FR_POSITIVO_PATTERNS))]
+FR_NEGATIVO_RE = [REGISTRO.regex(('FR_NEGATIVO_PATTERNS', i)) for i in range(len(FR_NEGATIVO_PATTERNS))]
+FR_VALOR_RE = REGISTRO.regex(('FR_VALOR_PATTERN',))
+CID_RE = REGISTRO.regex(('CID_PATTERN',))
+USO_ATIVO_RE = [REGISTRO.regex(('USO_ATIVO_PATTERNS', i)) for i in range(len(USO_ATIVO_PATTERNS))]
+USO_PREVIO_RE = [REGISTRO.regex(('USO_PREVIO_PATTERNS', i)) for i in range(len(USO_PREVIO_PATTERNS))]
+DOSE_RE = {'mtx': REGISTRO.regex(('MTX_DOSE_PATTERN',)), 'biologico': re.compile(DOSE_PATTERNS['biologico'])}
+MARCADORES_RE = {m: REGISTRO.regex(('MARCADORES_CONFIG', m)) for m in MARCADORES_PATTERNS}
+MTX_VIA_RE = [(via, REGISTRO.regex(('MTX_VIA_PATTERNS', via))) for via in REGISTRO['MTX_VIA_PATTERNS']]
+TROCA_RE = re.compile(r'troc[oa]r?\s+\w+\s+por')
+INICIAR_RE = re.compile(r'iniciar\s+(?:' + '|'.join(BIOLOGICOS.keys()) + ')')
+ALIAS_RE = {
+    alias.lower(): REGISTRO.regex((tabela, med, i))
+    for tabela in ['BIOLOGICOS_CONFIG', 'DMARDS_CONFIG']
+    for med, c in REGISTRO[tabela].items()
+    for i, alias in enumerate(c['aliases'])
+}
+
+
+def _padrao_alias(alias: str):
+    """Retorna o padrão compilado de um alias (compila e guarda se for novo)"""
+    alias = alias.lower()
+    if alias not in ALIAS_RE:
+        ALIAS_RE[alias] = re.compile(re.escape(alias))
+    return ALIAS_RE[alias]
 
 
 # =============================================================================
@@ -151,22 +104,22 @@ def extract_fator_reumatoide(text: str) -> Dict:
     result = {'fr_resultado': 'NÃO INFORMADO', 'fr_valor': None, 'fr_origem': None}
     
     # 1. Buscar padrões positivos
-    for pattern in FR_POSITIVO_PATTERNS:
-        if re.search(pattern, text_lower):
+    for pattern in FR_POSITIVO_RE:
+        if pattern.search(text_lower):
             result['fr_resultado'] = 'POSITIVO'
             result['fr_origem'] = 'TEXTO'
             break
     
     # 2. Buscar padrões negativos (se não encontrou positivo)
     if result['fr_resultado'] == 'NÃO INFORMADO':
-        for pattern in FR_NEGATIVO_PATTERNS:
-            if re.search(pattern, text_lower):
+        for pattern in FR_NEGATIVO_RE:
+            if pattern.search(text_lower):
                 result['fr_resultado'] = 'NEGATIVO'
                 result['fr_origem'] = 'TEXTO'
                 break
     
     # 3. Extrair valor numérico se disponível
-    valor_match = re.search(FR_VALOR_PATTERN, text_lower)
+    valor_match = FR_VALOR_RE.search(text_lower)
     if valor_match:
         try:
             result['fr_valor'] = float(valor_match.group(1).replace(',', '.'))
@@ -176,7 +129,7 @@ def extract_fator_reumatoide(text: str) -> Dict:
     
     # 4. Inferir por CID-10 se ainda não informado
     if result['fr_resultado'] == 'NÃO INFORMADO':
-        cid_match = re.search(CID_PATTERN, text, re.IGNORECASE)
+        cid_match = CID_RE.search(text)
         if cid_match:
             cid = cid_match.group(1).upper()
             # Normalizar CID (M060 -> M06.0)
@@ -213,19 +166,16 @@ def extract_medicamento_status(text: str, medicamento: str, aliases: List[str])
     if not med_found:
         return result
     
-    # Criar padrão para buscar contexto do medicamento
-    alias_pattern = '|'.join([re.escape(a) for a in aliases])
-    
-    # Buscar contexto próximo ao medicamento (300 chars antes e depois)
+    # Buscar contexto próximo ao medicamento (JANELA_CONTEXTO chars antes e depois)
     for alias in aliases:
-        for match in re.finditer(re.escape(alias.lower()), text_lower):
-            start = max(0, match.start() - 300)
-            end = min(len(text_lower), match.end() + 300)
+        for match in _padrao_alias(alias).finditer(text_lower):
+            start = max(0, match.start() - JANELA_CONTEXTO)
+            end = min(len(text_lower), match.end() + JANELA_CONTEXTO)
             context = text_lower[start:end]
             
             # Verificar uso prévio (tem prioridade se encontrar padrões de suspensão)
-            for pattern in USO_PREVIO_PATTERNS:
-                if re.search(pattern, context):
+            for pattern in USO_PREVIO_RE:
+                if pattern.search(context):
                     result['uso'] = 'PRÉVIO'
                     # Buscar motivo de suspensão
                     for motivo in MOTIVOS_SUSPENSAO:
@@ -236,18 +186,14 @@ def extract_medicamento_status(text: str, medicamento: str, aliases: List[str])
             
             # Verificar uso ativo (só se não encontrou prévio ou se encontrar padrão mais próximo)
             if result['uso'] != 'PRÉVIO':
-                for pattern in USO_ATIVO_PATTERNS:
-                    if re.search(pattern, context):
+                for pattern in USO_ATIVO_RE:
+                    if pattern.search(context):
                         result['uso'] = 'SIM'
                         break
     
     # Se mencionou mas não identificou status, assumir que está em uso (menção atual)
     if result['uso'] == 'NÃO' and med_found:
-        # Verificar se está em seção de "medicações em uso"
-        if re.search(r'medica[çc][oõ]es?\s+em\s+uso.*?' + alias_pattern, text_lower, re.DOTALL):
-            result['uso'] = 'SIM'
-        else:
-            result['uso'] = 'SIM'  # Default: se menciona, assume uso
+        result['uso'] = 'SIM'  # Default: se menciona, assume uso
     
     return result
 
@@ -274,7 +220,7 @@ def extract_mtx(text: str) -> Dict:
     text_lower = str(text).lower()
     
     # Extrair dose
-    dose_match = re.search(DOSE_PATTERNS['mtx'], text_lower)
+    dose_match = DOSE_RE['mtx'].search(text_lower)
     if dose_match:
         try:
             result['mtx_dose_mg_semana'] = float(dose_match.group(1).replace(',', '.'))
@@ -282,12 +228,10 @@ def extract_mtx(text: str) -> Dict:
             pass
     
     # Extrair via
-    if re.search(r'mtx\s*(sc|subcutan[eê])', text_lower):
-        result['mtx_via'] = 'SC'
-    elif re.search(r'mtx\s*(vo|oral|comprimido)', text_lower):
-        result['mtx_via'] = 'VO'
-    elif re.search(r'mtx\s*(im|intramuscular)', text_lower):
-        result['mtx_via'] = 'IM'
+    for via, pattern in MTX_VIA_RE:
+        if pattern.search(text_lower):
+            result['mtx_via'] = via
+            break
     
     return result
 
@@ -349,9 +293,9 @@ def extract_biologicos(text: str) -> Dict:
     result['biologicos_previos'] = biologicos_previos
     
     # Verificar plano de troca
-    if re.search(r'troc[oa]r?\s+\w+\s+por', text_lower):
+    if TROCA_RE.search(text_lower):
         result['biologico_plano'] = 'TROCA'
-    elif re.search(r'iniciar\s+(?:' + '|'.join(BIOLOGICOS.keys()) + ')', text_lower):
+    elif INICIAR_RE.search(text_lower):
         result['biologico_plano'] = 'INICIAR'
     
     return result
@@ -361,27 +305,14 @@ def extract_comorbidades_avancado(text: str) -> Dict:
     """
     Extrai comorbidades com mais detalhes
     """
-    comorbidades = {
-        'has': {'aliases': ['has', 'hipertensão', 'hipertensao', 'hipertenso'], 'flag': 0},
-        'dm': {'aliases': ['dm', 'dm2', 'diabetes', 'diabético', 'diabetico'], 'flag': 0},
-        'pre_dm': {'aliases': ['pré-dm', 'pre-dm', 'pré-diabetes', 'pre-diabetes'], 'flag': 0},
-        'dlp': {'aliases': ['dlp', 'dislipidemia', 'dislipidêmico'], 'flag': 0},
-        'fm': {'aliases': ['fm', 'fibromialgia'], 'flag': 0},
-        'op': {'aliases': ['op', 'osteoporose', 'osteoporótico'], 'flag': 0},
-        'hipotireoidismo': {'aliases': ['hipotireoidismo', 'tireoidite', 'hipotireoideo'], 'flag': 0},
-        'obesidade': {'aliases': ['obesidade', 'obeso', 'imc >'], 'flag': 0},
-        'dpoc': {'aliases': ['dpoc', 'enfisema', 'bronquite crônica'], 'flag': 0},
-        'irc': {'aliases': ['irc', 'doença renal', 'insuficiência renal'], 'flag': 0},
-    }
-    
     if pd.isna(text):
-        return {k: 0 for k in comorbidades.keys()}
+        return {k: 0 for k in COMORBIDADES.keys()}
     
     text_lower = str(text).lower()
     result = {}
     
-    for comorb, info in comorbidades.items():
-        for alias in info['aliases']:
+    for comorb, aliases in COMORBIDADES.items():
+        for alias in aliases:
             if alias in text_lower:
                 result[comorb] = 1
                 break
@@ -399,29 +330,15 @@ def extract_marcadores_clinicos(text: str) -> Dict:
     """
     Extrai marcadores clínicos com valores numéricos
     """
-    marcadores = {
-        'vhs': r'v[hs]s\s*[:\s=]*(\d+[\.,]?\d*)',
-        'pcr': r'pcr\s*[:\s=]*(\d+[\.,]?\d*)',
-        'haq': r'haq\s*[:\s=]*(\d+[\.,]?\d*)',
-        'das28': r'das\s*-?\s*28\s*[:\s=]*(\d+[\.,]?\d*)',
-        'cdai': r'cdai\s*[:\s=]*(\d+[\.,]?\d*)',
-        'sdai': r'sdai\s*[:\s=]*(\d+[\.,]?\d*)',
-        'basdai': r'basdai\s*[:\s=]*(\d+[\.,]?\d*)',
-        'asdas': r'asdas\s*[:\s=]*(\d+[\.,]?\d*)',
-        'eva_dor': r'eva\s*(?:dor)?\s*[:\s=]*(\d+[\.,]?\d*)',
-        'nav': r'nav\s*[:\s=]*(\d+[\.,]?\d*)',
-        'nad': r'nad\s*[:\s=]*(\d+[\.,]?\d*)',
-    }
-    
-    result = {k: None for k in marcadores.keys()}
+    result = {k: None for k in MARCADORES_PATTERNS.keys()}
     
     if pd.isna(text):
         return result
     
     text_lower = str(text).lower()
     
-    for marker, pattern in marcadores.items():
-        match = re.search(pattern, text_lower)
+    for marker, pattern in MARCADORES_RE.items():
+        match = pattern.search(text_lower)
         if match:
             try:
                 result[marker] = float(match.group(1).replace(',', '.'))
@@ -435,9 +352,10 @@ def extract_marcadores_clinicos(text: str) -> Dict:
 # FUNÇÃO PRINCIPAL DE PROCESSAMENTO
 # =============================================================================
 
-def process_prontuario(row: pd.Series) -> Dict:
+def process_prontuario(row: Mapping) -> Dict:
     """
-    Processa uma linha do DataFrame extraindo todas as variáveis
+    Processa uma linha do DataFrame (ou um dict com 'descricao') extraindo
+    todas as variáveis
     """
     text = row.get('descricao', '')
     
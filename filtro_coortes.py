@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+Filtro de Coortes por Índices Bitmap - IMMUNED
+Sobre a tabela de pacientes (uma linha por paciente), cada valor de cada
+coluna categórica ou de poucos valores (fr_resultado, <med>_status, uso_mtx,
+biologico_grupo, flags de comorbidade, ...) ganha um bitmap pré-calculado:
+um bit por paciente, empacotado em bytes. Um filtro com E/OU/NÃO vira uma
+sequência de operações bit a bit sobre esses bitmaps, sem percorrer a tabela.
+
+Os filtros podem ser montados em Python:
+
+    (Condicao('fr_resultado', 'POSITIVO') & Condicao('uso_mtx', 'PRÉVIO')
+     & Condicao('biologico_grupo', 'JAK Inibidores') & Condicao('has') & Condicao('dm'))
+
+ou escritos como texto (ver interpretar_filtro):
+
+    fr_resultado = POSITIVO e uso_mtx = PRÉVIO e biologico_grupo = "JAK Inibidores" e has e dm
+    (tofacitinibe_status = SIM ou baricitinibe_status = SIM) e não sexo = M
+    uso_biologico em [SIM, PRÉVIO]
+"""
+
+import re
+
+import numpy as np
+import pandas as pd
+
+# Colunas não categóricas com mais valores distintos que isto não são indexadas
+MAX_VALORES_INDICE = 50
+
+# Colunas nunca indexadas (identificadores e medidas contínuas)
+COLUNAS_IGNORADAS = {'paciente', 'n_registros', 'idade', 'comorbidades_mascara'}
+
+# Bits ligados em cada valor de byte (contagem de pacientes de um bitmap)
+_BITS_POR_BYTE = np.array([bin(i).count('1') for i in range(256)], dtype=np.int64)
+
+
+# =============================================================================
+# ÍNDICE
+# =============================================================================
+
+def colunas_indexaveis(df):
+    """Colunas da tabela de pacientes que recebem bitmaps"""
+    colunas = []
+    for coluna in df.columns:
+        serie = df[coluna]
+        if coluna in COLUNAS_IGNORADAS or pd.api.types.is_float_dtype(serie) \
+                or pd.api.types.is_datetime64_any_dtype(serie):
+            continue
+        if isinstance(serie.dtype, pd.CategoricalDtype) or serie.nunique(dropna=True) <= MAX_VALORES_INDICE:
+            colunas.append(coluna)
+    return colunas
+
+
+class IndiceBitmap:
+    """
+    Args:
+        df_pacientes: tabela com uma linha por paciente
+        colunas: colunas indexadas (None = colunas_indexaveis)
+    """
+
+    def __init__(self, df_pacientes, colunas=None):
+        self.n = len(df_pacientes)
+        self.pacientes = df_pacientes['paciente'].reset_index(drop=True) if 'paciente' in df_pacientes.columns \
+            else pd.Series(np.arange(self.n))
+        self._bitmaps = {}
+        for coluna in (colunas_indexaveis(df_pacientes) if colunas is None else colunas):
+            serie = df_pacientes[coluna]
+            if isinstance(serie.dtype, pd.CategoricalDtype):
+                codigos, valores = serie.cat.codes.to_numpy(), list(serie.cat.categories)
+            else:
+                codigos, valores = pd.factorize(serie, sort=True)
+                valores = list(valores)
+            self._bitmaps[coluna] = {
+                valor: np.packbits(codigos == i) for i, valor in enumerate(valores)
+            }
+        self._todos = np.packbits(np.ones(self.n, dtype=bool))
+
+    @property
+    def colunas(self):
+        return list(self._bitmaps)
+
+    def valores(self, coluna):
+        """Valores indexados da coluna"""
+        return list(self._bitmaps[self._coluna(coluna)])
+
+    def _coluna(self, coluna):
+        if coluna not in self._bitmaps:
+            raise ValueError(f"Coluna sem índice: {coluna} (disponíveis: {', '.join(self._bitmaps)})")
+        return coluna
+
+    def bitmap(self, coluna, valor):
+        """Bitmap dos pacientes com coluna == valor (texto comparado sem maiúsculas)"""
+        bitmaps = self._bitmaps[self._coluna(coluna)]
+        if valor in bitmaps:
+            return bitmaps[valor]
+        por_texto = {str(v).casefold(): v for v in bitmaps}
+        chave = str(valor).casefold()
+        if chave in por_texto:
+            return bitmaps[por_texto[chave]]
+        # Numéricos digitados como texto ('1') ou inteiros do numpy
+        for v in bitmaps:
+            try:
+                if float(v) == float(valor):
+                    return bitmaps[v]
+            except (TypeError, ValueError):
+                continue
+        raise ValueError(f"Valor inexistente em {coluna}: {valor} (valores: {', '.join(map(str, bitmaps))})")
+
+    def negar(self, bitmap):
+        # Os bits de preenchimento do último byte continuam desligados
+        return np.bitwise_and(np.invert(bitmap), self._todos)
+
+    def avaliar(self, filtro):
+        """Bitmap do filtro (None = todos os pacientes)"""
+        return self._todos if filtro is None else filtro.avaliar(self)
+
+    def mascara(self, filtro):
+        """Máscara booleana (uma posição por linha da tabela de pacientes)"""
+        return np.unpackbits(self.avaliar(filtro), count=self.n).astype(bool)
+
+    def contar(self, filtro):
+        return int(_BITS_POR_BYTE[self.avaliar(filtro)].sum())
+
+    def pacientes_filtro(self, filtro):
+        """Identificadores dos pacientes que atendem ao filtro"""
+        return self.pacientes_bitmap(self.avaliar(filtro))
+
+    def pacientes_bitmap(self, bitmap):
+        """Identificadores dos pacientes com o bit ligado em bitmap (ver avaliar)"""
+        return self.pacientes[np.unpackbits(bitmap, count=self.n).astype(bool)]
+
+
+# =============================================================================
+# FILTROS
+# =============================================================================
+
+class Filtro:
+    """Base dos filtros: combináveis com & (E), | (OU) e ~ (NÃO)"""
+
+    def __and__(self, outro):
+        return E(self, outro)
+
+    def __or__(self, outro):
+        return Ou(self, outro)
+
+    def __invert__(self):
+        return Nao(self)
+
+
+def _texto_valor(valor):
+    """Valor como escrito no filtro em texto (entre aspas se tiver espaços ou símbolos)"""
+    texto = str(valor)
+    if re.fullmatch(r'[^\s=()\[\],"\']+', texto):
+        return texto
+    return f"'{texto}'" if '"' in texto else f'"{texto}"'
+
+
+class Condicao(Filtro):
+    """
+    coluna igual a um dos valores. Sem valores, flag ligada (coluna == 1).
+
+    Args:
+        coluna: coluna indexada
+        valores: valor ou lista de valores
+    """
+
+    def __init__(self, coluna, valores=1):
+        self.coluna = coluna
+        self.valores = list(valores) if isinstance(valores, (list, tuple, set)) else [valores]
+
+    def avaliar(self, indice):
+        bitmaps = [indice.bitmap(self.coluna, valor) for valor in self.valores]
+        if not bitmaps:
+            return np.zeros_like(indice.avaliar(None))
+        return np.bitwise_or.reduce(bitmaps) if len(bitmaps) > 1 else bitmaps[0]
+
+    def __str__(self):
+        if self.valores == [1]:
+            return self.coluna
+        if len(self.valores) == 1:
+            return f"{self.coluna} = {_texto_valor(self.valores[0])}"
+        return f"{self.coluna} em [{', '.join(map(_texto_valor, self.valores))}]"
+
+
+class E(Filtro):
+    def __init__(self, *filtros):
+        self.filtros = filtros
+
+    def avaliar(self, indice):
+        return np.bitwise_and.reduce([f.avaliar(indice) for f in self.filtros])
+
+    def __str__(self):
+        return ' e '.join(f'({f})' if isinstance(f, Ou) else str(f) for f in self.filtros)
+
+
+class Ou(Filtro):
+    def __init__(self, *filtros):
+        self.filtros = filtros
+
+    def avaliar(self, indice):
+        return np.bitwise_or.reduce([f.avaliar(indice) for f in self.filtros])
+
+    def __str__(self):
+        return ' ou '.join(str(f) for f in self.filtros)
+
+
+class Nao(Filtro):
+    def __init__(self, filtro):
+        self.filtro = filtro
+
+    def avaliar(self, indice):
+        return indice.negar(self.filtro.avaliar(indice))
+
+    def __str__(self):
+        return f"não ({self.filtro})" if isinstance(self.filtro, (E, Ou)) else f"não {self.filtro}"
+
+
+# =============================================================================
+# FILTROS EM TEXTO
+# =============================================================================
+
+_TOKEN = re.compile(r'\s*(?:(?P<texto>"[^"]*"|\'[^\']*\')|(?P<simbolo>!=|[=()\[\],])|(?P<palavra>[^\s=()\[\],"\']+))')
+
+_E = {'e', 'and', '&'}
+_OU = {'ou', 'or', '|'}
+_NAO = {'não', 'nao', 'not', '!'}
+
+
+def _tokens(texto):
+    tokens, posicao = [], 0
+    texto = texto.strip()
+    while posicao < len(texto):
+        encontrado = _TOKEN.match(texto, posicao)
+        if encontrado is None or encontrado.end() == posicao:
+            raise ValueError(f"Filtro inválido perto de: {texto[posicao:posicao + 20]!r}")
+        if encontrado.group('texto') is not None:
+            tokens.append(('valor', encontrado.group('texto')[1:-1]))
+        elif encontrado.group('simbolo') is not None:
+            tokens.append(('simbolo', encontrado.group('simbolo')))
+        else:
+            tokens.append(('palavra', encontrado.group('palavra')))
+        posicao = encontrado.end()
+    return tokens
+
+
+class _Interpretador:
+    """
+    Gramática (palavras-chave sem distinção de maiúsculas):
+        expressao := termo (ou termo)*
+        termo     := fator (e fator)*
+        fator     := não fator | ( expressao ) | coluna [= valor | != valor | em [valor, ...]]
+    """
+
+    def __init__(self, texto):
+        self.tokens = _tokens(texto)
+        self.posicao = 0
+
+    def _atual(self):
+        return self.tokens[self.posicao] if self.posicao < len(self.tokens) else (None, None)
+
+    def _palavra_chave(self, chaves):
+        tipo, valor = self._atual()
+        if tipo in ('palavra', 'simbolo') and valor.casefold() in chaves:
+            self.posicao += 1
+            return True
+        return False
+
+    def _simbolo(self, simbolo):
+        if self._atual() == ('simbolo', simbolo):
+            self.posicao += 1
+            return True
+        return False
+
+    def _esperar(self, simbolo):
+        if not self._simbolo(simbolo):
+            raise ValueError(f"Filtro inválido: esperado {simbolo!r}")
+
+    def _valor(self):
+        tipo, valor = self._atual()
+        if tipo not in ('palavra', 'valor'):
+            raise ValueError("Filtro inválido: valor ausente")
+        self.posicao += 1
+        return valor
+
+    def interpretar(self):
+        if not self.tokens:
+            return None
+        filtro = self._expressao()
+        if self.posicao != len(self.tokens):
+            raise ValueError(f"Filtro inválido: sobrou {' '.join(v for _, v in self.tokens[self.posicao:])!r}")
+        return filtro
+
+    def _expressao(self):
+        filtros = [self._termo()]
+        while self._palavra_chave(_OU):
+            filtros.append(self._termo())
+        return filtros[0] if len(filtros) == 1 else Ou(*filtros)
+
+    def _termo(self):
+        filtros = [self._fator()]
+        while self._palavra_chave(_E):
+            filtros.append(self._fator())
+        return filtros[0] if len(filtros) == 1 else E(*filtros)
+
+    def _fator(self):
+        if self._palavra_chave(_NAO):
+            return Nao(self._fator())
+        if self._simbolo('('):
+            filtro = self._expressao()
+            self._esperar(')')
+            return filtro
+        coluna = self._valor()
+        if self._simbolo('='):
+            return Condicao(coluna, self._valor())
+        if self._simbolo('!='):
+            return Nao(Condicao(coluna, self._valor()))
+        if self._palavra_chave({'em', 'in'}):
+            self._esperar('[')
+            valores = [self._valor()]
+            while self._simbolo(','):
+                valores.append(self._valor())
+            self._esperar(']')
+            return Condicao(coluna, valores)
+        return Condicao(coluna)
+
+
+def interpretar_filtro(texto):
+    """
+    Filtro a partir do texto (None para texto vazio).
+
+    Raises:
+        ValueError se o texto não segue a gramática de _Interpretador
+    """
+    return _Interpretador(texto or '').interpretar()
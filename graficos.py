@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Gráficos Agregados - IMMUNED
+Histogramas e box plots calculados no servidor com NumPy: apenas as
+contagens por faixa e as estatísticas do box (quartis, cercas e uma amostra
+limitada de outliers) são enviadas ao Plotly, em vez de todos os pontos.
+Dispersões grandes usam WebGL. Figuras podem ser memorizadas por dataset
+e parâmetros (CacheFiguras) e construídas em paralelo.
+"""
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+
+# Acima deste número de pontos as dispersões usam WebGL (Scattergl)
+LIMIAR_WEBGL = 1000
+
+# Outliers enviados por box (os mais extremos)
+MAX_OUTLIERS_BOX = 200
+
+
+def _valores_numericos(valores):
+    arr = pd.to_numeric(pd.Series(valores), errors='coerce').to_numpy(dtype=float)
+    return arr[np.isfinite(arr)]
+
+
+def calcular_faixas(valores, nbins=30):
+    """Bordas comuns das faixas do histograma"""
+    arr = _valores_numericos(valores)
+    if len(arr) == 0:
+        return np.array([0.0, 1.0])
+    return np.histogram_bin_edges(arr, bins=nbins)
+
+
+def _barras_histograma(valores, bordas, **kwargs):
+    contagens, _ = np.histogram(_valores_numericos(valores), bins=bordas)
+    return go.Bar(x=(bordas[:-1] + bordas[1:]) / 2, y=contagens, width=np.diff(bordas),
+                  customdata=np.column_stack([bordas[:-1], bordas[1:]]),
+                  hovertemplate='%{customdata[0]:.2f} – %{customdata[1]:.2f}<br>%{y}<extra></extra>',
+                  **kwargs)
+
+
+def histograma_agregado(valores, nbins=30, cor='#3b82f6'):
+    """Equivalente a px.histogram(x=valores, nbins=nbins) com as faixas calculadas no servidor"""
+    bordas = calcular_faixas(valores, nbins)
+    fig = go.Figure(_barras_histograma(valores, bordas, marker_color=cor, showlegend=False))
+    fig.update_layout(bargap=0)
+    return fig
+
+
+def histograma_agregado_por_grupo(valores, grupos, nbins=30, cores=None, barmode='stack', nome_legenda=None):
+    """
+    Histograma com uma série por grupo (mesmas faixas para todos).
+
+    Args:
+        valores: valores numéricos
+        grupos: rótulo do grupo de cada valor (mesmo tamanho de valores)
+        cores: mapa grupo -> cor
+        barmode: 'stack' ou 'overlay'
+    """
+    valores = pd.Series(np.asarray(valores))
+    grupos = pd.Series(np.asarray(grupos))
+    bordas = calcular_faixas(valores, nbins)
+    cores = cores or {}
+
+    fig = go.Figure()
+    for grupo in grupos.dropna().unique():
+        fig.add_trace(_barras_histograma(
+            valores[grupos == grupo], bordas, name=str(grupo),
+            marker_color=cores.get(grupo), opacity=0.6 if barmode == 'overlay' else None
+        ))
+    fig.update_layout(barmode=barmode, bargap=0, legend_title_text=nome_legenda)
+    return fig
+
+
+def estatisticas_box(valores):
+    """
+    Quartis, cercas de Tukey (1,5 IQR) e os outliers mais extremos.
+
+    Returns:
+        Dict com q1, mediana, q3, media, cerca_inferior, cerca_superior, outliers, n
+        (None se não houver valores)
+    """
+    arr = _valores_numericos(valores)
+    if len(arr) == 0:
+        return None
+
+    q1, mediana, q3 = np.percentile(arr, [25, 50, 75])
+    iqr = q3 - q1
+    dentro = arr[(arr >= q1 - 1.5 * iqr) & (arr <= q3 + 1.5 * iqr)]
+    outliers = arr[(arr < q1 - 1.5 * iqr) | (arr > q3 + 1.5 * iqr)]
+    if len(outliers) > MAX_OUTLIERS_BOX:
+        distancia = np.abs(outliers - mediana)
+        outliers = outliers[np.argsort(distancia)[-MAX_OUTLIERS_BOX:]]
+
+    return {
+        'q1': float(q1), 'mediana': float(mediana), 'q3': float(q3),
+        'media': float(arr.mean()),
+        'cerca_inferior': float(dentro.min()), 'cerca_superior': float(dentro.max()),
+        'outliers': outliers, 'n': len(arr),
+    }
+
+
+def _traco_box(stats_por_x, nome, cor, showlegend=True):
+    """Box pré-calculado (um por valor de x) e seus outliers"""
+    xs = [x for x, st in stats_por_x.items() if st is not None]
+    stats = [stats_por_x[x] for x in xs]
+    box = go.Box(
+        x=xs, name=nome, marker_color=cor, showlegend=showlegend, legendgroup=nome, offsetgroup=nome,
+        q1=[s['q1'] for s in stats], median=[s['mediana'] for s in stats], q3=[s['q3'] for s in stats],
+        mean=[s['media'] for s in stats],
+        lowerfence=[s['cerca_inferior'] for s in stats], upperfence=[s['cerca_superior'] for s in stats],
+        boxpoints=False,
+    )
+    x_out = [x for x, s in zip(xs, stats) for _ in s['outliers']]
+    y_out = [v for s in stats for v in s['outliers']]
+    pontos = go.Box(x=x_out, y=y_out, name=nome, marker_color=cor, showlegend=False, legendgroup=nome,
+                    offsetgroup=nome, boxpoints='all', jitter=0, pointpos=0,
+                    fillcolor='rgba(0,0,0,0)', line=dict(width=0), hoverinfo='y')
+    return [box, pontos] if y_out else [box]
+
+
+def box_agregado(valores, nome='', cor='#3b82f6'):
+    """Equivalente a px.box(y=valores) com as estatísticas calculadas no servidor"""
+    fig = go.Figure(_traco_box({nome: estatisticas_box(valores)}, nome, cor, showlegend=False))
+    return fig
+
+
+def box_agregado_por_grupo(df, x, y, cor, cores=None, nome_legenda=None):
+    """
+    Box plots agrupados (equivalente a px.box(df, x=x, y=y, color=cor)).
+    """
+    cores = cores or {}
+    fig = go.Figure()
+    categorias_x = list(pd.unique(df[x].dropna()))
+    for grupo in pd.unique(df[cor].dropna()):
+        df_grupo = df[df[cor] == grupo]
+        stats_por_x = {cat: estatisticas_box(df_grupo.loc[df_grupo[x] == cat, y]) for cat in categorias_x}
+        for traco in _traco_box(stats_por_x, str(grupo), cores.get(grupo)):
+            fig.add_trace(traco)
+    fig.update_layout(boxmode='group', legend_title_text=nome_legenda)
+    return fig
+
+
+def dispersao(df, x, y, **kwargs):
+    """px.scatter que passa a usar WebGL quando há muitos pontos"""
+    render_mode = 'webgl' if len(df) > LIMIAR_WEBGL else 'svg'
+    return px.scatter(df, x=x, y=y, render_mode=render_mode, **kwargs)
+
+
+# =============================================================================
+# MEMORIZAÇÃO DE FIGURAS
+# =============================================================================
+
+class CacheFiguras:
+    """
+    Figuras (ou qualquer objeto derivado dos dados) memorizadas por
+    (impressão digital do dataset, nome, parâmetros da visualização).
+    Compartilhado entre sessões: os objetos guardados não devem ser alterados.
+    """
+
+    def __init__(self, max_itens=512, max_threads=4):
+        self.max_itens = max_itens
+        self.max_threads = max_threads
+        self._itens = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _obter(self, chave):
+        with self._lock:
+            if chave in self._itens:
+                self._itens.move_to_end(chave)
+                return True, self._itens[chave]
+            return False, None
+
+    def _guardar(self, chave, valor):
+        with self._lock:
+            self._itens[chave] = valor
+            self._itens.move_to_end(chave)
+            while len(self._itens) > self.max_itens:
+                self._itens.popitem(last=False)
+
+    def construir(self, impressao, tarefas):
+        """
+        Args:
+            impressao: impressão digital do dataset (None desativa a memorização)
+            tarefas: dict nome -> (parametros, construtor); construtor() sem argumentos
+
+        Returns:
+            Dict nome -> objeto construído. Só os itens ausentes do cache são
+            construídos, em paralelo em um pool de threads.
+        """
+        resultado, pendentes = {}, {}
+        for nome, (parametros, construtor) in tarefas.items():
+            chave = (impressao, nome, parametros)
+            encontrado, valor = self._obter(chave) if impressao is not None else (False, None)
+            if encontrado:
+                resultado[nome] = valor
+            else:
+                pendentes[nome] = (chave, construtor)
+
+        if len(pendentes) > 1 and self.max_threads > 1:
+            with ThreadPoolExecutor(max_workers=min(self.max_threads, len(pendentes))) as executor:
+                futuros = {nome: executor.submit(construtor) for nome, (_, construtor) in pendentes.items()}
+                construidos = {nome: futuro.result() for nome, futuro in futuros.items()}
+        else:
+            construidos = {nome: construtor() for nome, (_, construtor) in pendentes.items()}
+
+        for nome, valor in construidos.items():
+            if impressao is not None:
+                self._guardar(pendentes[nome][0], valor)
+            resultado[nome] = valor
+        return resultado
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Execução do ETL em Segundo Plano - IMMUNED
+Gerenciador de jobs compartilhado pelo processo do Streamlit: cada clique em
+"Processar" vira um job com id, progresso por etapa e por bloco, e pode ser
+cancelado. O número de jobs pesados simultâneos é limitado para que vários
+analistas não disputem a CPU.
+"""
+
+import os
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from checkpoints_etl import CheckpointsETL
+from pipeline_etl import ETAPAS_PIPELINE, ETLCancelado, executar_pipeline
+
+# Estados possíveis de um job
+NA_FILA = 'na_fila'
+EXECUTANDO = 'executando'
+CONCLUIDO = 'concluido'
+CANCELADO = 'cancelado'
+ERRO = 'erro'
+
+ESTADOS_FINAIS = (CONCLUIDO, CANCELADO, ERRO)
+
+
+class GerenciadorJobsETL:
+    """
+    Fila de jobs de ETL executados em threads de fundo.
+
+    Args:
+        max_jobs_simultaneos: jobs executados ao mesmo tempo (os demais aguardam na fila)
+        max_jobs_finalizados: jobs finalizados mantidos em memória para consulta
+        tamanho_bloco: linhas por bloco de extração (granularidade do progresso)
+        cache: CacheResultadosETL opcional onde os resultados concluídos são guardados
+        pasta_checkpoints: pasta opcional onde jobs com chave_cache gravam checkpoints;
+                           um job reenviado após o servidor cair retoma de onde parou
+    """
+
+    def __init__(self, max_jobs_simultaneos=1, max_jobs_finalizados=20, tamanho_bloco=500, cache=None,
+                 pasta_checkpoints=None):
+        self._executor = ThreadPoolExecutor(max_workers=max_jobs_simultaneos,
+                                            thread_name_prefix='job-etl')
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_jobs_finalizados = max_jobs_finalizados
+        self.tamanho_bloco = tamanho_bloco
+        self.cache = cache
+        self.pasta_checkpoints = pasta_checkpoints
+
+    def submeter(self, df, config, metadados=None, chave_cache=None, ao_concluir=None):
+        """
+        Enfileira um job de ETL e retorna seu id. Com chave_cache, um job
+        idêntico ainda na fila ou em execução é reaproveitado em vez de duplicado.
+        ao_concluir(resultado) é chamado na thread do job quando ele termina com sucesso.
+        """
+        if chave_cache is not None:
+            with self._lock:
+                for job in self._jobs.values():
+                    if job['chave_cache'] == chave_cache and job['status'] in (NA_FILA, EXECUTANDO):
+                        return job['id']
+
+        job_id = uuid.uuid4().hex[:12]
+        job = {
+            'id': job_id,
+            'status': NA_FILA,
+            'etapa': None,
+            'indice_etapa': 0,
+            'total_etapas': len(ETAPAS_PIPELINE),
+            'mensagens': [],
+            'blocos_concluidos': 0,
+            'total_blocos': 0,
+            'cancelar': threading.Event(),
+            'resultado': None,
+            'erro': None,
+            'traceback': None,
+            'metadados': metadados or {},
+            'chave_cache': chave_cache,
+            'criado_em': time.time(),
+            'finalizado_em': None,
+        }
+        with self._lock:
+            self._jobs[job_id] = job
+            self._descartar_antigos()
+        self._executor.submit(self._executar, job, df, config, ao_concluir)
+        return job_id
+
+    def estado(self, job_id):
+        """Cópia do estado atual do job (None se o id não existir mais)"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            estado = {k: v for k, v in job.items() if k != 'cancelar'}
+            estado['mensagens'] = list(job['mensagens'])
+            return estado
+
+    def cancelar(self, job_id):
+        """Pede o cancelamento; o job para no próximo bloco ou etapa"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job['status'] in ESTADOS_FINAIS:
+                return False
+            job['cancelar'].set()
+            if job['status'] == NA_FILA:
+                job['status'] = CANCELADO
+                job['finalizado_em'] = time.time()
+            return True
+
+    def _executar(self, job, df, config, ao_concluir):
+        with self._lock:
+            if job['cancelar'].is_set():
+                return
+            job['status'] = EXECUTANDO
+
+        def progresso(etapa, mensagem):
+            with self._lock:
+                job['etapa'] = etapa
+                job['indice_etapa'] = ETAPAS_PIPELINE.index(etapa) + 1
+                job['mensagens'].append(mensagem)
+
+        def progresso_blocos(concluidos, total):
+            with self._lock:
+                job['blocos_concluidos'] = concluidos
+                job['total_blocos'] = total
+
+        checkpoints = None
+        if self.pasta_checkpoints is not None and job['chave_cache'] is not None:
+            hash_entrada, hash_config = job['chave_cache']
+            checkpoints = CheckpointsETL(os.path.join(self.pasta_checkpoints, f'{hash_entrada[:16]}_{hash_config}'))
+
+        try:
+            resultado = executar_pipeline(
+                df, config, tamanho_bloco=self.tamanho_bloco,
+                progresso=progresso, progresso_blocos=progresso_blocos,
+                cancelado=job['cancelar'].is_set, checkpoints=checkpoints
+            )
+            status, erro, detalhes = CONCLUIDO, None, None
+            if self.cache is not None and job['chave_cache'] is not None:
+                self.cache.guardar(job['chave_cache'], resultado)
+            if ao_concluir is not None:
+                ao_concluir(resultado)
+            if checkpoints is not None:
+                checkpoints.limpar()
+        except ETLCancelado:
+            resultado, status, erro, detalhes = None, CANCELADO, None, None
+        except Exception as e:
+            resultado, status = None, ERRO
+            erro, detalhes = f"{type(e).__name__}: {e}", traceback.format_exc()
+
+        with self._lock:
+            job['resultado'] = resultado
+            job['status'] = status
+            job['erro'] = erro
+            job['traceback'] = detalhes
+            job['finalizado_em'] = time.time()
+
+    def _descartar_antigos(self):
+        finalizados = [j for j, job in self._jobs.items() if job['status'] in ESTADOS_FINAIS]
+        for job_id in finalizados[:max(0, len(finalizados) - self.max_jobs_finalizados)]:
+            del self._jobs[job_id]
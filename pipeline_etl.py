@@ -0,0 +1,1626 @@
+# -*- coding: utf-8 -*-
+"""
+Pipeline ETL - IMMUNED
+Regras de extração e etapas do pipeline compartilhadas pela aplicação
+Streamlit e pela execução em lote (etl_batch.py)
+"""
+
+import heapq
+import numpy as np
+import pandas as pd
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from busca_textos import construir_indice
+from quase_duplicatas import mapear_trechos, origens_reaproveitaveis
+from registro_regras import carregar_regras, nome_regra
+from textos_prontuarios import duplicados, impressao_textos, para_arrow, separar_texto
+
+# =============================================================================
+# CONFIGURAÇÕES E CONSTANTES
+# =============================================================================
+
+# Tabelas de padrões do conjunto de regras declarativo (regras_extracao.json,
+# lido e compilado uma vez por processo, ver registro_regras). As constantes
+# têm os nomes das tabelas no arquivo.
+REGISTRO = carregar_regras()
+
+# Padrões de Fator Reumatoide
+FR_POSITIVO_PATTERNS = REGISTRO['FR_POSITIVO_PATTERNS']
+FR_NEGATIVO_PATTERNS = REGISTRO['FR_NEGATIVO_PATTERNS']
+FR_VALOR_PATTERN = REGISTRO['FR_VALOR_PATTERN']
+CID_FR_MAPPING = REGISTRO['CID_FR_MAPPING']
+CID_PATTERN = REGISTRO['CID_PATTERN']
+
+# Medicamentos biológicos e JAK, DMARDs convencionais ({'aliases': [...], 'grupo': ...})
+BIOLOGICOS_CONFIG = REGISTRO['BIOLOGICOS_CONFIG']
+DMARDS_CONFIG = REGISTRO['DMARDS_CONFIG']
+
+# Comorbidades (termos) e marcadores clínicos ({'pattern': ..., 'label': ...})
+COMORBIDADES_CONFIG = REGISTRO['COMORBIDADES_CONFIG']
+MARCADORES_CONFIG = REGISTRO['MARCADORES_CONFIG']
+
+# Padrões de status de uso e motivos de suspensão
+USO_ATIVO_PATTERNS = REGISTRO['USO_ATIVO_PATTERNS']
+USO_PREVIO_PATTERNS = REGISTRO['USO_PREVIO_PATTERNS']
+MOTIVOS_SUSPENSAO = REGISTRO['MOTIVOS_SUSPENSAO']
+
+# Detalhes do metotrexato (dose e via, na ordem em que as vias são testadas)
+MTX_DOSE_PATTERN = REGISTRO['MTX_DOSE_PATTERN']
+MTX_VIA_PATTERNS = REGISTRO['MTX_VIA_PATTERNS']
+
+# Caracteres antes e depois de cada menção de medicamento examinados para o status de uso
+JANELA_CONTEXTO = REGISTRO['JANELA_CONTEXTO']
+
+# O que os extratores procuram (todas as regras configuradas, não só as
+# selecionadas). Uma nota quase duplicada só reaproveita o resultado da
+# anterior se nenhuma alteração tiver por perto um nome de medicamento, uma
+# comorbidade ou um acerto de uma regra de FR, CID, marcador ou MTX. Os nomes
+# são procurados como substring, com a mesma regra dos extratores (texto.find):
+# uma alteração que cria "nada" ou "administração" cria também uma menção de
+# 'ada' ou 'dm' para a extração completa e não pode ser ignorada aqui.
+TERMOS_RELEVANTES = sorted({
+    *(a for c in BIOLOGICOS_CONFIG.values() for a in c['aliases']),
+    *(a for c in DMARDS_CONFIG.values() for a in c['aliases']),
+    *(a for aliases in COMORBIDADES_CONFIG.values() for a in aliases),
+}, key=len, reverse=True)
+PADRAO_RELEVANTE = re.compile('|'.join([
+    *(re.escape(t.lower()) for t in TERMOS_RELEVANTES),
+    *(f'(?:{padrao})' for chave, padrao in REGISTRO.regras.items()
+      if chave[0] in ('FR_POSITIVO_PATTERNS', 'FR_NEGATIVO_PATTERNS', 'FR_VALOR_PATTERN', 'MARCADORES_CONFIG',
+                      'MTX_DOSE_PATTERN', 'MTX_VIA_PATTERNS')),
+    # CID_PATTERN é procurado sem distinção de maiúsculas; as janelas estão em minúsculas
+    f"(?i:{REGISTRO['CID_PATTERN']})",
+]))
+
+# Contexto em volta de cada alteração: a janela dos medicamentos mais o maior termo
+MARGEM_ALTERACAO = JANELA_CONTEXTO + max(len(t) for t in TERMOS_RELEVANTES)
+
+
+# =============================================================================
+# MÁSCARA DE COMORBIDADES
+# =============================================================================
+# Cada linha recebe em comorbidades_mascara (uint16) um bit por comorbidade,
+# na ordem de COMORBIDADES_CONFIG (has = bit 0, dm = bit 1, ...). As bandeiras
+# individuais continuam existindo; filtros e combinações usam a máscara com
+# operações inteiras em vez de reduções sobre várias colunas.
+
+BITS_COMORBIDADES = {nome: 1 << i for i, nome in enumerate(COMORBIDADES_CONFIG)}
+
+# Número de bits ligados em cada byte (popcount por tabela)
+_BITS_POR_BYTE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def mascara_de(comorbidades):
+    """Máscara com os bits das comorbidades informadas"""
+    mascara = 0
+    for nome in comorbidades:
+        mascara |= BITS_COMORBIDADES[nome]
+    return np.uint16(mascara)
+
+
+def nomes_da_mascara(mascara):
+    """Comorbidades presentes em um valor de máscara, na ordem de COMORBIDADES_CONFIG"""
+    return [nome for nome, bit in BITS_COMORBIDADES.items() if int(mascara) & bit]
+
+
+def mascara_das_colunas(df):
+    """Máscara montada a partir das bandeiras individuais (dados sem a coluna pronta)"""
+    mascara = np.zeros(len(df), dtype=np.uint16)
+    for nome, bit in BITS_COMORBIDADES.items():
+        if nome in df.columns:
+            mascara |= np.where(df[nome].to_numpy() > 0, bit, 0).astype(np.uint16)
+    return pd.Series(mascara, index=df.index, name='comorbidades_mascara')
+
+
+def obter_mascara(df):
+    """Coluna comorbidades_mascara do DataFrame (ou reconstruída das bandeiras)"""
+    if 'comorbidades_mascara' in df.columns:
+        return df['comorbidades_mascara']
+    return mascara_das_colunas(df)
+
+
+def tem_alguma(mascara, comorbidades):
+    """Linhas com pelo menos uma das comorbidades"""
+    return (mascara & mascara_de(comorbidades)) != 0
+
+
+def tem_todas(mascara, comorbidades):
+    """Linhas com todas as comorbidades"""
+    alvo = mascara_de(comorbidades)
+    return (mascara & alvo) == alvo
+
+
+def contar_comorbidades(mascara):
+    """Número de comorbidades por linha (popcount da máscara)"""
+    valores = np.asarray(mascara, dtype=np.uint16)
+    contagem = _BITS_POR_BYTE[valores & 0xFF] + _BITS_POR_BYTE[valores >> 8]
+    if isinstance(mascara, pd.Series):
+        return pd.Series(contagem, index=mascara.index)
+    return contagem
+
+
+def frequencia_combinacoes(mascara, comorbidades=None):
+    """
+    Frequência de cada combinação exata de comorbidades.
+
+    Args:
+        mascara: valores de comorbidades_mascara (uma linha por paciente, em geral)
+        comorbidades: restringe a análise a estas comorbidades (None = todas)
+
+    Returns:
+        DataFrame (mascara, combinacao, n_comorbidades, frequencia), da mais
+        frequente para a menos frequente
+    """
+    valores = np.asarray(mascara, dtype=np.uint16)
+    if comorbidades is not None:
+        valores = valores & mascara_de(comorbidades)
+    contagens = np.bincount(valores, minlength=1)
+    presentes = np.flatnonzero(contagens).astype(np.uint16)
+
+    tabela = pd.DataFrame({
+        'mascara': presentes,
+        'combinacao': [' + '.join(n.upper() for n in nomes_da_mascara(m)) or 'Nenhuma' for m in presentes],
+        'n_comorbidades': contar_comorbidades(presentes),
+        'frequencia': contagens[presentes],
+    })
+    return tabela.sort_values(['frequencia', 'mascara'], ascending=[False, True], kind='mergesort').reset_index(drop=True)
+
+
+# =============================================================================
+# EVIDÊNCIAS DA EXTRAÇÃO
+# =============================================================================
+# Cada valor extraído guarda a evidência que o decidiu: a coluna preenchida,
+# a regra que disparou e o trecho (início e fim, em caracteres da nota). As
+# regras são identificadas pela tabela de padrões e pela posição ou chave:
+#
+#   FR_POSITIVO_PATTERNS[2]          padrão de uma lista
+#   MARCADORES_CONFIG[das28]         padrão de um dicionário
+#   BIOLOGICOS_CONFIG[adalimumabe][2]  alias 'ada' do adalimumabe
+#
+# Durante a extração as evidências de cada linha ficam na coluna evidencias
+# (bytes: int32 coluna, regra, início, fim por evidência), que acompanha os
+# blocos, checkpoints e notas reaproveitadas. Ao final do ETL elas saem de
+# df_processed para uma tabela própria (separar_evidencias), com nota igual
+# à posição da linha em df_processed, como texto_id.
+
+
+# Identificador da regra -> padrão (regex ou termo procurado)
+REGRAS_EXTRACAO = {nome_regra(chave): padrao for chave, padrao in REGISTRO.regras.items()}
+
+# Colunas que recebem evidências
+CAMPOS_EVIDENCIA = [
+    'fr_resultado', 'fr_valor', *MARCADORES_CONFIG, *COMORBIDADES_CONFIG,
+    *(f'{m}_{sufixo}' for m in {**BIOLOGICOS_CONFIG, **DMARDS_CONFIG} for sufixo in ('status', 'motivo')),
+    'uso_mtx', 'motivo_suspensao_mtx', 'mtx_dose_mg_semana', 'mtx_via', 'uso_biologico',
+]
+
+_ID_REGRA = {regra: i for i, regra in enumerate(REGRAS_EXTRACAO)}
+_ID_CAMPO = {campo: i for i, campo in enumerate(CAMPOS_EVIDENCIA)}
+
+
+def regra_alias(medicamento, indice):
+    """Identificador da regra do alias de um medicamento"""
+    tabela = 'BIOLOGICOS_CONFIG' if medicamento in BIOLOGICOS_CONFIG else 'DMARDS_CONFIG'
+    return f'{tabela}[{medicamento}][{indice}]'
+
+
+def _evidencia(regra, match, deslocamento=0):
+    """(regra, início, fim) de um match (deslocamento: início do contexto buscado)"""
+    return regra, match.start() + deslocamento, match.end() + deslocamento
+
+
+def codificar_evidencias(evidencias):
+    """Lista de (coluna, regra, início, fim) de uma linha -> bytes (int32)"""
+    return np.array(
+        [(_ID_CAMPO[campo], _ID_REGRA[regra], inicio, fim) for campo, regra, inicio, fim in evidencias],
+        dtype=np.int32
+    ).tobytes()
+
+
+def separar_evidencias(df):
+    """
+    Retira de df a coluna evidencias (bytes por linha).
+
+    Returns:
+        (df sem a coluna, DataFrame (nota int32, coluna categórica, regra
+        categórica, inicio int32, fim int32) ordenado por nota, ou None se df
+        não tem evidências)
+    """
+    if 'evidencias' not in df.columns:
+        return df, None
+    blocos = [b if isinstance(b, bytes) else b'' for b in df['evidencias']]
+    valores = np.frombuffer(b''.join(blocos), dtype=np.int32).reshape(-1, 4)
+    quantidades = np.fromiter((len(b) // 16 for b in blocos), dtype=np.int64, count=len(blocos))
+    evidencias = pd.DataFrame({
+        'nota': np.repeat(np.arange(len(df), dtype=np.int32), quantidades),
+        'coluna': pd.Categorical.from_codes(valores[:, 0], categories=CAMPOS_EVIDENCIA),
+        'regra': pd.Categorical.from_codes(valores[:, 1], categories=list(REGRAS_EXTRACAO)),
+        'inicio': valores[:, 2].copy(),
+        'fim': valores[:, 3].copy(),
+    })
+    return df.drop(columns=['evidencias']), evidencias
+
+
+def _anotar(evidencias, idx, itens, colunas):
+    """Acrescenta às evidências da linha idx os itens (campo, regra, início, fim), com campo -> coluna"""
+    if evidencias is not None:
+        evidencias[idx].extend((colunas[campo], regra, inicio, fim)
+                               for campo, regra, inicio, fim in itens if campo in colunas)
+
+
+def evidencias_da_nota(evidencias, nota):
+    """Evidências de uma nota (posição em df_processed), com o padrão de cada regra"""
+    notas = evidencias['nota'].to_numpy()
+    inicio, fim = np.searchsorted(notas, nota, side='left'), np.searchsorted(notas, nota, side='right')
+    tabela = evidencias.iloc[inicio:fim].drop(columns=['nota']).reset_index(drop=True)
+    tabela['padrao'] = tabela['regra'].astype(str).map(REGRAS_EXTRACAO)
+    return tabela
+
+
+# =============================================================================
+# CONTADORES DE REGRAS
+# =============================================================================
+# Com contadores_regras na configuração, cada avaliação de uma regra de
+# REGRAS_EXTRACAO (busca do padrão compilado, str.find ou a varredura das menções de um
+# alias) é contada e cronometrada: avaliações, acertos (matches), notas com
+# pelo menos um acerto e tempo acumulado. Os extratores chamam _buscar,
+# _encontrar e _mencoes com a chave da regra, uma tupla como
+# ('USO_PREVIO_PATTERNS', 2), montada só como tupla para não custar nada
+# quando os contadores estão desligados. Notas reaproveitadas de uma quase
+# duplicata e blocos retomados de checkpoint não são avaliados e não contam.
+#
+# Com perfil_notas = N, cada nota também é cronometrada em cada extrator e
+# as N mais lentas (com o tempo por extrator e a regra que dominou o tempo
+# da nota) vão para relatorio['notas_lentas']: são as entradas que fazem as
+# regras com janela de contexto ou DOTALL retrocederem.
+
+_ID_CHAVE = {chave: i for i, chave in enumerate(REGISTRO.regras)}
+
+CAMPOS_CONTADORES = ['avaliacoes', 'acertos', 'notas', 'tempo_ms']
+
+# Extratores de extrair_variaveis, na ordem em que rodam
+EXTRATORES = ['fr', 'marcadores', 'comorbidades', 'medicamentos', 'mtx', 'biologicos']
+
+
+class ContadoresRegras:
+    """
+    Contadores das regras em um bloco de notas. Os extratores avisam o
+    extrator em execução (extrator) e a linha do bloco em avaliação
+    (iniciar_nota).
+
+    Args:
+        n_notas: linhas do bloco
+        perfil: também cronometra cada nota em cada extrator e cada regra
+                em cada nota (ver notas_lentas)
+    """
+
+    def __init__(self, n_notas, perfil=False):
+        n_regras = len(REGRAS_EXTRACAO)
+        self.avaliacoes = np.zeros(n_regras, dtype=np.int64)
+        self.acertos = np.zeros(n_regras, dtype=np.int64)
+        self.tempo_ns = np.zeros(n_regras, dtype=np.int64)
+        self._com_acerto = np.zeros((max(n_notas, 1), n_regras), dtype=bool)
+        self.nota = 0
+        self.perfil = perfil
+        if perfil:
+            self._tempo_nota_regra = np.zeros((max(n_notas, 1), n_regras), dtype=np.int64)
+            self._tempo_nota_extrator = np.zeros((max(n_notas, 1), len(EXTRATORES)), dtype=np.int64)
+        self._extrator = 0
+        self._inicio_nota = None
+
+    def extrator(self, nome):
+        """Início do extrator nome (None: fim da extração)"""
+        self._fechar_nota()
+        self._extrator = EXTRATORES.index(nome) if nome is not None else 0
+
+    def iniciar_nota(self, nota):
+        self._fechar_nota()
+        self.nota = nota
+        if self.perfil:
+            self._inicio_nota = time.perf_counter_ns()
+
+    def _fechar_nota(self):
+        if self._inicio_nota is not None:
+            self._tempo_nota_extrator[self.nota, self._extrator] += time.perf_counter_ns() - self._inicio_nota
+            self._inicio_nota = None
+
+    def registrar(self, chave, acertos, tempo_ns):
+        regra = _ID_CHAVE[chave]
+        self.avaliacoes[regra] += 1
+        self.tempo_ns[regra] += tempo_ns
+        if acertos:
+            self.acertos[regra] += acertos
+            self._com_acerto[self.nota, regra] = True
+        if self.perfil:
+            self._tempo_nota_regra[self.nota, regra] += tempo_ns
+
+    def resumo(self):
+        """Dict regra -> CAMPOS_CONTADORES, só das regras avaliadas (serializável em JSON)"""
+        notas = self._com_acerto.sum(axis=0)
+        regras = list(REGRAS_EXTRACAO)
+        return {
+            regras[i]: {'avaliacoes': int(self.avaliacoes[i]), 'acertos': int(self.acertos[i]),
+                        'notas': int(notas[i]), 'tempo_ms': float(self.tempo_ns[i]) / 1e6}
+            for i in np.flatnonzero(self.avaliacoes)
+        }
+
+    def notas_lentas(self, df, n):
+        """
+        As n notas de df (o bloco) que mais tempo levaram nos extratores, da
+        mais lenta para a mais rápida (serializáveis em JSON; a nota é
+        identificada por paciente, tipo, data_hora e impressao_texto).
+        """
+        totais = self._tempo_nota_extrator[:len(df)].sum(axis=1)
+        regras = list(REGRAS_EXTRACAO)
+        notas = []
+        for linha in heapq.nlargest(n, range(len(df)), key=totais.__getitem__):
+            registro = df.iloc[linha]
+            dominante = int(np.argmax(self._tempo_nota_regra[linha]))
+            tempo_dominante = int(self._tempo_nota_regra[linha, dominante])
+            notas.append({
+                **{c: _valor_json(registro[c]) for c in ['paciente', 'tipo', 'data_hora', 'impressao_texto']
+                   if c in df.columns},
+                'caracteres': len(str(registro['descricao'])) if pd.notna(registro['descricao']) else 0,
+                'tempo_ms': float(totais[linha]) / 1e6,
+                'extratores_ms': {nome: float(self._tempo_nota_extrator[linha, i]) / 1e6
+                                  for i, nome in enumerate(EXTRATORES) if self._tempo_nota_extrator[linha, i]},
+                'regra_dominante': regras[dominante] if tempo_dominante else None,
+                'regra_dominante_ms': tempo_dominante / 1e6,
+            })
+        return notas
+
+
+def _valor_json(valor):
+    if pd.isna(valor):
+        return None
+    if isinstance(valor, pd.Timestamp):
+        return valor.isoformat()
+    return valor.item() if isinstance(valor, np.generic) else valor
+
+
+def somar_notas_lentas(total, parcial, n):
+    """As n mais lentas entre as notas lentas de total e de outro bloco, parte ou shard"""
+    return heapq.nlargest(n, total + parcial, key=lambda nota: nota['tempo_ms'])
+
+
+def tabela_notas_lentas(notas):
+    """Notas lentas (relatorio['notas_lentas']) como DataFrame, com uma coluna de tempo por extrator"""
+    tabela = pd.DataFrame(notas, columns=['paciente', 'tipo', 'data_hora', 'impressao_texto', 'caracteres',
+                                          'tempo_ms', 'regra_dominante', 'regra_dominante_ms'])
+    for nome in EXTRATORES:
+        tabela[f'{nome}_ms'] = [nota.get('extratores_ms', {}).get(nome, 0.0) for nota in notas]
+    tabela.insert(tabela.columns.get_loc('regra_dominante') + 1, 'padrao_dominante',
+                  tabela['regra_dominante'].map(REGRAS_EXTRACAO))
+    return tabela
+
+
+def somar_medicoes(total, parcial, config):
+    """
+    Acumula em total as medições de um bloco, parte ou shard: regras
+    (somar_contadores) e notas_lentas (somar_notas_lentas).
+    """
+    if 'regras' in parcial:
+        somar_contadores(total.setdefault('regras', {}), parcial['regras'])
+    if 'notas_lentas' in parcial:
+        total['notas_lentas'] = somar_notas_lentas(total.get('notas_lentas', []), parcial['notas_lentas'],
+                                                   config['perfil_notas'])
+    return total
+
+
+def somar_contadores(total, parcial):
+    """Acumula em total (dict regra -> CAMPOS_CONTADORES) os contadores de outro bloco, parte ou shard"""
+    for regra, valores in parcial.items():
+        acumulado = total.setdefault(regra, dict.fromkeys(CAMPOS_CONTADORES, 0))
+        for campo in CAMPOS_CONTADORES:
+            acumulado[campo] += valores[campo]
+    return total
+
+
+def tabela_regras(contadores):
+    """
+    Contadores (relatorio['regras']) como DataFrame, da regra mais cara para a
+    mais barata, com o padrão, a fração de acertos e o custo por avaliação.
+    Regras sem nenhum acerto são candidatas a remoção.
+    """
+    tabela = pd.DataFrame.from_dict(contadores, orient='index', columns=CAMPOS_CONTADORES)
+    tabela.index.name = 'regra'
+    tabela = tabela.reset_index()
+    tabela.insert(1, 'padrao', tabela['regra'].map(REGRAS_EXTRACAO))
+    tabela['taxa_acerto'] = tabela['acertos'] / tabela['avaliacoes'].where(tabela['avaliacoes'] > 0)
+    tabela['us_por_avaliacao'] = 1000 * tabela['tempo_ms'] / tabela['avaliacoes'].where(tabela['avaliacoes'] > 0)
+    return tabela.sort_values('tempo_ms', ascending=False, kind='mergesort').reset_index(drop=True)
+
+
+def _buscar(contadores, chave, texto):
+    """Busca da regra (padrão pré-compilado do registro) em texto, contada em contadores (se houver)"""
+    if contadores is None:
+        return REGISTRO.regex(chave).search(texto)
+    inicio = time.perf_counter_ns()
+    match = REGISTRO.regex(chave).search(texto)
+    contadores.registrar(chave, match is not None, time.perf_counter_ns() - inicio)
+    return match
+
+
+def _encontrar(contadores, chave, termo, texto):
+    """texto.find(termo), contado em contadores (se houver)"""
+    if contadores is None:
+        return texto.find(termo)
+    inicio = time.perf_counter_ns()
+    posicao = texto.find(termo)
+    contadores.registrar(chave, posicao >= 0, time.perf_counter_ns() - inicio)
+    return posicao
+
+
+def _mencoes(contadores, chave, termo, texto):
+    """Matches de todas as ocorrências de termo em texto, contados em contadores (se houver)"""
+    if contadores is None:
+        return re.finditer(re.escape(termo), texto)
+    inicio = time.perf_counter_ns()
+    matches = list(re.finditer(re.escape(termo), texto))
+    contadores.registrar(chave, len(matches), time.perf_counter_ns() - inicio)
+    return matches
+
+
+# =============================================================================
+# FUNÇÕES DE EXTRAÇÃO
+# =============================================================================
+
+def is_number(s):
+    """Verifica se uma string contém números"""
+    return bool(re.search(r'\d', str(s)))
+
+
+def extract_fator_reumatoide(text, contadores=None):
+    """
+    Extrai informações sobre Fator Reumatoide. Em evidencias, (campo, regra,
+    início, fim) de cada valor encontrado. Com contadores (ContadoresRegras),
+    cada regra avaliada é contada.
+    """
+    if pd.isna(text):
+        return {'fr_resultado': 'NÃO INFORMADO', 'fr_valor': None, 'fr_origem': None, 'evidencias': []}
+    
+    text_lower = str(text).lower()
+    result = {'fr_resultado': 'NÃO INFORMADO', 'fr_valor': None, 'fr_origem': None, 'evidencias': []}
+    
+    # Buscar padrões positivos
+    for i in range(len(FR_POSITIVO_PATTERNS)):
+        match = _buscar(contadores, ('FR_POSITIVO_PATTERNS', i), text_lower)
+        if match:
+            result['fr_resultado'] = 'POSITIVO'
+            result['fr_origem'] = 'TEXTO'
+            result['evidencias'].append(('fr_resultado', *_evidencia(f'FR_POSITIVO_PATTERNS[{i}]', match)))
+            break
+    
+    # Buscar padrões negativos
+    if result['fr_resultado'] == 'NÃO INFORMADO':
+        for i in range(len(FR_NEGATIVO_PATTERNS)):
+            match = _buscar(contadores, ('FR_NEGATIVO_PATTERNS', i), text_lower)
+            if match:
+                result['fr_resultado'] = 'NEGATIVO'
+                result['fr_origem'] = 'TEXTO'
+                result['evidencias'].append(('fr_resultado', *_evidencia(f'FR_NEGATIVO_PATTERNS[{i}]', match)))
+                break
+    
+    # Extrair valor numérico
+    valor_match = _buscar(contadores, ('FR_VALOR_PATTERN',), text_lower)
+    if valor_match:
+        try:
+            result['fr_valor'] = float(valor_match.group(1).replace(',', '.'))
+            result['fr_origem'] = 'LAB'
+            result['evidencias'].append(('fr_valor', *_evidencia('FR_VALOR_PATTERN', valor_match)))
+        except:
+            pass
+    
+    # Inferir por CID-10
+    if result['fr_resultado'] == 'NÃO INFORMADO':
+        cid_match = _buscar(contadores, ('CID_PATTERN',), str(text))
+        if cid_match:
+            cid = cid_match.group(1).upper()
+            if '.' not in cid and len(cid) >= 4:
+                cid = cid[:3] + '.' + cid[3:]
+            if cid in CID_FR_MAPPING:
+                result['fr_resultado'] = CID_FR_MAPPING[cid]
+                result['fr_origem'] = 'CID'
+                result['evidencias'].append(('fr_resultado', *_evidencia('CID_PATTERN', cid_match)))
+    
+    return result
+
+
+def extract_medicamento_status(text, medicamento, aliases, contadores=None):
+    """
+    Extrai status de uso de medicamento (SIM/PRÉVIO/NÃO). Em evidencias,
+    (campo, regra, início, fim) da menção e do padrão que decidiram o uso e
+    do motivo de suspensão. Com contadores (ContadoresRegras), cada regra
+    avaliada é contada.
+    """
+    if pd.isna(text):
+        return {'uso': 'NÃO', 'nome': None, 'motivo_suspensao': None, 'evidencias': []}
+    
+    text_lower = str(text).lower()
+    result = {'uso': 'NÃO', 'nome': None, 'motivo_suspensao': None, 'evidencias': []}
+    
+    # Verificar se o medicamento é mencionado
+    tabela = 'BIOLOGICOS_CONFIG' if medicamento in BIOLOGICOS_CONFIG else 'DMARDS_CONFIG'
+    med_found = False
+    for i, alias in enumerate(aliases):
+        posicao = _encontrar(contadores, (tabela, medicamento, i), alias.lower(), text_lower)
+        if posicao >= 0:
+            med_found = True
+            result['nome'] = medicamento
+            mencao = ('uso', regra_alias(medicamento, i), posicao, posicao + len(alias.lower()))
+            break
+    
+    if not med_found:
+        return result
+    
+    # Evidências da última atribuição de cada valor (a que fica no resultado)
+    evidencia_uso = {}
+    evidencia_motivo = None
+    
+    # Buscar contexto próximo ao medicamento
+    for i, alias in enumerate(aliases):
+        for match in _mencoes(contadores, (tabela, medicamento, i), alias.lower(), text_lower):
+            start = max(0, match.start() - JANELA_CONTEXTO)
+            end = min(len(text_lower), match.end() + JANELA_CONTEXTO)
+            context = text_lower[start:end]
+            alias_match = ('uso', *_evidencia(regra_alias(medicamento, i), match))
+            
+            # Verificar uso prévio
+            for j in range(len(USO_PREVIO_PATTERNS)):
+                padrao_match = _buscar(contadores, ('USO_PREVIO_PATTERNS', j), context)
+                if padrao_match:
+                    result['uso'] = 'PRÉVIO'
+                    evidencia_uso['PRÉVIO'] = [
+                        alias_match, ('uso', *_evidencia(f'USO_PREVIO_PATTERNS[{j}]', padrao_match, start))
+                    ]
+                    for k, motivo in enumerate(MOTIVOS_SUSPENSAO):
+                        posicao = _encontrar(contadores, ('MOTIVOS_SUSPENSAO', k), motivo, context)
+                        if posicao >= 0:
+                            result['motivo_suspensao'] = motivo
+                            evidencia_motivo = ('motivo_suspensao', f'MOTIVOS_SUSPENSAO[{k}]',
+                                                start + posicao, start + posicao + len(motivo))
+                            break
+                    break
+            
+            # Verificar uso ativo
+            if result['uso'] != 'PRÉVIO':
+                for j in range(len(USO_ATIVO_PATTERNS)):
+                    padrao_match = _buscar(contadores, ('USO_ATIVO_PATTERNS', j), context)
+                    if padrao_match:
+                        result['uso'] = 'SIM'
+                        evidencia_uso['SIM'] = [
+                            alias_match, ('uso', *_evidencia(f'USO_ATIVO_PATTERNS[{j}]', padrao_match, start))
+                        ]
+                        break
+    
+    # Default: se menciona, assume uso
+    if result['uso'] == 'NÃO' and med_found:
+        result['uso'] = 'SIM'
+    
+    result['evidencias'] = evidencia_uso.get(result['uso'], [mencao])
+    if evidencia_motivo is not None:
+        result['evidencias'].append(evidencia_motivo)
+    return result
+
+
+def extract_marcadores(df, selected_markers, column_name='descricao', evidencias=None, contadores=None):
+    """Extrai marcadores clínicos selecionados"""
+    for marker in selected_markers:
+        df[marker] = None
+    
+    for idx, text in enumerate(df[column_name]):
+        if pd.isna(text):
+            continue
+        text_lower = str(text).lower()
+        if contadores is not None:
+            contadores.iniciar_nota(idx)
+        
+        for marker in selected_markers:
+            if marker in MARCADORES_CONFIG:
+                match = _buscar(contadores, ('MARCADORES_CONFIG', marker), text_lower)
+                if match and pd.isna(df.loc[idx, marker]):
+                    try:
+                        df.loc[idx, marker] = float(match.group(1).replace(',', '.'))
+                        _anotar(evidencias, idx, [(marker, *_evidencia(f'MARCADORES_CONFIG[{marker}]', match))],
+                                {marker: marker})
+                    except:
+                        pass
+    
+    return df
+
+
+def extract_comorbidades(df, selected_comorbidities, column_name='descricao', evidencias=None, contadores=None):
+    """Extrai comorbidades selecionadas como máscara de bits e flags binárias"""
+    selecionadas = [c for c in selected_comorbidities if c in COMORBIDADES_CONFIG]
+    mascara = np.zeros(len(df), dtype=np.uint16)
+    
+    for idx, text in enumerate(df[column_name]):
+        if pd.isna(text):
+            continue
+        text_lower = str(text).lower()
+        if contadores is not None:
+            contadores.iniciar_nota(idx)
+        
+        for comorb in selecionadas:
+            for i, alias in enumerate(COMORBIDADES_CONFIG[comorb]):
+                posicao = _encontrar(contadores, ('COMORBIDADES_CONFIG', comorb, i), alias, text_lower)
+                if posicao >= 0:
+                    mascara[idx] |= BITS_COMORBIDADES[comorb]
+                    _anotar(evidencias, idx, [(comorb, f'COMORBIDADES_CONFIG[{comorb}][{i}]',
+                                               posicao, posicao + len(alias))], {comorb: comorb})
+                    break
+    
+    for comorb in selected_comorbidities:
+        bit = BITS_COMORBIDADES.get(comorb, 0)
+        df[comorb] = ((mascara & bit) != 0).astype(int)
+    
+    # Máscara e flag geral
+    if selected_comorbidities:
+        df['comorbidades_mascara'] = mascara
+        df['comorbidade_qualquer'] = (mascara != 0).astype(int)
+    
+    return df
+
+
+def extract_medicamentos_v3(df, selected_medications, column_name='descricao', evidencias=None, contadores=None):
+    """Extrai medicamentos com status SIM/PRÉVIO/NÃO"""
+    # Colunas de status (novo)
+    for med in selected_medications:
+        df[f'{med}_status'] = 'NÃO'
+        df[f'{med}_motivo'] = None
+        df[med] = 0  # Manter compatibilidade binária
+    
+    for idx, text in enumerate(df[column_name]):
+        if pd.isna(text):
+            continue
+        if contadores is not None:
+            contadores.iniciar_nota(idx)
+        
+        for med in selected_medications:
+            # Buscar config em biológicos ou DMARDs
+            config = BIOLOGICOS_CONFIG.get(med) or DMARDS_CONFIG.get(med)
+            if config:
+                aliases = config['aliases']
+                status = extract_medicamento_status(text, med, aliases, contadores)
+                
+                df.loc[idx, f'{med}_status'] = status['uso']
+                df.loc[idx, f'{med}_motivo'] = status['motivo_suspensao']
+                _anotar(evidencias, idx, status['evidencias'],
+                        {'uso': f'{med}_status', 'motivo_suspensao': f'{med}_motivo'})
+                
+                # Flag binária para compatibilidade
+                if status['uso'] in ['SIM', 'PRÉVIO']:
+                    df.loc[idx, med] = 1
+    
+    return df
+
+
+def extract_mtx_detalhado(df, column_name='descricao', evidencias=None, contadores=None):
+    """Extrai detalhes específicos do Metotrexato"""
+    df['uso_mtx'] = 'NÃO'
+    df['mtx_dose_mg_semana'] = None
+    df['mtx_via'] = None
+    df['motivo_suspensao_mtx'] = None
+    
+    for idx, text in enumerate(df[column_name]):
+        if pd.isna(text):
+            continue
+        
+        text_lower = str(text).lower()
+        if contadores is not None:
+            contadores.iniciar_nota(idx)
+        
+        # Status
+        status = extract_medicamento_status(text, 'metotrexato', DMARDS_CONFIG['metotrexato']['aliases'],
+                                            contadores)
+        df.loc[idx, 'uso_mtx'] = status['uso']
+        df.loc[idx, 'motivo_suspensao_mtx'] = status['motivo_suspensao']
+        _anotar(evidencias, idx, status['evidencias'],
+                {'uso': 'uso_mtx', 'motivo_suspensao': 'motivo_suspensao_mtx'})
+        
+        # Dose
+        dose_match = _buscar(contadores, ('MTX_DOSE_PATTERN',), text_lower)
+        if dose_match:
+            try:
+                df.loc[idx, 'mtx_dose_mg_semana'] = float(dose_match.group(1).replace(',', '.'))
+                _anotar(evidencias, idx, [('dose', *_evidencia('MTX_DOSE_PATTERN', dose_match))],
+                        {'dose': 'mtx_dose_mg_semana'})
+            except:
+                pass
+        
+        # Via
+        for via in MTX_VIA_PATTERNS:
+            via_match = _buscar(contadores, ('MTX_VIA_PATTERNS', via), text_lower)
+            if via_match:
+                df.loc[idx, 'mtx_via'] = via
+                _anotar(evidencias, idx, [('via', *_evidencia(f'MTX_VIA_PATTERNS[{via}]', via_match))],
+                        {'via': 'mtx_via'})
+                break
+    
+    return df
+
+
+def extract_biologicos_detalhado(df, selected_biologicos, column_name='descricao', evidencias=None,
+                                 contadores=None):
+    """Extrai detalhes de biológicos com grupo terapêutico"""
+    df['uso_biologico'] = 'NÃO'
+    df['biologico_nome'] = None
+    df['biologico_grupo'] = None
+    df['num_biologicos_previos'] = 0
+    
+    for idx, text in enumerate(df[column_name]):
+        if pd.isna(text):
+            continue
+        
+        if contadores is not None:
+            contadores.iniciar_nota(idx)
+        biologicos_em_uso = []
+        biologicos_previos = []
+        
+        for med in selected_biologicos:
+            if med in BIOLOGICOS_CONFIG:
+                config = BIOLOGICOS_CONFIG[med]
+                status = extract_medicamento_status(text, med, config['aliases'], contadores)
+                
+                if status['uso'] == 'SIM':
+                    biologicos_em_uso.append({'nome': med, 'grupo': config['grupo'],
+                                              'evidencias': status['evidencias']})
+                elif status['uso'] == 'PRÉVIO':
+                    biologicos_previos.append({'nome': med, 'grupo': config['grupo'],
+                                               'evidencias': status['evidencias']})
+        
+        if biologicos_em_uso:
+            df.loc[idx, 'uso_biologico'] = 'SIM'
+            df.loc[idx, 'biologico_nome'] = biologicos_em_uso[0]['nome']
+            df.loc[idx, 'biologico_grupo'] = biologicos_em_uso[0]['grupo']
+            _anotar(evidencias, idx, biologicos_em_uso[0]['evidencias'], {'uso': 'uso_biologico'})
+        elif biologicos_previos:
+            df.loc[idx, 'uso_biologico'] = 'PRÉVIO'
+            df.loc[idx, 'biologico_nome'] = biologicos_previos[0]['nome']
+            df.loc[idx, 'biologico_grupo'] = biologicos_previos[0]['grupo']
+            _anotar(evidencias, idx, biologicos_previos[0]['evidencias'], {'uso': 'uso_biologico'})
+        
+        df.loc[idx, 'num_biologicos_previos'] = len(biologicos_previos)
+    
+    return df
+
+
+def extract_fator_reumatoide_df(df, column_name='descricao', evidencias=None, contadores=None):
+    """Aplica extração de FR ao DataFrame"""
+    df['fr_resultado'] = 'NÃO INFORMADO'
+    df['fr_valor'] = None
+    df['fr_origem'] = None
+    
+    for idx, text in enumerate(df[column_name]):
+        if contadores is not None:
+            contadores.iniciar_nota(idx)
+        fr_info = extract_fator_reumatoide(text, contadores)
+        df.loc[idx, 'fr_resultado'] = fr_info['fr_resultado']
+        df.loc[idx, 'fr_valor'] = fr_info['fr_valor']
+        df.loc[idx, 'fr_origem'] = fr_info['fr_origem']
+        _anotar(evidencias, idx, fr_info['evidencias'], {'fr_resultado': 'fr_resultado', 'fr_valor': 'fr_valor'})
+    
+    return df
+
+
+def clean_numeric_columns(df, columns):
+    """Limpa e converte colunas numéricas"""
+    for col in columns:
+        if col in df.columns:
+            df[col] = (
+                df[col]
+                .astype(str)
+                .str.extract(r'(\d+[.,]?\d*)', expand=False)
+                .str.replace(',', '.', regex=False)
+            )
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+    return df
+
+
+def create_longitudinal_data(df, baseline_type, followup_type, marker_cols,
+                            date_col='data_hora', patient_col='paciente'):
+    """Cria base longitudinal com medidas t0 e t1"""
+    baseline = df[df['tipo'] == baseline_type].copy()
+    followup = df[df['tipo'] == followup_type].copy()
+    
+    baseline = baseline.sort_values(by=date_col, ascending=True)
+    baseline = baseline.drop_duplicates(subset=[patient_col], keep="first")
+    
+    followup = followup.sort_values(by=date_col, ascending=False)
+    followup = followup.drop_duplicates(subset=[patient_col], keep="first")
+    
+    baseline_marker_cols = marker_cols + [date_col]
+    baseline.columns = [
+        col + '_t0' if col in baseline_marker_cols else col
+        for col in baseline.columns
+    ]
+    
+    followup.columns = [
+        col + '_t1' if col in baseline_marker_cols else col
+        for col in followup.columns
+    ]
+    
+    # Colunas extras para manter do baseline (não são marcadores, não ganham _t0)
+    extra_cols = ['idade', 'sexo', 'fr_resultado', 'fr_valor', 'fr_origem',
+                  'uso_mtx', 'mtx_dose_mg_semana', 'mtx_via', 'motivo_suspensao_mtx',
+                  'uso_biologico', 'biologico_nome', 'biologico_grupo', 'num_biologicos_previos',
+                  'comorbidade_qualquer', 'comorbidades_mascara']
+    
+    # Adicionar colunas de comorbidades individuais
+    comorb_cols = [c for c in baseline.columns if c in COMORBIDADES_CONFIG.keys()]
+    extra_cols.extend(comorb_cols)
+    
+    # Adicionar colunas de medicamentos individuais (status e binário)
+    med_cols = [c for c in baseline.columns if c.endswith('_status') or c.endswith('_motivo')]
+    extra_cols.extend(med_cols)
+    
+    # Colunas para manter do baseline
+    keep_cols = [patient_col]
+    keep_cols += [c for c in extra_cols if c in baseline.columns]
+    keep_cols += [col for col in baseline.columns if '_t0' in col]
+    
+    # Remover duplicatas na lista
+    keep_cols = list(dict.fromkeys(keep_cols))
+    
+    # Selecionar colunas do followup (apenas marcadores _t1 e paciente)
+    followup_keep = [patient_col] + [col for col in followup.columns if '_t1' in col]
+    
+    merged = baseline[keep_cols].merge(followup[followup_keep], on=patient_col, how='inner')
+    
+    # Tratar possíveis duplicatas restantes
+    for col in extra_cols:
+        if f'{col}_y' in merged.columns:
+            merged = merged.drop(columns=[f'{col}_y'], errors='ignore')
+        if f'{col}_x' in merged.columns:
+            merged = merged.rename(columns={f'{col}_x': col})
+    
+    # Calcular tempo de tratamento
+    if f'{date_col}_t0' in merged.columns and f'{date_col}_t1' in merged.columns:
+        merged['tempo_tratamento_dias'] = (
+            merged[f'{date_col}_t1'] - merged[f'{date_col}_t0']
+        ).dt.days
+    
+    return merged
+
+
+def calculate_improvement(merged_df, criteria_dict):
+    """Calcula melhora baseada em critérios personalizados"""
+    merged_df['improvement'] = None
+    
+    for marker, criteria_func in criteria_dict.items():
+        col_t0 = f'{marker}_t0'
+        col_t1 = f'{marker}_t1'
+        
+        if col_t0 in merged_df.columns and col_t1 in merged_df.columns:
+            for idx in merged_df.index:
+                v0 = merged_df.loc[idx, col_t0]
+                v1 = merged_df.loc[idx, col_t1]
+                
+                if merged_df.loc[idx, 'improvement'] is None:
+                    if not pd.isna(v0) and not pd.isna(v1):
+                        merged_df.loc[idx, 'improvement'] = int(criteria_func(v0, v1))
+    
+    merged_df['improvement'] = merged_df['improvement'].fillna(0).astype(int)
+    return merged_df
+
+
+
+
+# =============================================================================
+# ESQUEMA DAS COLUNAS EXTRAÍDAS
+# =============================================================================
+# Tipos emitidos pelo ETL (aplicados ao final da extração de cada bloco):
+#
+#   coluna                         tipo       valores
+#   -----------------------------  ---------  ------------------------------------
+#   fr_resultado                   category   POSITIVO, NEGATIVO, NÃO INFORMADO
+#   fr_origem                      category   LAB, TEXTO, CID (ausente = não informado)
+#   fr_valor                       float32    UI/mL
+#   <marcador> (vhs, pcr, ...)     float64    comparados com os limiares de melhora
+#   <comorbidade>, comorbidade_qualquer
+#                                  int8       0/1
+#   comorbidades_mascara           uint16     um bit por comorbidade (BITS_COMORBIDADES)
+#   <medicamento>                  int8       0/1 (mencionado em uso ou uso prévio)
+#   <medicamento>_status           category   SIM, PRÉVIO, NÃO
+#   uso_mtx, uso_biologico         category   SIM, PRÉVIO, NÃO
+#   mtx_dose_mg_semana             float32    mg/semana
+#   mtx_via                        category   SC, VO, IM
+#   biologico_nome                 category   chaves de BIOLOGICOS_CONFIG
+#   biologico_grupo                category   grupos de BIOLOGICOS_CONFIG
+#   num_biologicos_previos         int8
+#
+# As categorias são fixas: blocos extraídos separadamente são concatenados sem
+# voltar a object e comparações como == 'PRÉVIO' comparam códigos inteiros.
+# Os marcadores ficam em float64: em float32, um valor como 0.85 deixaria de
+# ser igual ao limiar 0.85 dos critérios de melhora.
+
+STATUS_USO = pd.CategoricalDtype(['SIM', 'PRÉVIO', 'NÃO'])
+
+ESQUEMA_COLUNAS = {
+    'fr_resultado': pd.CategoricalDtype(['POSITIVO', 'NEGATIVO', 'NÃO INFORMADO']),
+    'fr_origem': pd.CategoricalDtype(['LAB', 'TEXTO', 'CID']),
+    'fr_valor': 'float32',
+    'comorbidade_qualquer': 'int8',
+    'comorbidades_mascara': 'uint16',
+    'uso_mtx': STATUS_USO,
+    'mtx_dose_mg_semana': 'float32',
+    'mtx_via': pd.CategoricalDtype(['SC', 'VO', 'IM']),
+    'uso_biologico': STATUS_USO,
+    'biologico_nome': pd.CategoricalDtype(list(BIOLOGICOS_CONFIG)),
+    'biologico_grupo': pd.CategoricalDtype(list(dict.fromkeys(c['grupo'] for c in BIOLOGICOS_CONFIG.values()))),
+    'num_biologicos_previos': 'int8',
+}
+
+
+def tipo_coluna(coluna):
+    """Tipo da coluna extraída segundo o esquema (None para colunas de entrada)"""
+    if coluna in ESQUEMA_COLUNAS:
+        return ESQUEMA_COLUNAS[coluna]
+    if coluna in MARCADORES_CONFIG:
+        return 'float64'
+    if coluna in COMORBIDADES_CONFIG or coluna in BIOLOGICOS_CONFIG or coluna in DMARDS_CONFIG:
+        return 'int8'
+    if coluna.endswith('_status') and coluna[:-len('_status')] in {**BIOLOGICOS_CONFIG, **DMARDS_CONFIG}:
+        return STATUS_USO
+    return None
+
+
+def aplicar_esquema(df):
+    """Converte as colunas extraídas para os tipos compactos do esquema"""
+    for coluna in df.columns:
+        tipo = tipo_coluna(coluna)
+        if tipo is None or df[coluna].dtype == tipo:
+            continue
+        if tipo in ('float32', 'float64'):
+            df[coluna] = pd.to_numeric(df[coluna], errors='coerce').astype(tipo)
+        else:
+            df[coluna] = df[coluna].astype(tipo)
+    return df
+
+
+# =============================================================================
+# TABELA DE PACIENTES (UMA LINHA POR PACIENTE)
+# =============================================================================
+# Regras de consolidação dos registros de cada paciente, aplicadas sobre os
+# registros em ordem cronológica (paciente, data_hora, descricao), de modo que
+# o resultado não depende da ordem das linhas do arquivo:
+#   - idade, sexo, dose e via do MTX: valor não nulo mais recente
+#   - fr_resultado/fr_origem: registro informativo (POSITIVO/NEGATIVO) com a
+#     origem mais confiável (LAB > TEXTO > CID); empate -> o mais recente
+#   - fr_valor: valor laboratorial mais recente
+#   - comorbidades e flags binárias de medicamentos: máximo (teve em algum registro)
+#   - comorbidades_mascara: OU bit a bit dos registros
+#   - status SIM/PRÉVIO/NÃO (uso_mtx, uso_biologico, <med>_status): status
+#     informativo (SIM ou PRÉVIO) mais recente; NÃO se nunca mencionado.
+#     biologico_nome e biologico_grupo vêm do mesmo registro de uso_biologico
+#   - num_biologicos_previos: máximo
+
+PRIORIDADE_ORIGEM_FR = {'LAB': 3, 'TEXTO': 2, 'CID': 1}
+
+
+def _ultimo_informativo(ordenado, coluna, colunas_junto=()):
+    """Último registro (cronológico) de cada paciente em que coluna != 'NÃO'"""
+    informativos = ordenado[ordenado[coluna] != 'NÃO']
+    return informativos.groupby('paciente').tail(1).set_index('paciente')[[coluna, *colunas_junto]]
+
+
+def _ou_por_paciente(ordenado, coluna):
+    """OU bit a bit dos registros de cada paciente (registros já ordenados por paciente)"""
+    com_paciente = ordenado[ordenado['paciente'].notna()]
+    pacientes = com_paciente['paciente'].to_numpy()
+    valores = com_paciente[coluna].to_numpy(dtype=np.uint16)
+    if len(valores) == 0:
+        return pd.Series(valores, name=coluna)
+    inicios = np.flatnonzero(np.r_[True, pacientes[1:] != pacientes[:-1]])
+    return pd.Series(np.bitwise_or.reduceat(valores, inicios), index=pacientes[inicios], name=coluna)
+
+
+def construir_tabela_pacientes(df_processed):
+    """
+    Consolida os registros processados em uma linha por paciente (ver regras acima).
+    As colunas presentes dependem das variáveis extraídas.
+
+    Returns:
+        DataFrame com a coluna 'paciente' e as variáveis consolidadas
+    """
+    colunas_ordem = [c for c in ['paciente', 'data_hora', 'descricao'] if c in df_processed.columns]
+    ordenado = df_processed.sort_values(colunas_ordem, kind='mergesort')
+    grupos = ordenado.groupby('paciente', sort=True)
+
+    tabela = pd.DataFrame({'n_registros': grupos.size()})
+    if 'data_hora' in ordenado.columns:
+        tabela['primeiro_registro'] = grupos['data_hora'].min()
+        tabela['ultimo_registro'] = grupos['data_hora'].max()
+
+    # Valor não nulo mais recente
+    for col in ['idade', 'sexo', 'mtx_dose_mg_semana', 'mtx_via']:
+        if col in ordenado.columns:
+            tabela[col] = grupos[col].last()
+    if 'mtx_dose_mg_semana' in tabela.columns:
+        tabela['mtx_dose_mg_semana'] = pd.to_numeric(tabela['mtx_dose_mg_semana'], errors='coerce')
+
+    # Fator reumatoide: origem mais confiável, depois o mais recente
+    if 'fr_resultado' in ordenado.columns:
+        informativos = ordenado[ordenado['fr_resultado'] != 'NÃO INFORMADO']
+        informativos = informativos.assign(
+            _prioridade=informativos['fr_origem'].map(PRIORIDADE_ORIGEM_FR).astype(float).fillna(0)
+        ).sort_values(['paciente', '_prioridade'], kind='mergesort')
+        escolhido = informativos.groupby('paciente').tail(1).set_index('paciente')
+        tabela['fr_resultado'] = escolhido['fr_resultado'].reindex(tabela.index).fillna('NÃO INFORMADO')
+        tabela['fr_valor'] = pd.to_numeric(grupos['fr_valor'].last(), errors='coerce')
+        tabela['fr_origem'] = escolhido['fr_origem'].reindex(tabela.index)
+        tabela.loc[tabela['fr_origem'].isna() & tabela['fr_valor'].notna(), 'fr_origem'] = 'LAB'
+
+    # Flags binárias: teve em algum registro
+    flags = [c for c in ordenado.columns if c in COMORBIDADES_CONFIG or c == 'comorbidade_qualquer']
+    flags += [m for m in list(BIOLOGICOS_CONFIG) + list(DMARDS_CONFIG)
+              if m in ordenado.columns and f'{m}_status' in ordenado.columns]
+    if flags:
+        tabela[flags] = grupos[flags].max()
+    if 'comorbidades_mascara' in ordenado.columns:
+        tabela['comorbidades_mascara'] = _ou_por_paciente(ordenado, 'comorbidades_mascara')
+
+    # Status SIM/PRÉVIO/NÃO: informativo mais recente
+    if 'uso_mtx' in ordenado.columns:
+        tabela['uso_mtx'] = _ultimo_informativo(ordenado, 'uso_mtx')['uso_mtx']
+        tabela['uso_mtx'] = tabela['uso_mtx'].fillna('NÃO')
+    if 'uso_biologico' in ordenado.columns:
+        ultimo = _ultimo_informativo(ordenado, 'uso_biologico', ['biologico_nome', 'biologico_grupo'])
+        tabela = tabela.join(ultimo)
+        tabela['uso_biologico'] = tabela['uso_biologico'].fillna('NÃO')
+        tabela['num_biologicos_previos'] = grupos['num_biologicos_previos'].max()
+    for col in [c for c in ordenado.columns if c.endswith('_status')]:
+        tabela[col] = _ultimo_informativo(ordenado, col)[col]
+        tabela[col] = tabela[col].fillna('NÃO')
+
+    return tabela.reset_index()
+
+
+# =============================================================================
+# ORQUESTRAÇÃO DO PIPELINE
+# =============================================================================
+
+# Configuração padrão (mesmos valores pré-selecionados na interface)
+CONFIG_PADRAO = {
+    'extrair_fr': True,
+    'marcadores': ['vhs', 'pcr', 'haq', 'das28', 'cdai'],
+    'comorbidades': ['has', 'dm', 'dlp', 'fm', 'op'],
+    'medicamentos': ['tofacitinibe', 'upadacitinibe', 'adalimumabe', 'etanercepte', 'metotrexato'],
+    'criterios_melhora': {
+        'haq': {'tipo': 'reducao_absoluta', 'valor': 0.35},
+        'das28': {'tipo': 'reducao_percentual', 'valor': 50},
+        'cdai': {'tipo': 'reducao_absoluta', 'valor': 10.0},
+    },
+    'dias_minimos_tratamento': 60,
+    'tipo_baseline': 'ANAMNESE',
+    'tipo_followup': 'EVOLUCAO',
+    # 'arrow': descricao mantida em df_processed como strings Arrow
+    # 'comprimido': descricao substituída por texto_id e guardada em blocos comprimidos (resultado['textos'])
+    'texto_descricao': 'comprimido',
+    # 'exata': remove notas com texto idêntico
+    # 'normalizada': ignora diferenças de maiúsculas e de espaços em branco
+    'deduplicacao': 'exata',
+    # Notas quase idênticas à anterior do paciente, sem alteração perto de um
+    # termo relevante, reaproveitam o resultado dela em vez de serem extraídas
+    # (desligado: o custo do MinHash e do diff só compensa com muitas cópias)
+    'reaproveitar_quase_duplicatas': False,
+    # Índice invertido do texto das notas para buscas por termo, frase e
+    # proximidade (resultado['indice_busca'], ver busca_textos)
+    'indice_busca': False,
+    # Trecho e regra que decidiram cada valor extraído (resultado['evidencias'])
+    'evidencias': True,
+    # Avaliações, acertos, notas e tempo de cada regra de extração (relatorio['regras'])
+    'contadores_regras': True,
+    # Quantas das notas mais lentas de extrair guardar, com o tempo por
+    # extrator e a regra dominante (relatorio['notas_lentas']; 0 = desligado)
+    'perfil_notas': 0,
+}
+
+COLUNAS_OBRIGATORIAS = ['paciente', 'tipo', 'descricao', 'data_hora']
+
+# Etapas na ordem em que são executadas (usadas para relatar progresso)
+ETAPAS_PIPELINE = ['deduplicacao', 'extracao', 'filtro_pacientes', 'longitudinal', 'melhora', 'tempo_minimo',
+                   'tabela_pacientes', 'indice_busca']
+
+
+class ETLCancelado(Exception):
+    """Execução interrompida a pedido do usuário"""
+
+
+def normalizar_config(config=None):
+    """Completa a configuração com os valores padrão e valida as chaves"""
+    config = dict(config or {})
+    desconhecidas = set(config) - set(CONFIG_PADRAO)
+    if desconhecidas:
+        raise ValueError(f"Chaves de configuração desconhecidas: {', '.join(sorted(desconhecidas))}")
+
+    resultado = {k: config.get(k, v) for k, v in CONFIG_PADRAO.items()}
+
+    invalidos = [m for m in resultado['marcadores'] if m not in MARCADORES_CONFIG]
+    invalidos += [c for c in resultado['comorbidades'] if c not in COMORBIDADES_CONFIG]
+    invalidos += [m for m in resultado['medicamentos']
+                  if m not in BIOLOGICOS_CONFIG and m not in DMARDS_CONFIG]
+    if invalidos:
+        raise ValueError(f"Itens desconhecidos na configuração: {', '.join(invalidos)}")
+    if resultado['texto_descricao'] not in ('arrow', 'comprimido'):
+        raise ValueError(f"texto_descricao inválido: {resultado['texto_descricao']}")
+    if resultado['deduplicacao'] not in ('exata', 'normalizada'):
+        raise ValueError(f"deduplicacao inválida: {resultado['deduplicacao']}")
+    if not isinstance(resultado['reaproveitar_quase_duplicatas'], bool):
+        raise ValueError("reaproveitar_quase_duplicatas deve ser true ou false")
+    if not isinstance(resultado['indice_busca'], bool):
+        raise ValueError("indice_busca deve ser true ou false")
+    if not isinstance(resultado['evidencias'], bool):
+        raise ValueError("evidencias deve ser true ou false")
+    if not isinstance(resultado['contadores_regras'], bool):
+        raise ValueError("contadores_regras deve ser true ou false")
+    perfil_notas = resultado['perfil_notas']
+    if not isinstance(perfil_notas, int) or isinstance(perfil_notas, bool) or perfil_notas < 0:
+        raise ValueError(f"perfil_notas deve ser um inteiro maior ou igual a zero: {perfil_notas}")
+
+    # Critérios de melhora só fazem sentido para marcadores extraídos
+    resultado['criterios_melhora'] = {
+        m: c for m, c in resultado['criterios_melhora'].items() if m in resultado['marcadores']
+    }
+    return resultado
+
+
+def construir_criterios_melhora(criterios):
+    """Converte a especificação serializável dos critérios em funções (v0, v1) -> bool"""
+    funcoes = {}
+    for marker, spec in criterios.items():
+        valor = spec['valor']
+        if spec['tipo'] == 'reducao_absoluta':
+            funcoes[marker] = lambda v0, v1, t=valor: v1 <= v0 - t
+        elif spec['tipo'] == 'reducao_percentual':
+            funcoes[marker] = lambda v0, v1, p=valor: v1 <= v0 * (1 - p/100)
+        else:
+            raise ValueError(f"Tipo de critério desconhecido para {marker}: {spec['tipo']}")
+    return funcoes
+
+
+def biologicos_selecionados(config):
+    """Medicamentos da configuração que são biológicos/JAK"""
+    return [m for m in config['medicamentos'] if m in BIOLOGICOS_CONFIG]
+
+
+def extrair_variaveis(df, config, contadores=None):
+    """
+    Etapas de extração linha a linha (FR, marcadores, comorbidades, medicamentos,
+    MTX, biológicos e limpeza numérica), com os tipos do ESQUEMA_COLUNAS. Não
+    depende de outras linhas, por isso pode ser aplicada a blocos independentes
+    em paralelo. Com contadores (ContadoresRegras do tamanho de df), cada
+    regra avaliada é contada.
+    """
+    df = df.reset_index(drop=True)
+    medicamentos = config['medicamentos']
+    biologicos = biologicos_selecionados(config)
+    evidencias = [[] for _ in range(len(df))] if config['evidencias'] else None
+    opcoes = {'evidencias': evidencias, 'contadores': contadores}
+
+    # (nome em EXTRATORES, extrator) na ordem de execução
+    extratores = []
+    if config['extrair_fr']:
+        extratores.append(('fr', lambda df: extract_fator_reumatoide_df(df, **opcoes)))
+    if config['marcadores']:
+        extratores.append(('marcadores', lambda df: extract_marcadores(df, config['marcadores'], **opcoes)))
+    if config['comorbidades']:
+        extratores.append(('comorbidades', lambda df: extract_comorbidades(df, config['comorbidades'], **opcoes)))
+    if medicamentos:
+        extratores.append(('medicamentos', lambda df: extract_medicamentos_v3(df, medicamentos, **opcoes)))
+    if 'metotrexato' in medicamentos:
+        extratores.append(('mtx', lambda df: extract_mtx_detalhado(df, **opcoes)))
+    if biologicos:
+        extratores.append(('biologicos', lambda df: extract_biologicos_detalhado(df, biologicos, **opcoes)))
+
+    for nome, extrator in extratores:
+        if contadores is not None:
+            contadores.extrator(nome)
+        df = extrator(df)
+    if contadores is not None:
+        contadores.extrator(None)
+    if evidencias is not None:
+        df['evidencias'] = [codificar_evidencias(e) for e in evidencias]
+
+    return aplicar_esquema(clean_numeric_columns(df, config['marcadores']))
+
+
+def _extrair_bloco(df, config):
+    """(extrair_variaveis(df), medições do bloco: regras e notas_lentas, conforme a configuração)"""
+    if not config['contadores_regras'] and not config['perfil_notas']:
+        return extrair_variaveis(df, config), {}
+    contadores = ContadoresRegras(len(df), perfil=config['perfil_notas'] > 0)
+    extraido = extrair_variaveis(df, config, contadores)
+    medicoes = {}
+    if config['contadores_regras']:
+        medicoes['regras'] = contadores.resumo()
+    if config['perfil_notas']:
+        medicoes['notas_lentas'] = contadores.notas_lentas(df.reset_index(drop=True), config['perfil_notas'])
+    return extraido, medicoes
+
+
+def _dividir_em_blocos(df, tamanho_bloco):
+    return [df.iloc[i:i + tamanho_bloco] for i in range(0, len(df), tamanho_bloco)]
+
+
+def _extrair_em_blocos(df, config, n_workers, tamanho_bloco, progresso_blocos, verificar_cancelamento,
+                       checkpoints=None, medicoes=None):
+    """
+    Aplica extrair_variaveis bloco a bloco, relatando progresso e checando
+    cancelamento. Com checkpoints, blocos já extraídos (mesmo hash de entrada)
+    são lidos do disco e cada bloco novo é gravado ao terminar. As medições
+    dos blocos extraídos (contadores de regras e notas lentas, conforme a
+    configuração) são acumuladas no dict medicoes.
+    """
+    blocos = _dividir_em_blocos(df, tamanho_bloco) or [df]
+    partes = [None] * len(blocos)
+    hashes = [checkpoints.hash_bloco(bloco) for bloco in blocos] if checkpoints else [None] * len(blocos)
+    pendentes = []
+    for i, hash_bloco in enumerate(hashes):
+        if checkpoints is not None:
+            partes[i] = checkpoints.carregar_bloco(hash_bloco)
+        if partes[i] is None:
+            pendentes.append(i)
+
+    def concluir(i, extraido):
+        parte, medicoes_bloco = extraido
+        partes[i] = parte
+        if medicoes is not None:
+            somar_medicoes(medicoes, medicoes_bloco, config)
+        if checkpoints is not None:
+            checkpoints.salvar_bloco(hashes[i], parte)
+
+    concluidos = len(blocos) - len(pendentes)
+    progresso_blocos(concluidos, len(blocos))
+
+    if n_workers > 1 and len(pendentes) > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futuros = {executor.submit(_extrair_bloco, blocos[i], config): i for i in pendentes}
+            for futuro in as_completed(futuros):
+                concluir(futuros[futuro], futuro.result())
+                concluidos += 1
+                progresso_blocos(concluidos, len(blocos))
+                if verificar_cancelamento():
+                    for pendente in futuros:
+                        pendente.cancel()
+                    raise ETLCancelado("Execução cancelada durante a extração")
+    else:
+        for i in pendentes:
+            if verificar_cancelamento():
+                raise ETLCancelado("Execução cancelada durante a extração")
+            concluir(i, _extrair_bloco(blocos[i], config))
+            concluidos += 1
+            progresso_blocos(concluidos, len(blocos))
+
+    return pd.concat(partes, ignore_index=True)
+
+
+def reaproveitamento_quase_duplicatas(df):
+    """
+    Para cada registro, a posição do registro cujo resultado de extração ele
+    pode reaproveitar (nota quase idêntica do mesmo paciente, visitadas em
+    ordem cronológica), ou -1 se precisa ser extraído.
+    """
+    colunas_ordem = [c for c in ['paciente', 'data_hora'] if c in df.columns]
+    ordem = np.arange(len(df))
+    if colunas_ordem:
+        ordem = df.reset_index(drop=True).sort_values(colunas_ordem, kind='mergesort').index.to_numpy()
+    textos = df['descricao'].to_numpy(dtype=object)[ordem]
+    pacientes = df['paciente'].to_numpy(dtype=object)[ordem] if 'paciente' in df.columns else np.zeros(len(df))
+    origens_ordem = origens_reaproveitaveis(list(textos), pacientes, PADRAO_RELEVANTE, MARGEM_ALTERACAO)
+
+    origens = np.full(len(df), -1, dtype=np.int64)
+    reaproveitadas = origens_ordem >= 0
+    origens[ordem[reaproveitadas]] = ordem[origens_ordem[reaproveitadas]]
+    return origens
+
+
+def _extrair_reaproveitando(df, origens, extrair):
+    """
+    Extrai apenas os registros com origem -1 (via extrair(df_parcial)) e copia
+    as variáveis extraídas para os que reaproveitam o resultado de outro.
+    """
+    df = df.reset_index(drop=True)
+    a_extrair = origens < 0
+    extraidos = extrair(df[a_extrair])
+
+    fonte = np.where(a_extrair, np.arange(len(df)), origens)
+    posicao_extraida = np.cumsum(a_extrair) - 1
+    resultado = extraidos.iloc[posicao_extraida[fonte]].reset_index(drop=True)
+    for coluna in df.columns:
+        resultado[coluna] = df[coluna]
+    if 'evidencias' in resultado.columns:
+        resultado['evidencias'] = _evidencias_reaproveitadas(resultado['evidencias'], df['descricao'], origens)
+    return resultado
+
+
+def _evidencias_reaproveitadas(evidencias, textos, origens):
+    """
+    Evidências copiadas da nota de origem, com os trechos levados às
+    posições da nota que as reaproveita (trechos que cruzam uma alteração
+    são descartados).
+    """
+    evidencias = evidencias.to_numpy(dtype=object).copy()
+    for posicao in np.flatnonzero(origens >= 0):
+        valores = np.frombuffer(evidencias[posicao], dtype=np.int32).reshape(-1, 4).copy()
+        if not len(valores):
+            continue
+        inicios, fins = mapear_trechos(str(textos.iloc[origens[posicao]]).lower(),
+                                       str(textos.iloc[posicao]).lower(), valores[:, 2], valores[:, 3])
+        valores[:, 2], valores[:, 3] = inicios, fins
+        evidencias[posicao] = valores[inicios >= 0].tobytes()
+    return evidencias
+
+
+def remover_duplicatas(df, config):
+    """
+    Remove notas repetidas (ver deduplicacao na configuração), mantendo a
+    primeira ocorrência. A descricao vira strings Arrow e ganha ao lado a
+    impressao_texto (uint64).
+    """
+    # Texto livre como strings Arrow desde a entrada (uma cópia compacta em vez de objetos Python)
+    textos = para_arrow(df['descricao'])
+    # Impressão digital de 64 bits calculada uma vez: a comparação é entre inteiros,
+    # e só as repetições são conferidas contra o texto original
+    normalizado = config['deduplicacao'] == 'normalizada'
+    impressoes = impressao_textos(textos, normalizado)
+    unicos = ~duplicados(impressoes, textos, normalizado)
+    df_unicos = df.loc[unicos, [c for c in df.columns if c != 'descricao']].reset_index(drop=True)
+    posicao = df.columns.get_loc('descricao')
+    df_unicos.insert(posicao, 'descricao', textos[unicos].reset_index(drop=True))
+    df_unicos.insert(posicao + 1, 'impressao_texto', impressoes[unicos].reset_index(drop=True))
+    return df_unicos
+
+
+def extrair_registros(df, config, extrair):
+    """
+    Extração dos registros via extrair(df_parcial), reaproveitando notas quase
+    duplicadas se configurado.
+
+    Returns:
+        (DataFrame extraído, número de notas reaproveitadas ou None)
+    """
+    if not config['reaproveitar_quase_duplicatas']:
+        return extrair(df), None
+    origens = reaproveitamento_quase_duplicatas(df)
+    return _extrair_reaproveitando(df, origens, extrair), int((origens >= 0).sum())
+
+
+def tipos_longitudinais(tipos_disponiveis, config):
+    """(baseline, follow-up): os da configuração se existirem, senão os dois primeiros tipos"""
+    if len(tipos_disponiveis) < 2:
+        raise ValueError("São necessários pelo menos dois tipos de registro para a base longitudinal")
+    baseline_type = config['tipo_baseline'] if config['tipo_baseline'] in tipos_disponiveis else tipos_disponiveis[0]
+    followup_type = config['tipo_followup'] if config['tipo_followup'] in tipos_disponiveis else tipos_disponiveis[1]
+    return baseline_type, followup_type
+
+
+def base_longitudinal(df_processed, config, baseline_type, followup_type):
+    """Base longitudinal (uma linha por paciente)"""
+    return create_longitudinal_data(
+        df_processed, baseline_type, followup_type, config['marcadores']
+    )
+
+
+def calcular_melhora(df_longitudinal, config):
+    """Aplica os critérios de melhora da configuração"""
+    criterios = construir_criterios_melhora(config['criterios_melhora'])
+    return calculate_improvement(df_longitudinal, criterios)
+
+
+def filtrar_tempo_minimo(df_longitudinal, config):
+    """
+    Remove pacientes com tempo de tratamento abaixo do mínimo configurado.
+
+    Returns:
+        (DataFrame filtrado, número de removidos ou None se o filtro não se aplica)
+    """
+    min_treatment_days = config['dias_minimos_tratamento']
+    if min_treatment_days <= 0 or 'tempo_tratamento_dias' not in df_longitudinal.columns:
+        return df_longitudinal, None
+    before_filter = len(df_longitudinal)
+    df_longitudinal = df_longitudinal[
+        df_longitudinal['tempo_tratamento_dias'] >= min_treatment_days
+    ].reset_index(drop=True)
+    return df_longitudinal, before_filter - len(df_longitudinal)
+
+
+def executar_pipeline(df, config=None, n_workers=1, tamanho_bloco=5000, progresso=None,
+                      progresso_blocos=None, cancelado=None, checkpoints=None):
+    """
+    Executa o pipeline ETL completo sobre um DataFrame de prontuários.
+
+    Args:
+        df: DataFrame com as colunas obrigatórias (paciente, tipo, descricao, data_hora)
+        config: dicionário de configuração (ver CONFIG_PADRAO)
+        n_workers: número de processos para a extração (1 = sequencial)
+        tamanho_bloco: linhas por bloco de extração
+        progresso: callback opcional progresso(etapa, mensagem) para as mensagens de cada etapa
+        progresso_blocos: callback opcional progresso_blocos(concluidos, total) da extração
+        cancelado: função opcional sem argumentos; se retornar True a execução
+                   é interrompida com ETLCancelado na próxima etapa ou bloco
+        checkpoints: CheckpointsETL opcional (checkpoints_etl); blocos e etapas
+                     concluídos são gravados nele e reaproveitados ao retomar
+
+    Returns:
+        Dict com: df_processed (com impressao_texto, uint64), df_longitudinal,
+        df_pacientes (uma linha por paciente), relatorio
+        e, com texto_descricao='comprimido', textos (blocos do armazém de textos; em
+        df_processed a descricao vira texto_id)
+    """
+    config = normalizar_config(config)
+    relatorio = {'etapas': {}, 'registros_entrada': len(df), 'conjunto_regras': REGISTRO.descricao()}
+    verificar_cancelamento = cancelado or (lambda: False)
+
+    def notificar(etapa, mensagem):
+        if verificar_cancelamento():
+            raise ETLCancelado(f"Execução cancelada antes da etapa '{etapa}'")
+        if progresso:
+            progresso(etapa, mensagem)
+
+    missing_cols = [col for col in COLUNAS_OBRIGATORIAS if col not in df.columns]
+    if missing_cols:
+        raise ValueError(f"Colunas obrigatórias ausentes: {', '.join(missing_cols)}")
+
+    def cronometrar(etapa, inicio):
+        relatorio['etapas'][etapa] = round(time.perf_counter() - inicio, 3)
+
+    if checkpoints is not None:
+        checkpoints.iniciar(checkpoints.hash_bloco(df), config)
+
+    def retomar_etapa(etapa):
+        """DataFrames da etapa salva (ou None), com o relatório restaurado até ela"""
+        salvo = checkpoints.carregar_etapa(etapa) if checkpoints is not None else None
+        if salvo is None:
+            return None
+        tabelas, relatorio_salvo = salvo
+        relatorio.update(relatorio_salvo)
+        notificar(etapa, f"♻️ Etapa '{etapa}' retomada do checkpoint")
+        return tabelas
+
+    def salvar_etapa(etapa, **tabelas):
+        if checkpoints is not None:
+            checkpoints.salvar_etapa(etapa, tabelas, relatorio)
+
+    retomado = retomar_etapa('extracao')
+    if retomado is not None:
+        df_processed = retomado['df_processed']
+    else:
+        # Remover duplicatas
+        inicio = time.perf_counter()
+        df_processed = remover_duplicatas(df, config)
+        relatorio['duplicatas_removidas'] = len(df) - len(df_processed)
+        cronometrar('deduplicacao', inicio)
+        notificar('deduplicacao', f"🗑️ Removidas {relatorio['duplicatas_removidas']} duplicatas")
+
+        # ETAPAS 0-4: extração e limpeza numérica
+        inicio = time.perf_counter()
+        notificar('extracao', "🔎 Extraindo variáveis dos prontuários...")
+
+        medicoes = {}
+
+        def extrair(df_parcial):
+            return _extrair_em_blocos(
+                df_parcial, config, n_workers, tamanho_bloco,
+                progresso_blocos or (lambda concluidos, total: None), verificar_cancelamento,
+                checkpoints, medicoes
+            )
+
+        df_processed, reaproveitadas = extrair_registros(df_processed, config, extrair)
+        if reaproveitadas is not None:
+            relatorio['notas_reaproveitadas'] = reaproveitadas
+        if config['contadores_regras']:
+            relatorio['regras'] = medicoes.get('regras', {})
+        if config['perfil_notas']:
+            relatorio['notas_lentas'] = medicoes.get('notas_lentas', [])
+        cronometrar('extracao', inicio)
+        salvar_etapa('extracao', df_processed=df_processed)
+
+    retomado = retomar_etapa('longitudinal')
+    if retomado is not None:
+        df_processed, df_longitudinal = retomado['df_processed'], retomado['df_longitudinal']
+    else:
+        # ETAPA 5: Filtrar pacientes válidos
+        inicio = time.perf_counter()
+        notificar('filtro_pacientes', "🔍 Filtrando pacientes válidos...")
+        tipo_counts = df_processed.groupby('paciente')['tipo'].nunique()
+        valid_patients = tipo_counts[tipo_counts >= 2].index
+        df_processed = df_processed[df_processed['paciente'].isin(valid_patients)].reset_index(drop=True)
+        relatorio['pacientes_validos'] = len(valid_patients)
+        cronometrar('filtro_pacientes', inicio)
+        notificar('filtro_pacientes', f"✅ {len(valid_patients)} pacientes válidos")
+
+        # ETAPA 6: Base longitudinal
+        inicio = time.perf_counter()
+        baseline_type, followup_type = tipos_longitudinais(df_processed['tipo'].unique(), config)
+        relatorio['baseline'] = str(baseline_type)
+        relatorio['followup'] = str(followup_type)
+        notificar('longitudinal', f"📈 Criando base longitudinal (Baseline: {baseline_type} | Follow-up: {followup_type})...")
+
+        df_longitudinal = base_longitudinal(df_processed, config, baseline_type, followup_type)
+        cronometrar('longitudinal', inicio)
+
+        # ETAPA 7: Calcular melhora
+        if config['criterios_melhora']:
+            inicio = time.perf_counter()
+            notificar('melhora', "🎯 Calculando melhora clínica...")
+            df_longitudinal = calcular_melhora(df_longitudinal, config)
+            cronometrar('melhora', inicio)
+
+        # ETAPA 8: Filtrar tempo mínimo
+        min_treatment_days = config['dias_minimos_tratamento']
+        df_longitudinal, removidos = filtrar_tempo_minimo(df_longitudinal, config)
+        if removidos is not None:
+            relatorio['removidos_tempo_minimo'] = removidos
+            notificar('tempo_minimo', f"⏱️ Removidos {removidos} pacientes com <{min_treatment_days} dias")
+        salvar_etapa('longitudinal', df_processed=df_processed, df_longitudinal=df_longitudinal)
+
+    # ETAPA 9: Tabela de pacientes (uma linha por paciente, lida pelos gráficos)
+    inicio = time.perf_counter()
+    notificar('tabela_pacientes', "👤 Consolidando tabela de pacientes...")
+    df_pacientes = construir_tabela_pacientes(df_processed)
+    cronometrar('tabela_pacientes', inicio)
+
+    if checkpoints is not None:
+        relatorio['retomado'] = {'blocos': checkpoints.blocos_retomados, 'etapas': checkpoints.etapas_retomadas}
+    relatorio['registros_processados'] = len(df_processed)
+    relatorio['pacientes_longitudinal'] = len(df_longitudinal)
+    if 'improvement' in df_longitudinal.columns:
+        relatorio['pacientes_melhoraram'] = int(df_longitudinal['improvement'].sum())
+
+    # Evidências da extração em tabela própria (nota = posição da linha em df_processed)
+    df_processed, evidencias = separar_evidencias(df_processed)
+    resultado = {
+        'df_processed': df_processed,
+        'df_longitudinal': df_longitudinal,
+        'df_pacientes': df_pacientes,
+        'relatorio': relatorio,
+    }
+    if evidencias is not None:
+        resultado['evidencias'] = evidencias
+    # ETAPA 10: Índice de busca no texto (nota = posição da linha em df_processed)
+    if config['indice_busca']:
+        inicio = time.perf_counter()
+        notificar('indice_busca', "🔤 Indexando o texto das notas para busca...")
+        resultado['indice_busca'] = construir_indice(df_processed['descricao'])
+        relatorio['termos_indexados'] = len(resultado['indice_busca']['termo'].cat.categories)
+        cronometrar('indice_busca', inicio)
+    # As análises não usam o texto livre: ele sai dos DataFrames ao final
+    if config['texto_descricao'] == 'comprimido':
+        resultado['df_processed'], resultado['textos'] = separar_texto(df_processed)
+    return resultado
+
+
+# =============================================================================
+# TESTE DO MÓDULO
+# =============================================================================
+
+if __name__ == "__main__":
+    # Teste diferencial do reaproveitamento de quase duplicatas: cada evolução
+    # copia a anterior e acrescenta uma palavra longe dos medicamentos. O
+    # resultado tem de ser o mesmo com e sem reaproveitamento, inclusive quando
+    # a palavra contém um nome curto ('dm' em "administração", 'has' em "hashtag").
+    palavras = ['administração', 'hashtag', 'nada', 'opção', 'meta', 'retorno', 'tranquila', 'semana']
+    enchimento = ' '.join(['paciente refere melhora global sem queixas novas neste retorno'] * 20)
+    linhas = []
+    for paciente, palavra in enumerate(palavras):
+        texto = f"FR positivo. PCR 12. Em uso de tofacitinibe e MTX 15mg VO. {enchimento}"
+        linhas.append({'paciente': paciente, 'tipo': 'ANAMNESE', 'data_hora': pd.Timestamp('2024-01-01'),
+                       'descricao': texto, 'idade': 50, 'sexo': 'F'})
+        for mes in range(1, 4):
+            texto = f"{texto} {palavra}{mes}" if mes > 1 else f"{texto} {palavra}"
+            linhas.append({'paciente': paciente, 'tipo': 'EVOLUCAO', 'data_hora': pd.Timestamp(2024, 1 + 2 * mes, 1),
+                           'descricao': texto, 'idade': 50, 'sexo': 'F'})
+    df_teste = pd.DataFrame(linhas)
+
+    resultados = {
+        reaproveitar: executar_pipeline(df_teste, {'texto_descricao': 'arrow',
+                                                   'reaproveitar_quase_duplicatas': reaproveitar})
+        for reaproveitar in (False, True)
+    }
+    for tabela in ['df_processed', 'df_longitudinal', 'df_pacientes']:
+        pd.testing.assert_frame_equal(resultados[False][tabela], resultados[True][tabela])
+    print(f"=== TESTE DIFERENCIAL: {resultados[True]['relatorio']['notas_reaproveitadas']} notas "
+          f"reaproveitadas, resultado igual ao da extração completa ===")
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Notas Quase Duplicadas - IMMUNED
+Evoluções consecutivas de um paciente costumam ser copiadas da anterior com
+pequenas edições. Aqui cada nota recebe uma assinatura MinHash de seus
+shingles de palavras; um índice LSH (faixas da assinatura) aponta, entre as
+notas anteriores do mesmo paciente, a mais parecida. O diff entre as duas
+localiza os trechos alterados: se nenhum deles, com a janela de contexto
+usada pelos extratores, contém um termo relevante, a nota reaproveita o
+resultado da anterior em vez de ser extraída de novo.
+
+A regra é conservadora: um termo perto de qualquer alteração leva à extração
+completa da nota. Os extratores olham o texto inteiro (primeira ocorrência,
+contexto de ±300 caracteres), por isso não se extrai só o trecho alterado.
+"""
+
+import re
+import zlib
+from difflib import SequenceMatcher
+
+import numpy as np
+
+# Palavras por shingle
+TAMANHO_SHINGLE = 3
+
+# Permutações da assinatura MinHash, divididas em faixas para o índice LSH
+N_PERMUTACOES = 64
+N_FAIXAS = 16
+
+# Jaccard estimado mínimo para comparar duas notas pelo diff
+LIMIAR_SIMILARIDADE = 0.8
+
+_PRIMO = np.uint64((1 << 61) - 1)
+_GERADOR = np.random.default_rng(20240601)
+_COEF_A = _GERADOR.integers(1, 1 << 31, N_PERMUTACOES, dtype=np.uint64)
+_COEF_B = _GERADOR.integers(0, 1 << 31, N_PERMUTACOES, dtype=np.uint64)
+
+_PALAVRA = re.compile(r'\w+')
+_TOKEN = re.compile(r'\s+|\S+\s*')
+
+
+def shingles(texto, tamanho=TAMANHO_SHINGLE):
+    """Hashes (crc32) dos shingles de palavras do texto em minúsculas"""
+    palavras = _PALAVRA.findall(texto.lower())
+    if len(palavras) < tamanho:
+        palavras = palavras + [''] * (tamanho - len(palavras))
+    return np.fromiter(
+        (zlib.crc32(' '.join(palavras[i:i + tamanho]).encode('utf-8'))
+         for i in range(len(palavras) - tamanho + 1)),
+        dtype=np.uint64,
+    )
+
+
+def assinatura_minhash(texto):
+    """Assinatura MinHash (N_PERMUTACOES valores uint64) do texto"""
+    valores = shingles(texto)
+    # a < 2^31 e x < 2^32: o produto cabe em 63 bits
+    return ((valores[:, None] * _COEF_A + _COEF_B) % _PRIMO).min(axis=0)
+
+
+def similaridade(assinatura_a, assinatura_b):
+    """Jaccard estimado entre os shingles de duas notas"""
+    return float(np.mean(assinatura_a == assinatura_b))
+
+
+class IndiceMinHash:
+    """
+    Índice LSH: notas com alguma faixa da assinatura igual são candidatas.
+
+    Args:
+        n_faixas: faixas em que a assinatura é dividida (mais faixas, mais candidatos)
+    """
+
+    def __init__(self, n_faixas=N_FAIXAS):
+        self.n_faixas = n_faixas
+        self._faixas = [{} for _ in range(n_faixas)]
+        self._assinaturas = {}
+
+    def _chaves(self, assinatura):
+        return [faixa.tobytes() for faixa in np.array_split(assinatura, self.n_faixas)]
+
+    def adicionar(self, chave, assinatura):
+        self._assinaturas[chave] = assinatura
+        for baldes, faixa in zip(self._faixas, self._chaves(assinatura)):
+            baldes.setdefault(faixa, []).append(chave)
+
+    def mais_parecida(self, assinatura, limiar=LIMIAR_SIMILARIDADE):
+        """(chave, similaridade) da nota indexada mais parecida acima do limiar, ou None"""
+        candidatas = set()
+        for baldes, faixa in zip(self._faixas, self._chaves(assinatura)):
+            candidatas.update(baldes.get(faixa, ()))
+        melhor = None
+        # Ordem fixa das candidatas: no empate vence a primeira chave, seja qual
+        # for a ordem do conjunto (o resultado não depende da posição global da nota)
+        for chave in sorted(candidatas):
+            valor = similaridade(assinatura, self._assinaturas[chave])
+            if valor >= limiar and (melhor is None or valor > melhor[1]):
+                melhor = (chave, valor)
+        return melhor
+
+
+def _limites_tokens(texto):
+    tokens = _TOKEN.findall(texto)
+    return tokens, np.cumsum([0] + [len(t) for t in tokens])
+
+
+def _prefixo_comum(a, b):
+    """Tamanho do prefixo comum (busca binária sobre comparações de fatias)"""
+    inicio, fim = 0, min(len(a), len(b))
+    while inicio < fim:
+        meio = (inicio + fim + 1) // 2
+        if a[:meio] == b[:meio]:
+            inicio = meio
+        else:
+            fim = meio - 1
+    return inicio
+
+
+def trechos_alterados(anterior, atual):
+    """
+    Trechos diferentes entre duas notas: o prefixo e o sufixo comuns são
+    descartados e o meio é comparado por palavras.
+
+    Returns:
+        Lista de ((início, fim) em anterior, (início, fim) em atual), em caracteres
+    """
+    prefixo = _prefixo_comum(anterior, atual)
+    sufixo = _prefixo_comum(anterior[prefixo:][::-1], atual[prefixo:][::-1])
+    meio_ant = anterior[prefixo:len(anterior) - sufixo]
+    meio_atu = atual[prefixo:len(atual) - sufixo]
+
+    tokens_ant, pos_ant = _limites_tokens(meio_ant)
+    tokens_atu, pos_atu = _limites_tokens(meio_atu)
+    # Com autojunk, palavras muito frequentes não ancoram o alinhamento: o diff
+    # continua correto, apenas com trechos alterados possivelmente maiores
+    comparador = SequenceMatcher(None, tokens_ant, tokens_atu)
+    return [
+        ((prefixo + int(pos_ant[i1]), prefixo + int(pos_ant[i2])),
+         (prefixo + int(pos_atu[j1]), prefixo + int(pos_atu[j2])))
+        for operacao, i1, i2, j1, j2 in comparador.get_opcodes()
+        if operacao != 'equal'
+    ]
+
+
+def mapear_trechos(anterior, atual, inicios, fins):
+    """
+    Posições em `atual` de trechos de `anterior` (ver trechos_alterados): cada
+    trecho é deslocado pelo tamanho das alterações antes dele.
+
+    Returns:
+        (inícios, fins) em atual; -1 nos trechos que cruzam uma alteração
+    """
+    inicios = np.asarray(inicios, dtype=np.int64).copy()
+    fins = np.asarray(fins, dtype=np.int64).copy()
+    originais = inicios.copy(), fins.copy()
+    cruzam = np.zeros(len(inicios), dtype=bool)
+    for (ini_ant, fim_ant), (ini_atu, fim_atu) in trechos_alterados(anterior, atual):
+        if fim_ant > ini_ant:
+            cruzam |= (originais[0] < fim_ant) & (originais[1] > ini_ant)
+        else:
+            # Inserção pura: só invalida os trechos que a envolvem
+            cruzam |= (originais[0] < ini_ant) & (originais[1] > ini_ant)
+        depois = originais[0] >= fim_ant
+        deslocamento = (fim_atu - ini_atu) - (fim_ant - ini_ant)
+        inicios[depois] += deslocamento
+        fins[depois] += deslocamento
+    inicios[cruzam], fins[cruzam] = -1, -1
+    return inicios, fins
+
+
+def alteracao_relevante(anterior, atual, padrao_relevante, margem):
+    """
+    True se algum trecho alterado, com `margem` caracteres de cada lado (nas
+    duas versões), contém um termo de padrao_relevante. A comparação é feita em
+    minúsculas, como nos extratores.
+    """
+    anterior_min, atual_min = anterior.lower(), atual.lower()
+    for (ini_ant, fim_ant), (ini_atu, fim_atu) in trechos_alterados(anterior_min, atual_min):
+        janela_ant = anterior_min[max(0, ini_ant - margem):fim_ant + margem]
+        janela_atu = atual_min[max(0, ini_atu - margem):fim_atu + margem]
+        if padrao_relevante.search(janela_ant) or padrao_relevante.search(janela_atu):
+            return True
+    return False
+
+
+def origens_reaproveitaveis(textos, pacientes, padrao_relevante, margem, limiar=LIMIAR_SIMILARIDADE):
+    """
+    Para cada nota, a posição de uma nota do mesmo paciente (já extraída) cujo
+    resultado ela pode reaproveitar, ou -1 se precisa ser extraída.
+
+    Args:
+        textos: sequência de textos, na ordem em que as notas devem ser visitadas
+                (cronológica por paciente)
+        pacientes: identificador do paciente de cada nota
+        padrao_relevante: regex compilada dos termos que os extratores procuram
+        margem: caracteres de contexto em volta de cada alteração
+
+    Returns:
+        Array int64 com a posição de origem (sempre uma nota com origem -1)
+    """
+    origens = np.full(len(textos), -1, dtype=np.int64)
+    indices = {}
+    for posicao, (texto, paciente) in enumerate(zip(textos, pacientes)):
+        if texto is None or not isinstance(texto, str):
+            continue
+        assinatura = assinatura_minhash(texto)
+        indice = indices.setdefault(paciente, IndiceMinHash())
+        parecida = indice.mais_parecida(assinatura, limiar)
+        if parecida is not None:
+            anterior = parecida[0]
+            if not alteracao_relevante(textos[anterior], texto, padrao_relevante, margem):
+                origens[posicao] = anterior
+                continue
+        # Só notas extraídas entram no índice: a origem nunca é outra nota reaproveitada
+        indice.adicionar(posicao, assinatura)
+    return origens
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Registro das Regras de Extração - IMMUNED
+As tabelas de padrões (FR, CID, medicamentos, comorbidades, marcadores,
+status de uso, motivos de suspensão e detalhes do metotrexato) ficam em um
+único arquivo declarativo e versionado, regras_extracao.json, lido pelo
+pipeline (pipeline_etl, usado pela aplicação e pelo lote) e pelo serviço de
+extração (extraction_module).
+
+O arquivo é carregado uma vez por processo (carregar_regras): as tabelas
+são validadas, todos os padrões são compilados e o conteúdo ganha uma
+impressão digital estável. Os caches de resultados levam essa impressão na
+chave (ver artefatos_etl.versao_codigo), de modo que uma regra alterada não
+reaproveita resultados extraídos com as regras anteriores.
+
+Cada regra tem uma chave (tabela, posição ou chave, ...), como
+('USO_PREVIO_PATTERNS', 2) ou ('BIOLOGICOS_CONFIG', 'adalimumabe', 2), e um
+nome, 'USO_PREVIO_PATTERNS[2]', usado nas evidências e nos contadores.
+"""
+
+import hashlib
+import json
+import os
+import re
+from functools import lru_cache
+
+ARQUIVO_REGRAS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'regras_extracao.json')
+
+# Tabelas de expressões regulares (lista, dicionário ou padrão único)
+TABELAS_REGEX = ['FR_POSITIVO_PATTERNS', 'FR_NEGATIVO_PATTERNS', 'FR_VALOR_PATTERN', 'CID_PATTERN',
+                 'USO_ATIVO_PATTERNS', 'USO_PREVIO_PATTERNS', 'MTX_DOSE_PATTERN', 'MTX_VIA_PATTERNS']
+
+# Tabelas de termos procurados literalmente no texto em minúsculas
+TABELAS_TERMOS = ['COMORBIDADES_CONFIG', 'BIOLOGICOS_CONFIG', 'DMARDS_CONFIG', 'MOTIVOS_SUSPENSAO']
+
+TABELAS_OBRIGATORIAS = [*TABELAS_REGEX, *TABELAS_TERMOS, 'CID_FR_MAPPING', 'MARCADORES_CONFIG',
+                        'GRUPOS_BIOLOGICOS', 'JANELA_CONTEXTO']
+
+# CID_PATTERN é procurado no texto original (CID, cid, Cid)
+_FLAGS = {'CID_PATTERN': re.IGNORECASE}
+
+
+def nome_regra(chave):
+    """('COMORBIDADES_CONFIG', 'has', 0) -> 'COMORBIDADES_CONFIG[has][0]'"""
+    tabela, *posicoes = chave
+    return tabela + ''.join(f'[{p}]' for p in posicoes)
+
+
+class RegistroRegras:
+    """
+    Tabelas de um conjunto de regras, com os padrões compilados.
+
+    Args:
+        dados: conteúdo de regras_extracao.json
+
+    Raises:
+        ValueError se faltar uma tabela ou um padrão não compilar
+    """
+
+    def __init__(self, dados):
+        ausentes = [t for t in ['versao', *TABELAS_OBRIGATORIAS] if t not in dados]
+        if ausentes:
+            raise ValueError(f"Tabelas ausentes no conjunto de regras: {', '.join(ausentes)}")
+        if not isinstance(dados['versao'], int) or isinstance(dados['versao'], bool):
+            raise ValueError(f"versao do conjunto de regras deve ser um inteiro: {dados['versao']!r}")
+        sem_grupo = {c['grupo'] for c in dados['BIOLOGICOS_CONFIG'].values()} - set(dados['GRUPOS_BIOLOGICOS'])
+        if sem_grupo:
+            raise ValueError(f"Grupos de biológicos sem chave em GRUPOS_BIOLOGICOS: {', '.join(sorted(sem_grupo))}")
+
+        self.dados = dados
+        self.versao = dados['versao']
+        serializado = json.dumps(dados, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+        self.impressao = hashlib.sha256(serializado.encode('utf-8')).hexdigest()[:12]
+
+        self.regras = self._regras()
+        self.compiladas = {}
+        for chave, padrao in self.regras.items():
+            literal = chave[0] in TABELAS_TERMOS
+            try:
+                self.compiladas[chave] = re.compile(re.escape(padrao.lower()) if literal else padrao,
+                                                    _FLAGS.get(chave[0], 0))
+            except re.error as e:
+                raise ValueError(f"Padrão inválido em {nome_regra(chave)}: {e}") from None
+
+    def __getitem__(self, tabela):
+        return self.dados[tabela]
+
+    def _regras(self):
+        """Chave da regra -> padrão (regex ou termo procurado)"""
+        d = self.dados
+        regras = {}
+        for tabela in ['FR_POSITIVO_PATTERNS', 'FR_NEGATIVO_PATTERNS', 'USO_ATIVO_PATTERNS',
+                       'USO_PREVIO_PATTERNS', 'MOTIVOS_SUSPENSAO']:
+            regras.update({(tabela, i): padrao for i, padrao in enumerate(d[tabela])})
+        regras[('FR_VALOR_PATTERN',)] = d['FR_VALOR_PATTERN']
+        regras[('CID_PATTERN',)] = d['CID_PATTERN']
+        regras.update({('MARCADORES_CONFIG', m): c['pattern'] for m, c in d['MARCADORES_CONFIG'].items()})
+        regras.update({('COMORBIDADES_CONFIG', c, i): alias
+                       for c, aliases in d['COMORBIDADES_CONFIG'].items() for i, alias in enumerate(aliases)})
+        for tabela in ['BIOLOGICOS_CONFIG', 'DMARDS_CONFIG']:
+            regras.update({(tabela, m, i): alias
+                           for m, c in d[tabela].items() for i, alias in enumerate(c['aliases'])})
+        regras[('MTX_DOSE_PATTERN',)] = d['MTX_DOSE_PATTERN']
+        regras.update({('MTX_VIA_PATTERNS', via): padrao for via, padrao in d['MTX_VIA_PATTERNS'].items()})
+        return regras
+
+    def regex(self, chave):
+        """Padrão compilado da regra (termos literais compilados com re.escape)"""
+        return self.compiladas[chave]
+
+    def descricao(self):
+        """Versão e impressão, para relatórios e respostas do serviço"""
+        return {'versao': self.versao, 'impressao': self.impressao}
+
+
+@lru_cache(maxsize=None)
+def carregar_regras(caminho=ARQUIVO_REGRAS):
+    """Registro das regras do arquivo (lido e compilado uma vez por processo e caminho)"""
+    with open(caminho, encoding='utf-8') as f:
+        return RegistroRegras(json.load(f))
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+Serviço Local de Extração - IMMUNED
+Servidor HTTP de longa duração que aplica extraction_module.process_prontuario
+a notas individuais enquanto o clínico escreve.
+
+- Padrões compilados uma única vez (na importação de extraction_module)
+- Micro-lotes: requisições simultâneas são agrupadas e processadas juntas,
+  com notas idênticas no mesmo lote extraídas uma só vez
+- Resultados recentes guardados pela impressão digital do texto (um hash de
+  64 bits por nota), para reenvios da mesma nota entre lotes
+- Métricas de latência p50/p99 em GET /metricas
+- Versão e impressão do conjunto de regras carregado (regras_extracao.json)
+  em GET /metricas e GET /saude
+
+Uso:
+    python servico_extracao.py --porta 8765
+
+Endpoints:
+    POST /extrair    {"descricao": "..."}  ->  variáveis extraídas
+    GET  /metricas   ->  contagem, lotes, latências (ms) e conjunto de regras
+    GET  /saude      ->  {"status": "ok", "regras": {"versao": ..., "impressao": ...}}
+"""
+
+import argparse
+import json
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from extraction_module import REGISTRO, process_prontuario
+from textos_prontuarios import impressao_texto
+
+
+class MetricasLatencia:
+    """Janela deslizante das últimas latências para cálculo de percentis"""
+
+    def __init__(self, janela=10000):
+        self._latencias = deque(maxlen=janela)
+        self._lock = threading.Lock()
+        self.total_requisicoes = 0
+        self.total_lotes = 0
+        self.total_notas_lotes = 0
+
+    def registrar_requisicao(self, latencia_ms):
+        with self._lock:
+            self._latencias.append(latencia_ms)
+            self.total_requisicoes += 1
+
+    def registrar_lote(self, tamanho):
+        with self._lock:
+            self.total_lotes += 1
+            self.total_notas_lotes += tamanho
+
+    @staticmethod
+    def _percentil(valores_ordenados, p):
+        if not valores_ordenados:
+            return None
+        idx = min(len(valores_ordenados) - 1, int(round(p / 100 * (len(valores_ordenados) - 1))))
+        return round(valores_ordenados[idx], 3)
+
+    def resumo(self):
+        with self._lock:
+            valores = sorted(self._latencias)
+            return {
+                'requisicoes': self.total_requisicoes,
+                'lotes': self.total_lotes,
+                'tamanho_medio_lote': round(self.total_notas_lotes / self.total_lotes, 2) if self.total_lotes else 0.0,
+                'p50_ms': self._percentil(valores, 50),
+                'p99_ms': self._percentil(valores, 99),
+                'max_ms': round(valores[-1], 3) if valores else None,
+            }
+
+
+class ExtratorMicroLote:
+    """
+    Agrupa notas enviadas por várias threads e as processa em uma thread
+    dedicada. Cada lote espera no máximo `espera_max_ms` pela próxima nota
+    e tem no máximo `tamanho_max_lote` notas. Os últimos `max_resultados`
+    resultados ficam guardados pela impressão digital do texto.
+    """
+
+    def __init__(self, tamanho_max_lote=32, espera_max_ms=2.0, metricas=None, max_resultados=4096):
+        self.tamanho_max_lote = tamanho_max_lote
+        self.espera_max_s = espera_max_ms / 1000
+        self.metricas = metricas or MetricasLatencia()
+        self.max_resultados = max_resultados
+        self._resultados = OrderedDict()
+        self._fila = queue.Queue()
+        self._ativo = True
+        self._thread = threading.Thread(target=self._loop, name='extrator-micro-lote', daemon=True)
+        self._thread.start()
+
+    def extrair(self, descricao, timeout=30.0):
+        """Envia uma nota para o próximo lote e aguarda o resultado"""
+        futuro = Future()
+        self._fila.put((descricao, futuro))
+        return futuro.result(timeout=timeout)
+
+    def encerrar(self):
+        self._ativo = False
+        self._fila.put(None)
+        self._thread.join(timeout=5)
+
+    def _coletar_lote(self):
+        item = self._fila.get()
+        if item is None:
+            return []
+        lote = [item]
+        limite = time.perf_counter() + self.espera_max_s
+        while len(lote) < self.tamanho_max_lote:
+            restante = limite - time.perf_counter()
+            if restante <= 0:
+                break
+            try:
+                item = self._fila.get(timeout=restante)
+            except queue.Empty:
+                break
+            if item is None:
+                self._ativo = False
+                break
+            lote.append(item)
+        return lote
+
+    def _loop(self):
+        while self._ativo:
+            lote = self._coletar_lote()
+            if not lote:
+                continue
+            self.metricas.registrar_lote(len(lote))
+
+            # Notas idênticas (reenvios durante a digitação) são extraídas uma vez,
+            # pela impressão digital do texto. Cada nota tem seu próprio try: uma
+            # nota com erro não derruba as demais do lote.
+            for descricao, futuro in lote:
+                try:
+                    futuro.set_result(self._resultado(impressao_texto(descricao), descricao))
+                except Exception as e:
+                    futuro.set_exception(e)
+
+    def _resultado(self, impressao, descricao):
+        """Resultado guardado para a impressão (conferindo o texto) ou extraído agora"""
+        guardado = self._resultados.get(impressao)
+        if guardado is not None and guardado[0] == descricao:
+            self._resultados.move_to_end(impressao)
+            return guardado[1]
+
+        resultado = process_prontuario({'descricao': descricao})
+        self._resultados[impressao] = (descricao, resultado)
+        self._resultados.move_to_end(impressao)
+        if len(self._resultados) > self.max_resultados:
+            self._resultados.popitem(last=False)
+        return resultado
+
+
+class _HandlerExtracao(BaseHTTPRequestHandler):
+    server_version = 'ImmunedExtracao/1.0'
+
+    def _responder(self, status, corpo):
+        dados = json.dumps(corpo, ensure_ascii=False, default=str).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(dados)))
+        self.end_headers()
+        self.wfile.write(dados)
+
+    def do_GET(self):
+        if self.path == '/saude':
+            self._responder(200, {'status': 'ok', 'regras': REGISTRO.descricao()})
+        elif self.path == '/metricas':
+            self._responder(200, {**self.server.extrator.metricas.resumo(), 'regras': REGISTRO.descricao()})
+        else:
+            self._responder(404, {'erro': 'rota não encontrada'})
+
+    def do_POST(self):
+        if self.path != '/extrair':
+            self._responder(404, {'erro': 'rota não encontrada'})
+            return
+
+        inicio = time.perf_counter()
+        try:
+            tamanho = int(self.headers.get('Content-Length', 0))
+            corpo = json.loads(self.rfile.read(tamanho) or b'{}')
+            descricao = corpo['descricao']
+        except (ValueError, KeyError, TypeError):
+            self._responder(400, {'erro': 'corpo JSON com o campo "descricao" é obrigatório'})
+            return
+        if not isinstance(descricao, str):
+            self._responder(400, {'erro': 'o campo "descricao" deve ser um texto'})
+            return
+
+        try:
+            resultado = self.server.extrator.extrair(descricao)
+        except Exception as e:
+            self._responder(500, {'erro': str(e)})
+            return
+
+        self.server.extrator.metricas.registrar_requisicao((time.perf_counter() - inicio) * 1000)
+        self._responder(200, resultado)
+
+    def log_message(self, format, *args):
+        # Silencioso por padrão: as notas não devem aparecer em logs
+        pass
+
+
+def iniciar_servico(host='127.0.0.1', porta=8765, tamanho_max_lote=32, espera_max_ms=2.0):
+    """
+    Sobe o servidor em uma thread de fundo e retorna o objeto do servidor.
+    Use porta=0 para uma porta livre (ver servidor.server_address) e
+    servidor.encerrar() para parar.
+    """
+    servidor = ThreadingHTTPServer((host, porta), _HandlerExtracao)
+    servidor.daemon_threads = True
+    servidor.extrator = ExtratorMicroLote(tamanho_max_lote, espera_max_ms)
+
+    thread = threading.Thread(target=servidor.serve_forever, name='servico-extracao', daemon=True)
+    thread.start()
+
+    def encerrar():
+        servidor.shutdown()
+        servidor.server_close()
+        servidor.extrator.encerrar()
+
+    servidor.encerrar = encerrar
+    return servidor
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serviço HTTP local de extração de prontuários")
+    parser.add_argument('--host', default='127.0.0.1', help="Endereço de escuta (padrão: 127.0.0.1)")
+    parser.add_argument('--porta', type=int, default=8765, help="Porta (padrão: 8765)")
+    parser.add_argument('--tamanho-lote', type=int, default=32, help="Máximo de notas por micro-lote")
+    parser.add_argument('--espera-ms', type=float, default=2.0,
+                        help="Espera máxima para completar um micro-lote (ms)")
+    args = parser.parse_args(argv)
+
+    servidor = iniciar_servico(args.host, args.porta, args.tamanho_lote, args.espera_ms)
+    print(f"[SERVIÇO] Extração disponível em http://{servidor.server_address[0]}:{servidor.server_address[1]}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        servidor.encerrar()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+ETL em Shards por Paciente - IMMUNED
+Divide a exportação entre N nós (ou processos) por um hash estável do
+paciente: cada shard contém todos os registros dos seus pacientes, de modo
+que extração, filtro de pacientes, base longitudinal e tabela de pacientes
+rodam em cada nó sem trocar dados com os outros. Uma etapa final junta e
+valida as saídas dos shards.
+
+Fluxo:
+    # em cada nó i (0..N-1), com acesso ao mesmo arquivo de entrada
+    python etl_batch.py exportacao.csv --shard i/N --saida shard_i/
+    # no coordenador
+    python etl_batch.py --juntar shard_0/ shard_1/ ... --saida final/
+    # ou, numa única máquina, N processos locais no lugar dos nós
+    python etl_batch.py exportacao.csv --shards-locais N --saida final/
+
+A deduplicação de notas só compara notas do mesmo shard: a mesma nota em
+pacientes de shards diferentes é mantida nos dois.
+"""
+
+import json
+import os
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from artefatos_etl import versao_codigo
+from cache_resultados import impressao_config
+from etl_streaming import LINHAS_POR_PARTE, SAIDAS, juntar_parquet, ler_em_partes, particao_paciente
+from pipeline_etl import somar_medicoes
+
+# Contagens do relatório somadas entre shards
+CONTAGENS_SHARD = ['registros_entrada', 'duplicatas_removidas', 'notas_reaproveitadas', 'pacientes_validos',
+                   'removidos_tempo_minimo', 'registros_processados', 'pacientes_longitudinal',
+                   'pacientes_melhoraram']
+
+
+def shard_pacientes(pacientes, n_shards):
+    """Shard (0..n_shards-1) de cada paciente: o mesmo em qualquer nó, processo ou execução"""
+    return particao_paciente(pacientes, n_shards)
+
+
+def interpretar_shard(texto):
+    """'i/N' -> (i, N)"""
+    try:
+        indice, n_shards = (int(parte) for parte in texto.split('/'))
+    except ValueError:
+        raise ValueError(f"Shard inválido: {texto!r} (use i/N, por exemplo 0/4)")
+    if n_shards < 1 or not 0 <= indice < n_shards:
+        raise ValueError(f"Shard inválido: {texto!r} (i deve estar entre 0 e N-1)")
+    return indice, n_shards
+
+
+def carregar_shard(caminho, indice, n_shards, linhas_por_parte=LINHAS_POR_PARTE):
+    """Registros dos pacientes do shard, lendo a entrada em partes (só o shard fica em memória)"""
+    partes = []
+    for parte in ler_em_partes(caminho, linhas_por_parte):
+        if 'paciente' not in parte.columns:
+            raise ValueError("Colunas obrigatórias ausentes: paciente")
+        partes.append(parte[shard_pacientes(parte['paciente'], n_shards) == indice])
+    if not partes:
+        raise ValueError(f"Entrada vazia: {caminho}")
+    return pd.concat(partes, ignore_index=True)
+
+
+def descricao_shard(indice, n_shards, config):
+    """Identificação gravada no relatório de cada shard e conferida na junção"""
+    return {
+        'indice': indice,
+        'n_shards': n_shards,
+        'hash_config': impressao_config(config),
+        'versao_codigo': versao_codigo(),
+    }
+
+
+# =============================================================================
+# JUNÇÃO
+# =============================================================================
+
+def _ler_relatorio(pasta):
+    caminho = os.path.join(pasta, 'relatorio_execucao.json')
+    if not os.path.exists(caminho):
+        raise ValueError(f"Shard sem relatorio_execucao.json: {pasta}")
+    with open(caminho, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _linhas(pasta, nome):
+    return pq.ParquetFile(os.path.join(pasta, f'{nome}.parquet')).metadata.num_rows
+
+
+def validar_shards(pastas):
+    """
+    Confere que as pastas formam um conjunto completo e coerente de shards.
+
+    Returns:
+        (relatórios, pastas) dos shards, na ordem do índice
+
+    Raises:
+        ValueError com todos os problemas encontrados
+    """
+    relatorios = [_ler_relatorio(pasta) for pasta in pastas]
+    problemas = []
+
+    sem_shard = [pasta for pasta, rel in zip(pastas, relatorios) if 'shard' not in rel]
+    if sem_shard:
+        raise ValueError(f"Pastas que não são saídas de shard: {', '.join(sem_shard)}")
+
+    for chave in ('n_shards', 'hash_config', 'versao_codigo'):
+        valores = {rel['shard'][chave] for rel in relatorios}
+        if len(valores) > 1:
+            problemas.append(f"{chave} diferente entre os shards: {sorted(map(str, valores))}")
+    for chave in ('baseline', 'followup'):
+        valores = {rel.get(chave) for rel in relatorios}
+        if len(valores) > 1:
+            problemas.append(f"tipo de {chave} diferente entre os shards: {sorted(map(str, valores))}")
+
+    n_shards = relatorios[0]['shard']['n_shards']
+    indices = sorted(rel['shard']['indice'] for rel in relatorios)
+    if indices != list(range(n_shards)):
+        problemas.append(f"Shards esperados 0..{n_shards - 1}, encontrados {indices}")
+
+    for opcional in ('textos', 'indice_busca', 'evidencias'):
+        presentes = {os.path.exists(os.path.join(pasta, f"{SAIDAS[opcional]}.parquet")) for pasta in pastas}
+        if len(presentes) > 1:
+            problemas.append(f"Só parte dos shards tem {SAIDAS[opcional]}.parquet")
+
+    for pasta, rel in zip(pastas, relatorios):
+        indice = rel['shard']['indice']
+        esperado = {
+            SAIDAS['df_processed']: rel.get('registros_processados'),
+            SAIDAS['df_longitudinal']: rel.get('pacientes_longitudinal'),
+            SAIDAS['df_pacientes']: rel.get('pacientes_validos'),
+        }
+        for nome, linhas in esperado.items():
+            if _linhas(pasta, nome) != linhas:
+                problemas.append(f"Shard {indice}: {nome} tem {_linhas(pasta, nome)} linhas, relatório indica {linhas}")
+
+        # Cada paciente pertence ao shard do seu hash: nenhum paciente aparece em dois shards
+        pacientes = pd.read_parquet(os.path.join(pasta, f"{SAIDAS['df_pacientes']}.parquet"), columns=['paciente'])
+        pacientes = pacientes['paciente']
+        if pacientes.duplicated().any():
+            problemas.append(f"Shard {indice}: pacientes repetidos na tabela de pacientes")
+        fora = int((shard_pacientes(pacientes, n_shards) != indice).sum())
+        if fora:
+            problemas.append(f"Shard {indice}: {fora} pacientes pertencem a outro shard")
+
+    if problemas:
+        raise ValueError("Shards inconsistentes:\n- " + "\n- ".join(problemas))
+    ordem = sorted(range(len(pastas)), key=lambda i: relatorios[i]['shard']['indice'])
+    return [relatorios[i] for i in ordem], [pastas[i] for i in ordem]
+
+
+def juntar_shards(pastas, pasta_saida, log=print):
+    """
+    Valida e concatena as saídas dos shards em pasta_saida (mesmos arquivos
+    da execução em lote), com texto_id e a nota do índice de busca e das
+    evidências contínuos entre os shards.
+
+    Returns:
+        Relatório combinado (contagens, contadores de regras e notas lentas
+        somados e o relatório de cada shard)
+    """
+    relatorios, pastas = validar_shards(pastas)
+    os.makedirs(pasta_saida, exist_ok=True)
+    log(f"[ETL] Juntando {len(pastas)} shards validados...")
+
+    # texto_id e nota são a posição em dados_processados: cada shard começa após os anteriores
+    inicios, total = [], 0
+    for rel in relatorios:
+        inicios.append(total)
+        total += rel['registros_processados']
+    com_textos = os.path.exists(os.path.join(pastas[0], f"{SAIDAS['textos']}.parquet"))
+
+    saidas = {}
+    for nome in SAIDAS.values():
+        if not os.path.exists(os.path.join(pastas[0], f'{nome}.parquet')):
+            continue
+        deslocamentos = None
+        if com_textos and nome == SAIDAS['df_processed']:
+            deslocamentos = [{'texto_id': inicio} for inicio in inicios]
+        elif nome == SAIDAS['textos']:
+            deslocamentos = [{'primeiro_id': inicio} for inicio in inicios]
+        elif nome in (SAIDAS['indice_busca'], SAIDAS['evidencias']):
+            deslocamentos = [{'nota': inicio} for inicio in inicios]
+        saidas[nome] = os.path.join(pasta_saida, f'{nome}.parquet')
+        juntar_parquet([os.path.join(pasta, f'{nome}.parquet') for pasta in pastas], saidas[nome], deslocamentos)
+
+    relatorio = {
+        'shards': [{'pasta': os.path.abspath(pasta), **rel['shard'],
+                    **{c: rel[c] for c in CONTAGENS_SHARD if c in rel}}
+                   for pasta, rel in zip(pastas, relatorios)],
+        'baseline': relatorios[0].get('baseline'),
+        'followup': relatorios[0].get('followup'),
+        'config': relatorios[0].get('config'),
+        'conjunto_regras': relatorios[0].get('conjunto_regras'),
+        'saidas': saidas,
+    }
+    for contagem in CONTAGENS_SHARD:
+        if any(contagem in rel for rel in relatorios):
+            relatorio[contagem] = sum(rel.get(contagem, 0) for rel in relatorios)
+    medicoes = {}
+    for rel in relatorios:
+        somar_medicoes(medicoes, rel, relatorios[0]['config'])
+    relatorio.update(medicoes)
+
+    with open(os.path.join(pasta_saida, 'relatorio_execucao.json'), 'w', encoding='utf-8') as f:
+        json.dump(relatorio, f, ensure_ascii=False, indent=2, default=str)
+    log(f"[ETL] {relatorio.get('pacientes_validos', 0)} pacientes de {len(pastas)} shards em {pasta_saida}")
+    return relatorio
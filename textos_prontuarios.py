@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Armazém de Textos dos Prontuários - IMMUNED
+O texto livre (descricao) é a maior parte da memória dos dados, mas as abas
+de análise não o usam depois da extração. Aqui ele é guardado como strings
+Arrow ou, fora dos DataFrames de análise, em blocos comprimidos com zlib;
+cada registro passa a ter apenas um texto_id (int32) que aponta para o bloco.
+
+Os blocos ficam em um DataFrame (primeiro_id, n_textos, dados), de modo que
+o cache de resultados, o armazém de artefatos e o lote os tratam como
+qualquer outra tabela do resultado.
+
+Cada texto também recebe uma impressão digital de 64 bits (impressao_texto),
+calculada uma vez e usada na deduplicação e como chave de extração.
+"""
+
+import json
+import zlib
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+# Tipo das strings de texto livre (Arrow, sem um objeto Python por valor)
+TIPO_TEXTO = 'string[pyarrow]'
+
+# Textos por bloco comprimido (blocos maiores comprimem melhor, mas cada
+# consulta descomprime um bloco inteiro)
+TEXTOS_POR_BLOCO = 256
+
+# Blocos descomprimidos mantidos em memória por armazém
+MAX_BLOCOS_ABERTOS = 8
+
+
+def para_arrow(serie):
+    """Série de texto como strings Arrow (sem cópia se já estiver nesse tipo)"""
+    if serie.dtype == TIPO_TEXTO:
+        return serie
+    return serie.astype(TIPO_TEXTO)
+
+
+# =============================================================================
+# IMPRESSÃO DIGITAL E DEDUPLICAÇÃO
+# =============================================================================
+
+def normalizar_textos(serie):
+    """Minúsculas, espaços em branco colapsados e aparados (modo de deduplicação normalizado)"""
+    return para_arrow(serie).str.lower().str.replace(r'\s+', ' ', regex=True).str.strip()
+
+
+def impressao_textos(serie, normalizado=False):
+    """
+    Impressão digital de 64 bits de cada texto (uint64), em um único passe
+    vetorizado. Com normalizado=True, textos que diferem só em maiúsculas ou
+    espaços têm a mesma impressão.
+    """
+    if normalizado:
+        serie = normalizar_textos(serie)
+    return pd.util.hash_pandas_object(serie, index=False).rename('impressao_texto')
+
+
+def impressao_texto(texto, normalizado=False):
+    """Impressão digital de um único texto (mesmo valor de impressao_textos)"""
+    return int(impressao_textos(pd.Series([texto], dtype=TIPO_TEXTO), normalizado).iat[0])
+
+
+def duplicados(impressoes, textos=None, normalizado=False):
+    """
+    Marca como duplicadas as repetições de uma impressão (a primeira ocorrência
+    fica). Com os textos, cada repetição é conferida contra a primeira
+    ocorrência: uma colisão de hash (probabilidade ~n²/2^65) não descarta
+    uma nota diferente. Só as linhas repetidas são comparadas.
+    """
+    repetidos = impressoes.duplicated()
+    if textos is None or not repetidos.any():
+        return repetidos
+
+    if normalizado:
+        textos = normalizar_textos(textos)
+    valores = impressoes.to_numpy()
+    marcados = repetidos.to_numpy()
+    posicoes_rep = np.flatnonzero(marcados)
+
+    # Posição da primeira ocorrência de cada impressão repetida
+    primeiras = pd.Series(np.flatnonzero(~marcados), index=valores[~marcados])
+    origem = primeiras.reindex(valores[posicoes_rep]).to_numpy()
+
+    repeticao = textos.iloc[posicoes_rep].reset_index(drop=True)
+    original = textos.iloc[origem].reset_index(drop=True)
+    iguais = ((repeticao == original).fillna(False) | (repeticao.isna() & original.isna())).to_numpy(dtype=bool)
+
+    confirmados = repetidos.copy()
+    confirmados.iloc[posicoes_rep[~iguais]] = False
+    return confirmados
+
+
+class ArmazemTextos:
+    """
+    Textos comprimidos em blocos, indexados por texto_id (0..n-1).
+
+    Args:
+        blocos: DataFrame com primeiro_id, n_textos e dados (bytes zlib de uma lista JSON)
+    """
+
+    def __init__(self, blocos):
+        self.blocos = blocos
+        self._inicios = blocos['primeiro_id'].to_numpy(dtype=np.int64)
+        self._bloco = lru_cache(maxsize=MAX_BLOCOS_ABERTOS)(self._descomprimir)
+
+    @classmethod
+    def comprimir(cls, textos, textos_por_bloco=TEXTOS_POR_BLOCO):
+        """Armazém com os textos na ordem dada (texto_id = posição)"""
+        textos = [None if pd.isna(t) else str(t) for t in textos]
+        linhas = []
+        for inicio in range(0, len(textos), textos_por_bloco):
+            parte = textos[inicio:inicio + textos_por_bloco]
+            linhas.append({
+                'primeiro_id': inicio,
+                'n_textos': len(parte),
+                'dados': zlib.compress(json.dumps(parte, ensure_ascii=False).encode('utf-8'), 6),
+            })
+        return cls(pd.DataFrame(linhas, columns=['primeiro_id', 'n_textos', 'dados']))
+
+    def _descomprimir(self, posicao):
+        return json.loads(zlib.decompress(self.blocos['dados'].iat[posicao]).decode('utf-8'))
+
+    def __len__(self):
+        return int(self.blocos['n_textos'].sum())
+
+    @property
+    def tamanho_bytes(self):
+        return int(sum(len(d) for d in self.blocos['dados']))
+
+    def texto(self, texto_id):
+        posicao = int(np.searchsorted(self._inicios, texto_id, side='right')) - 1
+        if posicao < 0 or texto_id >= self._inicios[posicao] + self.blocos['n_textos'].iat[posicao]:
+            raise KeyError(f"texto_id inexistente: {texto_id}")
+        return self._bloco(posicao)[texto_id - self._inicios[posicao]]
+
+    def textos(self, ids):
+        """Textos dos ids informados (em ordem), descomprimindo cada bloco uma vez"""
+        ids = np.asarray(ids, dtype=np.int64)
+        posicoes = np.searchsorted(self._inicios, ids, side='right') - 1
+        resultado = [None] * len(ids)
+        for posicao in np.unique(posicoes):
+            bloco = self._bloco(int(posicao))
+            for i in np.flatnonzero(posicoes == posicao):
+                resultado[i] = bloco[ids[i] - self._inicios[posicao]]
+        return resultado
+
+
+def separar_texto(df, coluna='descricao'):
+    """
+    Move o texto livre para um armazém comprimido.
+
+    Returns:
+        (df com texto_id no lugar da coluna de texto, DataFrame de blocos do armazém)
+    """
+    armazem = ArmazemTextos.comprimir(df[coluna])
+    posicao = df.columns.get_loc(coluna)
+    sem_texto = df.drop(columns=[coluna])
+    sem_texto.insert(posicao, 'texto_id', np.arange(len(df), dtype=np.int32))
+    return sem_texto, armazem.blocos
+
+
+def restaurar_texto(df, blocos, coluna='descricao'):
+    """Cópia de df com a coluna de texto de volta no lugar de texto_id (exportação)"""
+    if blocos is None or 'texto_id' not in df.columns:
+        return df
+    armazem = ArmazemTextos(blocos)
+    posicao = df.columns.get_loc('texto_id')
+    com_texto = df.drop(columns=['texto_id'])
+    com_texto.insert(posicao, coluna, pd.Series(armazem.textos(df['texto_id']), index=df.index, dtype=TIPO_TEXTO))
+    return com_texto